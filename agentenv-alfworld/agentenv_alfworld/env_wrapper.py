@@ -4,7 +4,7 @@
 import os
 import json
 from .environment import SingleAlfredTWEnv
-from agentenv_pool import BaseEnvWrapper
+from agentenv_pool import BaseEnvWrapper, trace_span
 from agentenv_pool.errors import (
     EnvNotFoundError,
     EnvClosedError,
@@ -109,8 +109,10 @@ class ALFWorld_Wrapper(BaseEnvWrapper):
         self._check_id(env_id, True)
         self.env[env_id].game_files = [self.games[task_id]]
         self.env[env_id].num_games = 1
-        self.env_init[env_id] = self.env[env_id].init_env(batch_size=1)
-        ob, info = self.env_init[env_id].reset()
+        with trace_span("alfworld.init_env", task_id=task_id):
+            self.env_init[env_id] = self.env[env_id].init_env(batch_size=1)
+        with trace_span("alfworld.reset"):
+            ob, info = self.env_init[env_id].reset()
         ob = "\n".join(ob[0].split("\n\n")[1:])
         available_actions = info.get("admissible_commands", [[]])[0]
         self.info[env_id] = {
@@ -9,12 +9,14 @@ from .errors import (
     InvalidActionError,
     ConfigMissingError,
     EnvNotFoundError,
+    EnvCapacityError,
     register_error_handlers,
 )
 from .ipc import IPCRequest, IPCResponse
 from .worker import worker_main
 from .server_utils import create_app
 from .launch_utils import base_parser, run_server
+from .tracing import trace_span
 from .models import StepRequestBody, CloseRequestBody
 
 __all__ = [
@@ -28,6 +30,7 @@ __all__ = [
     "InvalidActionError",
     "ConfigMissingError",
     "EnvNotFoundError",
+    "EnvCapacityError",
     "register_error_handlers",
     "IPCRequest",
     "IPCResponse",
@@ -35,6 +38,7 @@ __all__ = [
     "create_app",
     "base_parser",
     "run_server",
+    "trace_span",
     "StepRequestBody",
     "CloseRequestBody",
 ]
@@ -12,6 +12,15 @@ class EnvError(Exception):
         super().__init__(message)
         self.message = message
 
+    def to_dict(self) -> dict:
+        """The ``error`` object of an error response."""
+        return {
+            "code": self.code,
+            "message": self.message,
+            "retryable": self.retryable,
+            "details": {},
+        }
+
 
 class EnvNotReadyError(EnvError):
     code = "ENV_NOT_READY"
@@ -49,17 +58,16 @@ class EnvNotFoundError(EnvError):
     status = 404
 
 
+class EnvCapacityError(EnvError):
+    code = "ENV_CAPACITY"
+    status = 503
+    retryable = True
+
+
 async def env_error_handler(request: Request, exc: EnvError) -> JSONResponse:
     return JSONResponse(
         status_code=exc.status,
-        content={
-            "error": {
-                "code": exc.code,
-                "message": exc.message,
-                "retryable": exc.retryable,
-                "details": {},
-            }
-        },
+        content={"error": exc.to_dict()},
     )
 
 
@@ -12,6 +12,7 @@ class CommandType(Enum):
     CLOSE = auto()
     SHUTDOWN = auto()
     PING = auto()
+    STEP_BATCH = auto()
 
 
 @dataclass
@@ -21,6 +22,7 @@ class IPCRequest:
     env_id: int = -1
     action: Optional[str] = None
     params: Dict[str, Any] = field(default_factory=dict)
+    trace: Optional[str] = None  # traceparent of the router span, if tracing
 
 
 @dataclass
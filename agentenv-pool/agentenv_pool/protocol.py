@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
+
+from .errors import EnvError
 
 
 class BaseEnvWrapper(ABC):
@@ -21,6 +23,19 @@ class BaseEnvWrapper(ABC):
         """Execute *action* in environment *idx* and return observation dict."""
         ...
 
+    def step_batch(self, steps: List[Tuple[int, str]]) -> List[dict]:
+        """Execute the (*idx*, *action*) *steps* in order.  Override to share work across them.
+
+        A step that fails gives an ``{"error": ...}`` entry and the others still run.
+        """
+        results = []
+        for idx, action in steps:
+            try:
+                results.append(self.step(idx, action))
+            except EnvError as e:
+                results.append({"error": e.to_dict()})
+        return results
+
     @abstractmethod
     def reset(self, idx: int, **kwargs: Any) -> dict:
         """Reset environment *idx*.  Extra keyword arguments are env-specific."""
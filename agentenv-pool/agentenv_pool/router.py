@@ -7,7 +7,7 @@ import uuid
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from multiprocessing.connection import Connection
-from typing import Any, Callable, Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from .ipc import CommandType, IPCRequest, IPCResponse
 from .protocol import BaseEnvWrapper
@@ -20,7 +20,9 @@ from .errors import (
     TaskOutOfRangeError,
     InvalidActionError,
     ConfigMissingError,
+    EnvCapacityError,
 )
+from .tracing import current_traceparent, trace_span
 from .worker import worker_main
 
 logger = logging.getLogger(__name__)
@@ -33,6 +35,7 @@ _ERROR_MAP: Dict[str, type] = {
     "TASK_OUT_OF_RANGE": TaskOutOfRangeError,
     "INVALID_ACTION": InvalidActionError,
     "CONFIG_MISSING": ConfigMissingError,
+    "ENV_CAPACITY": EnvCapacityError,
 }
 
 
@@ -54,6 +57,9 @@ class Router:
         A picklable callable that creates a fresh wrapper instance.
     ipc_timeout : float
         Seconds to wait for a worker response before raising.
+    preload : Callable[[], None], optional
+        Called once in this process before the workers are forked, to load
+        read-only data the workers then share copy-on-write.
     """
 
     def __init__(
@@ -61,10 +67,12 @@ class Router:
         parallel_actor: int,
         wrapper_factory: Callable[[], BaseEnvWrapper],
         ipc_timeout: float = 120.0,
+        preload: Optional[Callable[[], None]] = None,
     ):
         self._parallel_actor = parallel_actor
         self._wrapper_factory = wrapper_factory
         self._ipc_timeout = ipc_timeout
+        self._preload = preload
         self._next_id = 0
         self._id_lock = asyncio.Lock()
         self._workers: Dict[int, WorkerHandle] = {}
@@ -73,6 +81,8 @@ class Router:
     # ── lifecycle ──────────────────────────────────────────────
 
     def start_workers(self) -> None:
+        if self._preload is not None:
+            self._preload()
         for wid in range(self._parallel_actor):
             parent_conn, child_conn = multiprocessing.Pipe()
             p = multiprocessing.Process(
@@ -143,29 +153,41 @@ class Router:
             )
 
         loop = asyncio.get_running_loop()
-        async with handle.lock:
-            await loop.run_in_executor(
-                self._executor, handle.pipe.send, req
-            )
-            ready = await loop.run_in_executor(
-                self._executor, handle.pipe.poll, self._ipc_timeout
-            )
-            if not ready:
-                raise EnvNotReadyError(
-                    f"Worker {worker_id} timed out "
-                    f"after {self._ipc_timeout}s"
+        with trace_span("router.queue", worker_id=worker_id):
+            await handle.lock.acquire()
+        try:
+            with trace_span(
+                "router.ipc", worker_id=worker_id, command=req.command.name
+            ):
+                req.trace = current_traceparent()
+                await loop.run_in_executor(
+                    self._executor, handle.pipe.send, req
                 )
-            resp: IPCResponse = await loop.run_in_executor(
-                self._executor, handle.pipe.recv
-            )
+                ready = await loop.run_in_executor(
+                    self._executor, handle.pipe.poll, self._ipc_timeout
+                )
+                if not ready:
+                    raise EnvNotReadyError(
+                        f"Worker {worker_id} timed out "
+                        f"after {self._ipc_timeout}s"
+                    )
+                resp: IPCResponse = await loop.run_in_executor(
+                    self._executor, handle.pipe.recv
+                )
+        finally:
+            handle.lock.release()
         return resp
 
     @staticmethod
-    def _raise_if_error(resp: IPCResponse) -> Any:
+    def _error(resp: IPCResponse) -> EnvError:
+        cls = _ERROR_MAP.get(resp.error_code, EnvError)
+        return cls(resp.error_message or "Unknown error")
+
+    @classmethod
+    def _raise_if_error(cls, resp: IPCResponse) -> Any:
         if resp.success:
             return resp.payload
-        cls = _ERROR_MAP.get(resp.error_code, EnvError)
-        raise cls(resp.error_message or "Unknown error")
+        raise cls._error(resp)
 
     # ── public API ─────────────────────────────────────────────
 
@@ -194,6 +216,42 @@ class Router:
         resp = await self._send_to_worker(worker_id, req)
         return self._raise_if_error(resp)
 
+    async def step_batch(self, steps: List[Tuple[int, str]]) -> List[dict]:
+        """Steps several envs, each worker getting its (env_id, action) steps in one request.
+
+        Returns one entry per step, in order: the step result, or an
+        ``{"error": ...}`` entry for a step that failed or whose worker did
+        not answer.  The other steps are not affected.
+        """
+        positions: Dict[int, List[int]] = {}
+        for i, (env_id, _) in enumerate(steps):
+            positions.setdefault(self._route(env_id), []).append(i)
+        requests = [
+            IPCRequest(
+                request_id=str(uuid.uuid4()),
+                command=CommandType.STEP_BATCH,
+                params={"steps": [steps[i] for i in worker_positions]},
+            )
+            for worker_positions in positions.values()
+        ]
+        resps = await asyncio.gather(*(
+            self._send_to_worker(worker_id, req)
+            for worker_id, req in zip(positions, requests)
+        ), return_exceptions=True)
+        results: List[Any] = [None] * len(steps)
+        for worker_positions, resp in zip(positions.values(), resps):
+            if isinstance(resp, EnvError):
+                entries = [{"error": resp.to_dict()}] * len(worker_positions)
+            elif isinstance(resp, BaseException):
+                raise resp
+            elif not resp.success:
+                entries = [{"error": self._error(resp).to_dict()}] * len(worker_positions)
+            else:
+                entries = resp.payload
+            for i, entry in zip(worker_positions, entries):
+                results[i] = entry
+        return results
+
     async def reset(self, env_id: int, **kwargs: Any) -> dict:
         worker_id = self._route(env_id)
         req = IPCRequest(
@@ -4,13 +4,14 @@ import json
 import logging
 import time
 from contextlib import asynccontextmanager
-from typing import Callable
+from typing import Callable, Optional
 
 from fastapi import FastAPI, Request
 from starlette.responses import Response
 
 from .errors import register_error_handlers
 from .router import Router
+from .tracing import TRACEPARENT_HEADER, trace_span
 
 logger = logging.getLogger(__name__)
 
@@ -33,9 +34,20 @@ def _add_log_middleware(app: FastAPI) -> None:
         return response
 
 
+def _add_trace_middleware(app: FastAPI) -> None:
+    @app.middleware("http")
+    async def trace_requests(request: Request, call_next):
+        with trace_span(
+            f"server.{request.url.path.strip('/') or 'root'}",
+            traceparent=request.headers.get(TRACEPARENT_HEADER),
+        ):
+            return await call_next(request)
+
+
 def create_app(
     router: Router,
     extra_setup: Callable[[FastAPI, Router], None] = None,
+    service: Optional[str] = None,
 ) -> FastAPI:
     """Create a FastAPI app wired to the given *router*.
 
@@ -43,10 +55,12 @@ def create_app(
     - lifespan that starts / shuts down workers
     - error handlers
     - request-logging middleware
+    - tracing middleware (active when ``AGENTENV_TRACE_FILE`` is set)
     - ``/health`` endpoint
 
     *extra_setup* is an optional callback ``(app, router) -> None`` that can
-    register additional routes or middleware.
+    register additional routes or middleware. *service*, if given, is
+    reported by ``/health``.
     """
 
     @asynccontextmanager
@@ -58,9 +72,12 @@ def create_app(
     app = FastAPI(lifespan=lifespan)
     register_error_handlers(app)
     _add_log_middleware(app)
+    _add_trace_middleware(app)
 
     @app.get("/health")
     async def health():
+        if service is not None:
+            return {"status": "ok", "service": service}
         return {"status": "ok"}
 
     if extra_setup is not None:
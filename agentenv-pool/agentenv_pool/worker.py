@@ -8,6 +8,7 @@ from multiprocessing.connection import Connection
 from .ipc import CommandType, IPCRequest, IPCResponse
 from .protocol import BaseEnvWrapper
 from .errors import EnvError
+from .tracing import trace_span
 
 logging.basicConfig(
     level=logging.INFO,
@@ -27,6 +28,10 @@ def _handle_request(wrapper: BaseEnvWrapper, req: IPCRequest) -> IPCResponse:
             payload = wrapper.step(req.env_id, req.action)
             return IPCResponse(req.request_id, success=True, payload=payload)
 
+        if req.command == CommandType.STEP_BATCH:
+            payload = wrapper.step_batch(req.params["steps"])
+            return IPCResponse(req.request_id, success=True, payload=payload)
+
         if req.command == CommandType.RESET:
             payload = wrapper.reset(req.env_id, **req.params)
             return IPCResponse(req.request_id, success=True, payload=payload)
@@ -99,7 +104,13 @@ def worker_main(
             pipe.send(IPCResponse(req.request_id, success=True))
             break
 
-        resp = _handle_request(wrapper, req)
+        with trace_span(
+            f"worker.{req.command.name.lower()}",
+            traceparent=req.trace,
+            worker_id=worker_id,
+            env_id=req.env_id,
+        ):
+            resp = _handle_request(wrapper, req)
         try:
             pipe.send(resp)
         except (OSError, BrokenPipeError):
@@ -6,4 +6,13 @@ sys.path.append(
 )
 
 from .launch import launch
-from .server import app
+
+
+def __getattr__(name):
+    # The server reads its pool settings from the environment on import,
+    # which `launch` only sets once it has parsed the command line
+    if name == "app":
+        from .server import app
+
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
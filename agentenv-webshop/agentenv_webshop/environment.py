@@ -2,64 +2,188 @@
 WebshopEnvServer
 """
 
-from typing import Optional
+import gc
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, List, Optional, Tuple
 
 import gym
+from agentenv_pool import BaseEnvWrapper
+from web_agent_site.engine.catalog import get_catalog
+from web_agent_site.engine.engine import batch_search_asins, parse_action
 from web_agent_site.envs import WebAgentTextEnv
+from web_agent_site.utils import DEFAULT_FILE_PATH
+
+from .utils import EnvCapacityError, EnvClosedError, EnvNotFoundError
+
+NUM_PRODUCTS = 1000
+
+
+def make_env(seed: Optional[str] = None):
+    return gym.make(
+        "WebAgentTextEnv-v0",
+        observation_mode="text",
+        file_path=DEFAULT_FILE_PATH,
+        num_products=NUM_PRODUCTS,
+        seed=seed,
+    )
+
+
+def preload_catalog() -> None:
+    """
+    Loads the catalog `make_env` uses, without its searcher, and moves it
+    out of reach of the garbage collector, whose bookkeeping would otherwise
+    copy the pages of processes forked afterwards
+    """
+    get_catalog(DEFAULT_FILE_PATH, num_products=NUM_PRODUCTS)
+    gc.collect()
+    gc.freeze()
+
+
+def rss_mb() -> float:
+    """Resident memory of the process, 0 where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return 0.0
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
 
 
 class WebshopEnvServer:
     """
     WebshopEnvServer
+
+    Env ids are allocated monotonically and never reused. Envs are kept in
+    least recently used order; when `max_envs` are open, or the process is
+    above `memory_budget_mb` of resident memory, `create` evicts the least
+    recently used env idle for at least `min_idle_seconds`, and raises
+    `EnvCapacityError` if there is none. Each env draws its goals from its
+    own RNG, seeded from `seed` and its id when `seed` is set.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        max_envs: int = 8000,
+        memory_budget_mb: float = 0,
+        min_idle_seconds: float = 60,
+        seed: Optional[str] = None,
+        env_factory: Callable = make_env,
+    ) -> None:
         self._max_id = 0
-        self.env = {}
-        self.ls = []
-        self.sz = 8000
-        self.now = -1
-
-    def create(self) -> int:
-        env_idx = self._max_id
-        import random
-        import time
-
-        random.seed(time.time())
-        idx = random.randint(0, 48950076)
-        print(f"-------Env {idx} created--------")
-        if len(self.env) == self.sz:
-            self.now = self.now + 1
-            if self.now == self.sz:
-                self.now = 0
-            return self.ls[self.now]
-
-        self.env[idx] = gym.make(
-            "WebAgentTextEnv-v0",
-            observation_mode="text",
-            num_products=1000,
-        )
-        self.env[idx].reset()
-        self._max_id += 1
-        self.ls.append(idx)
-        return idx
+        self.env = OrderedDict()  # env_idx -> env, least recently used first
+        self.last_used = {}
+        self._pending = 0  # envs being built outside of the lock
+        self._lock = threading.Lock()
+        self.max_envs = max_envs
+        self.memory_budget_mb = memory_budget_mb
+        self.min_idle_seconds = min_idle_seconds
+        self.seed = seed
+        self.env_factory = env_factory
+
+    def create(self, env_idx: Optional[int] = None) -> int:
+        """Creates an env under the next id, or under `env_idx` when ids are allocated by the caller"""
+        with self._lock:
+            evicted = self._make_room()
+            if env_idx is None:
+                env_idx = self._max_id
+            self._max_id = max(self._max_id, env_idx + 1)
+            self._pending += 1
+        for idx, env in evicted:
+            env.close()
+            print(f"-------Env {idx} evicted--------")
+        try:
+            env = self.env_factory(None if self.seed is None else f"{self.seed}-{env_idx}")
+            env.reset()
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        with self._lock:
+            self._pending -= 1
+            self.env[env_idx] = env
+            self.last_used[env_idx] = time.monotonic()
+        print(f"-------Env {env_idx} created--------")
+        return env_idx
+
+    def _make_room(self):
+        """Pops the idle envs to evict for one more env, called with the lock held"""
+        needed = len(self.env) + self._pending + 1 - self.max_envs
+        over_budget = self.memory_budget_mb > 0 and rss_mb() > self.memory_budget_mb
+        if over_budget:
+            # The new env reuses the memory of the evicted one
+            needed = max(needed, 1)
+        if needed <= 0:
+            return []
+        victims = list(itertools.islice(self.env, needed))
+        now = time.monotonic()
+        if len(victims) < needed or any(
+            now - self.last_used[env_idx] < self.min_idle_seconds for env_idx in victims
+        ):
+            reason = (
+                f"the server is above its {self.memory_budget_mb:.0f} MB memory budget"
+                if over_budget else f"{self.max_envs} envs are open"
+            )
+            raise EnvCapacityError(
+                f"Cannot create an env: {reason} and not enough of them have been "
+                f"idle for {self.min_idle_seconds:.0f} s"
+            )
+        evicted = []
+        for env_idx in victims:
+            del self.last_used[env_idx]
+            evicted.append((env_idx, self.env.pop(env_idx)))
+        return evicted
+
+    def _get(self, env_idx: int):
+        """Returns the env and marks it as used"""
+        with self._lock:
+            env = self.env.get(env_idx)
+            if env is None:
+                if 0 <= env_idx < self._max_id:
+                    raise EnvClosedError(f"Env {env_idx} was closed or evicted")
+                raise EnvNotFoundError(f"Env {env_idx} not found")
+            self.env.move_to_end(env_idx)
+            self.last_used[env_idx] = time.monotonic()
+            return env
 
     def step(self, env_idx, action: str):
-        return self.env[env_idx].step(action)
+        return self._get(env_idx).step(action)
+
+    def prefetch_searches(self, steps: List[Tuple[int, str]]):
+        """
+        Sends the keyword searches of the (env_idx, action) `steps` to Lucene
+        as one batch query, so that the steps themselves hit the shared
+        search cache. Steps of closed or unknown envs are left out, stepping
+        them reports the error.
+        """
+        queries = defaultdict(list)
+        for env_idx, action in steps:
+            action_name, action_arg = parse_action(action)
+            # special `<a>`, `<c>`, `<q>` and `<r>` searches do not use Lucene
+            if action_name == "search" and action_arg and not action_arg.startswith("<"):
+                with self._lock:
+                    env = self.env.get(env_idx)
+                if env is not None:
+                    queries[env.unwrapped.server.search_engine].append(action_arg.lower())
+        for search_engine, engine_queries in queries.items():
+            batch_search_asins(search_engine, engine_queries)
 
     def get_available_actions(self, env_idx):
         """
         Return:
             {'has_search_bar': True, 'clickables': ['search']}
         """
-        return self.env[env_idx].get_available_actions()
+        return self._get(env_idx).get_available_actions()
 
     def get_image(self, env_idx):
         """
         Return:
             tensor()
         """
-        return self.env[env_idx].get_image()
+        return self._get(env_idx).get_image()
 
     def get_instruction_text(self, env_idx):
         """
@@ -69,7 +193,7 @@ class WebshopEnvServer:
             daily wear with color: green stripe, and size: large, and price lower than
             60.00 dollars
         """
-        return self.env[env_idx].get_instruction_text()
+        return self._get(env_idx).get_instruction_text()
 
     def observation(self, env_idx):
         """
@@ -79,7 +203,7 @@ class WebshopEnvServer:
             spandex for daily wear with color: green stripe, and size: large, and
             price lower than 60.00 dollars [SEP] Search"
         """
-        return self.env[env_idx].observation
+        return self._get(env_idx).observation
 
     def state(self, env_idx):
         """
@@ -90,24 +214,65 @@ class WebshopEnvServer:
                 'instruction_text': ""
             }
         """
-        return self.env[env_idx].state
+        return self._get(env_idx).state
 
     def reset(self, env_idx, task_id: Optional[int]):
-        return self.env[env_idx].reset(session=task_id)
+        return self._get(env_idx).reset(session=task_id)
 
     def close(self, env_idx: int):
-        if env_idx not in self.env:
-            raise IndexError(f"Env {env_idx} not found")
-        self.env[env_idx].close()
-        del self.env[env_idx]
-        if env_idx in self.ls:
-            self.ls.remove(env_idx)
+        env = self._get(env_idx)
+        with self._lock:
+            self.env.pop(env_idx, None)
+            self.last_used.pop(env_idx, None)
+        env.close()
         return True
-    
+
     def __del__(self):
-        for idx in self.ls:
-            self.env[idx].close()
+        for idx, env in list(self.env.items()):
+            env.close()
             print(f"-------Env {idx} closed--------")
 
 
-webshop_env_server = WebshopEnvServer()
+
+class WebshopEnvWrapper(BaseEnvWrapper):
+    """
+    Envs of one `agentenv_pool` worker, kept by a `WebshopEnvServer` under
+    the ids the router allocates
+    """
+
+    def __init__(self, **kwargs) -> None:
+        self.server = WebshopEnvServer(**kwargs)
+
+    @property
+    def ls(self) -> List[int]:
+        return list(self.server.env)
+
+    def create_with_id(self, env_id: int) -> dict:
+        self.server.create(env_id)
+        return {"env_id": env_id}
+
+    @staticmethod
+    def _step_payload(result) -> dict:
+        observation, reward, done, info = result
+        return {
+            "observation": observation,
+            "reward": reward,
+            "done": done,
+            "info": info or {},
+        }
+
+    def step(self, env_id: int, action: str) -> dict:
+        return self._step_payload(self.server.step(env_id, action))
+
+    def step_batch(self, steps: List[Tuple[int, str]]) -> List[dict]:
+        # The worker's keyword searches go to Lucene as one batch query
+        self.server.prefetch_searches(steps)
+        return super().step_batch(steps)
+
+    def reset(self, env_id: int, task_id: Optional[int] = None) -> dict:
+        # WebShop's env.reset() returns (observation, info)
+        observation, _ = self.server.reset(env_id, task_id)
+        return {"observation": observation, "info": {}}
+
+    def close(self, env_id: int) -> bool:
+        return self.server.close(env_id)
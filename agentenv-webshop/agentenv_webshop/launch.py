@@ -2,25 +2,22 @@
 Entrypoint for the webshop agent environment.
 """
 
-import argparse
+import os
 
-import uvicorn
-
-from .utils import debug_flg
+from agentenv_pool import base_parser, run_server
 
 
 def launch():
     """entrypoint for `webshop` commond"""
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--port", type=int, default=8000)
-    parser.add_argument("--host", type=str, default="0.0.0.0")
-    parser.add_argument("--workers", type=int, default=1)
+    parser = base_parser(default_parallel_actor=8)
     args = parser.parse_args()
-    uvicorn.run(
+
+    os.environ["WEBSHOP_PARALLEL_ACTOR"] = str(args.parallel_actor)
+    os.environ["WEBSHOP_IPC_TIMEOUT"] = str(args.ipc_timeout)
+
+    run_server(
         "agentenv_webshop:app",
         host=args.host,
         port=args.port,
-        reload=debug_flg,
-        workers=args.workers,
     )
@@ -8,6 +8,10 @@ class StepQuery(BaseModel):
     action: str
 
 
+class StepBatchQuery(BaseModel):
+    steps: List[StepQuery]
+
+
 class StepResponse(BaseModel):
     state: str
     reward: float
@@ -30,6 +34,3 @@ class ResetQuery(BaseModel):
     env_id: int
     task_id: Optional[int] = None
 
-
-class CloseRequestBody(BaseModel):
-    env_id: int
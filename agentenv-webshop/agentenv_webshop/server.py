@@ -2,69 +2,63 @@
 FastAPI Server
 """
 
+import functools
 import logging
-import time
+import math
+import os
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
 
-from .utils import register_error_handlers
-from .environment import webshop_env_server
-from .model import *
-from .utils import debug_flg
+from agentenv_pool import Router, create_app, StepRequestBody, CloseRequestBody
+from .environment import WebshopEnvWrapper, preload_catalog
+from .model import ResetQuery, StepBatchQuery
 
-app = FastAPI(debug=debug_flg)
-register_error_handlers(app)
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s %(filename)s:%(lineno)d - %(message)s",
+)
 
+_parallel_actor = int(os.environ.get("WEBSHOP_PARALLEL_ACTOR", "8"))
+_ipc_timeout = float(os.environ.get("WEBSHOP_IPC_TIMEOUT", "120.0"))
 
-# 自定义中间件
-@app.middleware("http")
-async def log_request_response_time(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    logging.info(
-        f"{request.client.host} - {request.method} {request.url.path} - {response.status_code} - {process_time:.2f} seconds"
-    )
-    return response
+# Env ids are spread evenly over the workers, each keeps its share of the envs
+_make_wrapper = functools.partial(
+    WebshopEnvWrapper,
+    max_envs=math.ceil(int(os.environ.get("WEBSHOP_MAX_ENVS", 8000)) / _parallel_actor),
+    memory_budget_mb=float(os.environ.get("WEBSHOP_MEMORY_BUDGET_MB", 0)),
+    min_idle_seconds=float(os.environ.get("WEBSHOP_MIN_IDLE_SECONDS", 60)),
+    seed=os.environ.get("WEBSHOP_SEED"),
+)
 
+router = Router(
+    parallel_actor=_parallel_actor,
+    wrapper_factory=_make_wrapper,
+    ipc_timeout=_ipc_timeout,
+    preload=preload_catalog,
+)
 
-@app.get("/health")
-async def health():
-    return {"status": "ok", "service": "webshop"}
 
+def _register_routes(application: FastAPI, r: Router):
+    @application.post("/create")
+    async def create():
+        return await r.create()
 
-@app.post("/create")
-async def create():
-    env = webshop_env_server.create()
-    return {"env_id": env}
+    @application.post("/step")
+    async def step(body: StepRequestBody):
+        return await r.step(body.env_id, body.action)
 
+    @application.post("/step_batch")
+    async def step_batch(body: StepBatchQuery):
+        return await r.step_batch([(step.env_id, step.action) for step in body.steps])
 
-@app.post("/step")
-def step(step_query: StepQuery):
-    observation, reward, done, info = webshop_env_server.step(step_query.env_id, step_query.action)
-    info = info or {}
-    return {
-        "observation": observation,
-        "reward": reward,
-        "done": done,
-        "info": info,
-    }
+    @application.post("/reset")
+    async def reset(body: ResetQuery):
+        return await r.reset(body.env_id, task_id=body.task_id)
 
+    @application.post("/close")
+    async def close(body: CloseRequestBody):
+        result = await r.close(body.env_id)
+        return {"closed": bool(result), "env_id": body.env_id}
 
-@app.post("/reset")
-def reset(reset_query: ResetQuery):
-    result = webshop_env_server.reset(reset_query.env_id, reset_query.task_id)
-    # WebShop's env.reset() returns a tuple/list [observation, info]
-    # Extract the observation string to match other environments' format
-    if isinstance(result, (list, tuple)) and len(result) >= 1:
-        observation = result[0]
-    else:
-        observation = result
-    return {"observation": observation, "info": {}}
 
-
-@app.post("/close")
-def close(body: CloseRequestBody):
-    result = webshop_env_server.close(body.env_id)
-    return {"closed": bool(result), "env_id": body.env_id}
+app = create_app(router, extra_setup=_register_routes, service="webshop")
@@ -10,8 +10,11 @@ mkdir -p resources resources_100 resources_1k resources_100k
 python convert_product_file_format.py # convert items.json => required doc format
 mkdir -p indexes
 bash ./run_indexing.sh
-cd ../..
+cd ..
+python -m web_agent_site.engine.preprocess --num_products 1000 # catalog of the agentenv server
+cd ..
 
+pip install -e ../agentenv-pool
 pip install -e .
 
 pip uninstall numpy
@@ -0,0 +1,37 @@
+import random
+
+from web_agent_site.engine import catalog
+
+
+def make_catalog(monkeypatch, limit_goals=-1):
+    goals = [{'asin': f'B{i}', 'name': f'goal {i}', 'weight': 1} for i in range(20)]
+    monkeypatch.setattr(
+        catalog, 'load_preprocessed_catalog',
+        lambda file_path, num_products, human_goals: ([], {}, {}, {}, [dict(g) for g in goals]),
+    )
+    monkeypatch.setattr(catalog, 'ProductIndex', lambda products: None)
+    monkeypatch.setattr(catalog, 'load_name_nouns', lambda names: None)
+    return catalog.Catalog('items.json', limit_goals=limit_goals)
+
+
+def test_goal_order_leaves_global_random_alone(monkeypatch):
+    random.seed(0)
+    state = random.getstate()
+    shuffled = make_catalog(monkeypatch).goals
+    assert random.getstate() == state
+
+    # Same order as the former `random.seed(233)` on the global RNG
+    expected = [{'asin': f'B{i}', 'name': f'goal {i}', 'weight': 1} for i in range(20)]
+    random.seed(233)
+    random.shuffle(expected)
+    assert shuffled == expected
+
+
+def test_limited_goals_do_not_depend_on_global_random(monkeypatch):
+    random.seed(1)
+    first = make_catalog(monkeypatch, limit_goals=5).goals
+    random.seed(2)
+    state = random.getstate()
+    assert make_catalog(monkeypatch, limit_goals=5).goals == first
+    assert random.getstate() == state
+    assert len(first) == 5
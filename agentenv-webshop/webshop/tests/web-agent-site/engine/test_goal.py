@@ -197,4 +197,69 @@ def test_get_reward():
     purchased['query'] = "Query 2"
     purchased['product_category'] = "a › d › e"
     total_reward = get_reward(purchased, goal, 35, purchased['goal_options'])
-    assert isclose(total_reward, 0.2857, abs_tol=1e-2)
\ No newline at end of file
+    assert isclose(total_reward, 0.2857, abs_tol=1e-2)
+
+class FakeToken:
+    def __init__(self, text):
+        self.text = text
+        self.pos_ = 'NOUN' if text[0].isupper() else 'ADJ'
+
+
+class FakeNLP:
+    """spaCy stand-in tagging capitalized words as nouns"""
+    pipe_names = ['tok2vec', 'tagger', 'parser', 'attribute_ruler', 'ner']
+
+    def __init__(self):
+        self.parsed = []
+
+    def __call__(self, text):
+        self.parsed.append(text)
+        return [FakeToken(t) for t in text.split()]
+
+    def pipe(self, texts, batch_size=None, disable=None):
+        assert 'tagger' not in disable
+        return [self(text) for text in texts]
+
+
+def test_name_nouns_cache(tmp_path, monkeypatch):
+    from web_agent_site.engine import goal as goal_module
+    nlp = FakeNLP()
+    monkeypatch.setattr(goal_module, 'get_nlp', lambda: nlp)
+    monkeypatch.setattr(goal_module, '_name_nouns', {})
+    cache_path = tmp_path / 'name_nouns.json'
+
+    load_name_nouns(['Red Sofa Couch', 'small Side Table'], cache_path=cache_path)
+    assert nlp.parsed == ['Red Sofa Couch', 'small Side Table']
+    assert get_name_nouns('small Side Table') == ('side', 'table')
+
+    # A new process reads the file and only parses the new names
+    monkeypatch.setattr(goal_module, '_name_nouns', {})
+    nlp.parsed = []
+    load_name_nouns(['Red Sofa Couch', 'Lamp'], cache_path=cache_path)
+    assert nlp.parsed == ['Lamp']
+    goal = {'query': 'q', 'product_category': 'a › b', 'name': 'Red Sofa Couch'}
+    purchased = {'query': 'p', 'product_category': 'c › d', 'name': 'small Side Table'}
+    assert get_type_reward(purchased, goal)['title_score'] == 0
+    purchased['name'] = 'grey Sofa'
+    assert isclose(get_type_reward(purchased, goal)['title_score'], 1. / 3.)
+    # Names missing from the cache are parsed on demand
+    assert nlp.parsed == ['Lamp', 'grey Sofa']
+
+
+def test_product_texts_follow_the_product():
+    goal = {'attributes': ['natural ingredients']}
+    purchased = {
+        'asin': 'B000TEST01',
+        'Attributes': [],
+        'Title': "",
+        'BulletPoints': ["Made with Natural Ingredients"],
+        'Description': "",
+    }
+    assert get_attribute_reward(purchased, goal) == (1, 1)
+    # Another product dict with the same asin is matched on its own texts
+    other = dict(purchased, BulletPoints=[])
+    assert get_attribute_reward(other, goal) == (0, 0)
+    # Catalog products carry the texts computed at load
+    add_product_texts([purchased])
+    assert purchased[PRODUCT_TEXTS_KEY] == ("", "made with natural ingredients", "")
+    assert get_attribute_reward(purchased, goal) == (1, 1)
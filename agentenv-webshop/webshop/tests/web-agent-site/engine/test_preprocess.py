@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from web_agent_site.engine import preprocess
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    """Source files, a fake `load_products`/`get_goals` counting their calls"""
+    paths = [tmp_path / name for name in ('items.json', 'attrs.json', 'human_attrs.json')]
+    for path in paths:
+        path.write_text('[]')
+    monkeypatch.setattr(preprocess, 'PREPROCESSED_DIR', str(tmp_path / 'preprocessed'))
+    monkeypatch.setattr(preprocess, 'DEFAULT_ATTR_PATH', str(paths[1]))
+    monkeypatch.setattr(preprocess, 'HUMAN_ATTR_PATH', str(paths[2]))
+    calls = []
+
+    def load_products(filepath, num_products=None, human_goals=True):
+        calls.append(filepath)
+        products = [{'asin': 'B1', 'Attributes': ['a']}, {'asin': 'B2', 'Attributes': ['a', 'b']}]
+        return products, None, {'B1': 1.0, 'B2': 2.0}, {'a': {'B1', 'B2'}, 'b': {'B2'}}
+
+    monkeypatch.setattr(preprocess, 'load_products', load_products)
+    monkeypatch.setattr(preprocess, 'get_goals', lambda products, prices, human_goals: [{'asin': 'B1'}])
+    return paths, calls
+
+
+def test_round_trip(sources):
+    (items, _, _), calls = sources
+    assert preprocess.load_preprocessed_catalog(str(items), 2) is None
+    path = preprocess.preprocess_catalog(str(items), 2)
+    assert path == preprocess.preprocessed_path(str(items), 2)
+    assert os.path.basename(path) == 'items_2_synthetic.pkl'
+    all_products, product_item_dict, prices, attribute_to_asins, goals = \
+        preprocess.load_preprocessed_catalog(str(items), 2)
+    assert [p['asin'] for p in all_products] == ['B1', 'B2']
+    assert product_item_dict['B2'] is all_products[1]
+    assert prices == {'B1': 1.0, 'B2': 2.0}
+    assert attribute_to_asins['b'] == {'B2'}
+    assert attribute_to_asins['missing'] == set()
+    assert goals == [{'asin': 'B1'}]
+    assert calls == [str(items)]
+    # Other arguments have their own file
+    assert preprocess.load_preprocessed_catalog(str(items), 2, human_goals=1) is None
+    assert preprocess.load_preprocessed_catalog(str(items), None) is None
+
+
+def test_changed_sources_invalidate(sources):
+    (items, attrs, _), _ = sources
+    preprocess.preprocess_catalog(str(items))
+    # Same content, new mtime: the checksum still matches
+    os.utime(attrs, ns=(0, 0))
+    assert preprocess.load_preprocessed_catalog(str(items)) is not None
+    # Same size, other content
+    attrs.write_text('{}')
+    os.utime(attrs, ns=(0, 0))
+    assert preprocess.load_preprocessed_catalog(str(items)) is None
+    preprocess.preprocess_catalog(str(items))
+    items.write_text('[{}]')
+    assert preprocess.load_preprocessed_catalog(str(items)) is None
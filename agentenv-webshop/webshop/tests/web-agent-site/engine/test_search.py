@@ -0,0 +1,125 @@
+import random
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+from web_agent_site.engine import engine
+from web_agent_site.engine.engine import (
+    ProductIndex,
+    batch_search_asins,
+    get_top_n_product_from_keywords,
+    search_asins,
+)
+
+
+class FakeSearcher:
+    """LuceneSearcher stand-in whose hits are the query words as asins"""
+    def __init__(self):
+        self.searches = []
+        self.batch_searches = []
+
+    def hits(self, query):
+        return [SimpleNamespace(docid=word.upper()) for word in query.split()]
+
+    def search(self, query, k=10):
+        self.searches.append(query)
+        return self.hits(query)[:k]
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        self.batch_searches.append(list(queries))
+        return {qid: self.hits(query)[:k] for query, qid in zip(queries, qids)}
+
+
+def test_search_is_cached_across_calls():
+    searcher = FakeSearcher()
+    assert search_asins(searcher, 'b1 b2') == ('B1', 'B2')
+    assert search_asins(searcher, 'b1 b2') == ('B1', 'B2')
+    assert searcher.searches == ['b1 b2']
+    # Each search engine has its own cache
+    other = FakeSearcher()
+    search_asins(other, 'b1 b2')
+    assert other.searches == ['b1 b2']
+
+
+def test_batch_search_only_sends_missing_queries():
+    searcher = FakeSearcher()
+    search_asins(searcher, 'b1')
+    results = batch_search_asins(searcher, ['b2', 'b1', 'b3 b4', 'b2'])
+    assert results == [('B2',), ('B1',), ('B3', 'B4'), ('B2',)]
+    assert searcher.batch_searches == [['b2', 'b3 b4']]
+    assert batch_search_asins(searcher, ['b3 b4', 'b2']) == [('B3', 'B4'), ('B2',)]
+    assert searcher.batch_searches == [['b2', 'b3 b4']]
+
+
+def test_search_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(engine, 'SEARCH_CACHE_SIZE', 2)
+    searcher = FakeSearcher()
+    search_asins(searcher, 'b1')
+    search_asins(searcher, 'b2')
+    search_asins(searcher, 'b1')
+    search_asins(searcher, 'b3')
+    search_asins(searcher, 'b1')
+    search_asins(searcher, 'b2')
+    assert searcher.searches == ['b1', 'b2', 'b3', 'b2']
+
+
+def test_top_n_products_skips_unknown_asins():
+    searcher = FakeSearcher()
+    product_item_dict = {'B1': {'asin': 'B1'}, 'B3': {'asin': 'B3'}}
+    products = get_top_n_product_from_keywords(
+        ['b3', 'b2', 'b1'], searcher, [], product_item_dict
+    )
+    assert products == [{'asin': 'B3'}, {'asin': 'B1'}]
+
+
+def synthetic_catalog(n=2000, seed=0):
+    rng = random.Random(seed)
+    categories = ['beauty', 'garden', 'grocery', 'electronics', 'fashion']
+    queries = [f'query {i}' for i in range(40)]
+    attributes = [f'attribute {i}' for i in range(60)]
+    all_products = [
+        {
+            'asin': f'B{i:09d}',
+            'category': rng.choice(categories),
+            'query': rng.choice(queries),
+            'Attributes': rng.sample(attributes, k=rng.randint(1, 4)),
+        }
+        for i in rng.sample(range(10 * n), k=n)
+    ]
+    attribute_to_asins = defaultdict(set)
+    for p in all_products:
+        for a in p['Attributes']:
+            attribute_to_asins[a].add(p['asin'])
+    return all_products, attribute_to_asins
+
+
+def scan(keywords, all_products, attribute_to_asins):
+    """The linear scans the special modes did before `ProductIndex`"""
+    if keywords[0] == '<a>':
+        asins = attribute_to_asins[' '.join(keywords[1:]).strip()]
+        return [p for p in all_products if p['asin'] in asins]
+    elif keywords[0] == '<c>':
+        return [p for p in all_products if p['category'] == keywords[1].strip()]
+    else:
+        query = ' '.join(keywords[1:]).strip()
+        return [p for p in all_products if p['query'] == query]
+
+
+@pytest.mark.parametrize("with_index", [True, False])
+def test_special_modes_match_scans(with_index):
+    all_products, attribute_to_asins = synthetic_catalog()
+    product_index = ProductIndex(all_products) if with_index else None
+    suite = (
+        [['<a>'] + a.split() for a in list(attribute_to_asins) + ['missing attribute']]
+        + [['<c>', c] for c in ['beauty', 'garden ', 'fashion', 'toys']]
+        + [['<q>'] + q.split() for q in ['query 0', 'query 39', 'query 40']]
+    )
+    for keywords in suite:
+        expected = scan(keywords, all_products, defaultdict(set, attribute_to_asins))
+        output = get_top_n_product_from_keywords(
+            keywords, None, all_products, {}, attribute_to_asins, product_index
+        )
+        assert output == expected
+        assert [p['asin'] for p in output] == [p['asin'] for p in expected]
+    assert 'missing attribute' not in attribute_to_asins
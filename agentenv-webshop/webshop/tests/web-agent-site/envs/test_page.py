@@ -0,0 +1,106 @@
+import pytest
+from bs4 import BeautifulSoup
+from bs4.element import Comment
+
+from web_agent_site.envs.page import PageModel, lxml
+
+MOCKS = [
+    "tests/transfer/mocks/mock_parse_item_page_ws",
+    "tests/transfer/mocks/mock_parse_item_page_ws_desc",
+    "tests/transfer/mocks/mock_parse_item_page_ws_feat",
+    "tests/transfer/mocks/mock_parse_results_ws",
+    "tests/transfer/mocks/mock_parse_item_page_amz",
+    "tests/transfer/mocks/mock_parse_results_amz",
+    "tests/transfer/mocks/mock_parse_item_page_ebay",
+    "tests/transfer/mocks/mock_parse_results_ebay",
+]
+PARSERS = ["html.parser"] + (["lxml"] if lxml is not None else [])
+
+
+def tag_visible(element):
+    ignore = {'style', 'script', 'head', 'title', 'meta', '[document]'}
+    return (
+        element.parent.name not in ignore and not isinstance(element, Comment)
+    )
+
+
+def reference(html, url, asins):
+    """The BeautifulSoup extraction WebAgentTextEnv used before PageModel"""
+    html_obj = BeautifulSoup(html, 'html.parser')
+    visible_texts = list(filter(tag_visible, html_obj.findAll(text=True)))
+    simple = ' [SEP] '.join(t.strip() for t in visible_texts if t != '\n')
+    observation = ''
+    for t in visible_texts:
+        if t == '\n': continue
+        if t.parent.name == 'button':
+            processed_t = f'[button] {t} [button_]'
+        elif t.parent.name == 'label':
+            if f'"{t}"' in url:
+                processed_t = f'  [clicked button] {t} [clicked button_]'
+                observation = f'You have clicked {t}.\n' + observation
+            else:
+                processed_t = f'  [button] {t} [button_]'
+        elif t.parent.get('class') == ["product-link"]:
+            if f'{t}' in asins:
+                processed_t = f'\n[clicked button] {t} [clicked button_]'
+            else:
+                processed_t = f'\n[button] {t} [button_]'
+        else:
+            processed_t = str(t)
+        observation += processed_t + '\n'
+
+    buttons = html_obj.find_all(class_='btn')
+    product_links = html_obj.find_all(class_='product-link')
+    text_to_clickable = {
+        f'{b.get_text()}'.lower(): b for b in buttons + product_links
+    }
+    for opt in html_obj.select('input[type="radio"]'):
+        text_to_clickable[f'{opt.get("value")}'] = opt
+    instruction = html_obj.find(id='instruction-text')
+    return dict(
+        simple=simple,
+        rich=observation,
+        clickables={k: (v.get('class'), v.get('name')) for k, v in text_to_clickable.items()},
+        has_search_bar=html_obj.find(id='search_input') is not None,
+        instruction_text=instruction.h4.text if instruction is not None else None,
+    )
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+@pytest.mark.parametrize("path", MOCKS)
+def test_page_model_matches_reference(path, parser):
+    with open(path) as f:
+        html = f.read()
+    url = 'http://127.0.0.1:3000/item_page/abc/B09P87V3LZ/red/1/{"color": "red"}'
+    asins = {'B09GKFNQWT', 'B09P87V3LZ'}
+    page = PageModel(html, parser=parser)
+    expected = reference(html, url, asins)
+    assert page.simple_text() == expected['simple']
+    assert page.rich_text(url, asins) == expected['rich']
+    assert {
+        k: (v.get('class'), v.get('name')) for k, v in page.text_to_clickable.items()
+    } == expected['clickables']
+    assert page.has_search_bar == expected['has_search_bar']
+    assert page.instruction_text == expected['instruction_text']
+
+
+@pytest.mark.skipif(lxml is None, reason="lxml not installed")
+def test_lxml_falls_back_on_stray_end_tags():
+    with open("tests/transfer/mocks/mock_parse_item_page_ws") as f:
+        assert PageModel(f.read()).parser == 'lxml'
+    # results_page.html closes its <h4> titles with </h5>
+    with open("tests/transfer/mocks/mock_parse_results_ws") as f:
+        assert PageModel(f.read()).parser == 'html.parser'
+    html = '<html><body><p>a\r\nb</p></body></html>'
+    assert PageModel(html).parser == 'html.parser'
+
+
+def test_whitespace_strings():
+    html = (
+        '<html><body><div>\n   <span>a</span> <span>b</span>'
+        '<button class="btn">  Buy <!-- x --> Now </button></div></body></html>'
+    )
+    for parser in PARSERS:
+        page = PageModel(html, parser=parser)
+        assert page.simple_text() == 'a [SEP]  [SEP] b [SEP] Buy [SEP] Now'
+        assert list(page.text_to_clickable) == ['  buy  now ']
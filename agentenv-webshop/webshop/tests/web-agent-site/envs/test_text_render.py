@@ -0,0 +1,101 @@
+import ast
+import glob
+import json
+
+import pytest
+from flask import Flask
+
+from web_agent_site.engine.engine import ACTION_TO_TEMPLATE, END_BUTTON, map_action_to_html
+from web_agent_site.envs.page import PageModel
+from web_agent_site.envs.text_render import map_action_to_page
+
+TRAJECTORIES = sorted(glob.glob("all_trajs/*.jsonl"))
+ENDPOINTS = ['index', 'search_results', 'item_page', 'item_sub_page', 'done']
+
+app = Flask(__name__)
+for endpoint in ENDPOINTS:
+    app.add_url_rule(f'/{endpoint}', endpoint, lambda **kwargs: '')
+
+
+def product(asin):
+    """Product info with the strings the templates and parsers may treat specially"""
+    return {
+        'asin': asin,
+        'Title': f'{asin} Sofa & Couch <Grey> "3-Seat"',
+        'Price': '$12.99 to $20.00',
+        'Rating': None,
+        'MainImage': f'https://m.media-amazon.com/images/{asin}.jpg',
+        'option_to_image': {},
+        'options': {
+            'color': ['grey', 'navy  blue', ' '],
+            'size': ['x-large', '', '3 ft & 4 ft'],
+        },
+        'Description': '\n',
+        'BulletPoints': ['wood frame', '', 'Ünïcode — café', '  '],
+        'Reviews': [
+            {'title': 'Great', 'score': 5, 'body': 'Comfy\n\n'},
+            {'title': '', 'score': 1, 'body': ''},
+        ],
+        'Attributes': ['living room', 'wood frame'],
+        'category': 'garden',
+        'query': 'sofas and couches',
+    }
+
+
+def recorded_actions(path):
+    """(action, url, kwargs) of every page of a recorded session"""
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    for record in records:
+        content = record.get('content') or {}
+        instruction_text = record['goal']['instruction_text']
+        keywords = content.get('keywords', "['a']")
+        if isinstance(keywords, str):
+            keywords = ast.literal_eval(keywords)
+        kwargs = dict(
+            session_id=record['url'].split('/')[3],
+            keywords=keywords,
+            page=int(content.get('page', 1)),
+            instruction_text=instruction_text,
+        )
+        if record['page'] == 'index':
+            yield 'start', record['url'], kwargs
+        elif record['page'] == 'search_results':
+            asins = content['search_result_asins']
+            kwargs.update(products=[product(asin) for asin in asins], total=len(asins) * 5)
+            yield 'search', record['url'], kwargs
+        elif record['page'] == 'done':
+            kwargs.update(asin=content['asin'], options=content['options'], reward=0.5)
+            yield f'click[{END_BUTTON}]', record['url'], kwargs
+        else:
+            kwargs.update(
+                asin=content['asin'],
+                options=content['options'] or {'color': 'navy  blue'},
+                product_info=product(content['asin']),
+            )
+            for show_attrs in (False, True):
+                yield f"click[{content['asin']}]", record['url'], dict(kwargs, show_attrs=show_attrs)
+            for sub_page in ACTION_TO_TEMPLATE:
+                yield f'click[{sub_page}]', record['url'], kwargs
+
+
+def test_recorded_sessions_exist():
+    assert TRAJECTORIES
+
+
+@pytest.mark.parametrize("path", TRAJECTORIES)
+def test_text_render_matches_html(path):
+    with app.app_context(), app.test_request_context():
+        for action, url, kwargs in recorded_actions(path):
+            html_page = PageModel(map_action_to_html(action, **kwargs))
+            text_page = map_action_to_page(action, **kwargs)
+            clicked_asins = {kwargs.get('asin'), 'B09F3V2HVT'}
+            assert text_page.simple_text() == html_page.simple_text(), action
+            assert text_page.rich_text(url, clicked_asins) == html_page.rich_text(url, clicked_asins), action
+            assert {
+                k: (v.get('class'), v.get('name')) for k, v in text_page.text_to_clickable.items()
+            } == {
+                k: (v.get('class'), v.get('name')) for k, v in html_page.text_to_clickable.items()
+            }, action
+            assert text_page.has_search_bar == html_page.has_search_bar, action
+            assert text_page.instruction_text == html_page.instruction_text, action
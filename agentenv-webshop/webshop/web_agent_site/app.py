@@ -18,9 +18,10 @@ from web_agent_site.engine.engine import (
     get_top_n_product_from_keywords,
     get_product_per_page,
     map_action_to_html,
+    ProductIndex,
     END_BUTTON
 )
-from web_agent_site.engine.goal import get_reward, get_goals
+from web_agent_site.engine.goal import add_product_texts, get_reward, get_goals
 from web_agent_site.utils import (
     generate_mturk_code,
     setup_logger,
@@ -35,6 +36,7 @@ all_products = None
 product_item_dict = None
 product_prices = None
 attribute_to_asins = None
+product_index = None
 goals = None
 weights = None
 
@@ -51,7 +53,7 @@ def index(session_id):
     global user_log_dir
     global all_products, product_item_dict, \
            product_prices, attribute_to_asins, \
-           search_engine, \
+           product_index, search_engine, \
            goals, weights, user_sessions
 
     if search_engine is None:
@@ -60,6 +62,8 @@ def index(session_id):
                 filepath=DEFAULT_FILE_PATH,
                 num_products=DEBUG_PROD_SIZE
             )
+        add_product_texts(all_products)
+        product_index = ProductIndex(all_products)
         search_engine = init_search_engine(num_products=DEBUG_PROD_SIZE)
         goals = get_goals(all_products, product_prices)
         random.seed(233)
@@ -118,6 +122,7 @@ def search_results(session_id, keywords, page):
         all_products,
         product_item_dict,
         attribute_to_asins,
+        product_index,
     )
     products = get_product_per_page(top_n_products, page)
     html = map_action_to_html(
@@ -0,0 +1,123 @@
+"""
+Process-wide product catalog shared by every simulated WebShop server.
+
+Loading the products, building the goals and opening the Lucene index take
+seconds and hundreds of MB, but none of it depends on the user session. A
+`Catalog` holds all of it, read-only, and `get_catalog` hands out a single
+instance per set of load arguments, so every `SimServer` (one per
+`WebAgentTextEnv`) only keeps its own session dict. Products and goals come
+from the preprocessed catalog when there is an up to date one (see
+`preprocess`). The searcher is only opened on first use, so a catalog loaded
+before forking worker processes is shared by them copy-on-write, each worker
+opening its own searcher.
+"""
+import random
+import threading
+
+from web_agent_site.engine.engine import ProductIndex, load_products, init_search_engine
+from web_agent_site.engine.goal import add_product_texts, get_goals, load_name_nouns
+from web_agent_site.engine.preprocess import load_preprocessed_catalog
+from web_agent_site.utils import random_idx
+
+
+class Catalog:
+    """Products, goals and search engine of one WebShop instance"""
+    def __init__(
+        self,
+        file_path,
+        filter_goals=None,
+        limit_goals=-1,
+        num_products=None,
+        human_goals=0,
+    ):
+        """
+        Arguments:
+        filter_goals (`func`) -- Select specific goal(s) for consideration based on criteria of custom function
+        limit_goals (`int`) -- Limit to number of goals available
+        num_products (`int`) -- Number of products to search across
+        human_goals (`bool`) -- If true, load human goals; otherwise, load synthetic goals
+        """
+        preprocessed = load_preprocessed_catalog(file_path, num_products, human_goals)
+        if preprocessed is not None:
+            self.all_products, self.product_item_dict, self.product_prices, \
+                self.attribute_to_asins, self.goals = preprocessed
+        else:
+            self.all_products, self.product_item_dict, self.product_prices, self.attribute_to_asins = \
+                load_products(filepath=file_path, num_products=num_products, human_goals=human_goals)
+            self.goals = get_goals(self.all_products, self.product_prices, human_goals)
+        add_product_texts(self.all_products)
+        self.product_index = ProductIndex(self.all_products)
+        self.num_products = num_products
+        self._search_engine = None
+        self._search_engine_lock = threading.Lock()
+        print(f'Loaded {len(self.goals)} goals.')
+        load_name_nouns(
+            [p.get('name') for p in self.all_products] + [goal['name'] for goal in self.goals]
+        )
+
+        # HBY: Fix outcome for random shuffling of goals, without reseeding
+        # the global RNG that unseeded envs draw their goals from
+        rng = random.Random(233)
+        rng.shuffle(self.goals)
+
+        # Apply `filter_goals` parameter if exists to select speific goal(s)
+        if filter_goals is not None:
+            self.goals = [
+                goal for (i, goal) in enumerate(self.goals)
+                if filter_goals(i, goal)
+            ]
+
+        # Imposes `limit` on goals via random selection
+        if limit_goals != -1 and limit_goals < len(self.goals):
+            print("has limit")
+            self.weights = [goal['weight'] for goal in self.goals]
+            self.cum_weights = [0]
+            for w in self.weights:
+                self.cum_weights.append(self.cum_weights[-1] + w)
+            idxs = []
+            while len(idxs) < limit_goals:
+                idx = random_idx(self.cum_weights, rng)
+                if idx not in idxs:
+                    idxs.append(idx)
+            self.goals = [self.goals[i] for i in idxs]
+        print(f'Loaded {len(self.goals)} goals.')
+
+        self.weights = [goal['weight'] for goal in self.goals]
+        self.cum_weights = [0]
+        for w in self.weights:
+            self.cum_weights.append(self.cum_weights[-1] + w)
+
+    @property
+    def search_engine(self):
+        """Lucene searcher of the catalog, opened by the first caller"""
+        with self._search_engine_lock:
+            if self._search_engine is None:
+                self._search_engine = init_search_engine(num_products=self.num_products)
+            return self._search_engine
+
+
+_catalogs = dict()
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(
+    file_path,
+    filter_goals=None,
+    limit_goals=-1,
+    num_products=None,
+    human_goals=0,
+):
+    """Returns the shared `Catalog` for these arguments, loading it on first use"""
+    key = (file_path, filter_goals, limit_goals, num_products, bool(human_goals))
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = Catalog(
+                file_path, filter_goals, limit_goals, num_products, human_goals
+            )
+        return _catalogs[key]
+
+
+def clear_catalogs():
+    """Drops the shared catalogs, the next `get_catalog` call reloads"""
+    with _catalogs_lock:
+        _catalogs.clear()
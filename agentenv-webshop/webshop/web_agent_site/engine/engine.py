@@ -4,16 +4,17 @@ import os
 import re
 import json
 import random
-from collections import defaultdict
+import threading
+import weakref
+from collections import OrderedDict, defaultdict
 from ast import literal_eval
 from decimal import Decimal
 
 import cleantext
 from tqdm import tqdm
 from rank_bm25 import BM25Okapi
-from flask import render_template_string
+from flask import current_app
 from rich import print
-from pyserini.search.lucene import LuceneSearcher
 
 from web_agent_site.utils import (
     BASE_DIR,
@@ -41,19 +42,27 @@ ACTION_TO_TEMPLATE = {
     'Attributes': 'attributes_page.html',
 }
 
+PAGE_CACHE_SIZE = 4096
+SEARCH_CACHE_SIZE = 16384
+SEARCH_THREADS = 4
+
+_page_cache_lock = threading.Lock()
+# Search engine to its LRU of query to top asins, shared by all sessions
+_search_caches = weakref.WeakKeyDictionary()
+_search_cache_lock = threading.Lock()
+
+
 def map_action_to_html(action, **kwargs):
     action_name, action_arg = parse_action(action)
     if action_name == 'start':
-        path = os.path.join(TEMPLATE_DIR, 'search_page.html')
-        html = render_template_string(
-            read_html_template(path=path),
+        html = render_html_template(
+            'search_page.html',
             session_id=kwargs['session_id'],
             instruction_text=kwargs['instruction_text'],
         )
     elif action_name == 'search':
-        path = os.path.join(TEMPLATE_DIR, 'results_page.html')
-        html = render_template_string(
-            read_html_template(path=path),
+        html = render_html_template(
+            'results_page.html',
             session_id=kwargs['session_id'],
             products=kwargs['products'],
             keywords=kwargs['keywords'],
@@ -62,9 +71,8 @@ def map_action_to_html(action, **kwargs):
             instruction_text=kwargs['instruction_text'],
         )
     elif action_name == 'click' and action_arg == END_BUTTON:
-        path = os.path.join(TEMPLATE_DIR, 'done_page.html')
-        html = render_template_string(
-            read_html_template(path),
+        html = render_html_template(
+            'done_page.html',
             session_id=kwargs['session_id'],
             reward=kwargs['reward'],
             asin=kwargs['asin'],
@@ -79,9 +87,8 @@ def map_action_to_html(action, **kwargs):
             product_category=kwargs.get('product_category'),
         )
     elif action_name == 'click' and action_arg in ACTION_TO_TEMPLATE:
-        path = os.path.join(TEMPLATE_DIR, ACTION_TO_TEMPLATE[action_arg])
-        html = render_template_string(
-            read_html_template(path),
+        html = render_cached_page(
+            ACTION_TO_TEMPLATE[action_arg],
             session_id=kwargs['session_id'],
             product_info=kwargs['product_info'],
             keywords=kwargs['keywords'],
@@ -91,9 +98,8 @@ def map_action_to_html(action, **kwargs):
             instruction_text=kwargs.get('instruction_text')
         )
     elif action_name == 'click':
-        path = os.path.join(TEMPLATE_DIR, 'item_page.html')
-        html = render_template_string(
-            read_html_template(path),
+        html = render_cached_page(
+            'item_page.html',
             session_id=kwargs['session_id'],
             product_info=kwargs['product_info'],
             keywords=kwargs['keywords'],
@@ -114,6 +120,67 @@ def read_html_template(path):
     return template
 
 
+TEMPLATE_SOURCES = {
+    name: read_html_template(os.path.join(TEMPLATE_DIR, name))
+    for name in sorted(os.listdir(TEMPLATE_DIR))
+    if name.endswith('.html')
+}
+
+
+def get_html_template(name):
+    """
+    Returns the compiled template `name` of TEMPLATE_DIR. All templates are
+    compiled once per Flask app, with its Jinja environment, on first use.
+    """
+    app = current_app._get_current_object()
+    templates = app.extensions.get('webshop_templates')
+    if templates is None:
+        templates = {
+            template_name: app.jinja_env.from_string(source)
+            for template_name, source in TEMPLATE_SOURCES.items()
+        }
+        app.extensions['webshop_templates'] = templates
+    return templates[name]
+
+
+def render_html_template(name, **context):
+    """Same as `render_template_string` on the template source, without recompiling it"""
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    return get_html_template(name).render(context)
+
+
+def render_cached_page(name, **context):
+    """
+    Renders an item page or sub page, memoized per Flask app. The page only
+    depends on the product and on the arguments, so everything but
+    `product_info` (fixed by `asin`) goes into the key.
+    """
+    key = (
+        name,
+        context['asin'],
+        tuple(context['options'].items()),
+        context['session_id'],
+        tuple(context['keywords']) if isinstance(context['keywords'], list) else context['keywords'],
+        context['page'],
+        context.get('instruction_text'),
+        context.get('show_attrs'),
+    )
+    app = current_app._get_current_object()
+    with _page_cache_lock:
+        cache = app.extensions.setdefault('webshop_page_cache', OrderedDict())
+        html = cache.get(key)
+        if html is not None:
+            cache.move_to_end(key)
+            return html
+    html = render_html_template(name, **context)
+    with _page_cache_lock:
+        cache[key] = html
+        while len(cache) > PAGE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return html
+
+
 def parse_action(action):
     """
     Parse action string to action name and its arguments.
@@ -151,28 +218,98 @@ def get_top_n_product_from_keywords(
         all_products,
         product_item_dict,
         attribute_to_asins=None,
+        product_index=None,
     ):
+    """
+    Products matching `keywords`, in `all_products` order for the special
+    `<a>`, `<c>` and `<q>` modes. `product_index` is the `ProductIndex` of
+    `all_products`, built here if not given.
+    """
+    if keywords[0] in ('<a>', '<c>', '<q>') and product_index is None:
+        product_index = ProductIndex(all_products)
     if keywords[0] == '<r>':
         top_n_products = random.sample(all_products, k=SEARCH_RETURN_N)
     elif keywords[0] == '<a>':
         attribute = ' '.join(keywords[1:]).strip()
-        asins = attribute_to_asins[attribute]
-        top_n_products = [p for p in all_products if p['asin'] in asins]
+        asins = attribute_to_asins.get(attribute, ())
+        top_n_products = product_index.products_with_asins(asins)
     elif keywords[0] == '<c>':
         category = keywords[1].strip()
-        top_n_products = [p for p in all_products if p['category'] == category]
+        top_n_products = list(product_index.category_to_products.get(category, ()))
     elif keywords[0] == '<q>':
         query = ' '.join(keywords[1:]).strip()
-        top_n_products = [p for p in all_products if p['query'] == query]
+        top_n_products = list(product_index.query_to_products.get(query, ()))
     else:
-        keywords = ' '.join(keywords)
-        hits = search_engine.search(keywords, k=SEARCH_RETURN_N)
-        docs = [search_engine.doc(hit.docid) for hit in hits]
-        top_n_asins = [json.loads(doc.raw())['id'] for doc in docs]
+        top_n_asins = search_asins(search_engine, ' '.join(keywords))
         top_n_products = [product_item_dict[asin] for asin in top_n_asins if asin in product_item_dict]
     return top_n_products
 
 
+class ProductIndex:
+    """Products by asin, category and query, for the special search modes"""
+    def __init__(self, all_products):
+        """
+        Arguments:
+        all_products (`list`) -- Products with unique asins, as from `load_products`
+        """
+        self.all_products = all_products
+        self.asin_to_position = {p['asin']: i for i, p in enumerate(all_products)}
+        self.category_to_products = defaultdict(list)
+        self.query_to_products = defaultdict(list)
+        for p in all_products:
+            self.category_to_products[p['category']].append(p)
+            self.query_to_products[p['query']].append(p)
+
+    def products_with_asins(self, asins):
+        """Products of the given asins, in `all_products` order"""
+        positions = sorted(
+            self.asin_to_position[asin] for asin in asins if asin in self.asin_to_position
+        )
+        return [self.all_products[i] for i in positions]
+
+
+def search_asins(search_engine, query):
+    """Asins of the top `SEARCH_RETURN_N` hits for `query`, memoized across sessions"""
+    return batch_search_asins(search_engine, [query])[0]
+
+
+def batch_search_asins(search_engine, queries, threads=SEARCH_THREADS):
+    """
+    `search_asins` for several queries, e.g. the search actions of a batch of
+    env steps. Queries missing from the cache go to Lucene in a single
+    `batch_search` call.
+
+    The index is built with each product's asin as document id
+    (`search_engine/convert_product_file_format.py`), so hits give the asins
+    without fetching and decoding the stored documents.
+    """
+    with _search_cache_lock:
+        cache = _search_caches.setdefault(search_engine, OrderedDict())
+        results = {}
+        for query in queries:
+            if query in cache:
+                cache.move_to_end(query)
+                results[query] = cache[query]
+    missing = [query for query in dict.fromkeys(queries) if query not in results]
+    if len(missing) == 1:
+        hits = {missing[0]: search_engine.search(missing[0], k=SEARCH_RETURN_N)}
+    elif missing:
+        qids = [str(i) for i in range(len(missing))]
+        qid_hits = search_engine.batch_search(missing, qids, k=SEARCH_RETURN_N, threads=threads)
+        hits = {query: qid_hits.get(qid, []) for query, qid in zip(missing, qids)}
+    else:
+        hits = {}
+    for query, query_hits in hits.items():
+        results[query] = tuple(hit.docid for hit in query_hits)
+    if hits:
+        with _search_cache_lock:
+            for query in hits:
+                cache[query] = results[query]
+            while len(cache) > SEARCH_CACHE_SIZE:
+                cache.popitem(last=False)
+    return [results[query] for query in queries]
+
+
 def get_product_per_page(top_n_products, page):
     return top_n_products[(page - 1) * PRODUCT_WINDOW:page * PRODUCT_WINDOW]
 
@@ -203,6 +340,9 @@ def init_search_engine(num_products=None):
         indexes = 'indexes'
     else:
         raise NotImplementedError(f'num_products being {num_products} is not supported yet.')
+    # Importing pyserini starts the JVM, which does not survive a fork: a
+    # process that forks env workers must not open a searcher beforehand
+    from pyserini.search.lucene import LuceneSearcher
     search_engine = LuceneSearcher(os.path.join(BASE_DIR, f'../search_engine/{indexes}'))
     return search_engine
 
@@ -2,17 +2,115 @@
 Functions for specifying goals and reward calculations.
 """
 import itertools
+import json
+import os
 import random
-import spacy
+import threading
 from collections import defaultdict
+from functools import lru_cache
 from rich import print
 from thefuzz import fuzz
 from web_agent_site.engine.normalize import normalize_color
-
-nlp = spacy.load("en_core_web_lg")
+from web_agent_site.utils import NAME_NOUNS_PATH
 
 PRICE_RANGE = [10.0 * i for i in range(1, 100)]
 
+SPACY_MODEL = 'en_core_web_lg'
+NOUN_POS = ('PNOUN', 'NOUN', 'PROPN')
+FUZZY_CACHE_SIZE = 1 << 18
+
+_nlp = None
+_nlp_lock = threading.Lock()
+# Product or goal name to its lowercased nouns, see `load_name_nouns`
+_name_nouns = {}
+# Key of the lowercased Title, BulletPoints and Description on catalog products
+PRODUCT_TEXTS_KEY = '_lower_texts'
+
+
+def get_nlp():
+    """The spaCy pipeline, loaded on first use since it takes seconds"""
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            import spacy
+            _nlp = spacy.load(SPACY_MODEL)
+        return _nlp
+
+
+def doc_nouns(doc):
+    return tuple(t.text.lower() for t in doc if t.pos_ in NOUN_POS)
+
+
+def get_name_nouns(name):
+    """Lowercased nouns of a product or goal name in order, repeats included"""
+    nouns = _name_nouns.get(name)
+    if nouns is None:
+        nouns = doc_nouns(get_nlp()(name))
+        _name_nouns[name] = nouns
+    return nouns
+
+
+def load_name_nouns(names, cache_path=NAME_NOUNS_PATH):
+    """
+    Fills the name noun cache for `names`, so that rewards need no spaCy.
+    Nouns are read from the JSON file at `cache_path`; only the names missing
+    there are parsed, and then written back to it.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached.get('model') == SPACY_MODEL:
+            for name, nouns in cached['nouns'].items():
+                _name_nouns.setdefault(name, tuple(nouns))
+    missing = [
+        name for name in dict.fromkeys(names)
+        if isinstance(name, str) and name not in _name_nouns
+    ]
+    if not missing:
+        return
+    nlp = get_nlp()
+    # Part of speech tags come from the tagger and attribute ruler alone
+    disable = [pipe for pipe in ('parser', 'ner', 'lemmatizer') if pipe in nlp.pipe_names]
+    for name, doc in zip(missing, nlp.pipe(missing, batch_size=256, disable=disable)):
+        _name_nouns[name] = doc_nouns(doc)
+    print(f'Parsed {len(missing)} product and goal names.')
+    if cache_path is not None:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'model': SPACY_MODEL, 'nouns': _name_nouns}, f)
+        os.replace(tmp_path, cache_path)
+
+
+@lru_cache(maxsize=FUZZY_CACHE_SIZE)
+def fuzzy_match(a, b):
+    """Whether a purchased and a goal attribute or option are the same"""
+    return fuzz.token_set_ratio(a, b) > 85
+
+
+def lower_product_texts(product):
+    return (
+        product['Title'].lower(),
+        ' '.join(product['BulletPoints']).lower(),
+        product['Description'].lower(),
+    )
+
+
+def add_product_texts(products):
+    """Stores the lowercased texts `get_product_texts` returns on each product"""
+    for product in products:
+        product[PRODUCT_TEXTS_KEY] = lower_product_texts(product)
+
+
+def get_product_texts(product):
+    """
+    Lowercased Title, BulletPoints and Description of a product, computed
+    at catalog load for catalog products and on the fly for any other one
+    """
+    texts = product.get(PRODUCT_TEXTS_KEY)
+    if texts is None:
+        texts = lower_product_texts(product)
+    return texts
+
 def get_goals(all_products, product_prices, human_goals=True):
     if human_goals:
         return get_human_goals(all_products, product_prices)
@@ -151,11 +249,8 @@ def get_type_reward(purchased_product, goal):
     purchased_type = purchased_product['name']
     desired_type = goal['name']
 
-    purchased_type_parse = nlp(purchased_type)
-    desired_type_parse = nlp(desired_type)
-
-    purchased_type_parse = [t.text.lower() for t in purchased_type_parse if t.pos_ in ('PNOUN', 'NOUN', 'PROPN')]
-    desired_type_parse = [t.text.lower() for t in desired_type_parse if t.pos_ in ('PNOUN', 'NOUN', 'PROPN')]
+    purchased_type_parse = get_name_nouns(purchased_type)
+    desired_type_parse = get_name_nouns(desired_type)
 
     n_intersect_type = len(
         set(purchased_type_parse) & set(desired_type_parse)
@@ -196,19 +291,14 @@ def get_attribute_reward(purchased_product, goal):
         matched = False
         # Check whether goal attribute found in purchased product attribute list
         for p_attr in purchased_attrs:
-            score = fuzz.token_set_ratio(p_attr, g_attr)
-            if score > 85:
+            if fuzzy_match(p_attr, g_attr):
                 num_attr_matches += 1
                 matched = True
                 break
         # If not in purchased attrs, check Title, Bullet Points (Features), Desc
         if (
             not matched and
-            (
-                g_attr in purchased_product['Title'].lower() or
-                g_attr in ' '.join(purchased_product['BulletPoints']).lower() or
-                g_attr in purchased_product['Description'].lower()
-            )
+            any(g_attr in text for text in get_product_texts(purchased_product))
         ):
             num_attr_matches += 1
             matched = True
@@ -226,8 +316,7 @@ def get_option_reward(purchased_options, goal_options):
     num_option_matches = 0
     for g_option in goal_options:
         for p_option in purchased_options:
-            score = fuzz.token_set_ratio(p_option, g_option)
-            if score > 85:
+            if fuzzy_match(p_option, g_option):
                 num_option_matches += 1
                 break
     
@@ -0,0 +1,144 @@
+"""
+Preprocessed product catalog.
+
+`load_products` parses the full items and attributes JSON files and cleans
+every product, which takes minutes on the full dataset. Running this module
+once writes the result, with the product prices, the goals and the attribute
+index, to a pickle file per catalog configuration; `Catalog` then loads that
+file instead. Its header holds the size, mtime and SHA-256 of each source
+file, and a file whose sources changed is ignored until it is rebuilt:
+
+    python -m web_agent_site.engine.preprocess --num_products 1000
+"""
+import argparse
+import gc
+import hashlib
+import os
+import pickle
+from collections import defaultdict
+
+from web_agent_site.engine.engine import load_products
+from web_agent_site.engine.goal import get_goals
+from web_agent_site.utils import (
+    DEFAULT_ATTR_PATH,
+    DEFAULT_FILE_PATH,
+    HUMAN_ATTR_PATH,
+    PREPROCESSED_DIR,
+)
+
+# Bump when `load_products` or `get_goals` change what they produce
+CATALOG_VERSION = 1
+
+
+def preprocessed_path(file_path, num_products=None, human_goals=0):
+    """Path of the preprocessed catalog for these `load_products` arguments"""
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    size = 'all' if num_products is None else num_products
+    goals = 'human' if human_goals else 'synthetic'
+    return os.path.join(PREPROCESSED_DIR, f'{name}_{size}_{goals}.pkl')
+
+
+def source_files(file_path):
+    """Files `load_products` reads"""
+    return [file_path, DEFAULT_ATTR_PATH, HUMAN_ATTR_PATH]
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=file_sha256(path))
+
+
+def is_unchanged(path, signature):
+    """
+    Whether the file still matches its signature. Only files whose size
+    or mtime differ are hashed again, so an up to date catalog loads
+    without reading its sources.
+    """
+    if not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != signature['size']:
+        return False
+    if stat.st_mtime_ns == signature['mtime_ns']:
+        return True
+    return file_sha256(path) == signature['sha256']
+
+
+def preprocess_catalog(file_path=DEFAULT_FILE_PATH, num_products=None, human_goals=0):
+    """Loads the products and goals from the source files and writes the preprocessed catalog"""
+    sources = {path: file_signature(path) for path in source_files(file_path)}
+    all_products, _, product_prices, attribute_to_asins = \
+        load_products(filepath=file_path, num_products=num_products, human_goals=human_goals)
+    goals = get_goals(all_products, product_prices, human_goals)
+    header = dict(version=CATALOG_VERSION, sources=sources)
+    catalog = dict(
+        all_products=all_products,
+        product_prices=product_prices,
+        attribute_to_asins=dict(attribute_to_asins),
+        goals=goals,
+    )
+    path = preprocessed_path(file_path, num_products, human_goals)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(catalog, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    print(f'Wrote {len(all_products)} products and {len(goals)} goals to {path}.')
+    return path
+
+
+def load_preprocessed_catalog(file_path, num_products=None, human_goals=0):
+    """
+    Returns (all_products, product_item_dict, product_prices,
+    attribute_to_asins, goals) like `load_products` and `get_goals`, or None
+    if there is no preprocessed catalog for these arguments or it is stale.
+    """
+    path = preprocessed_path(file_path, num_products, human_goals)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        header = pickle.load(f)
+        if header.get('version') != CATALOG_VERSION or not all(
+            is_unchanged(source, signature)
+            for source, signature in header['sources'].items()
+        ):
+            print(f'{path} is out of date, loading the source files. Rerun '
+                  'python -m web_agent_site.engine.preprocess to rebuild it.')
+            return None
+        # The collector would traverse the millions of new objects repeatedly
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            catalog = pickle.load(f)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    all_products = catalog['all_products']
+    product_item_dict = {p['asin']: p for p in all_products}
+    attribute_to_asins = defaultdict(set, catalog['attribute_to_asins'])
+    print(f'Loaded {len(all_products)} products from {path}.')
+    return (
+        all_products,
+        product_item_dict,
+        catalog['product_prices'],
+        attribute_to_asins,
+        catalog['goals'],
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Preprocess the WebShop product catalog")
+    parser.add_argument("--file_path", default=DEFAULT_FILE_PATH, help="Items file")
+    parser.add_argument("--num_products", type=int, default=None, help="Number of products to keep")
+    parser.add_argument("--human_goals", action='store_true', help="Build human instead of synthetic goals")
+    args = parser.parse_args()
+    preprocess_catalog(args.file_path, args.num_products, args.human_goals)
@@ -0,0 +1,196 @@
+"""
+Page model of a WebShop HTML page, parsed once per transition.
+
+`WebAgentTextEnv` needs the clickables, the search bar flag, the text
+observation and the instruction of the current page. `PageModel` parses the
+page once and extracts all of them from a flat list of its text nodes. When
+lxml is installed it is used as parser, with the text nodes normalized like
+BeautifulSoup's `html.parser` tree (whitespace-only strings become a single
+newline or space) so that observations are byte-identical either way.
+"""
+import re
+
+from bs4 import BeautifulSoup
+from bs4.element import Comment
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+HARMLESS_LXML_ERRORS = re.compile(r'Tag \S+ invalid|ID \S* already defined')
+IGNORED_PARENTS = {'style', 'script', 'head', 'title', 'meta', '[document]'}
+ASCII_SPACES = ' \n\t\x0c\r'
+
+
+def normalize_string(text):
+    """BeautifulSoup's handling of a string made of ASCII whitespace only"""
+    if text.strip(ASCII_SPACES):
+        return text
+    return '\n' if '\n' in text else ' '
+
+
+class PageModel:
+    """Text nodes and clickables of one page"""
+    def __init__(self, html=None, parser=None):
+        """
+        Arguments:
+        html (`str`) -- Page HTML, None for an empty model to be filled in
+            directly (see `text_render`)
+        parser (`str`) -- 'lxml' or 'html.parser', by default lxml if installed.
+            Pages lxml would not read like html.parser are parsed with the latter
+        """
+        self.html = html
+        if parser is None:
+            parser = 'html.parser' if lxml is None else 'lxml'
+        # Every text node as (text, parent tag name, parent class list, visible)
+        self.texts = []
+        # Clickable elements as (text, attributes) in document order
+        self.buttons = []
+        self.product_links = []
+        self.radios = []
+        self.has_search_bar = False
+        self.instruction_text = None
+        if html is None:
+            self.parser = 'text'
+            return
+        if parser != 'lxml' or not self._parse_lxml(html):
+            parser = 'html.parser'
+            self._parse_bs4(html)
+        self.parser = parser
+
+    def _parse_bs4(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        for t in soup.find_all(string=True):
+            visible = t.parent.name not in IGNORED_PARENTS and not isinstance(t, Comment)
+            self.texts.append((str(t), t.parent.name, t.parent.get('class'), visible))
+        self.buttons = [(b.get_text(), b.attrs) for b in soup.find_all(class_='btn')]
+        self.product_links = [(a.get_text(), a.attrs) for a in soup.find_all(class_='product-link')]
+        self.radios = [(None, opt.attrs) for opt in soup.select('input[type="radio"]')]
+        self.has_search_bar = soup.find(id='search_input') is not None
+        instruction = soup.find(id='instruction-text')
+        if instruction is not None and instruction.h4 is not None:
+            self.instruction_text = instruction.h4.text
+
+    def _parse_lxml(self, html):
+        """Returns False, having extracted nothing, if lxml may not build the same tree"""
+        # html.parser keeps carriage returns, processing instructions and
+        # CDATA sections as text, libxml2 does not
+        if any(s in html for s in ('\r', '<?', '<![')):
+            return False
+        lxml_parser = lxml.html.HTMLParser()
+        root = lxml.html.document_fromstring(html, parser=lxml_parser)
+        # libxml2 drops stray end tags without splitting the text around them
+        # (results_page.html closes <h4> with </h5>) and repairs nesting
+        # differently from html.parser; only unknown tags and duplicate ids
+        # leave the tree as html.parser builds it.
+        for error in lxml_parser.error_log:
+            if not HARMLESS_LXML_ERRORS.match(error.message):
+                return False
+        # (element, its texts) of the open clickables, to rebuild `get_text`
+        open_elements = []
+        buttons, product_links = [], []
+        instruction = None
+
+        def add_text(text, parent, is_comment=False):
+            text = normalize_string(text)
+            classes = parent.get('class')
+            classes = classes.split() if classes is not None else None
+            visible = parent.tag not in IGNORED_PARENTS and not is_comment
+            self.texts.append((text, parent.tag, classes, visible))
+            if not is_comment:
+                for _, element_texts in open_elements:
+                    element_texts.append(text)
+
+        for event, el in etree.iterwalk(root, events=('start', 'end', 'comment')):
+            if event == 'comment':
+                if el.text:
+                    add_text(el.text, el.getparent(), is_comment=True)
+                if el.tail:
+                    add_text(el.tail, el.getparent())
+                continue
+            if event == 'start':
+                classes = (el.get('class') or '').split()
+                tracked = []
+                if 'btn' in classes:
+                    tracked.append(buttons)
+                if 'product-link' in classes:
+                    tracked.append(product_links)
+                if el.get('id') == 'instruction-text' and instruction is None:
+                    instruction = el
+                if tracked:
+                    texts = []
+                    for target in tracked:
+                        target.append((texts, el))
+                    open_elements.append((el, texts))
+                if el.tag == 'input' and (el.get('type') or '').lower() == 'radio':
+                    self.radios.append((None, element_attrs(el)))
+                if el.get('id') == 'search_input':
+                    self.has_search_bar = True
+                if el.text:
+                    add_text(el.text, el)
+            else:
+                if open_elements and open_elements[-1][0] is el:
+                    open_elements.pop()
+                if el.tail and el.getparent() is not None:
+                    add_text(el.tail, el.getparent())
+
+        self.buttons = [(''.join(texts), element_attrs(el)) for texts, el in buttons]
+        self.product_links = [(''.join(texts), element_attrs(el)) for texts, el in product_links]
+        if instruction is not None:
+            h4 = next(instruction.iter('h4'), None)
+            if h4 is not None:
+                self.instruction_text = ''.join(
+                    normalize_string(text) for text in h4.itertext(with_tail=True)
+                )
+        return True
+
+    @property
+    def visible_texts(self):
+        return [t for t in self.texts if t[3]]
+
+    @property
+    def text_to_clickable(self):
+        """Clickable name to the attributes of its element, as `WebAgentTextEnv` expects"""
+        text_to_clickable = {
+            f'{text}'.lower(): attrs for text, attrs in self.buttons + self.product_links
+        }
+        for _, attrs in self.radios:
+            text_to_clickable[f'{attrs.get("value")}'] = attrs
+        return text_to_clickable
+
+    def simple_text(self):
+        """Visible texts joined with [SEP]"""
+        return ' [SEP] '.join(t.strip() for t, *_ in self.visible_texts if t != '\n')
+
+    def rich_text(self, url, clicked_asins):
+        """Visible texts with buttons, options and product links marked up"""
+        observation = ''
+        for t, parent_name, parent_class, _ in self.visible_texts:
+            if t == '\n': continue
+            if parent_name == 'button':  # button
+                processed_t = f'[button] {t} [button_]'
+            elif parent_name == 'label':  # options
+                if f'"{t}"' in url:
+                    processed_t = f'  [clicked button] {t} [clicked button_]'
+                    observation = f'You have clicked {t}.\n' + observation
+                else:
+                    processed_t = f'  [button] {t} [button_]'
+            elif parent_class == ["product-link"]: # product asins
+                if f'{t}' in clicked_asins:
+                    processed_t = f'\n[clicked button] {t} [clicked button_]'
+                else:
+                    processed_t = f'\n[button] {t} [button_]'
+            else: # regular, unclickable text
+                processed_t = str(t)
+            observation += processed_t + '\n'
+        return observation
+
+
+def element_attrs(el):
+    """lxml attributes with `class` split into a list, like BeautifulSoup"""
+    attrs = dict(el.attrib)
+    if 'class' in attrs:
+        attrs['class'] = attrs['class'].split()
+    return attrs
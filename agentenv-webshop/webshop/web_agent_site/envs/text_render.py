@@ -0,0 +1,177 @@
+"""
+Text render backend of the simulated WebShop server.
+
+`map_action_to_page` takes the arguments of `map_action_to_html` and builds
+the `PageModel` that parsing the rendered template would give: the visible
+text nodes with their parent tag, the clickables, the search bar flag and
+the instruction, straight from the product and session data. Text mode
+observations never look at the HTML, so this skips both rendering and
+parsing. Each builder below follows its template in `TEMPLATE_DIR` node by
+node and must be kept in sync with it; the done page, shown once per
+episode, still goes through the HTML.
+"""
+from web_agent_site.engine.engine import (
+    ACTION_TO_TEMPLATE,
+    END_BUTTON,
+    map_action_to_html,
+    parse_action,
+)
+from web_agent_site.envs.page import PageModel, normalize_string
+
+BACK_TO_SEARCH_CLASS = ['btn', 'btn-success']
+PRIMARY_CLASS = ['btn', 'btn-primary']
+PURCHASE_CLASS = ['btn', 'btn-lg', 'purchase']
+PRODUCT_LINK_CLASS = ['product-link']
+
+
+def field(obj, name):
+    """`{{ obj.name }}` as Jinja prints it, empty if undefined"""
+    value = obj.get(name, '') if isinstance(obj, dict) else getattr(obj, name, '')
+    return str(value)
+
+
+class PageBuilder:
+    """Appends text nodes and clickables to a `PageModel` in document order"""
+    def __init__(self):
+        self.page = PageModel()
+
+    def text(self, text, parent, classes=None):
+        # Empty strings make no text node, whitespace-only ones collapse
+        if text:
+            self.page.texts.append((normalize_string(text), parent, classes, True))
+
+    def button(self, text, classes):
+        self.text(text, 'button', classes)
+        self.page.buttons.append((text, {'type': 'submit', 'class': classes}))
+
+    def instruction_header(self, instruction_text, label='Instruction:'):
+        self.text(label, 'h4')
+        self.text(instruction_text, 'h4')
+        self.page.instruction_text = ''.join(
+            normalize_string(t) for t in (label, instruction_text) if t
+        )
+
+
+def start_page(instruction_text):
+    """search_page.html"""
+    b = PageBuilder()
+    b.text('WebShop', 'h2')
+    b.instruction_header(instruction_text, label='Instruction: ')
+    b.page.has_search_bar = True
+    b.button('Search', ['btn', 'btn-success'])
+    return b.page
+
+
+def results_page(products, page, total, instruction_text):
+    """results_page.html"""
+    b = PageBuilder()
+    b.instruction_header(instruction_text)
+    b.button('Back to Search', BACK_TO_SEARCH_CLASS)
+    b.text(f'Page {page} (Total results: {total})', 'h3')
+    if page > 1:
+        b.button('< Prev', PRIMARY_CLASS)
+    b.button('Next >', PRIMARY_CLASS)
+    for item in products:
+        asin = field(item, 'asin')
+        b.text(asin, 'a', PRODUCT_LINK_CLASS)
+        b.page.product_links.append((asin, {'class': PRODUCT_LINK_CLASS}))
+        b.text(field(item, 'Title'), 'h4', ['mt-0', 'font-weight-bold', 'mb-2', 'product-title'])
+        b.text(field(item, 'Price'), 'h5', ['font-weight-bold', 'my-2', 'product-price'])
+    return b.page
+
+
+def sub_page_header(instruction_text):
+    b = PageBuilder()
+    b.instruction_header(instruction_text)
+    b.button('Back to Search', BACK_TO_SEARCH_CLASS)
+    b.button('< Prev', PRIMARY_CLASS)
+    return b
+
+
+def item_page(product_info, instruction_text, show_attrs):
+    """item_page.html"""
+    b = sub_page_header(instruction_text)
+    for option_name, option_contents in product_info['options'].items():
+        b.text(str(option_name), 'h4')
+        for i, option_content in enumerate(option_contents):
+            b.text(str(option_content), 'label')
+            b.page.radios.append((None, {
+                'type': 'radio',
+                'id': f'radio_{option_name}{i}',
+                'name': str(option_name),
+                'value': str(option_content),
+            }))
+    b.text(field(product_info, 'Title'), 'h2')
+    b.text(f"Price: {field(product_info, 'Price')}", 'h4')
+    b.text(f"Rating: {field(product_info, 'Rating')}", 'h4')
+    for name in ('Description', 'Features', 'Reviews'):
+        b.button(name, PRIMARY_CLASS)
+    if show_attrs:
+        b.button('Attributes', PRIMARY_CLASS)
+    b.button(END_BUTTON, PURCHASE_CLASS)
+    return b.page
+
+
+def description_page(product_info, instruction_text):
+    """description_page.html"""
+    b = sub_page_header(instruction_text)
+    b.text(field(product_info, 'Description'), 'p', ['product-info'])
+    return b.page
+
+
+def features_page(product_info, instruction_text):
+    """features_page.html"""
+    b = sub_page_header(instruction_text)
+    for bulletpoint in product_info['BulletPoints']:
+        b.text(f' {bulletpoint}', 'p', ['product-info'])
+    return b.page
+
+
+def review_page(product_info, instruction_text):
+    """review_page.html"""
+    b = sub_page_header(instruction_text)
+    for review in product_info['Reviews']:
+        b.text(f'"{field(review, "title")}"', 'h4', ['blue-text', 'mt-3'])
+        b.text(field(review, 'score'), 'span')
+        b.text(field(review, 'body'), 'p', ['content'])
+    return b.page
+
+
+def attributes_page(product_info, instruction_text):
+    """attributes_page.html"""
+    b = sub_page_header(instruction_text)
+    for attribute in product_info['Attributes']:
+        b.text(f' {attribute}', 'p', ['attribute'])
+    for name in ('category', 'query', 'product_category'):
+        b.text(field(product_info, name), 'h5', ['font-weight-bold', 'my-2', f'product-{name}'])
+    return b.page
+
+
+SUB_PAGES = {
+    'Description': description_page,
+    'Features': features_page,
+    'Reviews': review_page,
+    'Attributes': attributes_page,
+}
+assert set(SUB_PAGES) == set(ACTION_TO_TEMPLATE)
+
+
+def map_action_to_page(action, **kwargs):
+    """`map_action_to_html`, returning the `PageModel` of the page instead of its HTML"""
+    action_name, action_arg = parse_action(action)
+    if action_name == 'start':
+        return start_page(kwargs['instruction_text'])
+    elif action_name == 'search':
+        return results_page(
+            kwargs['products'], kwargs['page'], kwargs['total'], kwargs['instruction_text']
+        )
+    elif action_name == 'click' and action_arg == END_BUTTON:
+        return PageModel(map_action_to_html(action, **kwargs))
+    elif action_name == 'click' and action_arg in SUB_PAGES:
+        return SUB_PAGES[action_arg](kwargs['product_info'], kwargs.get('instruction_text'))
+    elif action_name == 'click':
+        return item_page(
+            kwargs['product_info'], kwargs.get('instruction_text'), kwargs['show_attrs']
+        )
+    else:
+        raise ValueError('Action name not recognized.')
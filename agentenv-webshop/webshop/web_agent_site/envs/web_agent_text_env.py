@@ -6,12 +6,10 @@ import time
 import torch
 
 from bs4 import BeautifulSoup
-from bs4.element import Comment
 from collections import defaultdict
 from flask import Flask
+from web_agent_site.engine.catalog import get_catalog
 from web_agent_site.engine.engine import (
-    load_products,
-    init_search_engine,
     get_top_n_product_from_keywords,
     map_action_to_html,
     parse_action,
@@ -19,7 +17,9 @@ from web_agent_site.engine.engine import (
     ACTION_TO_TEMPLATE,
     END_BUTTON, NEXT_PAGE, PREV_PAGE, BACK_TO_SEARCH,
 )
-from web_agent_site.engine.goal import get_reward, get_goals
+from web_agent_site.engine.goal import get_reward
+from web_agent_site.envs.page import PageModel
+from web_agent_site.envs.text_render import map_action_to_page
 from web_agent_site.utils import (
     DEFAULT_FILE_PATH,
     FEAT_CONV,
@@ -50,13 +50,25 @@ class WebAgentTextEnv(gym.Env):
         session
         session_prefix
         show_attrs
+        render_backend (`str`) -- ['html' | 'text'] (default 'html'), see `SimServer`
+        seed -- Seed of the env's own RNG for session names and goals, by default
+            the global `random` is used
         """
         super(WebAgentTextEnv, self).__init__()
         self.observation_mode = observation_mode
         self.kwargs = kwargs
+        if self.kwargs.get('render_backend', 'html') == 'text' and (
+            observation_mode == 'html' or self.kwargs.get('get_image', 0)
+        ):
+            raise ValueError(
+                'The text render backend produces no HTML, use it with a text observation mode.'
+            )
 
         self.file_path = file_path
 
+        seed = self.kwargs.get('seed')
+        self.rng = random.Random(seed) if seed is not None else random
+
         self.base_url = 'http://127.0.0.1:3000'
         self.server = SimServer(
             self.base_url,
@@ -66,6 +78,8 @@ class WebAgentTextEnv(gym.Env):
             self.kwargs.get('num_products'),
             self.kwargs.get('human_goals'),
             self.kwargs.get('show_attrs', False),
+            render_backend=self.kwargs.get('render_backend', 'html'),
+            rng=self.rng,
         ) if server is None else server
         self.browser = SimBrowser(self.server)
 
@@ -75,6 +89,7 @@ class WebAgentTextEnv(gym.Env):
             self.feats = torch.load(FEAT_CONV)
             self.ids = torch.load(FEAT_IDS)
             self.ids = {url: idx for idx, url in enumerate(self.ids)}
+        self._page = None
         self.prev_obs = []
         self.prev_actions = []
         self.num_prev_obs = self.kwargs.get('num_prev_obs', 0)
@@ -124,24 +139,12 @@ class WebAgentTextEnv(gym.Env):
 
     def get_available_actions(self):
         """Returns list of available actions at the current step"""
-        html_obj = self._parse_html()
+        page = self._page_model()
 
         # Collect search bar, buttons, links, and options as clickables
-        search_bar = html_obj.find(id='search_input')
-        has_search_bar = True if search_bar is not None else False
-        buttons = html_obj.find_all(class_='btn')
-        product_links  = html_obj.find_all(class_='product-link')
-        buying_options = html_obj.select('input[type="radio"]')
-
-        self.text_to_clickable = {
-            f'{b.get_text()}'.lower(): b
-            for b in buttons + product_links
-        }
-        for opt in buying_options:
-            opt_value = opt.get('value')
-            self.text_to_clickable[f'{opt_value}'] = opt
+        self.text_to_clickable = page.text_to_clickable
         return dict(
-            has_search_bar=has_search_bar,
+            has_search_bar=page.has_search_bar,
             clickables=list(self.text_to_clickable.keys()),
         )
     
@@ -159,9 +162,7 @@ class WebAgentTextEnv(gym.Env):
 
     def get_instruction_text(self):
         """Get corresponding instruction text for current environment session"""
-        html_obj = self._parse_html(self.browser.page_source)
-        instruction_text = html_obj.find(id='instruction-text').h4.text
-        return instruction_text
+        return self._page_model(self.browser.page_source).instruction_text
 
     def _parse_html(self, html=None):
         """
@@ -175,6 +176,20 @@ class WebAgentTextEnv(gym.Env):
             html = self.state['html']
         html_obj = BeautifulSoup(html, 'html.parser')
         return html_obj
+
+    def _page_model(self, html=None):
+        """
+        Returns the `PageModel` of the given HTML, by default the current
+        page. The model is kept until the page changes, so each transition
+        is parsed once. Pages of the text render backend are models already.
+        """
+        if html is None:
+            html = self.browser.page_source
+        if isinstance(html, PageModel):
+            self._page = html
+        elif self._page is None or self._page.html != html:
+            self._page = PageModel(html)
+        return self._page
     
     @property
     def observation(self):
@@ -199,41 +214,27 @@ class WebAgentTextEnv(gym.Env):
         State that includes all information. The actual observation are
         likely to be a subset or reduced form of the state.
         """
+        page_source = self.browser.page_source
+        if isinstance(page_source, PageModel):
+            page_source = page_source.html
         return dict(
             url=self.browser.current_url,
-            html=self.browser.page_source,
+            html=page_source,
             instruction_text=self.instruction_text,
         )
     
     def convert_html_to_text(self, html, simple=False):
         """Strip HTML of tags and add separators to convert observation into simple mode"""
-        texts = self._parse_html(html).findAll(text=True)
-        visible_texts = filter(tag_visible, texts)
+        page = self._page_model(html)
         if simple:
             # For `simple` mode, return just [SEP] separators
-            return ' [SEP] '.join(t.strip() for t in visible_texts if t != '\n')
+            return page.simple_text()
         else:
             # Otherwise, return an observation with tags mapped to specific, unique separators
-            observation = ''
-            for t in visible_texts:
-                if t == '\n': continue
-                if t.parent.name == 'button':  # button
-                    processed_t = f'[button] {t} [button_]'
-                elif t.parent.name == 'label':  # options
-                    if f'"{t}"' in self.state['url']:
-                        processed_t = f'  [clicked button] {t} [clicked button_]'
-                        observation = f'You have clicked {t}.\n' + observation
-                    else:
-                        processed_t = f'  [button] {t} [button_]'
-                elif t.parent.get('class') == ["product-link"]: # product asins
-                    if f'{t}' in self.server.user_sessions[self.session]['asins']:
-                        processed_t = f'\n[clicked button] {t} [clicked button_]'
-                    else:
-                        processed_t = f'\n[button] {t} [button_]'
-                else: # regular, unclickable text
-                    processed_t =  str(t)
-                observation += processed_t + '\n'
-            return observation
+            return page.rich_text(
+                self.browser.current_url,
+                self.server.user_sessions[self.session]['asins'],
+            )
     
     def reset(self, session=None, instruction_text=None):
         """Create a new session and reset environment variables"""
@@ -243,7 +244,7 @@ class WebAgentTextEnv(gym.Env):
             if isinstance(session, int):
                 session_int = session
         else:
-            self.session = ''.join(random.choices(string.ascii_lowercase, k=10))
+            self.session = ''.join(self.rng.choices(string.ascii_lowercase, k=10))
         if self.session_prefix is not None:
             self.session = self.session_prefix + self.session
 
@@ -264,13 +265,6 @@ class WebAgentTextEnv(gym.Env):
         pass
     
 
-def tag_visible(element):
-    ignore = {'style', 'script', 'head', 'title', 'meta', '[document]'}
-    return (
-        element.parent.name not in ignore and not isinstance(element, Comment)
-    )
-
-
 class SimServer:
     """Lightweight simulator of WebShop Flask application for generating HTML observations"""
     def __init__(
@@ -282,6 +276,9 @@ class SimServer:
         num_products=None,
         human_goals=0,
         show_attrs=False,
+        catalog=None,
+        render_backend='html',
+        rng=None,
     ):
         """
         Constructor for simulated server serving WebShop application
@@ -291,48 +288,36 @@ class SimServer:
         limit_goals (`int`) -- Limit to number of goals available
         num_products (`int`) -- Number of products to search across
         human_goals (`bool`) -- If true, load human goals; otherwise, load synthetic goals
+        catalog (`Catalog`) -- Catalog to serve, by default the process-wide one for these arguments
+        render_backend (`str`) -- 'html' renders pages from the templates, 'text' builds
+            their `PageModel` directly from the product and session data, for text
+            observation modes only
+        rng (`random.Random`) -- RNG of the goal draws, by default the global `random`
         """
-        # Load all products, goals, and search engine
+        # Products, goals and search engine are shared by all servers of the process
         self.base_url = base_url
-        self.all_products, self.product_item_dict, self.product_prices, _ = \
-            load_products(filepath=file_path, num_products=num_products, human_goals=human_goals)
-        self.search_engine = init_search_engine(num_products=num_products)
-        self.goals = get_goals(self.all_products, self.product_prices, human_goals)
+        self.catalog = get_catalog(
+            file_path, filter_goals, limit_goals, num_products, human_goals
+        ) if catalog is None else catalog
+        self.all_products = self.catalog.all_products
+        self.product_item_dict = self.catalog.product_item_dict
+        self.product_prices = self.catalog.product_prices
+        self.attribute_to_asins = self.catalog.attribute_to_asins
+        self.product_index = self.catalog.product_index
+        self.search_engine = self.catalog.search_engine
+        self.goals = self.catalog.goals
+        self.weights = self.catalog.weights
+        self.cum_weights = self.catalog.cum_weights
         self.show_attrs = show_attrs
-        print(f'Loaded {len(self.goals)} goals.')
-
-
-        # HBY: Fix outcome for random shuffling of goals
-        random.seed(233)
-        random.shuffle(self.goals)
+        self.rng = random if rng is None else rng
+        if render_backend == 'html':
+            self.render_page = map_action_to_html
+        elif render_backend == 'text':
+            self.render_page = map_action_to_page
+        else:
+            raise ValueError(f'Render backend {render_backend} not supported.')
 
-        # Apply `filter_goals` parameter if exists to select speific goal(s)
-        if filter_goals is not None:
-            self.goals = [
-                goal for (i, goal) in enumerate(self.goals)
-                if filter_goals(i, goal)
-            ]
-        
-        # Imposes `limit` on goals via random selection
-        if limit_goals != -1 and limit_goals < len(self.goals):
-            print("has limit")
-            self.weights = [goal['weight'] for goal in self.goals]
-            self.cum_weights = [0]
-            for w in self.weights:
-                self.cum_weights.append(self.cum_weights[-1] + w)
-            idxs = []
-            while len(idxs) < limit_goals:
-                idx = random_idx(self.cum_weights)
-                if idx not in idxs:
-                    idxs.append(idx)
-            self.goals = [self.goals[i] for i in idxs]
-        print(f'Loaded {len(self.goals)} goals.')
-
-        # Set extraneous housekeeping variables
-        self.weights = [goal['weight'] for goal in self.goals]
-        self.cum_weights = [0]
-        for w in self.weights:
-            self.cum_weights.append(self.cum_weights[-1] + w)
+        # Per-server state
         self.user_sessions = dict()
         self.search_time = 0
         self.render_time = 0
@@ -342,7 +327,7 @@ class SimServer:
     @app.route('/', methods=['GET', 'POST'])
     def index(self, session_id, **kwargs):
         """Redirect to the search page with the given session ID"""
-        html = map_action_to_html(
+        html = self.render_page(
             'start',
             session_id=session_id,
             instruction_text=kwargs['instruction_text'],
@@ -370,6 +355,8 @@ class SimServer:
             self.search_engine,
             self.all_products,
             self.product_item_dict,
+            self.attribute_to_asins,
+            self.product_index,
         )
         self.search_time += time.time() - old_time
         
@@ -384,7 +371,7 @@ class SimServer:
 
         # Render HTML search page and record amount of time taken
         old_time = time.time()
-        html = map_action_to_html(
+        html = self.render_page(
             'search',
             session_id=session_id,
             products=products,
@@ -426,7 +413,8 @@ class SimServer:
             f'{session["page"]}/{option_string}'
         )
 
-        html = map_action_to_html(
+        old_time = time.time()
+        html = self.render_page(
             'click',
             session_id=session_id,
             product_info=product_info,
@@ -437,6 +425,7 @@ class SimServer:
             instruction_text=session["goal"]["instruction_text"],
             show_attrs=self.show_attrs,
         )
+        self.render_time += time.time() - old_time
         return html, url
 
     @app.route('/', methods=['GET', 'POST'])
@@ -458,7 +447,8 @@ class SimServer:
             f'{session["asin"]}/{keywords_url_string}/{session["page"]}/'
             f'{clickable_name}/{session["options"]}'
         )
-        html = map_action_to_html(
+        old_time = time.time()
+        html = self.render_page(
             f'click[{clickable_name}]',
             session_id=session_id,
             product_info=product_info,
@@ -468,6 +458,7 @@ class SimServer:
             options=session["options"],
             instruction_text=session["goal"]["instruction_text"],
         )
+        self.render_time += time.time() - old_time
         return html, url
 
     @app.route('/', methods=['GET', 'POST'])
@@ -496,7 +487,7 @@ class SimServer:
             f'{self.base_url}/done/{session_id}/'
             f'{session["asin"]}/{session["options"]}'
         )
-        html = map_action_to_html(
+        html = self.render_page(
             f'click[{END_BUTTON}]',
             session_id=session_id,
             reward=reward,
@@ -513,7 +504,7 @@ class SimServer:
         with app.app_context(), app.test_request_context():
             # Create/determine goal, instruction_text from current session
             if session_id not in self.user_sessions:
-                idx = session_int if (session_int is not None and isinstance(session_int, int)) else random_idx(self.cum_weights) 
+                idx = session_int if (session_int is not None and isinstance(session_int, int)) else random_idx(self.cum_weights, self.rng) 
                 print(f"---------------1----------------")
                 goal = self.goals[idx]
                 instruction_text = goal['instruction_text']
@@ -525,7 +516,11 @@ class SimServer:
             if self.assigned_instruction_text is not None:
                 print(f"---------------3----------------")
                 instruction_text = self.assigned_instruction_text  # TODO: very hacky, should remove
-                self.user_sessions[session_id]['goal']['instruction_text'] = instruction_text
+                # goals belong to the shared catalog, override on a copy
+                self.user_sessions[session_id]['goal'] = dict(
+                    self.user_sessions[session_id]['goal'],
+                    instruction_text=instruction_text,
+                )
             session = self.user_sessions[session_id]
 
             if not kwargs:
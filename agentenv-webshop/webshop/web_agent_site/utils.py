@@ -18,13 +18,18 @@ FEAT_IDS = join(BASE_DIR, '../data/feat_ids.pt')
 
 HUMAN_ATTR_PATH = join(BASE_DIR, '../data/items_human_ins.json')
 HUMAN_ATTR_PATH = join(BASE_DIR, '../data/items_human_ins.json')
+# Nouns of product and goal names, written by `goal.load_name_nouns`
+NAME_NOUNS_PATH = join(BASE_DIR, '../data/name_nouns.json')
+# Catalogs written by `python -m web_agent_site.engine.preprocess`
+PREPROCESSED_DIR = join(BASE_DIR, '../data/preprocessed')
 
-def random_idx(cum_weights):
+def random_idx(cum_weights, rng=random):
     """Generate random index by sampling uniformly from sum of all weights, then
     selecting the `min` between the position to keep the list sorted (via bisect)
-    and the value of the second to last index
+    and the value of the second to last index. `rng` is a `random.Random`, by
+    default the global one
     """
-    pos = random.uniform(0, cum_weights[-1])
+    pos = rng.uniform(0, cum_weights[-1])
     idx = bisect.bisect(cum_weights, pos)
     idx = min(idx, len(cum_weights) - 2)
     return idx
@@ -8,7 +8,13 @@ from .agent import (
     Llama3Template,
 )
 from .env import BaseEnvClient, StepOutput
-from .task import BaseTask
+from .eval_journal import EvalJournal, summarize_entries
+from .parsing import CodeActionEvaluator, parse_batch, parse_function_call_json
+from .budget import ContextBudget, TruncationStrategy
+from .task import BaseTask, EpisodeState
+from .scheduler import RolloutScheduler
+from .tracing import enable_tracing, to_chrome_trace, trace_headers, trace_span
+from .trajectory_trie import TrajectoryTrie, tree_attention_mask
 from .types import ActionFormat, ActionWithTought, ConversationMessage
 from .utils import (
     BaseAdapter,
@@ -14,7 +14,7 @@ from transformers.generation.utils import GenerateOutput
 from .types import ConversationMessage, APIConversationMessage, InferenceEngine, TokenizedConversationOutput
 
 import time
-from typing import Tuple
+from typing import Sequence, Tuple
 from openai import OpenAI
 
 try:
@@ -76,10 +76,19 @@ class Agent:
     @torch.no_grad()
     def generate(
         self,
-        input_ids: list[int],
-        generation_config: GenerationConfig,
+        input_ids: list[list[int]],
+        generation_config: GenerationConfig | Sequence[GenerationConfig],
         refresh_engine: bool = False,
     ) -> torch.Tensor:
+        """
+        Generates a continuation for every prompt in *input_ids*. With the vLLM
+        engine *generation_config* may also be one config per prompt.
+        """
+        if isinstance(generation_config, GenerationConfig):
+            generation_configs = [generation_config] * len(input_ids)
+        else:
+            generation_configs = list(generation_config)
+            generation_config = generation_configs[0]
         if isinstance(self.model, DistributedDataParallel):
             model = self.model.module
         else:
@@ -141,36 +150,14 @@ class Agent:
                 self._vllm = llm
                 shutil.rmtree(shm_path)
 
-            INF = float("inf")
-            max_tokens = generation_config.max_new_tokens or INF
-            if generation_config.max_length:
-                max_length = generation_config.max_length - len(input_ids)
-            else:
-                max_length = INF
-            max_tokens = min(max_tokens, max_length)
-            if max_tokens == INF:
-                max_tokens = None
-
-            generation_config = {
-                "repetition_penalty": generation_config.repetition_penalty,
-                "temperature": generation_config.temperature,
-                "top_p": generation_config.top_p,
-                "top_k": generation_config.top_k,
-                "min_p": generation_config.min_p,
-                # "length_penalty": generation_config.length_penalty,
-                "early_stopping": generation_config.early_stopping,
-                "max_tokens": max_tokens,
-                "min_new_tokens": generation_config.min_new_tokens,
-                "stop_token_ids": [self.tokenizer.eos_token_id],
-            }
-            generation_config = {k: v for k, v in generation_config.items() if v}
+            sampling_params = [
+                self._vllm_sampling_params(config, len(ids))
+                for config, ids in zip(generation_configs, input_ids)
+            ]
             output = llm.generate(
                 # prompts=TokensPrompt(prompt_token_ids=input_ids),
                 prompt_token_ids=input_ids,
-                sampling_params=SamplingParams.from_optional(
-                    **generation_config,
-                    detokenize=False,
-                ),
+                sampling_params=sampling_params,
                 use_tqdm=False,
             )
 
@@ -180,6 +167,8 @@ class Agent:
                 generated_tokens.append(list(o.outputs[0].token_ids))
 
         else:
+            if any(config is not generation_config for config in generation_configs):
+                raise ValueError("Per-prompt generation configs need the vLLM engine")
             output = model.generate(
                 inputs=torch.tensor(input_ids, device=model.device),
                 generation_config=generation_config,
@@ -192,6 +181,39 @@ class Agent:
 
         return generated_tokens
 
+    def _vllm_sampling_params(
+        self, generation_config: GenerationConfig, prompt_length: int
+    ):
+        from vllm import SamplingParams
+
+        INF = float("inf")
+        max_tokens = generation_config.max_new_tokens or INF
+        if generation_config.max_length:
+            max_length = generation_config.max_length - prompt_length
+        else:
+            max_length = INF
+        max_tokens = min(max_tokens, max_length)
+        if max_tokens == INF:
+            max_tokens = None
+
+        generation_config = {
+            "repetition_penalty": generation_config.repetition_penalty,
+            "temperature": generation_config.temperature,
+            "top_p": generation_config.top_p,
+            "top_k": generation_config.top_k,
+            "min_p": generation_config.min_p,
+            # "length_penalty": generation_config.length_penalty,
+            "early_stopping": generation_config.early_stopping,
+            "max_tokens": max_tokens,
+            "min_new_tokens": generation_config.min_new_tokens,
+            "stop_token_ids": [self.tokenizer.eos_token_id],
+        }
+        generation_config = {k: v for k, v in generation_config.items() if v}
+        return SamplingParams.from_optional(
+            **generation_config,
+            detokenize=False,
+        )
+
 
 class APIAgent:
     def __init__(
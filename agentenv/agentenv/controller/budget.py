@@ -0,0 +1,135 @@
+"""
+Per-episode context budget for rollouts with a local ``Agent``.
+
+A ``ContextBudget`` knows how many tokens an episode may still use. Env
+observations that would not fit are cut down with a ``TruncationStrategy``
+before they enter the conversation, ``max_new_tokens`` is capped to what is
+left, and an episode stops as soon as fewer than ``min_new_tokens`` remain
+instead of paying for a prefill whose output cannot fit.
+"""
+
+import copy
+from enum import Enum
+from typing import Callable, Optional
+
+from transformers import GenerationConfig, PreTrainedTokenizerBase
+
+
+class TruncationStrategy(Enum):
+    HEAD = "head"  # keep the beginning of the observation
+    TAIL = "tail"  # keep the end
+    MIDDLE = "middle"  # keep beginning and end, drop the middle
+    SUMMARIZE = "summarize"  # call the summarizer, MIDDLE if it overshoots
+
+
+class ContextBudget:
+    def __init__(
+        self,
+        max_length: int = 4096,
+        max_observation_tokens: Optional[int] = None,
+        strategy: TruncationStrategy | str = TruncationStrategy.MIDDLE,
+        min_new_tokens: int = 1,
+        summarizer: Optional[Callable[[str, int], str]] = None,
+        marker: str = "\n...[truncated]...\n",
+    ) -> None:
+        """
+        Args:
+            max_length: Token limit of a whole episode (prompt and generations).
+            max_observation_tokens: Optional cap on the tokens of one env observation.
+            strategy: How oversized observations are shortened.
+            min_new_tokens: Stop the episode when fewer tokens than this are left
+                for the next generation. 1 reproduces the plain max_length check.
+            summarizer: ``(text, max_tokens) -> text`` for ``SUMMARIZE``.
+            marker: Text put where tokens were dropped.
+        """
+        self.max_length = max_length
+        self.max_observation_tokens = max_observation_tokens
+        self.strategy = TruncationStrategy(strategy)
+        if self.strategy == TruncationStrategy.SUMMARIZE and summarizer is None:
+            raise ValueError("The summarize strategy needs a summarizer")
+        self.min_new_tokens = max(1, min_new_tokens)
+        self.summarizer = summarizer
+        self.marker = marker
+        self.stats = {
+            "truncated_observations": 0,
+            "dropped_tokens": 0,
+            "early_stops": 0,
+        }
+
+    def remaining(self, used: int) -> int:
+        return self.max_length - used
+
+    def should_stop(self, used: int) -> bool:
+        """Whether an episode with *used* tokens has no room left to generate."""
+        if self.remaining(used) < self.min_new_tokens:
+            self.stats["early_stops"] += 1
+            return True
+        return False
+
+    def generation_config(
+        self, used: int, generation_config: GenerationConfig
+    ) -> GenerationConfig:
+        """
+        A copy of *generation_config* whose ``max_new_tokens`` does not exceed
+        what is left of the budget.
+        """
+        cap = self.remaining(used)
+        if generation_config.max_new_tokens is not None:
+            cap = min(cap, generation_config.max_new_tokens)
+        if cap == generation_config.max_new_tokens:
+            return generation_config
+        generation_config = copy.copy(generation_config)
+        generation_config.max_new_tokens = cap
+        return generation_config
+
+    def observation_limit(self, used: int, overhead: int) -> int:
+        """
+        Tokens the next observation may take when *used* tokens are already in
+        the episode and the chat template adds *overhead* tokens around it.
+        """
+        limit = self.remaining(used) - overhead - self.min_new_tokens
+        if self.max_observation_tokens is not None:
+            limit = min(limit, self.max_observation_tokens)
+        return max(limit, 0)
+
+    def fit_observation(
+        self, text: str, tokenizer: PreTrainedTokenizerBase, limit: int
+    ) -> str:
+        """Shorten *text* to at most *limit* tokens with the configured strategy."""
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        if len(ids) <= limit:
+            return text
+        self.stats["truncated_observations"] += 1
+        if self.strategy == TruncationStrategy.SUMMARIZE:
+            summary = self.summarizer(text, limit)
+            summary_ids = tokenizer.encode(summary, add_special_tokens=False)
+            if len(summary_ids) <= limit:
+                self.stats["dropped_tokens"] += len(ids) - len(summary_ids)
+                return summary
+            text, ids = summary, summary_ids
+
+        marker_len = len(tokenizer.encode(self.marker, add_special_tokens=False))
+        keep = limit - marker_len
+        while True:
+            truncated = self._truncate(ids, keep, tokenizer) if keep > 0 else ""
+            # decode/encode is not always a round trip, re-check the length
+            n_tokens = len(tokenizer.encode(truncated, add_special_tokens=False))
+            if n_tokens <= limit or keep <= 0:
+                break
+            keep -= n_tokens - limit
+        self.stats["dropped_tokens"] += len(ids) - n_tokens
+        return truncated
+
+    def _truncate(
+        self, ids: list[int], keep: int, tokenizer: PreTrainedTokenizerBase
+    ) -> str:
+        if self.strategy == TruncationStrategy.HEAD:
+            return tokenizer.decode(ids[:keep]) + self.marker
+        if self.strategy == TruncationStrategy.TAIL:
+            return self.marker + tokenizer.decode(ids[len(ids) - keep :])
+        head = (keep + 1) // 2
+        return (
+            tokenizer.decode(ids[:head])
+            + self.marker
+            + tokenizer.decode(ids[len(ids) - (keep - head) :])
+        )
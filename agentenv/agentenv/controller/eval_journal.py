@@ -0,0 +1,131 @@
+"""
+Append-only journal of finished evaluation episodes.
+
+Every finished episode is committed in two appends under an exclusive
+``flock``: first the trajectory record to the trajectory file, then one
+journal line ``{"task", "idx", "reward", "success", "offset", "length"}``
+pointing at it. The journal line is the commit: on reopening, a trailing
+partial journal line and any trajectory bytes past the last committed record
+are cut off, so a run killed at any point restarts from a consistent state.
+A trajectory file with content but no journal was not written through one,
+and is refused rather than cut. Restarted runs rebuild the aggregates from
+the journal and only schedule the idxs it does not contain.
+"""
+
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+
+class EvalJournal:
+    def __init__(self, path: str, trajectory_file: str, recover: bool = True) -> None:
+        """
+        Args:
+            path: The journal file.
+            trajectory_file: The JSONL file the trajectories are appended to.
+            recover: Repair both files after a crash. Only the process that
+                opens the run may do this, not workers appending next to others.
+        """
+        self.path = path
+        self.trajectory_file = trajectory_file
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(trajectory_file)), exist_ok=True)
+        if recover:
+            if (
+                not os.path.exists(path)
+                and os.path.exists(trajectory_file)
+                and os.path.getsize(trajectory_file) > 0
+            ):
+                raise ValueError(
+                    f"{trajectory_file} already has trajectories but no journal at {path}, "
+                    "so the finished items are unknown. Move it away or write to a new file."
+                )
+            with self._locked():
+                self._recover()
+
+    @contextmanager
+    def _locked(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # releases the lock
+
+    def _recover(self) -> None:
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+        end = max((e["offset"] + e["length"] for e in self.entries()), default=0)
+        if os.path.exists(self.trajectory_file) and os.path.getsize(self.trajectory_file) > end:
+            with open(self.trajectory_file, "rb+") as f:
+                f.truncate(end)
+
+    def entries(self) -> list[dict]:
+        """The committed entries in commit order."""
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if line.endswith("\n"):
+                    entries.append(json.loads(line))
+        return entries
+
+    def completed(self, task: Optional[str] = None) -> set[int]:
+        return {e["idx"] for e in self.entries() if task is None or e["task"] == task}
+
+    def commit(self, task: str, idx: int, reward: float, success: int, record: dict) -> dict:
+        """Appends *record* to the trajectory file and commits it to the journal."""
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._locked():
+            with open(self.trajectory_file, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            entry = {
+                "task": task,
+                "idx": idx,
+                "reward": reward,
+                "success": success,
+                "offset": offset,
+                "length": len(line),
+            }
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        return entry
+
+    def summary(self, task: Optional[str] = None) -> dict:
+        return summarize_entries(
+            e for e in self.entries() if task is None or e["task"] == task
+        )
+
+    def read_trajectory(self, entry: dict) -> dict:
+        with open(self.trajectory_file, "rb") as f:
+            f.seek(entry["offset"])
+            return json.loads(f.read(entry["length"]))
+
+
+def summarize_entries(entries: Iterable[dict]) -> dict:
+    """Episode count, mean reward and success rate, each (task, idx) once."""
+    seen = set()
+    rewards, success = [], []
+    for entry in entries:
+        key = (entry["task"], entry["idx"])
+        if key in seen:
+            continue
+        seen.add(key)
+        rewards.append(entry["reward"])
+        success.append(entry["success"])
+    count = len(rewards)
+    return {
+        "count": count,
+        "score": sum(rewards) / count if count else 0.0,
+        "success": sum(success) / count if count else 0.0,
+    }
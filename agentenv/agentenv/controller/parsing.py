@@ -0,0 +1,153 @@
+"""
+Action parsers shared by the ``BaseAdapter`` subclasses.
+
+Everything here runs once per environment step, so patterns are compiled at
+import time, code actions are checked against an AST whitelist instead of being
+passed to ``eval``, and malformed responses are reported through ``logging``
+rather than ``print``.
+"""
+
+import ast
+import json
+import logging
+import re
+from typing import Any, Callable, Iterable, Mapping, TypeVar
+
+from .types import ActionWithTought
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_json_object_pattern = re.compile(r"\{.*\}", re.DOTALL)
+_json_decoder = json.JSONDecoder(strict=False)
+
+# `fn('a', "b")` optionally surrounded by comment lines: the shape almost every
+# code action has. Strings with escapes fall through to the AST path.
+_string_literal = r"'[^'\\\n]*'" + r'|"[^"\\\n]*"'
+_simple_call_pattern = re.compile(
+    r"(?:[ \t]*(?:#[^\n]*)?\n)*[ \t]*"
+    r"(\w+)\(\s*((?:(?:%s)\s*,\s*)*(?:%s)?)\s*\)"
+    r"[ \t]*(?:#[^\n]*)?\s*" % (_string_literal, _string_literal)
+)
+_string_literal_pattern = re.compile(_string_literal)
+
+
+def parse_react(text: str) -> ActionWithTought:
+    """
+    ReAct format:
+    ```
+    Thought:
+    I think ...
+
+    Action:
+    action
+    ```
+    """
+    invalid_format_flg = False
+    _split = text.rsplit("Action:", 1)
+    if len(_split) == 1:
+        if "search[" in text or "click[" in text:
+            _thought, _action = "", _split[0]
+        else:
+            _thought, _action = _split[0], ""
+        invalid_format_flg = True
+    else:
+        _thought, _action = _split
+
+    thought = _thought.split("Thought:")
+    if len(thought) == 1:
+        thought = thought[0]
+        invalid_format_flg = True
+    else:
+        thought = thought[1].strip()
+    action = _action.strip()
+    if invalid_format_flg and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "The text is not in the correct format. Parsing result may not be accurate."
+            "\n###RAW TEXT:\n%s\n###PARSED THOUGHT:\n%s\n###PARSED ACTION:\n%s",
+            text,
+            thought,
+            action,
+        )
+    return ActionWithTought(thought, action)
+
+
+def parse_function_call_json(text: str) -> dict[str, Any]:
+    """
+    Decode the outermost ``{...}`` object of a function-calling response.
+    Surrounding prose and markdown fences are ignored.
+    """
+    match = _json_object_pattern.search(text)
+    if match is None:
+        raise ValueError("No JSON object found in the response.")
+    return _json_decoder.decode(match.group())
+
+
+class CodeActionEvaluator:
+    """
+    Evaluates a code-as-action response without ``eval``.
+
+    The code must be a single call ``fn(arg, ..., key=arg)`` where ``fn`` is one
+    of the registered functions and every argument is a Python literal.
+    Anything else (attribute access, nested calls, names, comprehensions, ...)
+    is rejected with ``ValueError`` before any function runs.
+    """
+
+    def __init__(self, functions: Mapping[str, Callable[..., str]]) -> None:
+        self.functions = dict(functions)
+
+    def __call__(self, code: str) -> str:
+        match = _simple_call_pattern.fullmatch(code)
+        if match is not None and match.group(1) in self.functions:
+            args = [a[1:-1] for a in _string_literal_pattern.findall(match.group(2))]
+            try:
+                return self.functions[match.group(1)](*args)
+            except TypeError as e:
+                raise ValueError(f"Invalid action:{code}") from e
+        return self._evaluate_ast(code)
+
+    def _evaluate_ast(self, code: str) -> str:
+        try:
+            tree = ast.parse(code.strip(" \t"), mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"Invalid action:{code}") from e
+
+        call = tree.body
+        if not (
+            isinstance(call, ast.Call)
+            and isinstance(call.func, ast.Name)
+            and call.func.id in self.functions
+        ):
+            raise ValueError(f"Invalid action:{code}")
+
+        try:
+            args = [self._literal(arg) for arg in call.args]
+            kwargs = {kw.arg: self._literal(kw.value) for kw in call.keywords}
+            if None in kwargs:
+                raise ValueError("**kwargs is not allowed.")
+            return self.functions[call.func.id](*args, **kwargs)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid action:{code}") from e
+
+    @staticmethod
+    def _literal(node: ast.expr) -> Any:
+        if isinstance(node, ast.Starred):
+            raise ValueError("*args is not allowed.")
+        return ast.literal_eval(node)
+
+
+def parse_batch(
+    parse_fn: Callable[[str], T], texts: Iterable[str]
+) -> list[T | Exception]:
+    """
+    Apply ``parse_fn`` to every text. A response that fails to parse yields the
+    raised exception in its slot instead of aborting the whole batch.
+    """
+    results = []
+    for text in texts:
+        try:
+            results.append(parse_fn(text))
+        except Exception as e:  # pylint: disable=W0718:broad-exception-caught
+            results.append(e)
+    return results
@@ -0,0 +1,256 @@
+"""
+Interleaved rollouts over several tasks.
+
+``RolloutScheduler`` keeps up to ``max_concurrency[i]`` episodes of task ``i``
+in flight, each on its own env client, and runs the blocking env calls
+(reset/step) on a thread pool so that every env server works while the model
+generates. Episodes waiting for the model are generated together in one
+``Agent.generate`` call (vLLM engine) to keep the batch full across tasks.
+"""
+
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Optional, Sequence
+
+from transformers import GenerationConfig
+
+from . import Agent, APIAgent, BaseTask
+from .task import EpisodeState
+from .tracing import trace_span
+from .types import APIExperienceOutput, ExperienceOutput, InferenceEngine
+
+logger = logging.getLogger(__name__)
+
+
+class RolloutScheduler:
+    def __init__(
+        self,
+        agent: Agent | APIAgent,
+        tasks: Sequence[BaseTask],
+        max_concurrency: Optional[Sequence[int]] = None,
+        max_batch_size: Optional[int] = None,
+        batch_wait: float = 0.0,
+    ) -> None:
+        """
+        Args:
+            agent: The agent that generates the actions.
+            tasks: The tasks to roll out. Task ``i`` runs at most
+                ``len(tasks[i].clients)`` episodes at once, so create it with
+                ``n_clients`` matching its env server's capacity.
+            max_concurrency: Optional lower per-task limit on concurrent episodes.
+            max_batch_size: Maximum number of sequences per generate call.
+                Defaults to all episodes waiting for the model.
+            batch_wait: Seconds to wait for more episodes to become ready
+                before generating a batch smaller than ``max_batch_size``.
+        """
+        if max_concurrency is not None and len(max_concurrency) != len(tasks):
+            raise ValueError("max_concurrency needs one entry per task")
+        self.agent = agent
+        self.tasks = tasks
+        self.limits = []
+        for i, task in enumerate(tasks):
+            limit = len(task.clients)
+            if max_concurrency is not None:
+                if max_concurrency[i] < 1:
+                    raise ValueError("max_concurrency must be positive")
+                if max_concurrency[i] > limit:
+                    logger.warning(
+                        "Task %s has %d clients, running %d episodes at once instead of %d",
+                        task.env_name, limit, limit, max_concurrency[i],
+                    )
+                limit = min(limit, max_concurrency[i])
+            self.limits.append(limit)
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self._refresh_engine = False
+
+    def run(
+        self,
+        idxs: Sequence[Sequence[int]],
+        generation_config: Optional[GenerationConfig] = None,
+        max_rounds: Optional[int] = None,
+        refresh_engine: bool = False,
+    ) -> list[list[ExperienceOutput | APIExperienceOutput]]:
+        """
+        Rolls out ``idxs[i]`` on ``tasks[i]`` for every task. Returns the
+        experiences grouped by task, each group in the order of ``idxs[i]``.
+        With *refresh_engine* the first generate call rebuilds the vLLM
+        engine, so that it picks up new weights of ``agent.model``.
+        """
+        if len(idxs) != len(self.tasks):
+            raise ValueError("idxs needs one sequence of task ids per task")
+        self._refresh_engine = refresh_engine
+
+        results = [[None] * len(task_idxs) for task_idxs in idxs]
+        pending = [deque(enumerate(task_idxs)) for task_idxs in idxs]
+        free_clients = [
+            list(task.clients[:limit]) for task, limit in zip(self.tasks, self.limits)
+        ]
+        # episode handle: (task index, position in idxs[task], EpisodeState)
+        in_flight: dict[Future, tuple[int, int, Optional[EpisodeState]]] = {}
+        ready: list[tuple[int, int, EpisodeState]] = []
+        # episodes are interleaved, so their spans are never the current one
+        spans = {}  # (task index, position) -> episode span
+        start_time = time.perf_counter()
+
+        def finish(task_i: int, pos: int, episode: EpisodeState) -> None:
+            results[task_i][pos] = BaseTask._finish_episode(self.agent, episode)
+            free_clients[task_i].append(episode.client)
+            span = spans.pop((task_i, pos))
+            span.set(reward=results[task_i][pos].reward)
+            span.finish()
+
+        def admit(executor: ThreadPoolExecutor) -> None:
+            # round-robin over tasks so that no env server waits for another
+            admitted = True
+            while admitted:
+                admitted = False
+                for task_i, task in enumerate(self.tasks):
+                    if pending[task_i] and free_clients[task_i]:
+                        pos, idx = pending[task_i].popleft()
+                        client = free_clients[task_i].pop()
+                        span = trace_span("episode", env=task.env_name, idx=idx).start()
+                        spans[task_i, pos] = span
+                        future = executor.submit(
+                            self._reset, task, client, idx, span.traceparent
+                        )
+                        in_flight[future] = (task_i, pos, None)
+                        admitted = True
+
+        def collect(futures) -> None:
+            for future in futures:
+                task_i, pos, episode = in_flight.pop(future)
+                output = future.result()
+                if episode is None:
+                    client, idx, state = output
+                    episode = self.tasks[task_i]._new_episode(
+                        self.agent, client, idx, state
+                    )
+                else:
+                    BaseTask._record_step(self.agent, episode, output, max_rounds)
+                if episode.finished:
+                    finish(task_i, pos, episode)
+                else:
+                    ready.append((task_i, pos, episode))
+
+        def wait_for_batch(executor: ThreadPoolExecutor) -> None:
+            # block until some episode needs the model, then give the others up
+            # to ``batch_wait`` seconds to join the batch
+            deadline = time.monotonic() + self.batch_wait
+            while True:
+                admit(executor)
+                # pick up everything that completed meanwhile
+                collect([f for f in list(in_flight) if f.done()])
+                target = len(ready) + len(in_flight)
+                if self.max_batch_size is not None:
+                    target = min(target, self.max_batch_size)
+                if not in_flight or (ready and len(ready) >= target):
+                    return
+                timeout = max(0.0, deadline - time.monotonic()) if ready else None
+                done, _ = wait(
+                    list(in_flight), timeout=timeout, return_when=FIRST_COMPLETED
+                )
+                if not done:
+                    return
+                collect(done)
+
+        with ThreadPoolExecutor(max_workers=max(1, sum(self.limits))) as executor:
+            while any(pending) or in_flight or ready:
+                wait_for_batch(executor)
+                if not ready:
+                    continue
+
+                batch_size = self.max_batch_size or len(ready)
+                batch, ready[:] = ready[:batch_size], ready[batch_size:]
+                for (task_i, pos, episode), generated_text in zip(
+                    batch, self._generate(batch, generation_config)
+                ):
+                    if generated_text is None:
+                        finish(task_i, pos, episode)
+                        continue
+                    future = executor.submit(
+                        self._step, episode, generated_text, spans[task_i, pos].traceparent
+                    )
+                    in_flight[future] = (task_i, pos, episode)
+
+        logger.info(
+            "Rolled out %s in %.1fs",
+            ", ".join(
+                f"{len(r)} {task.env_name} episodes" for task, r in zip(self.tasks, results)
+            ),
+            time.perf_counter() - start_time,
+        )
+        return results
+
+    def _generate(
+        self,
+        batch: list[tuple[int, int, EpisodeState]],
+        generation_config: Optional[GenerationConfig],
+    ) -> list[Optional[str]]:
+        """
+        Generates one action per episode of *batch*. ``None`` marks an
+        episode that has to stop (context full or generation failed).
+        """
+        agent = self.agent
+        episodes = [episode for _, _, episode in batch]
+        if isinstance(agent, APIAgent):
+            with trace_span("llm.generate", batch_size=len(episodes)):
+                return [
+                    BaseTask._record_generation(
+                        agent, episode, agent.generate(episode.conversation)
+                    )
+                    for episode in episodes
+                ]
+        if not isinstance(agent, Agent):
+            raise NotImplementedError
+
+        prompts = [BaseTask._episode_prompt(e, generation_config) for e in episodes]
+        live = [i for i, prompt in enumerate(prompts) if prompt is not None]
+        configs = {
+            i: BaseTask._episode_generation_config(episodes[i], generation_config)
+            for i in live
+        }
+        outputs: list[Optional[list[int]]] = [None] * len(episodes)
+        if agent.inference_engine == InferenceEngine.VLLM:
+            # vLLM takes prompts of different lengths and per-prompt
+            # sampling params (budget-capped max_new_tokens) in one call
+            groups = [live] if live else []
+        else:
+            # ``model.generate`` is called without padding
+            groups = [[i] for i in live]
+        for group in groups:
+            refresh_engine, self._refresh_engine = self._refresh_engine, False
+            try:
+                with trace_span("llm.generate", batch_size=len(group)):
+                    generated = agent.generate(
+                        [prompts[i] for i in group],
+                        [configs[i] for i in group],
+                        refresh_engine=refresh_engine,
+                    )
+            except Exception:  # pylint: disable=W0718:broad-exception-caught
+                logger.warning(
+                    "Generation failed, stopping %d episodes", len(group), exc_info=True
+                )
+                continue  # these episodes stop, as in BaseTask
+            for i, tokens in zip(group, generated):
+                outputs[i] = tokens
+
+        return [
+            None
+            if tokens is None
+            else BaseTask._record_generation(agent, episode, tokens)
+            for episode, tokens in zip(episodes, outputs)
+        ]
+
+    @staticmethod
+    def _reset(task: BaseTask, client, idx: int, traceparent: Optional[str]):
+        return client, idx, task._reset_client(client, idx, traceparent)
+
+    @staticmethod
+    def _step(episode: EpisodeState, generated_text: str, traceparent: Optional[str]):
+        with trace_span(
+            "env.step", traceparent=traceparent, idx=episode.idx, round=episode.rounds
+        ):
+            return episode.client.step(generated_text)
@@ -1,31 +1,63 @@
+import logging
+from dataclasses import dataclass
 from typing import Any, Callable, Mapping, Optional, Sequence
 
 from transformers import GenerationConfig
 
 from . import Agent, APIAgent, BaseEnvClient
-from .types import ConversationMessage, APIConversationMessage, ExperienceOutput, APIExperienceOutput
+from .budget import ContextBudget
+from .tracing import trace_span
+from .types import (
+    APIConversationMessage,
+    APIExperienceOutput,
+    ConversationMessage,
+    ExperienceOutput,
+    StepOutput,
+    TokenizedConversationOutput,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EpisodeState:
+    """Progress of one rollout between model calls."""
+
+    client: BaseEnvClient
+    idx: int
+    conversation: list[ConversationMessage | APIConversationMessage]
+    conversation_tokenized: Optional[TokenizedConversationOutput] = None
+    reward: float = 0.0
+    done: bool = False
+    rounds: int = 0
+    finished: bool = False
+    budget: Optional[ContextBudget] = None
 
 
 class BaseTask:
     env_client_cls: Callable
     env_name: str
+    context_budget: Optional[ContextBudget] = None
 
     def __init__(
         self,
         client_args: Mapping[str, Any],
         n_clients: int = 1,
+        context_budget: Optional[ContextBudget] = None,
     ) -> None:
         """
         Initializes the Task object.
 
         Args:
             client_args (Mapping[str, Any]): A mapping of client arguments.
-            n_clients (int, optional): The number of clients. Defaults to 1. Larger than 1 for batch generation. Batch generation is not implemented yet.
+            n_clients (int, optional): The number of clients. Defaults to 1. RolloutScheduler runs up to n_clients episodes of this task at once.
+            context_budget (ContextBudget, optional): Token budget that truncates env observations and caps generation of each episode. Only used with a local Agent.
         """
         if self.env_client_cls is None or self.env_name is None:
             raise NotImplementedError
         self.clients = [self.env_client_cls(**client_args) for _ in range(n_clients)]
         self.len = len(self.clients[0])
+        self.context_budget = context_budget
 
     def _generate_experience_one(
         self,
@@ -35,105 +67,251 @@ class BaseTask:
         generation_config: Optional[GenerationConfig] = None,
         max_rounds: Optional[int] = None,
     ) -> ExperienceOutput:
-        client.reset(idx)
-        reward = 0.0
-        done = False
-        state = client.observe()
+        with trace_span("episode", env=self.env_name, idx=idx) as span:
+            experience = self._run_episode(
+                agent, client, idx, generation_config, max_rounds
+            )
+            span.set(reward=experience.reward)
+            return experience
+
+    def _run_episode(
+        self,
+        agent: Agent | APIAgent,
+        client: BaseEnvClient,
+        idx: int,
+        generation_config: Optional[GenerationConfig] = None,
+        max_rounds: Optional[int] = None,
+    ) -> ExperienceOutput:
+        state = self._reset_client(client, idx)
+        episode = self._new_episode(agent, client, idx, state)
+        while not episode.finished:
+            if isinstance(agent, Agent):
+                input_ids = self._episode_prompt(episode, generation_config)
+                if input_ids is None:
+                    break
+                episode_generation_config = self._episode_generation_config(
+                    episode, generation_config
+                )
+                try:
+                    with trace_span("llm.generate", input_tokens=len(input_ids)) as span:
+                        generated_tokens = agent.generate(
+                            [input_ids], episode_generation_config
+                        )[0]
+                        span.set(output_tokens=len(generated_tokens))
+                except Exception:  # pylint: disable=W0718:broad-exception-caught
+                    logger.warning("Generation failed, stopping the episode", exc_info=True)
+                    break  # break if generate method raises exceptions
+                generated_text = self._record_generation(agent, episode, generated_tokens)
+            elif isinstance(agent, APIAgent):
+                with trace_span("llm.generate"):
+                    generated = agent.generate(episode.conversation)
+                generated_text = self._record_generation(agent, episode, generated)
+            else:
+                raise NotImplementedError
+
+            with trace_span("env.step", round=episode.rounds):
+                step_output = client.step(generated_text)
+            self._record_step(agent, episode, step_output, max_rounds)
+
+        return self._finish_episode(agent, episode)
+
+    def _reset_client(
+        self, client: BaseEnvClient, idx: int, traceparent: Optional[str] = None
+    ) -> str:
+        """
+        Resets the client to task *idx* and returns the first observation.
+        *traceparent* is the episode span when it is not the current one.
+        """
+        with trace_span("env.reset", traceparent=traceparent, env=self.env_name, idx=idx):
+            client.reset(idx)
+            return client.observe()
+
+    def _new_episode(
+        self,
+        agent: Agent | APIAgent,
+        client: BaseEnvClient,
+        idx: int,
+        state: str,
+    ) -> EpisodeState:
+        """
+        Builds the initial conversation from the first observation. The returned
+        state is advanced with ``_record_generation`` and ``_record_step``, which
+        lets ``RolloutScheduler`` interleave many episodes.
+        """
         if isinstance(agent, Agent):
-            tokenizer = agent.tokenizer
             conversation = list(client.conversation_start)
+            if self.context_budget is not None:
+                used = len(
+                    agent.chat_template.tokenize_conversation(
+                        conversation, agent.tokenizer
+                    )["input_ids"]
+                )
+                state = self._fit_observation(
+                    agent, self.context_budget, state, used, len(conversation)
+                )
             conversation.append(
                 ConversationMessage({"from": "human", "loss": None, "value": state})
             )
             conversation_tokenized = agent.chat_template.tokenize_conversation(
-                conversation, tokenizer, add_generation_prompt=True
+                conversation, agent.tokenizer, add_generation_prompt=True
             )
         elif isinstance(agent, APIAgent):
             conversation = [APIConversationMessage({"role": "user", "content": client.conversation_start[0]["value"], "reasoning_content": None}),
                             APIConversationMessage({"role": "assistant", "content": client.conversation_start[1]["value"], "reasoning_content": None}),
                             APIConversationMessage({"role": "user", "content": state, "reasoning_content": None})]
+            conversation_tokenized = None
         else:
             raise NotImplementedError
-        rounds = 0
+        return EpisodeState(
+            client=client,
+            idx=idx,
+            conversation=conversation,
+            conversation_tokenized=conversation_tokenized,
+            budget=self.context_budget,
+        )
 
-        while not done:
-            if isinstance(agent, Agent):
-                input_length = len(conversation_tokenized["input_ids"])
-                # if input_length exceeds max_length, break
-                if input_length >= (generation_config.max_length or 4096):
-                    break
-                try:
-                    generated_tokens = agent.generate(
-                        [conversation_tokenized["input_ids"]], generation_config
-                    )[0]
-                except Exception as e:  # pylint: disable=W0718:broad-exception-caught
-                    print(e)
-                    break  # break if generate method raises exceptions
+    @staticmethod
+    def _fit_observation(
+        agent: Agent, budget: ContextBudget, state: str, used: int, idx: int = -1
+    ) -> str:
+        """
+        Shortens the observation *state* so that, wrapped by the chat template,
+        it leaves room for the next generation within *budget*.
+        """
+        empty_message = ConversationMessage({"from": "human", "loss": None, "value": ""})
+        overhead = len(
+            agent.chat_template.tokenize_conversation_one(
+                empty_message, agent.tokenizer, idx, add_generation_prompt=True
+            )["input_ids"]
+        )
+        limit = budget.observation_limit(used, overhead)
+        return budget.fit_observation(state, agent.tokenizer, limit)
+
+    @staticmethod
+    def _episode_prompt(
+        episode: EpisodeState, generation_config: Optional[GenerationConfig]
+    ) -> Optional[list[int]]:
+        """
+        Returns the token ids to generate from, or ``None`` (and finishes the
+        episode) if the conversation no longer fits in ``max_length``.
+        """
+        input_ids = episode.conversation_tokenized["input_ids"]
+        # if input_length exceeds max_length, break
+        if len(input_ids) >= (generation_config.max_length or 4096) or (
+            episode.budget is not None and episode.budget.should_stop(len(input_ids))
+        ):
+            episode.finished = True
+            return None
+        return input_ids
+
+    @staticmethod
+    def _episode_generation_config(
+        episode: EpisodeState, generation_config: GenerationConfig
+    ) -> GenerationConfig:
+        """The generation config with ``max_new_tokens`` capped by the budget."""
+        if episode.budget is None:
+            return generation_config
+        return episode.budget.generation_config(
+            len(episode.conversation_tokenized["input_ids"]), generation_config
+        )
 
-                if generated_tokens[-1] != tokenizer.eos_token_id:
-                    generated_tokens += [tokenizer.eos_token_id]
-
-                generated_text = tokenizer.decode(generated_tokens)
-                conversation_tokenized["text"] += f" {generated_text}"
-                conversation_tokenized["input_ids"] += generated_tokens
-                conversation_tokenized["action_mask"] += [1] * len(generated_tokens)
-
-                generated_text = generated_text[
-                    : -len(tokenizer.eos_token)
-                ]  # not endswith eos_token
-                conversation.append(
-                    ConversationMessage(
-                        {"from": "gpt", "loss": True, "value": generated_text}
-                    )
+    @staticmethod
+    def _record_generation(
+        agent: Agent | APIAgent,
+        episode: EpisodeState,
+        generated: list[int] | tuple[str, str | None],
+    ) -> str:
+        """
+        Appends the model output to the episode: token ids for ``Agent``, the
+        ``(text, reasoning)`` pair for ``APIAgent``. Returns the action text.
+        """
+        if isinstance(agent, Agent):
+            tokenizer = agent.tokenizer
+            generated_tokens = generated
+            if generated_tokens[-1] != tokenizer.eos_token_id:
+                generated_tokens += [tokenizer.eos_token_id]
+
+            generated_text = tokenizer.decode(generated_tokens)
+            conversation_tokenized = episode.conversation_tokenized
+            conversation_tokenized["text"] += f" {generated_text}"
+            conversation_tokenized["input_ids"] += generated_tokens
+            conversation_tokenized["action_mask"] += [1] * len(generated_tokens)
+
+            generated_text = generated_text[
+                : -len(tokenizer.eos_token)
+            ]  # not endswith eos_token
+            episode.conversation.append(
+                ConversationMessage(
+                    {"from": "gpt", "loss": True, "value": generated_text}
                 )
-            elif isinstance(agent, APIAgent):
-                generated_text, generated_reasoning_text = agent.generate(conversation)
-                conversation.append(
-                    APIConversationMessage(
-                        {"role": "assistant", "content": generated_text, "reasoning_content": generated_reasoning_text}
-                    )
+            )
+        elif isinstance(agent, APIAgent):
+            generated_text, generated_reasoning_text = generated
+            episode.conversation.append(
+                APIConversationMessage(
+                    {"role": "assistant", "content": generated_text, "reasoning_content": generated_reasoning_text}
                 )
-            else:
-                raise NotImplementedError
-
-            step_output = client.step(generated_text)
-            state, reward, done = (
-                step_output.state,
-                step_output.reward,
-                step_output.done,
             )
+        else:
+            raise NotImplementedError
+        return generated_text
 
-            if isinstance(agent, Agent):
-                env_message = ConversationMessage(
-                    {"from": "human", "loss": None, "value": state}
+    @staticmethod
+    def _record_step(
+        agent: Agent | APIAgent,
+        episode: EpisodeState,
+        step_output: StepOutput,
+        max_rounds: Optional[int] = None,
+    ) -> None:
+        state = step_output.state
+        episode.reward = step_output.reward
+        episode.done = step_output.done
+
+        if isinstance(agent, Agent):
+            if episode.budget is not None:
+                state = BaseTask._fit_observation(
+                    agent,
+                    episode.budget,
+                    state,
+                    len(episode.conversation_tokenized["input_ids"]),
                 )
+            env_message = ConversationMessage(
+                {"from": "human", "loss": None, "value": state}
+            )
+            with trace_span("tokenize"):
                 env_message_tokenized = agent.chat_template.tokenize_conversation_one(
-                    env_message, tokenizer, add_generation_prompt=True
+                    env_message, agent.tokenizer, add_generation_prompt=True
                 )
 
-                conversation.append(env_message)
-                conversation_tokenized["text"] += env_message_tokenized["text"]
-                conversation_tokenized["input_ids"] += env_message_tokenized["input_ids"]
-                conversation_tokenized["action_mask"] += env_message_tokenized[
-                    "action_mask"
-                ]
-            elif isinstance(agent, APIAgent):
-                conversation.append(
-                    APIConversationMessage(
-                        {"role": "user", "content": state, "reasoning_content": None}
-                    )
+            conversation_tokenized = episode.conversation_tokenized
+            episode.conversation.append(env_message)
+            conversation_tokenized["text"] += env_message_tokenized["text"]
+            conversation_tokenized["input_ids"] += env_message_tokenized["input_ids"]
+            conversation_tokenized["action_mask"] += env_message_tokenized[
+                "action_mask"
+            ]
+        elif isinstance(agent, APIAgent):
+            episode.conversation.append(
+                APIConversationMessage(
+                    {"role": "user", "content": state, "reasoning_content": None}
                 )
-            else:
-                raise NotImplementedError
+            )
+        else:
+            raise NotImplementedError
 
-            rounds += 1
-            if max_rounds is not None and rounds >= max_rounds:
-                break
+        episode.rounds += 1
+        if episode.done or (max_rounds is not None and episode.rounds >= max_rounds):
+            episode.finished = True
 
+    @staticmethod
+    def _finish_episode(
+        agent: Agent | APIAgent, episode: EpisodeState
+    ) -> ExperienceOutput | APIExperienceOutput:
         if isinstance(agent, Agent):
+            conversation_tokenized = episode.conversation_tokenized
             return ExperienceOutput(
-                conversation=conversation,
-                reward=reward,
+                conversation=episode.conversation,
+                reward=episode.reward,
                 text=conversation_tokenized["text"],
                 seq_ids=conversation_tokenized["input_ids"],
                 attention_mask=[1] * len(conversation_tokenized["input_ids"]),
@@ -141,8 +319,8 @@ class BaseTask:
             )
         elif isinstance(agent, APIAgent):
             return APIExperienceOutput(
-                conversation=conversation,
-                reward=reward,
+                conversation=episode.conversation,
+                reward=episode.reward,
             )
         else:
             raise NotImplementedError
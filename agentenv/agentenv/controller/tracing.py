@@ -0,0 +1,220 @@
+"""
+Lightweight per-step latency tracing.
+
+Spans are written as Chrome trace events ("ph": "X"), one JSON object per line,
+to the file named by ``AGENTENV_TRACE_FILE`` (or the path given to
+``enable_tracing``). The env servers built on ``agentenv_pool`` write to the same
+format, and the ``traceparent`` header returned by ``trace_headers`` links their
+spans to the rollout that issued the request. ``to_chrome_trace`` merges one or
+more of these files into a file that chrome://tracing or Perfetto can open.
+
+Tracing is disabled unless a trace file is configured; ``trace_span`` is then a
+shared no-op context manager.
+"""
+
+import json
+import os
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Iterable, Optional
+
+TRACE_FILE_ENV = "AGENTENV_TRACE_FILE"
+TRACEPARENT_HEADER = "traceparent"
+
+
+class _SpanContext:
+    __slots__ = ("trace_id", "span_id")
+
+    def __init__(self, trace_id: str, span_id: str) -> None:
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+_current_span: ContextVar[Optional[_SpanContext]] = ContextVar(
+    "agentenv_current_span", default=None
+)
+
+
+class _TraceWriter:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._lock = threading.Lock()
+
+    def write(self, event: dict[str, Any]) -> None:
+        line = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            os.write(self._fd, line)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+_writer: Optional[_TraceWriter] = None
+
+
+def enable_tracing(path: str) -> None:
+    """Start writing spans of this process to *path* (appending)."""
+    global _writer
+    disable_tracing()
+    _writer = _TraceWriter(path)
+
+
+def disable_tracing() -> None:
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+def tracing_enabled() -> bool:
+    return _writer is not None
+
+
+class _NullSpan:
+    """Span of disabled tracing, every method is a no-op."""
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def start(self) -> "_NullSpan":
+        return self
+
+    def finish(self, error: Optional[str] = None) -> None:
+        pass
+
+    @property
+    def traceparent(self) -> Optional[str]:
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional[_SpanContext], attrs: dict) -> None:
+        self.name = name
+        self.attrs = attrs
+        self.context = _SpanContext(
+            parent.trace_id if parent is not None else secrets.token_hex(16),
+            secrets.token_hex(8),
+        )
+        self.parent_id = parent.span_id if parent is not None else None
+        self._token = None
+        self._start_ns = 0
+
+    def set(self, **attrs: Any) -> None:
+        """Attach extra attributes once they are known (e.g. token counts)."""
+        self.attrs.update(attrs)
+
+    @property
+    def traceparent(self) -> str:
+        """``traceparent`` value that makes spans opened elsewhere children of this one."""
+        return f"00-{self.context.trace_id}-{self.context.span_id}-01"
+
+    def start(self) -> "Span":
+        """
+        Start timing without making this the current span, for spans that do
+        not fit one block (e.g. an episode interleaved with others); end it
+        with ``finish``.
+        """
+        self._start_ns = time.time_ns()
+        return self
+
+    def finish(self, error: Optional[str] = None) -> None:
+        end_ns = time.time_ns()
+        writer = _writer
+        if writer is None:
+            return
+        args = {
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            **self.attrs,
+        }
+        if error is not None:
+            args["error"] = error
+        writer.write(
+            {
+                "name": self.name,
+                "cat": "agentenv",
+                "ph": "X",
+                "ts": self._start_ns // 1000,
+                "dur": (end_ns - self._start_ns) // 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+        )
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self.context)
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current_span.reset(self._token)
+        self.finish(exc_type.__name__ if exc_type is not None else None)
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[_SpanContext]:
+    """Parse a W3C ``traceparent`` value (``00-<trace>-<span>-<flags>``)."""
+    if not value:
+        return None
+    parts = value.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return _SpanContext(parts[1], parts[2])
+
+
+def trace_span(name: str, traceparent: Optional[str] = None, **attrs: Any):
+    """
+    Context manager timing the enclosed block. Nested spans become children of
+    the enclosing one; *traceparent* overrides the parent, which is how spans
+    continue across a process boundary.
+    """
+    if _writer is None:
+        return _NULL_SPAN
+    parent = parse_traceparent(traceparent) if traceparent else _current_span.get()
+    return Span(name, parent, attrs)
+
+
+def current_traceparent() -> Optional[str]:
+    span = _current_span.get()
+    if span is None:
+        return None
+    return f"00-{span.trace_id}-{span.span_id}-01"
+
+
+def trace_headers() -> dict[str, str]:
+    """HTTP headers that link the server-side spans to the current span."""
+    traceparent = current_traceparent()
+    return {TRACEPARENT_HEADER: traceparent} if traceparent else {}
+
+
+def to_chrome_trace(jsonl_paths: Iterable[str], output_path: str) -> int:
+    """
+    Merge span files into a Chrome trace JSON file. Returns the number of events.
+    """
+    events = []
+    for path in jsonl_paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    events.append(json.loads(line))
+    events.sort(key=lambda e: e["ts"])
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return len(events)
+
+
+if os.environ.get(TRACE_FILE_ENV):
+    enable_tracing(os.environ[TRACE_FILE_ENV])
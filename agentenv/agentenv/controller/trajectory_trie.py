@@ -0,0 +1,278 @@
+"""
+Prefix-tree storage for rollout token sequences.
+
+Best-of-N and AgentEvol sampling produce many trajectories per task that share
+``conversation_start``, the first observation and often the first actions.
+``TrajectoryTrie`` keeps every distinct token run once (a radix tree keyed on
+``(token, action_mask)``), both in memory and in its ``.npz`` file, and exports
+the stored sequences either as flat rows or as one packed tree batch in which
+every shared prefix token appears a single time.
+"""
+
+import json
+from typing import Any, Iterator, Optional, Sequence
+
+import numpy as np
+import torch
+
+from .types import ExperienceOutput
+
+
+class TrajectoryTrie:
+    def __init__(self) -> None:
+        # node 0 is the root, its segment is empty
+        self._tokens: list[list[int]] = [[]]
+        self._masks: list[list[int]] = [[]]
+        self._parent: list[int] = [-1]
+        self._start: list[int] = [0]  # position of the segment's first token
+        self._children: list[dict[tuple[int, int], int]] = [{}]
+        # one record per added trajectory
+        self._record_node: list[int] = []
+        self._record_reward: list[float] = []
+        self._record_meta: list[dict[str, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self._record_node)
+
+    @property
+    def num_stored_tokens(self) -> int:
+        """Tokens kept in the trie, every shared prefix counted once."""
+        return sum(len(tokens) for tokens in self._tokens)
+
+    @property
+    def num_tokens(self) -> int:
+        """Tokens of all added trajectories, as flat rows would store them."""
+        return sum(self._end(node) for node in self._record_node)
+
+    def compression_ratio(self) -> float:
+        return self.num_tokens / max(1, self.num_stored_tokens)
+
+    def _new_node(self, tokens, masks, parent: int, start: int) -> int:
+        self._tokens.append(tokens)
+        self._masks.append(masks)
+        self._parent.append(parent)
+        self._start.append(start)
+        self._children.append({})
+        return len(self._tokens) - 1
+
+    def _end(self, node: int) -> int:
+        return self._start[node] + len(self._tokens[node])
+
+    def _split(self, node: int, at: int) -> int:
+        """Cuts the segment of *node* after *at* tokens, returns the new upper node."""
+        tokens, masks = self._tokens[node], self._masks[node]
+        parent = self._parent[node]
+        upper = self._new_node(tokens[:at], masks[:at], parent, self._start[node])
+        self._children[parent][(tokens[0], masks[0])] = upper
+        self._tokens[node], self._masks[node] = tokens[at:], masks[at:]
+        self._start[node] += at
+        self._parent[node] = upper
+        self._children[upper][(tokens[at], masks[at])] = node
+        return upper
+
+    def _insert(self, seq_ids: Sequence[int], action_mask: Sequence[int]) -> int:
+        node, i, n = 0, 0, len(seq_ids)
+        while i < n:
+            child = self._children[node].get((seq_ids[i], action_mask[i]))
+            if child is None:
+                child = self._new_node(seq_ids[i:], action_mask[i:], node, i)
+                self._children[node][(seq_ids[i], action_mask[i])] = child
+                return child
+            tokens, masks = self._tokens[child], self._masks[child]
+            length = len(tokens)
+            if tokens == seq_ids[i : i + length] and masks == action_mask[i : i + length]:
+                node, i = child, i + length
+                continue
+            j = 1
+            while (
+                j < length
+                and i + j < n
+                and tokens[j] == seq_ids[i + j]
+                and masks[j] == action_mask[i + j]
+            ):
+                j += 1
+            node, i = self._split(child, j), i + j
+        return node
+
+    def add(
+        self,
+        seq_ids: Sequence[int],
+        action_mask: Sequence[int],
+        reward: float = 0.0,
+        **meta: Any,
+    ) -> int:
+        """
+        Stores one trajectory and returns its record id. *meta* (e.g. item_id)
+        must be JSON serializable.
+        """
+        if len(seq_ids) != len(action_mask):
+            raise ValueError("seq_ids and action_mask have different lengths")
+        node = self._insert(list(seq_ids), list(action_mask))
+        self._record_node.append(node)
+        self._record_reward.append(float(reward))
+        self._record_meta.append(meta)
+        return len(self._record_node) - 1
+
+    def add_experience(self, exp: ExperienceOutput, **meta: Any) -> int:
+        return self.add(exp.seq_ids, exp.action_mask, exp.reward, **meta)
+
+    def extend(self, other: "TrajectoryTrie") -> None:
+        """Adds every record of *other*, keeping its reward and metadata."""
+        for record_id in range(len(other)):
+            self.add(
+                *other.sequence(record_id),
+                other._record_reward[record_id],
+                **other._record_meta[record_id],
+            )
+
+    def _path(self, node: int) -> list[int]:
+        path = []
+        while node > 0:
+            path.append(node)
+            node = self._parent[node]
+        return path[::-1]
+
+    def sequence(self, record_id: int) -> tuple[list[int], list[int]]:
+        """The ``(seq_ids, action_mask)`` of a record."""
+        seq_ids, action_mask = [], []
+        for node in self._path(self._record_node[record_id]):
+            seq_ids += self._tokens[node]
+            action_mask += self._masks[node]
+        return seq_ids, action_mask
+
+    def to_rows(self, unique: bool = False) -> Iterator[dict[str, Any]]:
+        """
+        Yields one flat row per record. With ``unique`` identical trajectories
+        are yielded once, with their rewards, metadata and ``count``.
+        """
+        if not unique:
+            for record_id in range(len(self)):
+                seq_ids, action_mask = self.sequence(record_id)
+                yield {
+                    "input_ids": seq_ids,
+                    "action_mask": action_mask,
+                    "reward": self._record_reward[record_id],
+                    **self._record_meta[record_id],
+                }
+            return
+        by_node: dict[int, list[int]] = {}
+        for record_id, node in enumerate(self._record_node):
+            by_node.setdefault(node, []).append(record_id)
+        for record_ids in by_node.values():
+            seq_ids, action_mask = self.sequence(record_ids[0])
+            yield {
+                "input_ids": seq_ids,
+                "action_mask": action_mask,
+                "count": len(record_ids),
+                "rewards": [self._record_reward[r] for r in record_ids],
+                "meta": [self._record_meta[r] for r in record_ids],
+            }
+
+    def to_tree_batch(
+        self, record_ids: Optional[Sequence[int]] = None
+    ) -> dict[str, torch.Tensor]:
+        """
+        Packs the selected records (default: all) into one sequence in which
+        each trie token appears once, in depth-first order:
+
+        - ``input_ids``, ``action_mask``: the tokens
+        - ``position_ids``: position of the token in its trajectories
+        - ``parent_ids``: index of the preceding token (-1 for the first); token
+          ``i`` may attend to ``i`` and its ancestors, see ``tree_attention_mask``,
+          and is predicted from the logits at ``parent_ids[i]``
+        - ``weights``: number of selected records containing the token, so a
+          weighted token loss equals the loss summed over the flat rows
+        - ``record_last_index``, ``rewards``: last token and reward per record
+        """
+        if record_ids is None:
+            record_ids = range(len(self))
+        record_ids = list(record_ids)
+        weights = np.zeros(len(self._tokens), dtype=np.int64)
+        for record_id in record_ids:
+            for node in self._path(self._record_node[record_id]):
+                weights[node] += 1
+
+        input_ids, action_mask, position_ids, parent_ids, token_weights = [], [], [], [], []
+        last_index = {0: -1}  # node -> index of its last token in the batch
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if node > 0:
+                parent_index = last_index[self._parent[node]]
+                for offset, (token, mask) in enumerate(
+                    zip(self._tokens[node], self._masks[node])
+                ):
+                    index = len(input_ids)
+                    input_ids.append(token)
+                    action_mask.append(mask)
+                    position_ids.append(self._start[node] + offset)
+                    parent_ids.append(parent_index)
+                    token_weights.append(weights[node])
+                    parent_index = index
+                last_index[node] = parent_index
+            children = [c for c in self._children[node].values() if weights[c] > 0]
+            stack.extend(reversed(children))
+
+        return {
+            "input_ids": torch.tensor(input_ids, dtype=torch.long),
+            "action_mask": torch.tensor(action_mask, dtype=torch.long),
+            "position_ids": torch.tensor(position_ids, dtype=torch.long),
+            "parent_ids": torch.tensor(parent_ids, dtype=torch.long),
+            "weights": torch.tensor(token_weights, dtype=torch.long),
+            "record_last_index": torch.tensor(
+                [last_index[self._record_node[r]] for r in record_ids], dtype=torch.long
+            ),
+            "rewards": torch.tensor(
+                [self._record_reward[r] for r in record_ids], dtype=torch.float
+            ),
+        }
+
+    def save(self, path: str) -> None:
+        """Writes the trie to *path* (``.npz``); shared prefixes are stored once."""
+        lengths = np.array([len(t) for t in self._tokens], dtype=np.int64)
+        flat_tokens = [token for tokens in self._tokens for token in tokens]
+        flat_masks = [mask for masks in self._masks for mask in masks]
+        meta = json.dumps(self._record_meta, ensure_ascii=False).encode("utf-8")
+        np.savez_compressed(
+            path,
+            tokens=np.array(flat_tokens, dtype=np.int64),
+            masks=np.array(flat_masks, dtype=np.int8),
+            lengths=lengths,
+            parent=np.array(self._parent, dtype=np.int64),
+            start=np.array(self._start, dtype=np.int64),
+            record_node=np.array(self._record_node, dtype=np.int64),
+            record_reward=np.array(self._record_reward, dtype=np.float64),
+            record_meta=np.frombuffer(meta, dtype=np.uint8),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "TrajectoryTrie":
+        trie = cls()
+        with np.load(path) as data:
+            offsets = np.concatenate([[0], np.cumsum(data["lengths"])])
+            tokens, masks = data["tokens"].tolist(), data["masks"].tolist()
+            trie._parent = data["parent"].tolist()
+            trie._start = data["start"].tolist()
+            trie._record_node = data["record_node"].tolist()
+            trie._record_reward = data["record_reward"].tolist()
+            trie._record_meta = json.loads(data["record_meta"].tobytes().decode("utf-8"))
+        trie._tokens = [tokens[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+        trie._masks = [masks[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+        trie._children = [{} for _ in trie._tokens]
+        for node in range(1, len(trie._tokens)):
+            key = (trie._tokens[node][0], trie._masks[node][0])
+            trie._children[trie._parent[node]][key] = node
+        return trie
+
+
+def tree_attention_mask(parent_ids: torch.Tensor) -> torch.Tensor:
+    """
+    Boolean ``[n, n]`` mask of a tree batch: token ``i`` attends to ``j`` iff
+    ``j`` is ``i`` or one of its ancestors. Parents precede their children.
+    """
+    n = parent_ids.shape[0]
+    mask = torch.eye(n, dtype=torch.bool)
+    for i, parent in enumerate(parent_ids.tolist()):
+        if parent >= 0:
+            mask[i] |= mask[parent]
+    return mask
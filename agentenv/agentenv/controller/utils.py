@@ -1,6 +1,6 @@
 import json
 import re
-from typing import Optional, Sequence
+from typing import Callable, Optional, Sequence
 
 import numpy as np
 from transformers import GenerationConfig
@@ -14,6 +14,8 @@ from .types import (
     ExperienceOutput,
     APIExperienceOutput,
 )
+from .parsing import parse_batch, parse_react
+from .scheduler import RolloutScheduler
 
 INVOKING_FUNCTION_PROMPT = """
 
@@ -126,36 +128,7 @@ class BaseAdapter:
         action
         ```
         """
-        invalid_format_flg = False
-        _split = text.rsplit("Action:", 1)
-        if len(_split) == 0:
-            _thought, _action = text
-            invalid_format_flg = True
-        elif len(_split) == 1:
-            if "search[" in text or "click[" in text:
-                _thought, _action = "", _split[0]
-            else:
-                _thought, _action = _split[0], ""
-            invalid_format_flg = True
-        else:
-            assert len(_split) == 2
-            _thought, _action = _split
-
-        thought = _thought.split("Thought:")
-        if len(thought) == 1:
-            thought = thought[0]
-            invalid_format_flg = True
-        else:
-            thought = thought[1].strip()
-        action = _action.strip()
-        if invalid_format_flg:
-            print(
-                "The text is not in the correct format. Parsing result may not be accurate."
-            )
-            print("###RAW TEXT:\n", text)
-            print("\n###PARSED THOUGHT:\n", thought)
-            print("\n###PARSED ACTION:\n", action)
-        return ActionWithTought(thought, action)
+        return parse_react(text)
 
     @staticmethod
     def to_react(action_with_thought: ActionWithTought) -> str:
@@ -193,21 +166,76 @@ class BaseAdapter:
         raise NotImplementedError
 
     @classmethod
-    def action_parser(cls, action: str, action_format: ActionFormat) -> str:
+    def _get_parse_fn(
+        cls, action_format: ActionFormat
+    ) -> Callable[[str], ActionWithTought]:
         if action_format == ActionFormat.REACT:
-            return cls.parse_react(action).action
+            return cls.parse_react
         elif action_format == ActionFormat.FUNCTION_CALLING:
-            return cls.parse_function_calling(action).action
+            return cls.parse_function_calling
         elif action_format == ActionFormat.CODE_AS_ACTION:
-            return cls.parse_code_as_action(action).action
+            return cls.parse_code_as_action
         else:
             raise NotImplementedError
 
+    @classmethod
+    def action_parser(cls, action: str, action_format: ActionFormat) -> str:
+        return cls._get_parse_fn(action_format)(action).action
+
+    @classmethod
+    def action_parser_batch(
+        cls, actions: Sequence[str], action_format: ActionFormat
+    ) -> list[str | Exception]:
+        """
+        Parse many responses in one call. Responses that cannot be parsed
+        yield the raised exception instead of an action string.
+        """
+        parse_fn = cls._get_parse_fn(action_format)
+        return [
+            res if isinstance(res, Exception) else res.action
+            for res in parse_batch(parse_fn, actions)
+        ]
+
 
 class BaseAgentEnvController:
-    def __init__(self, agent: Agent | APIAgent, tasks: Sequence[BaseTask]) -> None:
+    # Rollout scheduling, see RolloutScheduler. Per-task concurrency is also
+    # bounded by the number of clients of each task.
+    max_concurrency: Sequence[int] | None = None
+    max_batch_size: int | None = None
+
+    def __init__(
+        self,
+        agent: Agent | APIAgent,
+        tasks: Sequence[BaseTask],
+        max_concurrency: Sequence[int] | None = None,
+        max_batch_size: int | None = None,
+    ) -> None:
         self.agent = agent
         self.tasks = tasks
+        self.max_concurrency = max_concurrency
+        self.max_batch_size = max_batch_size
+
+    def generate_experience_by_task(
+        self,
+        idxs: Sequence[Sequence[int]],
+        generation_config: Optional[GenerationConfig] = None,
+        max_rounds: Optional[int] = None,
+    ) -> list[list[ExperienceOutput | APIExperienceOutput]]:
+        """
+        Rolls out ``idxs[i]`` on ``self.tasks[i]``, interleaving the episodes of
+        all tasks. Returns the experiences grouped by task.
+        """
+        scheduler = RolloutScheduler(
+            self.agent,
+            self.tasks[: len(idxs)],
+            max_concurrency=(
+                self.max_concurrency[: len(idxs)]
+                if self.max_concurrency is not None
+                else None
+            ),
+            max_batch_size=self.max_batch_size,
+        )
+        return scheduler.run(idxs, generation_config, max_rounds)
 
     def generate_experience(
         self,
@@ -215,26 +243,18 @@ class BaseAgentEnvController:
         generation_config: Optional[GenerationConfig] = None,
         max_rounds: Optional[int] = None,
     ) -> list[ExperienceOutput | APIExperienceOutput]:
-        experience = []
         if isinstance(idxs[0], int):
-            experience += self.tasks[0].generate_experience(
-                self.agent,
-                idxs,
-                generation_config,
-                max_rounds,
+            grouped = self.generate_experience_by_task(
+                [idxs], generation_config, max_rounds
             )
         elif isinstance(idxs[0], Sequence):
-            for idx, task in enumerate(self.tasks):
-                experience += task.generate_experience(
-                    self.agent,
-                    idxs[idx],
-                    generation_config,
-                    max_rounds,
-                )
+            grouped = self.generate_experience_by_task(
+                idxs, generation_config, max_rounds
+            )
         else:
             raise ValueError("Incorrect Format for idxs")
 
-        return experience
+        return [exp for task_experience in grouped for exp in task_experience]
 
 
 class Evaluator(BaseAgentEnvController):
@@ -255,7 +275,7 @@ class Evaluator(BaseAgentEnvController):
         )
         rewards = np.array([exp.reward for exp in exps])
         return EvaluationOutput(
-            experiences=exps, score=rewards.mean(), success=(rewards == 1 or rewards == 100).mean()
+            experiences=exps, score=rewards.mean(), success=((rewards == 1) | (rewards == 100)).mean()
         )
 
 
@@ -279,7 +299,7 @@ class BaseTrainer(BaseAgentEnvController):
         )
         rewards = np.array([exp.reward for exp in exps])
         return EvaluationOutput(
-            experiences=exps, score=rewards.mean(), success=(rewards == 1 or rewards == 100).mean()
+            experiences=exps, score=rewards.mean(), success=((rewards == 1) | (rewards == 100)).mean()
         )
 
     def save_model(self):
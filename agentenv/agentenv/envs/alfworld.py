@@ -1,4 +1,5 @@
 import json
+import logging
 from typing import Any, Mapping
 import re
 
@@ -9,10 +10,14 @@ from agentenv.controller import (
     BaseAdapter,
     BaseEnvClient,
     BaseTask,
+    CodeActionEvaluator,
     extract_python_code_blocks,
     format_code_as_action_prompt,
     format_function_call_prompt,
+    parse_function_call_json,
     parse_python_code_comments,
+    trace_headers,
+    trace_span,
 )
 from agentenv.controller.types import (
     ActionFormat,
@@ -24,6 +29,8 @@ from agentenv.controller.types import (
 from agentenv.controller import BaseEnvClient, BaseTask
 from agentenv.controller.types import ConversationMessage, StepOutput
 
+logger = logging.getLogger(__name__)
+
 
 ALFWORLD_FUNCTION_DESCRIPTION = [
         {
@@ -312,9 +319,7 @@ class AlfWorldAdapter(BaseAdapter):
 
     @staticmethod
     def parse_function_calling(text: str) -> ActionWithTought:
-        _fn_call = json.loads(
-            "{" + text.split("{", 1)[-1].rsplit("}", 1)[0] + "}", strict=False
-        )
+        _fn_call = parse_function_call_json(text)
         thought = _fn_call["thought"]
         fn_name = _fn_call["function_name"].strip()
         args = _fn_call["arguments"]
@@ -390,88 +395,11 @@ class AlfWorldAdapter(BaseAdapter):
     
     @staticmethod
     def parse_code_as_action(text: str) -> ActionWithTought:
-        def goto(recep: str):
-            action_name = AlfWorldAdapter.function_to_name["goto"]
-            return f"{action_name} {recep}"
-        
-        def take(obj: str, recep: str):
-            action_name = AlfWorldAdapter.function_to_name["take"]
-            conjunction = AlfWorldAdapter.conjunction_words["take"]
-            return f"{action_name} {obj} {conjunction} {recep}"
-        
-        def put(obj: str, recep: str):
-            action_name = AlfWorldAdapter.function_to_name["put"]
-            conjunction = AlfWorldAdapter.conjunction_words["put"]
-            return f"{action_name} {obj} {conjunction} {recep}"
-        
-        def toggle(recep: str):
-            action_name = AlfWorldAdapter.function_to_name["toggle"]
-            return f"{action_name} {recep}"
-        
-        def open(recep: str):
-            action_name = AlfWorldAdapter.function_to_name["open"]
-            return f"{action_name} {recep}"
-        
-        def close(recep: str):
-            action_name = AlfWorldAdapter.function_to_name["close"]
-            return f"{action_name} {recep}"
-        
-        def heat(obj: str, recep: str):
-            action_name = AlfWorldAdapter.function_to_name["heat"]
-            conjunction = AlfWorldAdapter.conjunction_words["heat"]
-            return f"{action_name} {obj} {conjunction} {recep}"
-        
-        def cool(obj: str, recep: str):
-            action_name = AlfWorldAdapter.function_to_name["cool"]
-            conjunction = AlfWorldAdapter.conjunction_words["cool"]
-            return f"{action_name} {obj} {conjunction} {recep}"
-        
-        def clean(obj: str, recep: str):
-            action_name = AlfWorldAdapter.function_to_name["clean"]
-            conjunction = AlfWorldAdapter.conjunction_words["clean"]
-            return f"{action_name} {obj} {conjunction} {recep}"
-        
-        def examine(recep: str, obj: str=''): # obj is optional
-            action_name = AlfWorldAdapter.function_to_name["examine"]
-            conjunction = AlfWorldAdapter.conjunction_words["examine"]
-            return f"{action_name} {recep} {conjunction} {obj}" if obj else f"{action_name} {recep}"
-        
-        def inventory():
-            action_name = AlfWorldAdapter.function_to_name["inventory"]
-            return f"{action_name}"
-        
-        def look():
-            action_name = AlfWorldAdapter.function_to_name["look"]
-            return f"{action_name}"
-        
-        def use(obj:str):
-            action_name = AlfWorldAdapter.function_to_name["use"]
-            return f"{action_name} {obj}"
         code = extract_python_code_blocks(text)
-
-        try:
-            action = eval(code, {
-                "goto": goto,
-                "take": take,
-                "put": put,
-                "toggle": toggle,
-                "open": open,
-                "close": close,
-                "heat": heat,
-                "cool": cool,
-                "clean": clean,
-                "examine": examine,
-                "inventory": inventory,
-                "look": look,
-                "use": use
-            })
-        except Exception as e:
-            print(e)
-            raise ValueError(f"Invalid action:{code}")
+        action = ALFWORLD_CODE_ACTION_EVALUATOR(code)
         thought = parse_python_code_comments(code)
         return ActionWithTought(thought=thought, action=action)
 
-
     @staticmethod
     def to_code_as_action(action_with_thought: ActionWithTought) -> str:
         text = f"```python\n#{action_with_thought.thought}\n"
@@ -512,6 +440,96 @@ class AlfWorldAdapter(BaseAdapter):
         
 
 
+def _goto(recep: str):
+    action_name = AlfWorldAdapter.function_to_name["goto"]
+    return f"{action_name} {recep}"
+
+
+def _take(obj: str, recep: str):
+    action_name = AlfWorldAdapter.function_to_name["take"]
+    conjunction = AlfWorldAdapter.conjunction_words["take"]
+    return f"{action_name} {obj} {conjunction} {recep}"
+
+
+def _put(obj: str, recep: str):
+    action_name = AlfWorldAdapter.function_to_name["put"]
+    conjunction = AlfWorldAdapter.conjunction_words["put"]
+    return f"{action_name} {obj} {conjunction} {recep}"
+
+
+def _toggle(recep: str):
+    action_name = AlfWorldAdapter.function_to_name["toggle"]
+    return f"{action_name} {recep}"
+
+
+def _open(recep: str):
+    action_name = AlfWorldAdapter.function_to_name["open"]
+    return f"{action_name} {recep}"
+
+
+def _close(recep: str):
+    action_name = AlfWorldAdapter.function_to_name["close"]
+    return f"{action_name} {recep}"
+
+
+def _heat(obj: str, recep: str):
+    action_name = AlfWorldAdapter.function_to_name["heat"]
+    conjunction = AlfWorldAdapter.conjunction_words["heat"]
+    return f"{action_name} {obj} {conjunction} {recep}"
+
+
+def _cool(obj: str, recep: str):
+    action_name = AlfWorldAdapter.function_to_name["cool"]
+    conjunction = AlfWorldAdapter.conjunction_words["cool"]
+    return f"{action_name} {obj} {conjunction} {recep}"
+
+
+def _clean(obj: str, recep: str):
+    action_name = AlfWorldAdapter.function_to_name["clean"]
+    conjunction = AlfWorldAdapter.conjunction_words["clean"]
+    return f"{action_name} {obj} {conjunction} {recep}"
+
+
+def _examine(recep: str, obj: str=''): # obj is optional
+    action_name = AlfWorldAdapter.function_to_name["examine"]
+    conjunction = AlfWorldAdapter.conjunction_words["examine"]
+    return f"{action_name} {recep} {conjunction} {obj}" if obj else f"{action_name} {recep}"
+
+
+def _inventory():
+    action_name = AlfWorldAdapter.function_to_name["inventory"]
+    return f"{action_name}"
+
+
+def _look():
+    action_name = AlfWorldAdapter.function_to_name["look"]
+    return f"{action_name}"
+
+
+def _use(obj:str):
+    action_name = AlfWorldAdapter.function_to_name["use"]
+    return f"{action_name} {obj}"
+
+
+ALFWORLD_CODE_ACTION_EVALUATOR = CodeActionEvaluator(
+    {
+        "goto": _goto,
+        "take": _take,
+        "put": _put,
+        "toggle": _toggle,
+        "open": _open,
+        "close": _close,
+        "heat": _heat,
+        "cool": _cool,
+        "clean": _clean,
+        "examine": _examine,
+        "inventory": _inventory,
+        "look": _look,
+        "use": _use,
+    }
+)
+
+
 class AlfWorldEnvClient(BaseEnvClient):
     adapter_cls = AlfWorldAdapter
     
@@ -546,11 +564,13 @@ class AlfWorldEnvClient(BaseEnvClient):
 
     def _post(self, path: str, data: dict[str, Any]) -> dict[str, Any]:
         data["env_id"] = self.env_id
-        res = requests.post(
-            f"{self.env_server_base}/{path}",
-            json=data,
-            timeout=self.timeout,
-        )
+        with trace_span(f"client.{path}"):
+            res = requests.post(
+                f"{self.env_server_base}/{path}",
+                json=data,
+                headers=trace_headers(),
+                timeout=self.timeout,
+            )
         assert res.status_code == 200
         return res.json()
 
@@ -558,6 +578,7 @@ class AlfWorldEnvClient(BaseEnvClient):
         res = requests.get(
             f"{self.env_server_base}/{path}?env_id={self.env_id}",
             timeout=self.timeout,
+            headers=trace_headers(),
         )
         assert res.status_code == 200
         return res.json()
@@ -569,9 +590,10 @@ class AlfWorldEnvClient(BaseEnvClient):
         if action.endswith("</s>"):
             action = action[:-5]
         try:
-            action = self.adapter_cls.action_parser(action, self.action_format)
+            with trace_span("client.parse"):
+                action = self.adapter_cls.action_parser(action, self.action_format)
         except Exception as e:
-            print(e, action)
+            logger.debug("Failed to parse action %r: %s", action, e)
             return StepOutput(
                 state="Invalid Action.\n\n" + self.observe(), reward=0.0, done=False
             )
@@ -1,4 +1,5 @@
 import json
+import logging
 import re
 from typing import Any, Mapping
 
@@ -9,10 +10,14 @@ from agentenv.controller import (
     BaseAdapter,
     BaseEnvClient,
     BaseTask,
+    CodeActionEvaluator,
     extract_python_code_blocks,
     format_code_as_action_prompt,
     format_function_call_prompt,
+    parse_function_call_json,
     parse_python_code_comments,
+    trace_headers,
+    trace_span,
 )
 from agentenv.controller.types import (
     ActionFormat,
@@ -21,6 +26,8 @@ from agentenv.controller.types import (
     StepOutput,
 )
 
+logger = logging.getLogger(__name__)
+
 # Five actions take two arguments, 16 take one argument, and four actions take zero arguments.
 SCIWORLD_FUNCTION_DESCRIPTION = [
     {
@@ -525,9 +532,7 @@ class SciWorldAdapter(BaseAdapter):
 
     @staticmethod
     def parse_function_calling(text: str) -> ActionWithTought:
-        _fn_call = json.loads(
-            "{" + text.split("{", 1)[-1].rsplit("}", 1)[0] + "}", strict=False
-        )
+        _fn_call = parse_function_call_json(text)
         thought = _fn_call["thought"]
         fn_name = _fn_call["function_name"].strip()
         args = _fn_call["arguments"]
@@ -608,139 +613,8 @@ class SciWorldAdapter(BaseAdapter):
 
     @staticmethod
     def parse_code_as_action(text: str) -> ActionWithTought:
-        def open(obj: str):
-            action_name = SciWorldAdapter.function_to_name["open"]
-            return f"{action_name} {obj}"
-
-        def close(obj: str):
-            action_name = SciWorldAdapter.function_to_name["close"]
-            return f"{action_name} {obj}"
-
-        def activate(obj: str):
-            action_name = SciWorldAdapter.function_to_name["activate"]
-            return f"{action_name} {obj}"
-
-        def deactivate(obj: str):
-            action_name = SciWorldAdapter.function_to_name["deactivate"]
-            return f"{action_name} {obj}"
-
-        def connect(obj1: str, obj2: str):
-            action_name = SciWorldAdapter.function_to_name["connect"]
-            conjuction = SciWorldAdapter.conjunction_words["connect"]
-            return f"{action_name} {obj1} {conjuction} {obj2}"
-
-        def disconnect(obj: str):
-            action_name = SciWorldAdapter.function_to_name["disconnect"]
-            return f"{action_name} {obj}"
-
-        def use(tool: str, obj: str=''):
-            action_name = SciWorldAdapter.function_to_name["use"]
-            conjuction = SciWorldAdapter.conjunction_words["use"]
-            return f"{action_name} {tool} {conjuction} {obj}" if obj else f"{action_name} {tool}"
-
-        def lookaround():
-            action_name = SciWorldAdapter.function_to_name["lookaround"]
-            return f"{action_name}"
-
-        def lookat(obj: str):
-            action_name = SciWorldAdapter.function_to_name["lookat"]
-            return f"{action_name} {obj}"
-
-        def read(obj: str):
-            action_name = SciWorldAdapter.function_to_name["read"]
-            return f"{action_name} {obj}"
-
-        def move(obj: str, container: str):
-            action_name = SciWorldAdapter.function_to_name["move"]
-            conjuction = SciWorldAdapter.conjunction_words["move"]
-            return f"{action_name} {obj} {conjuction} {container}"
-
-        def pickup(obj: str):
-            action_name = SciWorldAdapter.function_to_name["pickup"]
-            return f"{action_name} {obj}" 
-
-        def drop(obj: str):
-            action_name = SciWorldAdapter.function_to_name["drop"]
-            return f"{action_name} {obj}" 
-
-        def pour(liq: str, container: str):
-            action_name = SciWorldAdapter.function_to_name["pour"]
-            conjuction = SciWorldAdapter.conjunction_words["pour"]
-            return f"{action_name} {liq} {conjuction} {container}" 
-
-        def dunk(container: str, liq: str):
-            action_name = SciWorldAdapter.function_to_name["dunk"]
-            conjuction = SciWorldAdapter.conjunction_words["dunk"]
-            return f"{action_name} {container} {conjuction} {liq}" 
-
-        def mix(container: str):
-            action_name = SciWorldAdapter.function_to_name["mix"]
-            return f"{action_name} {container}" 
-
-        def goto(loc: str):
-            action_name = SciWorldAdapter.function_to_name["goto"]
-            return f"{action_name} {loc}"  
-
-        def eat(food: str):
-            action_name = SciWorldAdapter.function_to_name["eat"]
-            return f"{action_name} {food}" 
-
-        def flush(obj: str):
-            action_name = SciWorldAdapter.function_to_name["flush"]
-            return f"{action_name} {obj}" 
-
-        def focus(obj: str):
-            action_name = SciWorldAdapter.function_to_name["focus"]
-            return f"{action_name} {obj}"
-
-        def wait(duration: str):
-            action_name = SciWorldAdapter.function_to_name["wait"]
-            return f"{action_name}{duration}"
-
-        def choose(option: str):
-            return f"{option}"
-
-        def examine(obj: str):
-            action_name = SciWorldAdapter.function_to_name["examine"]
-            return f"{action_name} {obj}"
-
-        def task():
-            return f"{SciWorldAdapter.function_to_name['task']}"
-
-        def inventory():
-            return f"{SciWorldAdapter.function_to_name['inventory']}"
-
         code = extract_python_code_blocks(text)
-        try:
-            action = eval(code, {
-                "open": open,
-                "close" : close,
-                "activate": activate,
-                "deactivate": deactivate,
-                "connect": connect,
-                "disconnect": disconnect,
-                "use": use,
-                "lookaround": lookaround,
-                "lookat": lookat,
-                "read": read,
-                "move": move,
-                "pickup": pickup,
-                "drop": drop,
-                "pour": pour,
-                "dunk": dunk,
-                "mix": mix,
-                "goto": goto,
-                "eat": eat,
-                "flush": flush,
-                "focus": focus,
-                "wait": wait,
-                "choose": choose,
-                "examine": examine,
-                "task": task,
-                "inventory": inventory
-            })
-        except Exception as e:
-            raise ValueError(f"Invalid action:{code}") from e  
+        action = SCIWORLD_CODE_ACTION_EVALUATOR(code)
         thought = parse_python_code_comments(code)
         return ActionWithTought(thought=thought, action=action)
 
@@ -790,6 +664,165 @@ class SciWorldAdapter(BaseAdapter):
         text += "\n```"
         return text
 
+
+def _open(obj: str):
+    action_name = SciWorldAdapter.function_to_name["open"]
+    return f"{action_name} {obj}"
+
+
+def _close(obj: str):
+    action_name = SciWorldAdapter.function_to_name["close"]
+    return f"{action_name} {obj}"
+
+
+def _activate(obj: str):
+    action_name = SciWorldAdapter.function_to_name["activate"]
+    return f"{action_name} {obj}"
+
+
+def _deactivate(obj: str):
+    action_name = SciWorldAdapter.function_to_name["deactivate"]
+    return f"{action_name} {obj}"
+
+
+def _connect(obj1: str, obj2: str):
+    action_name = SciWorldAdapter.function_to_name["connect"]
+    conjuction = SciWorldAdapter.conjunction_words["connect"]
+    return f"{action_name} {obj1} {conjuction} {obj2}"
+
+
+def _disconnect(obj: str):
+    action_name = SciWorldAdapter.function_to_name["disconnect"]
+    return f"{action_name} {obj}"
+
+
+def _use(tool: str, obj: str=''):
+    action_name = SciWorldAdapter.function_to_name["use"]
+    conjuction = SciWorldAdapter.conjunction_words["use"]
+    return f"{action_name} {tool} {conjuction} {obj}" if obj else f"{action_name} {tool}"
+
+
+def _lookaround():
+    action_name = SciWorldAdapter.function_to_name["lookaround"]
+    return f"{action_name}"
+
+
+def _lookat(obj: str):
+    action_name = SciWorldAdapter.function_to_name["lookat"]
+    return f"{action_name} {obj}"
+
+
+def _read(obj: str):
+    action_name = SciWorldAdapter.function_to_name["read"]
+    return f"{action_name} {obj}"
+
+
+def _move(obj: str, container: str):
+    action_name = SciWorldAdapter.function_to_name["move"]
+    conjuction = SciWorldAdapter.conjunction_words["move"]
+    return f"{action_name} {obj} {conjuction} {container}"
+
+
+def _pickup(obj: str):
+    action_name = SciWorldAdapter.function_to_name["pickup"]
+    return f"{action_name} {obj}"
+
+
+def _drop(obj: str):
+    action_name = SciWorldAdapter.function_to_name["drop"]
+    return f"{action_name} {obj}"
+
+
+def _pour(liq: str, container: str):
+    action_name = SciWorldAdapter.function_to_name["pour"]
+    conjuction = SciWorldAdapter.conjunction_words["pour"]
+    return f"{action_name} {liq} {conjuction} {container}"
+
+
+def _dunk(container: str, liq: str):
+    action_name = SciWorldAdapter.function_to_name["dunk"]
+    conjuction = SciWorldAdapter.conjunction_words["dunk"]
+    return f"{action_name} {container} {conjuction} {liq}"
+
+
+def _mix(container: str):
+    action_name = SciWorldAdapter.function_to_name["mix"]
+    return f"{action_name} {container}"
+
+
+def _goto(loc: str):
+    action_name = SciWorldAdapter.function_to_name["goto"]
+    return f"{action_name} {loc}"
+
+
+def _eat(food: str):
+    action_name = SciWorldAdapter.function_to_name["eat"]
+    return f"{action_name} {food}"
+
+
+def _flush(obj: str):
+    action_name = SciWorldAdapter.function_to_name["flush"]
+    return f"{action_name} {obj}"
+
+
+def _focus(obj: str):
+    action_name = SciWorldAdapter.function_to_name["focus"]
+    return f"{action_name} {obj}"
+
+
+def _wait(duration: str):
+    action_name = SciWorldAdapter.function_to_name["wait"]
+    return f"{action_name}{duration}"
+
+
+def _choose(option: str):
+    return f"{option}"
+
+
+def _examine(obj: str):
+    action_name = SciWorldAdapter.function_to_name["examine"]
+    return f"{action_name} {obj}"
+
+
+def _task():
+    return f"{SciWorldAdapter.function_to_name['task']}"
+
+
+def _inventory():
+    return f"{SciWorldAdapter.function_to_name['inventory']}"
+
+
+SCIWORLD_CODE_ACTION_EVALUATOR = CodeActionEvaluator(
+    {
+        "open": _open,
+        "close": _close,
+        "activate": _activate,
+        "deactivate": _deactivate,
+        "connect": _connect,
+        "disconnect": _disconnect,
+        "use": _use,
+        "lookaround": _lookaround,
+        "lookat": _lookat,
+        "read": _read,
+        "move": _move,
+        "pickup": _pickup,
+        "drop": _drop,
+        "pour": _pour,
+        "dunk": _dunk,
+        "mix": _mix,
+        "goto": _goto,
+        "eat": _eat,
+        "flush": _flush,
+        "focus": _focus,
+        "wait": _wait,
+        "choose": _choose,
+        "examine": _examine,
+        "task": _task,
+        "inventory": _inventory,
+    }
+)
+
+
 class SciworldEnvClient(BaseEnvClient):
     adapter_cls = SciWorldAdapter
 
@@ -815,11 +848,13 @@ class SciworldEnvClient(BaseEnvClient):
 
     def _post(self, path: str, data: dict[str, Any]) -> dict[str, Any]:
         data["env_id"] = self.env_id
-        res = requests.post(
-            f"{self.env_server_base}/{path}",
-            json=data,
-            timeout=self.timeout,
-        )
+        with trace_span(f"client.{path}"):
+            res = requests.post(
+                f"{self.env_server_base}/{path}",
+                json=data,
+                headers=trace_headers(),
+                timeout=self.timeout,
+            )
         assert res.status_code == 200
         return res.json()
 
@@ -827,6 +862,7 @@ class SciworldEnvClient(BaseEnvClient):
         res = requests.get(
             f"{self.env_server_base}/{path}?env_id={self.env_id}",
             timeout=self.timeout,
+            headers=trace_headers(),
         )
         assert res.status_code == 200
         return res.json()
@@ -838,9 +874,10 @@ class SciworldEnvClient(BaseEnvClient):
         if action.endswith("</s>"):
             action = action[:-5]
         try:
-            action = self.adapter_cls.action_parser(action, self.action_format)
+            with trace_span("client.parse"):
+                action = self.adapter_cls.action_parser(action, self.action_format)
         except Exception as e:
-            print(e, action)
+            logger.debug("Failed to parse action %r: %s", action, e)
             return StepOutput(
                 state="Invalid Action.\n\n" + self.observe(), reward=0.0, done=False
             )
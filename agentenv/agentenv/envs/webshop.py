@@ -1,4 +1,5 @@
 import json
+import logging
 from typing import Any, Mapping
 
 import requests
@@ -7,10 +8,14 @@ from agentenv.controller import (
     BaseAdapter,
     BaseEnvClient,
     BaseTask,
+    CodeActionEvaluator,
     extract_python_code_blocks,
     format_code_as_action_prompt,
     format_function_call_prompt,
+    parse_function_call_json,
     parse_python_code_comments,
+    trace_headers,
+    trace_span,
 )
 from agentenv.controller.types import (
     ActionFormat,
@@ -19,6 +24,8 @@ from agentenv.controller.types import (
     StepOutput,
 )
 
+logger = logging.getLogger(__name__)
+
 WEBSHOP_FUNCTION_DESCRIPTION = [
     {
         "name": "search",
@@ -50,6 +57,20 @@ WEBSHOP_FUNCTION_DESCRIPTION = [
     },
 ]
 
+
+def _search(keywords: str):
+    return f"search[{keywords}]"
+
+
+def _click(item: str):
+    return f"click[{item}]"
+
+
+WEBSHOP_CODE_ACTION_EVALUATOR = CodeActionEvaluator(
+    {"search": _search, "click": _click}
+)
+
+
 class WebshopAdapter(BaseAdapter):
     conversation_start_dict = {
         ActionFormat.REACT: (
@@ -86,9 +107,7 @@ class WebshopAdapter(BaseAdapter):
 
     @staticmethod
     def parse_function_calling(text: str) -> ActionWithTought:
-        _fn_call = json.loads(
-            "{" + text.split("{", 1)[-1].rsplit("}", 1)[0] + "}", strict=False
-        )
+        _fn_call = parse_function_call_json(text)
         thought = _fn_call["thought"]
         fn_name = _fn_call["function_name"]
         args = _fn_call["arguments"]
@@ -122,17 +141,8 @@ class WebshopAdapter(BaseAdapter):
 
     @staticmethod
     def parse_code_as_action(text: str) -> ActionWithTought:
-        def search(keywords: str):
-            return f"search[{keywords}]"
-
-        def click(item: str):
-            return f"click[{item}]"
-
         text = extract_python_code_blocks(text)
-        try:
-            action = eval(text, {}, {"search": search, "click": click})
-        except Exception as e:
-            raise ValueError("Invalid action.") from e
+        action = WEBSHOP_CODE_ACTION_EVALUATOR(text)
         thought = parse_python_code_comments(text)
         return ActionWithTought(thought=thought, action=action)
 
@@ -176,11 +186,13 @@ class WebshopEnvClient(BaseEnvClient):
         data["env_id"] = self.env_id
         max_retries = 5
         for attempt in range(max_retries):
-            res = requests.post(
-                f"{self.env_server_base}/{path}",
-                json=data,
-                timeout=self.timeout,
-            )
+            with trace_span(f"client.{path}", attempt=attempt):
+                res = requests.post(
+                    f"{self.env_server_base}/{path}",
+                    json=data,
+                    headers=trace_headers(),
+                    timeout=self.timeout,
+                )
             if res.status_code == 503:
                 import time
 
@@ -198,6 +210,7 @@ class WebshopEnvClient(BaseEnvClient):
         res = requests.get(
             f"{self.env_server_base}/{path}?env_id={self.env_id}",
             timeout=self.timeout,
+            headers=trace_headers(),
         )
         assert res.status_code == 200
         return res.json()
@@ -210,10 +223,10 @@ class WebshopEnvClient(BaseEnvClient):
         if action.endswith("</s>"):
             action = action[:-5]
         try:
-            action = WebshopAdapter.action_parser(action, self.action_format)
-            print(action)
+            with trace_span("client.parse"):
+                action = WebshopAdapter.action_parser(action, self.action_format)
         except Exception as e:
-            print(e, action)
+            logger.debug("Failed to parse action %r: %s", action, e)
             return StepOutput(
                 state="Invalid Action.\n\n" + self.observe(), reward=0.0, done=False
             )
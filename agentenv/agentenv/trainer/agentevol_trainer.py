@@ -1,5 +1,7 @@
+import copy
 import json
 import os
+import time
 from collections import defaultdict
 from dataclasses import asdict
 from datetime import timedelta
@@ -11,10 +13,27 @@ import numpy as np
 import torch
 import wandb
 from accelerate import Accelerator, InitProcessGroupKwargs
-from accelerate.utils import broadcast, gather_object
+from accelerate.utils import broadcast
 from agentenv.controller.agent import Agent
 from agentenv.controller.task import BaseTask, GenerationConfig
+from agentenv.controller.trajectory_trie import TrajectoryTrie
 from agentenv.controller.utils import BaseTrainer
+from agentenv.trainer.async_rollout import (
+    DEFAULT_MAX_STALENESS,
+    DEFAULT_POLICY_SYNC_STEPS,
+    PolicyStore,
+    ReplayBuffer,
+    RolloutWorker,
+    pad_and_concat,
+)
+from agentenv.trainer.packing import PackedDataset, packed_collate_fn
+from agentenv.trainer.rollout_writer import (
+    REWARD_THRESHOLDS,
+    RolloutShardWriter,
+    merge_rollout_shards,
+)
+from agentenv.trainer.sampler import LengthGroupedBatchSampler
+from agentenv.trainer.tokenization import tokenize_dataset, tokenize_fn
 from agentenv.trainer.utils import set_seed
 from datasets import Dataset, DatasetDict
 from torch.utils.data import DataLoader
@@ -46,6 +65,11 @@ class AgentEvolTrainer(BaseTrainer):
         self.best_eval_log_dict = {}
         self.summary_log_dict = {}
 
+        # asynchronous rollouts
+        self.policy_store = None
+        self.replay_buffer = None
+        self.rollout_worker = None
+
         self.create_accelerator()
         self.set_seed()
         self.setup_tokenizer()
@@ -95,68 +119,19 @@ class AgentEvolTrainer(BaseTrainer):
         create train_dataset 和 train_dataloader
         """
 
-        def tokenize_fn(batch, args, tokenizer):
-            # tokenizer.chat_template = "{% if messages[0]['role'] == 'system' %}{% set loop_messages = messages[1:] %}{% set system_message = messages[0]['content'] %}{% else %}{% set loop_messages = messages %}{% set system_message = false %}{% endif %}{% for message in loop_messages %}{% if (message['role'] == 'user') != (loop.index0 % 2 == 0) %}{{ raise_exception('Conversation roles must alternate user/assistant/user/assistant/...') }}{% endif %}{% if loop.index0 == 0 and system_message != false %}{% set content = '<<SYS>>\\n' + system_message + '\\n<</SYS>>\\n\\n' + message['content'] %}{% else %}{% set content = message['content'] %}{% endif %}{% if message['role'] == 'user' %}{{ bos_token + '[INST] ' + content | trim + ' [/INST]' }}{% elif message['role'] == 'assistant' %}{{ ' '  + content | trim + ' ' + eos_token }}{% endif %}{% endfor %}"
-            assert tokenizer.eos_token_id is not None, (
-                tokenizer.eos_token_id,
-                tokenizer.eos_token,
+        with self.accelerator.main_process_first():
+            tokenized_dataset = DatasetDict(
+                {
+                    "train": tokenize_dataset(
+                        self.raw_dataset["train"],
+                        self.agent.tokenizer,
+                        self.agent.chat_template,
+                        self.args["max_input_length"],
+                        cache_dir=self.args.get("tokenization_cache_dir"),
+                        print_fn=self.accelerator.print,
+                    )
+                }
             )
-            new_batch = defaultdict(list)
-            all_keys = list(batch.keys())
-            for item_values in zip(*(batch[k] for k in all_keys)):
-                item = {k: item_values[i] for i, k in enumerate(all_keys)}
-                item_id, conversations = (item["item_id"], item["conversations"])
-
-                input_ids = []
-                labels = []
-                for message in conversations:
-                    if message["from"] == "human":
-                        text = f"<s>[INST] {message['value']} [/INST]"
-                        input_encode = tokenizer.encode(text, add_special_tokens=False)
-                        input_ids.extend(input_encode)
-                        labels.extend([-100] * len(input_encode))
-                    else:
-                        # message["from"] == "gpt":
-                        text = f" {message['value']}"
-                        input_encode = tokenizer.encode(text, add_special_tokens=False)
-                        input_encode += [tokenizer.eos_token_id]
-                        input_ids.extend(input_encode)
-                        labels.extend(input_encode)
-
-                attention_mask = [1] * len(input_ids)
-
-                # Truncation
-                input_ids_max_length = len(input_ids)
-                # assert input_ids_max_length <= args['max_input_length'], input_ids_max_length
-                input_ids = input_ids[: args["max_input_length"]]
-                labels = labels[: args["max_input_length"]]
-                attention_mask = attention_mask[: args["max_input_length"]]
-
-                ##
-                new_batch["input_ids"].append(input_ids)
-                new_batch["labels"].append(labels)
-                new_batch["attention_mask"].append(attention_mask)
-                ##
-                new_batch["item_id"].append(item_id)
-                new_batch["input_ids_max_length"].append(input_ids_max_length)
-
-            return new_batch
-
-        tokenized_dataset = DatasetDict(
-            {
-                "train": self.raw_dataset["train"].map(
-                    tokenize_fn,
-                    fn_kwargs={
-                        "args": self.args,
-                        "tokenizer": self.agent.tokenizer,
-                    },
-                    batched=True,
-                    remove_columns=self.raw_dataset["train"].column_names,
-                    num_proc=8,
-                    load_from_cache_file=False,
-                )
-            }
-        )
         self.accelerator.print("Processed data:", tokenized_dataset)
         for mode, dataset in tokenized_dataset.items():
             self.accelerator.print(
@@ -185,17 +160,57 @@ class AgentEvolTrainer(BaseTrainer):
                 "attention_mask": torch.BoolTensor(attention_mask),
                 "labels": torch.LongTensor(labels),
             }
-            return {"forward_kwargs": forward_kwargs}
+            return {
+                "forward_kwargs": forward_kwargs,
+                "num_tokens": sum(len(item["input_ids"]) for item in batch),
+            }
 
         self.train_dataset = tokenized_dataset["train"]
-        self.train_dataloader = DataLoader(
-            tokenized_dataset["train"],
-            shuffle=True,
-            batch_size=self.args["batch_size"],
-            num_workers=self.args["num_workers"],
-            pin_memory=True,
-            collate_fn=partial(collate_fn, tokenizer=self.agent.tokenizer),
-        )
+        train_data = tokenized_dataset["train"]
+        train_collate_fn = partial(collate_fn, tokenizer=self.agent.tokenizer)
+        if self.args.get("packing"):
+            pack_length = self.args.get("pack_length") or self.args["max_input_length"]
+            train_data = PackedDataset(tokenized_dataset["train"], pack_length)
+            self.accelerator.print(
+                f"Packed {len(self.train_dataset)} conversations into {len(train_data)} rows "
+                f"of {pack_length} tokens, packing efficiency: {train_data.efficiency:.4f}"
+            )
+            train_collate_fn = partial(
+                packed_collate_fn,
+                tokenizer=self.agent.tokenizer,
+                pack_length=pack_length,
+                # flash-attention-2 separates documents on position_ids
+                document_mask=self.agent.model.config._attn_implementation
+                != "flash_attention_2",
+                mask_dtype=self.agent.model.dtype,
+            )
+        if self.args.get("group_by_length") and not self.args.get("packing"):
+            # seeded without process_index: every process builds the same batches
+            batch_sampler = LengthGroupedBatchSampler(
+                [
+                    min(length, self.args["max_input_length"])
+                    for length in self.train_dataset["input_ids_max_length"]
+                ],
+                self.args["batch_size"],
+                seed=self.args["seed"],
+                num_processes=self.accelerator.num_processes,
+            )
+            self.train_dataloader = DataLoader(
+                train_data,
+                batch_sampler=batch_sampler,
+                num_workers=self.args["num_workers"],
+                pin_memory=True,
+                collate_fn=train_collate_fn,
+            )
+        else:
+            self.train_dataloader = DataLoader(
+                train_data,
+                shuffle=True,
+                batch_size=self.args["batch_size"],
+                num_workers=self.args["num_workers"],
+                pin_memory=True,
+                collate_fn=train_collate_fn,
+            )
         self.accelerator.print("Number of train batches:", len(self.train_dataloader))
 
     def get_inference_test_dataloader(self):
@@ -230,7 +245,7 @@ class AgentEvolTrainer(BaseTrainer):
         """
         Set the wandb.
         """
-        if torch.distributed.get_rank() == 0 and self.args["wandb_log"]:
+        if self.args["wandb_log"] and torch.distributed.get_rank() == 0:
             wandb.init(
                 project=self.args["wandb_project"],
                 name=self.args["wandb_run_name"],
@@ -328,6 +343,7 @@ class AgentEvolTrainer(BaseTrainer):
         logging_step_freq = self.args.get("logging_step_freq", None)
         self.agent.model.train()
         epoch_result_dict = defaultdict(list)
+        num_tokens, start_time = 0, time.perf_counter()
         with tqdm(
             enumerate(self.train_dataloader),
             total=len(self.train_dataloader),
@@ -335,11 +351,18 @@ class AgentEvolTrainer(BaseTrainer):
             desc=f"Train Loop | Epoch {epoch}",
         ) as t:
             for idx, batch in t:
+                if self.rollout_worker is not None:
+                    batch = self.add_replay(batch)
                 with self.accelerator.accumulate(self.agent.model):
                     output = self.agent.model(**batch["forward_kwargs"])
                     # Get some metrics
                     loss = output[0]
                     result_dict, extra = {}, None
+                    num_tokens += batch["num_tokens"]
+                    if "replay_size" in batch:
+                        result_dict["replay_size"] = batch["replay_size"]
+                    if "packing_efficiency" in batch:
+                        result_dict["packing_efficiency"] = batch["packing_efficiency"]
                     # Update
                     self.accelerator.backward(loss)
                     if self.accelerator.sync_gradients:
@@ -352,6 +375,8 @@ class AgentEvolTrainer(BaseTrainer):
 
                 if self.accelerator.sync_gradients:
                     global_step += 1
+                    if self.rollout_worker is not None:
+                        self.sync_policy(global_step)
                     # Step update metric
                     epoch_result_dict["loss"].append(loss.item())
                     for k, v in result_dict.items():
@@ -390,6 +415,14 @@ class AgentEvolTrainer(BaseTrainer):
         epoch_result_dict = {
             k: (sum(v) / len(v) if isinstance(v, list) else v) for k, v in epoch_result_dict.items()
         }
+        # Throughput of all processes: real (non-padding) tokens per second
+        elapsed = time.perf_counter() - start_time
+        total_tokens = self.accelerator.gather(torch.tensor([num_tokens], device=self.accelerator.device)).sum().item()
+        epoch_result_dict["tokens_per_sec"] = total_tokens / max(elapsed, 1e-6)
+        self.accelerator.print(
+            f"[E={epoch}/{self.args['n_epochs']}] {total_tokens} tokens in {elapsed:.1f}s, "
+            f"{epoch_result_dict['tokens_per_sec']:.1f} tokens/s"
+        )
         return epoch_result_dict, global_step
 
     def train(self):
@@ -517,7 +550,13 @@ class AgentEvolTrainer(BaseTrainer):
         all_rewards = []
         all_success = []
 
-        iter_data_file_path = os.path.join(self.args["iter_data_path"], f"webshop_iter_{iter + 1}.jsonl")
+        iter_data_file_path = os.path.join(self.args["iter_data_path"], f"{self.args['task_name']}_iter_{iter + 1}.jsonl")
+        inference_file_path = os.path.join(self.args["model_save_path"], f"inference_iter_{iter + 1}.jsonl")
+        # every rank streams its own shard, the main process merges them at the end
+        shard_dir = os.path.join(self.args["model_save_path"], f"inference_iter_{iter + 1}.shards")
+        rank = self.accelerator.process_index
+        writer = RolloutShardWriter(shard_dir, rank, REWARD_THRESHOLDS)
+        trajectory_trie = TrajectoryTrie() if self.args.get("save_trajectory_trie") else None
 
         for _, batch in tqdm(
             enumerate(dataloader),
@@ -550,49 +589,55 @@ class AgentEvolTrainer(BaseTrainer):
                 cur_batch_success = torch.FloatTensor(
                     [1 if exp.reward == 1 else 0 for exp in exps.experiences]
                 ).to(self.accelerator.device)
-                cur_batch_data_idx = torch.tensor(data_idxs).to(self.accelerator.device)
 
-                # gather operation
+                # gather operation, only the rewards cross processes
                 all_device_batch_rewards = self.accelerator.gather(cur_batch_rewards)
                 all_device_batch_success = self.accelerator.gather(cur_batch_success)
-                all_device_batch_exp = gather_object(exps.experiences)
-                all_device_data_idx = self.accelerator.gather(cur_batch_data_idx)
                 all_rewards.extend(all_device_batch_rewards.cpu().numpy().tolist())
                 all_success.extend(all_device_batch_success.cpu().numpy().tolist())
 
-                # write inference results to file
-                if self.accelerator.is_main_process:
-                    inference_file_path = os.path.join(
-                        self.args["model_save_path"], f"inference_iter_{iter + 1}.jsonl"
-                    )
-                    with jsonlines.open(inference_file_path, mode="a") as f:
-                        for idx, exp in enumerate(all_device_batch_exp):
-                            cur_idx = all_device_data_idx[idx]
-                            conversation = exp.conversation
-                            cur_reward = exp.reward
-                            cur_success = 1 if exp.reward == 1 else 0
-                            item_id = f"{self.args['task_name']}_{cur_idx}"
-                            f.write(
-                                {
-                                    "conversations": conversation,
-                                    "item_id": item_id,
-                                    "reward": cur_reward,
-                                    "success": cur_success,
-                                }
-                            )
-                    # filter data with high reward
-                    with jsonlines.open(iter_data_file_path, mode="a") as f:
-                        for idx, exp in enumerate(all_device_batch_exp):
-                            if exp.reward > 0.99:
-                                cur_idx = all_device_data_idx[idx]
-                                conversation = exp.conversation
-                                item_id = f"webshop_{cur_idx}"
-                                f.write({"conversations": conversation, "item_id": item_id})
+                # write inference results and filtered data to this rank's shard
+                item_ids = [f"{self.args['task_name']}_{idx}" for idx in data_idxs]
+                writer.write_batch(item_ids, exps.experiences)
+                if trajectory_trie is not None:
+                    for item_id, exp in zip(item_ids, exps.experiences):
+                        trajectory_trie.add_experience(exp, item_id=item_id)
+
+        writer.close()
+        if trajectory_trie is not None:
+            trajectory_trie.save(os.path.join(shard_dir, f"rank{rank}.trie.npz"))
+        self.accelerator.wait_for_everyone()
 
         # fix for duplicated data
         all_rewards = all_rewards[: len(dataloader.dataset)]
         all_success = all_success[: len(dataloader.dataset)]
 
+        if self.accelerator.is_main_process:
+            index = merge_rollout_shards(
+                shard_dir, self.accelerator.num_processes, inference_file_path, iter_data_file_path
+            )
+            for task, stats in index["tasks"].items():
+                self.accelerator.print(
+                    f"[Filter] {task}: kept {stats['kept']} of {stats['episodes']} trajectories"
+                )
+
+        if trajectory_trie is not None and self.accelerator.is_main_process:
+            trajectory_trie = TrajectoryTrie()
+            for shard_rank in range(self.accelerator.num_processes):
+                trajectory_trie.extend(
+                    TrajectoryTrie.load(os.path.join(shard_dir, f"rank{shard_rank}.trie.npz"))
+                )
+            trie_path = os.path.join(
+                self.args["model_save_path"], f"inference_iter_{iter + 1}.trie.npz"
+            )
+            trajectory_trie.save(trie_path)
+            self.accelerator.print(
+                f"[Trajectory trie] {len(trajectory_trie)} trajectories, "
+                f"{trajectory_trie.num_tokens} tokens stored as "
+                f"{trajectory_trie.num_stored_tokens} "
+                f"({trajectory_trie.compression_ratio():.2f}x) in {trie_path}"
+            )
+
         if self.accelerator.is_main_process and self.accelerator.is_local_main_process:
             mean_reward = torch.FloatTensor([np.mean(all_rewards)]).to(self.accelerator.device)
             mean_success = torch.FloatTensor([np.mean(all_success)]).to(self.accelerator.device)
@@ -616,8 +661,140 @@ class AgentEvolTrainer(BaseTrainer):
 
         return {"score": mean_reward, "success": mean_success}
 
+    def start_rollout_worker(self):
+        """
+        Start the actor: a copy of the policy rolling out the inference set
+        into the replay buffer while the learner trains.
+        """
+        if self.args.get("packing"):
+            raise ValueError("async_rollouts does not support packing")
+        iter = self.args["iter_num"]
+        model = self.accelerator.unwrap_model(self.agent.model)
+        self.policy_store = PolicyStore()
+        self.policy_store.publish(model)
+        self.replay_buffer = ReplayBuffer(
+            self.args.get("replay_buffer_size") or 256,
+            max_staleness=self.args.get("max_staleness", DEFAULT_MAX_STALENESS),
+        )
+        actor_model = copy.deepcopy(model).eval().requires_grad_(False)
+        # own tokenizer: fast tokenizers must not be shared between threads
+        actor_tokenizer = copy.deepcopy(self.agent.tokenizer)
+        actor_agent = Agent(
+            actor_model,
+            actor_tokenizer,
+            self.agent.chat_template,
+            self.agent.inference_engine,
+        )
+
+        os.makedirs(self.args["model_save_path"], exist_ok=True)
+        rollout_file_path = os.path.join(
+            self.args["model_save_path"],
+            f"async_rollouts_iter_{iter + 1}_rank{self.accelerator.process_index}.jsonl",
+        )
+
+        def make_item(task_i, idx, exp, version):
+            item_id = f"{self.args['task_name']}_{idx}"
+            with jsonlines.open(rollout_file_path, mode="a") as f:
+                f.write(
+                    {
+                        "conversations": exp.conversation,
+                        "item_id": item_id,
+                        "reward": exp.reward,
+                        "success": 1 if exp.reward == 1 else 0,
+                        "policy_version": version,
+                    }
+                )
+            # filter data with high reward
+            if exp.reward <= 0.99:
+                return None
+            row = tokenize_fn(
+                {"item_id": [item_id], "conversations": [exp.conversation]},
+                actor_tokenizer,
+                self.agent.chat_template,
+                self.args["max_input_length"],
+            )
+            return {k: v[0] for k, v in row.items()}
+
+        # every process rolls out its own shard of the inference set
+        idxs = [int(item["item_id"].split("_")[-1]) for item in self.raw_dataset["inference"]]
+        idxs = idxs[self.accelerator.process_index :: self.accelerator.num_processes]
+        self.rollout_worker = RolloutWorker(
+            actor_agent,
+            self.tasks[:1],
+            [idxs],
+            self.policy_store,
+            self.replay_buffer,
+            make_item,
+            generation_config=GenerationConfig(
+                max_length=4096,
+                max_new_tokens=self.args.get("rollout_max_new_tokens"),
+                do_sample=True,
+                temperature=1.2,
+                eos_token_id=actor_tokenizer.eos_token_id,
+                pad_token_id=(
+                    actor_tokenizer.pad_token_id
+                    if actor_tokenizer.pad_token_id is not None
+                    else actor_tokenizer.unk_token_id
+                ),
+            ),
+            max_rounds=self.args["max_round"],
+            chunk_size=self.args.get("rollout_chunk_size") or 8,
+            seed=self.args["seed"] + self.accelerator.process_index,
+        )
+        self.rollout_worker.start()
+
+    def stop_rollout_worker(self):
+        worker, self.rollout_worker = self.rollout_worker, None
+        worker.stop()
+        worker.join()
+        episodes = worker.stats["episodes"]
+        self.accelerator.print(
+            f"[Async rollouts] {episodes} episodes, "
+            f"mean reward {worker.stats['reward_sum'] / max(1, episodes):.4f}, "
+            f"{worker.stats['kept']} kept, {worker.stats['syncs']} policy syncs, "
+            f"replay buffer {self.replay_buffer.stats}"
+        )
+        worker.check()
+
+    def add_replay(self, batch):
+        """
+        Append fresh filtered rollouts from the replay buffer to a train batch.
+        """
+        self.rollout_worker.check()
+        rows = self.replay_buffer.get(
+            self.args.get("replay_batch_size") or self.args["batch_size"],
+            self.policy_store.version,
+            timeout=self.args.get("replay_wait") or 0.0,
+        )
+        if not rows:
+            return batch
+        return {
+            **batch,
+            "forward_kwargs": pad_and_concat(
+                batch["forward_kwargs"], rows, self.agent.tokenizer.pad_token_id
+            ),
+            "num_tokens": batch["num_tokens"] + sum(len(row["input_ids"]) for row in rows),
+            "replay_size": len(rows),
+        }
+
+    def sync_policy(self, global_step):
+        """
+        Publish the learner's weights to the actor every policy_sync_steps steps.
+        """
+        if global_step % (self.args.get("policy_sync_steps", DEFAULT_POLICY_SYNC_STEPS)) == 0:
+            self.policy_store.publish(self.accelerator.unwrap_model(self.agent.model))
+
     def evol(self):
         self.accelerator.print(f"[Iter {self.args['iter_num']+1}]")
 
+        if self.args.get("async_rollouts"):
+            self.accelerator.print("[Agent Evol Trainer] Start training with asynchronous rollouts.")
+            self.start_rollout_worker()
+            try:
+                self.train()
+            finally:
+                self.stop_rollout_worker()
+            return
+
         self.accelerator.print("[Agent Evol Trainer] Start training.")
         self.train()
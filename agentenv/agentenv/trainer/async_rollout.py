@@ -0,0 +1,243 @@
+"""
+Actor/learner pieces for overlapping rollouts with training.
+
+A ``RolloutWorker`` thread keeps rolling out the inference tasks with its own
+copy of the policy (``actor_agent``) and puts the trajectories that pass the
+filter into a bounded ``ReplayBuffer``. The learner publishes its weights to a
+``PolicyStore`` every few optimizer steps; the worker picks them up before its
+next rollout chunk. Every trajectory is tagged with the policy version that
+produced it, and the buffer hands out only trajectories at most
+``max_staleness`` versions behind the learner. A full buffer blocks the
+worker, so rollouts never run far ahead of training.
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Optional, Sequence
+
+import torch
+from transformers import GenerationConfig
+
+from agentenv.controller import Agent, BaseTask, RolloutScheduler
+from agentenv.controller.types import ExperienceOutput
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_STALENESS = 2
+DEFAULT_POLICY_SYNC_STEPS = 10
+
+
+class ReplayBuffer:
+    def __init__(self, capacity: int, max_staleness: int = DEFAULT_MAX_STALENESS) -> None:
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.max_staleness = max_staleness
+        self._items: deque[tuple[int, Any]] = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+        self.stats = {"added": 0, "consumed": 0, "stale_dropped": 0}
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._items)
+
+    def put(self, item: Any, version: int, timeout: Optional[float] = None) -> bool:
+        """
+        Adds *item* produced by policy *version*, waiting while the buffer is
+        full. Returns False if the buffer was closed or *timeout* expired.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self._closed or len(self._items) < self.capacity, timeout
+            ):
+                return False
+            if self._closed:
+                return False
+            self._items.append((version, item))
+            self.stats["added"] += 1
+            self._cond.notify_all()
+            return True
+
+    def get(self, n: int, version: int, timeout: float = 0.0) -> list[Any]:
+        """
+        Takes up to *n* items, oldest first, waiting at most *timeout* seconds
+        for the first one. Items older than ``version - max_staleness`` are
+        dropped.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while self._items and version - self._items[0][0] > self.max_staleness:
+                    self._items.popleft()
+                    self.stats["stale_dropped"] += 1
+                remaining = deadline - time.monotonic()
+                if self._items or self._closed or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            items = []
+            while self._items and len(items) < n:
+                items.append(self._items.popleft()[1])
+            self.stats["consumed"] += len(items)
+            self._cond.notify_all()
+            return items
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class PolicyStore:
+    """The learner's latest weights, kept on CPU for the actors."""
+
+    def __init__(self) -> None:
+        self.version = 0
+        self._state_dict: Optional[dict[str, torch.Tensor]] = None
+        self._lock = threading.Lock()
+
+    def publish(self, model: torch.nn.Module) -> int:
+        state_dict = {
+            k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()
+        }
+        with self._lock:
+            self._state_dict = state_dict
+            self.version += 1
+            return self.version
+
+    def sync(self, model: torch.nn.Module, version: int) -> int:
+        """Loads the latest weights into *model* if newer than *version*."""
+        with self._lock:
+            if self._state_dict is None or self.version <= version:
+                return version
+            model.load_state_dict(self._state_dict)
+            return self.version
+
+
+class RolloutWorker(threading.Thread):
+    def __init__(
+        self,
+        agent: Agent,
+        tasks: Sequence[BaseTask],
+        idxs: Sequence[Sequence[int]],
+        policy: PolicyStore,
+        buffer: ReplayBuffer,
+        make_item: Callable[[int, int, ExperienceOutput, int], Optional[Any]],
+        generation_config: Optional[GenerationConfig] = None,
+        max_rounds: Optional[int] = None,
+        chunk_size: int = 8,
+        seed: int = 0,
+    ) -> None:
+        """
+        Args:
+            agent: The actor's agent; its model is only touched by this thread.
+            tasks, idxs: ``idxs[i]`` are the task ids rolled out on ``tasks[i]``,
+                cycled in a new random order every pass.
+            policy: Source of the learner's weights.
+            buffer: Destination of the filtered trajectories.
+            make_item: ``(task index, idx, experience, policy version)`` to
+                a buffer item, or None to filter the trajectory out.
+            chunk_size: Episodes per task and rollout chunk; the policy is
+                synced between chunks.
+        """
+        super().__init__(daemon=True, name="rollout-worker")
+        self.agent = agent
+        self.tasks = tasks
+        self.idxs = [list(task_idxs) for task_idxs in idxs]
+        self.policy = policy
+        self.buffer = buffer
+        self.make_item = make_item
+        self.generation_config = generation_config
+        self.max_rounds = max_rounds
+        self.chunk_size = chunk_size
+        self.rng = random.Random(seed)
+        self.version = policy.version
+        self.error: Optional[BaseException] = None
+        self.stats = {"episodes": 0, "kept": 0, "reward_sum": 0.0, "syncs": 0}
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.buffer.close()
+
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def _chunks(self):
+        queues = [deque() for _ in self.idxs]
+        while True:
+            for queue, task_idxs in zip(queues, self.idxs):
+                if len(queue) < self.chunk_size and task_idxs:
+                    order = list(task_idxs)
+                    self.rng.shuffle(order)
+                    queue.extend(order)
+            yield [
+                [queue.popleft() for _ in range(min(self.chunk_size, len(queue)))]
+                for queue in queues
+            ]
+
+    def run(self) -> None:
+        scheduler = RolloutScheduler(self.agent, self.tasks)
+        try:
+            for chunk in self._chunks():
+                if self.stopped():
+                    break
+                version = self.policy.sync(self.agent.model, self.version)
+                synced = version != self.version
+                if synced:
+                    self.stats["syncs"] += 1
+                    self.version = version
+                with torch.no_grad():
+                    # a vLLM engine holds its own copy of the weights
+                    grouped = scheduler.run(
+                        chunk, self.generation_config, self.max_rounds, refresh_engine=synced
+                    )
+                for task_i, (task_idxs, exps) in enumerate(zip(chunk, grouped)):
+                    for idx, exp in zip(task_idxs, exps):
+                        self.stats["episodes"] += 1
+                        self.stats["reward_sum"] += exp.reward
+                        item = self.make_item(task_i, idx, exp, self.version)
+                        if item is None:
+                            continue
+                        self.stats["kept"] += 1
+                        if not self.buffer.put(item, self.version):
+                            return
+        except BaseException as e:  # surfaced to the learner by check()
+            logger.exception("Rollout worker failed")
+            self.error = e
+            self.buffer.close()
+
+    def check(self) -> None:
+        """Re-raises a failure of the worker thread in the caller."""
+        if self.error is not None:
+            raise RuntimeError("Rollout worker failed") from self.error
+
+
+def pad_and_concat(
+    forward_kwargs: dict[str, torch.Tensor], rows: Sequence[dict], pad_token_id: int
+) -> dict[str, torch.Tensor]:
+    """
+    Appends tokenized *rows* (``input_ids``, ``labels``, ``attention_mask``)
+    to a padded batch, right-padding both to the same length.
+    """
+    length = max(
+        forward_kwargs["input_ids"].shape[1], max(len(row["input_ids"]) for row in rows)
+    )
+    device = forward_kwargs["input_ids"].device
+    pad_values = {"input_ids": pad_token_id, "labels": -100, "attention_mask": 0}
+    merged = {}
+    for key, pad_value in pad_values.items():
+        tensor = forward_kwargs[key]
+        tensor = torch.nn.functional.pad(
+            tensor, (0, length - tensor.shape[1]), value=pad_value
+        )
+        extra = torch.tensor(
+            [list(row[key]) + [pad_value] * (length - len(row[key])) for row in rows],
+            dtype=tensor.dtype,
+            device=device,
+        )
+        merged[key] = torch.cat([tensor, extra])
+    return merged
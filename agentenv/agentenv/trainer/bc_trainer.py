@@ -1,5 +1,6 @@
 import json
 import os
+import time
 from collections import defaultdict
 from dataclasses import asdict
 from datetime import timedelta
@@ -16,6 +17,9 @@ from agentenv.controller import Agent
 from agentenv.controller.agent import Agent
 from agentenv.controller.task import BaseTask
 from agentenv.controller.utils import BaseTrainer
+from agentenv.trainer.packing import PackedDataset, packed_collate_fn
+from agentenv.trainer.sampler import LengthGroupedBatchSampler
+from agentenv.trainer.tokenization import tokenize_dataset
 from agentenv.trainer.utils import set_seed
 from datasets import Dataset, DatasetDict
 from torch.utils.data import DataLoader
@@ -100,70 +104,19 @@ class BCTrainer(BaseTrainer):
         create train_dataset and train_dataloader
         """
 
-        def tokenize_fn(batch, args, tokenizer):
-            # tokenizer.chat_template = "{% if messages[0]['role'] == 'system' %}{% set loop_messages = messages[1:] %}{% set system_message = messages[0]['content'] %}{% else %}{% set loop_messages = messages %}{% set system_message = false %}{% endif %}{% for message in loop_messages %}{% if (message['role'] == 'user') != (loop.index0 % 2 == 0) %}{{ raise_exception('Conversation roles must alternate user/assistant/user/assistant/...') }}{% endif %}{% if loop.index0 == 0 and system_message != false %}{% set content = '<<SYS>>\\n' + system_message + '\\n<</SYS>>\\n\\n' + message['content'] %}{% else %}{% set content = message['content'] %}{% endif %}{% if message['role'] == 'user' %}{{ bos_token + '[INST] ' + content | trim + ' [/INST]' }}{% elif message['role'] == 'assistant' %}{{ ' '  + content | trim + ' ' + eos_token }}{% endif %}{% endfor %}"
-            assert tokenizer.eos_token_id is not None, (
-                tokenizer.eos_token_id,
-                tokenizer.eos_token,
+        with self.accelerator.main_process_first():
+            tokenized_dataset = DatasetDict(
+                {
+                    "train": tokenize_dataset(
+                        self.raw_dataset["train"],
+                        self.agent.tokenizer,
+                        self.agent.chat_template,
+                        self.args["max_input_length"],
+                        cache_dir=self.args.get("tokenization_cache_dir"),
+                        print_fn=self.accelerator.print,
+                    )
+                }
             )
-            new_batch = defaultdict(list)
-            all_keys = list(batch.keys())
-            for item_values in zip(*(batch[k] for k in all_keys)):
-                item = {k: item_values[i] for i, k in enumerate(all_keys)}
-                item_id, conversations = (item["item_id"], item["conversations"])
-
-                input_ids = []
-                labels = []
-
-                for message in conversations:
-                    if message["from"] == "human":
-                        text = f"<s>[INST] {message['value']} [/INST]"
-                        input_encode = tokenizer.encode(text, add_special_tokens=False)
-                        input_ids.extend(input_encode)
-                        labels.extend([-100] * len(input_encode))
-                    else:
-                        # message["from"] == "gpt":
-                        # text = f" {message['value']}</s>"
-                        text = f" {message['value']}"
-                        input_encode = tokenizer.encode(text, add_special_tokens=False)
-                        input_encode += [tokenizer.eos_token_id]
-                        input_ids.extend(input_encode)
-                        labels.extend(input_encode)
-
-                attention_mask = [1] * len(input_ids)
-
-                # Truncation
-                input_ids_max_length = len(input_ids)
-                # assert input_ids_max_length <= args['max_input_length'], input_ids_max_length
-                input_ids = input_ids[: args["max_input_length"]]
-                labels = labels[: args["max_input_length"]]
-                attention_mask = attention_mask[: args["max_input_length"]]
-
-                ##
-                new_batch["input_ids"].append(input_ids)
-                new_batch["labels"].append(labels)
-                new_batch["attention_mask"].append(attention_mask)
-                ##
-                new_batch["item_id"].append(item_id)
-                new_batch["input_ids_max_length"].append(input_ids_max_length)
-
-            return new_batch
-
-        tokenized_dataset = DatasetDict(
-            {
-                "train": self.raw_dataset["train"].map(
-                    tokenize_fn,
-                    fn_kwargs={
-                        "args": self.args,
-                        "tokenizer": self.agent.tokenizer,
-                    },
-                    batched=True,
-                    remove_columns=self.raw_dataset["train"].column_names,
-                    num_proc=8,
-                    load_from_cache_file=False,
-                )
-            }
-        )
         self.accelerator.print("Processed data:", tokenized_dataset)
         for mode, dataset in tokenized_dataset.items():
             self.accelerator.print(
@@ -197,17 +150,57 @@ class BCTrainer(BaseTrainer):
                 "attention_mask": torch.BoolTensor(attention_mask),
                 "labels": torch.LongTensor(labels),
             }
-            return {"forward_kwargs": forward_kwargs}
+            return {
+                "forward_kwargs": forward_kwargs,
+                "num_tokens": sum(len(item["input_ids"]) for item in batch),
+            }
 
         self.train_dataset = tokenized_dataset["train"]
-        self.train_dataloader = DataLoader(
-            tokenized_dataset["train"],
-            shuffle=True,
-            batch_size=self.args["batch_size"],
-            num_workers=self.args["num_workers"],
-            pin_memory=True,
-            collate_fn=partial(collate_fn, tokenizer=self.agent.tokenizer),
-        )
+        train_data = tokenized_dataset["train"]
+        train_collate_fn = partial(collate_fn, tokenizer=self.agent.tokenizer)
+        if self.args.get("packing"):
+            pack_length = self.args.get("pack_length") or self.args["max_input_length"]
+            train_data = PackedDataset(tokenized_dataset["train"], pack_length)
+            self.accelerator.print(
+                f"Packed {len(self.train_dataset)} conversations into {len(train_data)} rows "
+                f"of {pack_length} tokens, packing efficiency: {train_data.efficiency:.4f}"
+            )
+            train_collate_fn = partial(
+                packed_collate_fn,
+                tokenizer=self.agent.tokenizer,
+                pack_length=pack_length,
+                # flash-attention-2 separates documents on position_ids
+                document_mask=self.agent.model.config._attn_implementation
+                != "flash_attention_2",
+                mask_dtype=self.agent.model.dtype,
+            )
+        if self.args.get("group_by_length") and not self.args.get("packing"):
+            # seeded without process_index: every process builds the same batches
+            batch_sampler = LengthGroupedBatchSampler(
+                [
+                    min(length, self.args["max_input_length"])
+                    for length in self.train_dataset["input_ids_max_length"]
+                ],
+                self.args["batch_size"],
+                seed=self.args["seed"],
+                num_processes=self.accelerator.num_processes,
+            )
+            self.train_dataloader = DataLoader(
+                train_data,
+                batch_sampler=batch_sampler,
+                num_workers=self.args["num_workers"],
+                pin_memory=True,
+                collate_fn=train_collate_fn,
+            )
+        else:
+            self.train_dataloader = DataLoader(
+                train_data,
+                shuffle=True,
+                batch_size=self.args["batch_size"],
+                num_workers=self.args["num_workers"],
+                pin_memory=True,
+                collate_fn=train_collate_fn,
+            )
         self.accelerator.print("Number of train batches:", len(self.train_dataloader))
 
     def get_inference_test_dataloader(self):
@@ -350,6 +343,7 @@ class BCTrainer(BaseTrainer):
         logging_step_freq = self.args.get("logging_step_freq", None)
         self.agent.model.train()
         epoch_result_dict = defaultdict(list)
+        num_tokens, start_time = 0, time.perf_counter()
         with tqdm(
             enumerate(self.train_dataloader),
             total=len(self.train_dataloader),
@@ -365,6 +359,9 @@ class BCTrainer(BaseTrainer):
                     # Get some metrics
                     loss = output[0]
                     result_dict, extra = {}, None
+                    num_tokens += batch["num_tokens"]
+                    if "packing_efficiency" in batch:
+                        result_dict["packing_efficiency"] = batch["packing_efficiency"]
                     # Update
                     self.accelerator.backward(loss)
                     if self.accelerator.sync_gradients:
@@ -426,6 +423,16 @@ class BCTrainer(BaseTrainer):
             k: (sum(v) / len(v) if isinstance(v, list) else v)
             for k, v in epoch_result_dict.items()
         }
+        # Throughput of all processes: real (non-padding) tokens per second
+        elapsed = time.perf_counter() - start_time
+        total_tokens = self.accelerator.gather(
+            torch.tensor([num_tokens], device=self.accelerator.device)
+        ).sum().item()
+        epoch_result_dict["tokens_per_sec"] = total_tokens / max(elapsed, 1e-6)
+        self.accelerator.print(
+            f"[E={epoch}/{self.args['n_epochs']}] {total_tokens} tokens in {elapsed:.1f}s, "
+            f"{epoch_result_dict['tokens_per_sec']:.1f} tokens/s"
+        )
         return epoch_result_dict, global_step
 
     def train(self):
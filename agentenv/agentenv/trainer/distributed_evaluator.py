@@ -1,5 +1,7 @@
+import glob
 import json
 import os
+import uuid
 from dataclasses import asdict
 from datetime import timedelta
 from functools import partial
@@ -9,17 +11,23 @@ import jsonlines
 import numpy as np
 import torch
 from accelerate import Accelerator, InitProcessGroupKwargs
-from accelerate.utils import broadcast, gather_object
+from accelerate.utils import broadcast, broadcast_object_list, gather_object
 from agentenv.controller import Agent
 from agentenv.controller.agent import Agent
+from agentenv.controller.eval_journal import EvalJournal, summarize_entries
 from agentenv.controller.task import BaseTask, GenerationConfig
 from agentenv.controller.utils import BaseTrainer
+from agentenv.trainer.sampler import LengthGroupedBatchSampler
 from agentenv.trainer.utils import set_seed
+from agentenv.trainer.work_queue import FileWorkQueue, StoreWorkQueue, WorkQueue
 from datasets import Dataset, DatasetDict
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers import AdamW, GenerationConfig
 
+# the work queue's TCPStore listens on MASTER_PORT + this offset
+WORK_QUEUE_PORT_OFFSET = 1
+
 
 class DistributedEvaluator(BaseTrainer):
     def __init__(self, agent: Agent, tasks: Sequence[BaseTask], args) -> None:
@@ -29,6 +37,7 @@ class DistributedEvaluator(BaseTrainer):
 
         # data & loader
         self.raw_dataset = None
+        self.journal = None
 
         # accelerator
         self.accelerator = None
@@ -71,6 +80,18 @@ class DistributedEvaluator(BaseTrainer):
                     ),
                 }
             )
+            if self.args.get("resume") and not self.args.get("work_stealing"):
+                # the main process repairs the journal before the others read it
+                self.journal = EvalJournal(
+                    f"{self.args['output_file']}.journal",
+                    self.args["output_file"],
+                    recover=self.accelerator.is_main_process,
+                )
+                done = self.journal.completed(self.args["task_name"])
+                self.raw_dataset["inference"] = self.raw_dataset["inference"].filter(
+                    lambda item: int(item["item_id"].split("_")[-1]) not in done
+                )
+                self.accelerator.print(f"Resuming: {len(done)} items done before")
             self.accelerator.print("Raw data:", self.raw_dataset)
 
     def get_inference_dataloader(self):
@@ -81,19 +102,71 @@ class DistributedEvaluator(BaseTrainer):
             return result
 
         with self.accelerator.main_process_first():
-            self.inference_dataloader = DataLoader(
-                self.raw_dataset["inference"],
-                batch_size=self.args["eval_batch_size"],
-                num_workers=self.args["num_workers"],
-                pin_memory=True,
-                collate_fn=partial(collate_fn),
-            )
+            lengths = None
+            if self.args.get("group_by_length"):
+                lengths = self.get_length_hints(self.raw_dataset["inference"])
+            if lengths is not None:
+                # longest rollouts first, neighbouring processes get similar lengths
+                self.inference_dataloader = DataLoader(
+                    self.raw_dataset["inference"],
+                    batch_sampler=LengthGroupedBatchSampler(
+                        lengths,
+                        self.args["eval_batch_size"],
+                        shuffle=False,
+                        seed=self.args["seed"],
+                        num_processes=self.accelerator.num_processes,
+                    ),
+                    num_workers=self.args["num_workers"],
+                    pin_memory=True,
+                    collate_fn=partial(collate_fn),
+                )
+            else:
+                self.inference_dataloader = DataLoader(
+                    self.raw_dataset["inference"],
+                    batch_size=self.args["eval_batch_size"],
+                    num_workers=self.args["num_workers"],
+                    pin_memory=True,
+                    collate_fn=partial(collate_fn),
+                )
 
             self.accelerator.print(
                 "Number of inference batches:", len(self.inference_dataloader)
             )
 
+    def get_length_hints(self, dataset):
+        """
+        Expected length of every rollout: ``input_ids_max_length`` if the file
+        has it, else the characters of a reference ``conversations``.
+        """
+        if "input_ids_max_length" in dataset.column_names:
+            return dataset["input_ids_max_length"]
+        if "conversations" in dataset.column_names:
+            return [
+                sum(len(message["value"]) for message in conversations)
+                for conversations in dataset["conversations"]
+            ]
+        self.accelerator.print(
+            "group_by_length: the inference file has no lengths, keeping the file order"
+        )
+        return None
+
+    def get_generation_config(self):
+        return GenerationConfig(
+            max_length=4096,
+            do_sample=self.args["do_sample"],
+            temperature=self.args["temperature"],
+            eos_token_id=self.agent.tokenizer.eos_token_id,
+            pad_token_id=(
+                self.agent.tokenizer.pad_token_id
+                if self.agent.tokenizer.pad_token_id is not None
+                else self.agent.tokenizer.unk_token_id
+            ),
+        )
+
     def generate(self, dataloader=None):
+        if self.args.get("work_stealing") and dataloader is None:
+            return self.generate_work_stealing()
+
         self.optimizer = AdamW(self.agent.model.parameters())
         self.agent.model, self.optimizer, self.inference_dataloader = (
             self.accelerator.prepare(
@@ -115,17 +188,7 @@ class DistributedEvaluator(BaseTrainer):
             data_idxs = batch["data_idxs"]
             with torch.no_grad():
                 exps = self.eval(
-                    generation_config=GenerationConfig(
-                        max_length=4096,
-                        do_sample=self.args["do_sample"],
-                        temperature=self.args["temperature"],
-                        eos_token_id=self.agent.tokenizer.eos_token_id,
-                        pad_token_id=(
-                            self.agent.tokenizer.pad_token_id
-                            if self.agent.tokenizer.pad_token_id is not None
-                            else self.agent.tokenizer.unk_token_id
-                        ),
-                    ),
+                    generation_config=self.get_generation_config(),
                     max_rounds=self.args["max_round"],
                     idxs=data_idxs,
                 )
@@ -147,7 +210,23 @@ class DistributedEvaluator(BaseTrainer):
                 all_success.extend(all_device_batch_success.cpu().numpy().tolist())
                 
                 # write inference results to file
-                if self.accelerator.is_main_process:
+                if self.accelerator.is_main_process and self.journal is not None:
+                    for idx, exp in enumerate(all_device_batch_exp):
+                        cur_idx = int(all_device_data_idx[idx])
+                        cur_success = 1 if exp.reward == 1 else 0
+                        self.journal.commit(
+                            self.args["task_name"],
+                            cur_idx,
+                            exp.reward,
+                            cur_success,
+                            {
+                                "conversations": exp.conversation,
+                                "item_id": f"{self.args['task_name']}_{cur_idx}",
+                                "reward": exp.reward,
+                                "success": cur_success,
+                            },
+                        )
+                elif self.accelerator.is_main_process:
                     with jsonlines.open(self.args["output_file"], mode="a") as f:
                         for idx, exp in enumerate(all_device_batch_exp):
                             cur_idx = all_device_data_idx[idx]
@@ -168,6 +247,11 @@ class DistributedEvaluator(BaseTrainer):
         all_rewards = all_rewards[: len(dataloader.dataset)]
         all_success = all_success[: len(dataloader.dataset)]
 
+        if self.accelerator.is_main_process and self.journal is not None:
+            # the items of earlier runs count as well
+            summary = self.journal.summary(self.args["task_name"])
+            all_rewards, all_success = [summary["score"]], [summary["success"]]
+
         if self.accelerator.is_main_process and self.accelerator.is_local_main_process:
             mean_reward = torch.FloatTensor([np.mean(all_rewards)]).to(
                 self.accelerator.device
@@ -185,3 +269,162 @@ class DistributedEvaluator(BaseTrainer):
         self.accelerator.print(f"Score: {mean_reward:.5f}")
         self.accelerator.print(f"Success: {mean_success:.5f}")
 
+    def create_queue_store(self):
+        """
+        A TCPStore served by the main process on ``MASTER_PORT +
+        WORK_QUEUE_PORT_OFFSET``. If that port is taken, the process group's
+        own store, which torch only exposes through a private function.
+        None if neither is available.
+        """
+        host, port = os.environ.get("MASTER_ADDR"), os.environ.get("MASTER_PORT")
+        if host and port:
+            port = int(port) + WORK_QUEUE_PORT_OFFSET
+            timeout = timedelta(seconds=300)
+            store = None
+            if self.accelerator.is_main_process:
+                try:
+                    store = torch.distributed.TCPStore(
+                        host, port, is_master=True, timeout=timeout, wait_for_workers=False
+                    )
+                except (RuntimeError, OSError) as e:
+                    self.accelerator.print(f"Work queue store on port {port} failed: {e}")
+            # the other ranks connect once the server is up
+            if broadcast_object_list([store is not None])[0]:
+                if store is None:
+                    store = torch.distributed.TCPStore(host, port, is_master=False, timeout=timeout)
+                return store
+        get_default_store = getattr(
+            torch.distributed.distributed_c10d, "_get_default_store", None
+        )
+        if get_default_store is not None:
+            try:
+                return get_default_store()
+            except Exception:  # pylint: disable=W0718:broad-exception-caught
+                pass
+        return None
+
+    def create_work_queue(self, num_items: int, shard_dir: str) -> WorkQueue:
+        """A counter in a TCPStore shared by the ranks, or a locked file without one."""
+        if self.accelerator.num_processes > 1 and torch.distributed.is_initialized():
+            store = self.create_queue_store()
+            if store is not None:
+                # a fresh key per run, so a restarted run counts from zero
+                key = broadcast_object_list([uuid.uuid4().hex])[0]
+                return StoreWorkQueue(store, f"agentenv_eval_queue/{key}", num_items)
+        path = os.path.join(shard_dir, "queue")
+        # the ranks claim only after the barrier that follows
+        if self.accelerator.is_main_process and os.path.exists(path):
+            os.remove(path)
+        return FileWorkQueue(path, num_items)
+
+    def shard_journals(self, shard_dir: str) -> list[EvalJournal]:
+        """The journals of all ranks of this and earlier runs, by rank."""
+        paths = glob.glob(os.path.join(shard_dir, "rank*.journal.jsonl"))
+        paths.sort(key=lambda path: int(os.path.basename(path)[4:].split(".")[0]))
+        return [
+            EvalJournal(path, path.replace(".journal.jsonl", ".jsonl"), recover=False)
+            for path in paths
+        ]
+
+    def generate_work_stealing(self):
+        """
+        Rollouts pulled from a shared work queue: every rank claims the next
+        batch of task ids when it finishes its previous one and appends the
+        results to its own journaled shard under ``{output_file}.shards``. Ids
+        committed by an earlier, interrupted run are skipped. The main process
+        merges the shards into ``output_file`` at the end.
+        """
+        self.agent.model = self.accelerator.prepare(self.agent.model)
+        self.agent.model.eval()
+        shard_dir = f"{self.args['output_file']}.shards"
+        rank = self.accelerator.process_index
+        # every rank repairs its own shard
+        journal = EvalJournal(
+            os.path.join(shard_dir, f"rank{rank}.journal.jsonl"),
+            os.path.join(shard_dir, f"rank{rank}.jsonl"),
+        )
+
+        dataset = self.raw_dataset["inference"]
+        data_idxs = [int(item_id.split("_")[-1]) for item_id in dataset["item_id"]]
+        done = set()
+        for shard_journal in self.shard_journals(shard_dir):
+            done |= shard_journal.completed(self.args["task_name"])
+        pending = [i for i, data_idx in enumerate(data_idxs) if data_idx not in done]
+        if self.args.get("group_by_length"):
+            lengths = self.get_length_hints(dataset)
+            if lengths is not None:
+                # longest first, the short ones fill the gaps at the end
+                pending.sort(key=lambda i: -lengths[i])
+        self.accelerator.print(
+            f"Work queue: {len(pending)} tasks, {len(data_idxs) - len(pending)} done before"
+        )
+        queue = self.create_work_queue(len(pending), shard_dir)
+        # every rank has read the old shards before any rank appends to them
+        self.accelerator.wait_for_everyone()
+
+        progress = tqdm(
+            total=len(pending),
+            disable=not self.accelerator.is_main_process,
+            desc="Inference Gen Loop",
+        )
+        while True:
+            positions = queue.next(self.args["eval_batch_size"])
+            if not positions:
+                break
+            batch_idxs = [data_idxs[pending[position]] for position in positions]
+            with torch.no_grad():
+                exps = self.eval(
+                    generation_config=self.get_generation_config(),
+                    max_rounds=self.args["max_round"],
+                    idxs=batch_idxs,
+                )
+            for data_idx, exp in zip(batch_idxs, exps.experiences):
+                success = 1 if exp.reward == 1 else 0
+                journal.commit(
+                    self.args["task_name"],
+                    data_idx,
+                    exp.reward,
+                    success,
+                    {
+                        "conversations": exp.conversation,
+                        "item_id": f"{self.args['task_name']}_{data_idx}",
+                        "reward": exp.reward,
+                        "success": success,
+                    },
+                )
+            # the main process only sees its own share of the queue
+            progress.update(len(positions))
+        progress.close()
+        self.accelerator.wait_for_everyone()
+
+        if self.accelerator.is_main_process:
+            summary = merge_eval_shards(
+                self.shard_journals(shard_dir), self.args["output_file"]
+            )
+            stats = [summary["score"], summary["success"]]
+        else:
+            stats = [-1.0, -1.0]
+        mean_reward, mean_success = broadcast_object_list(stats)
+        self.accelerator.print("\n\n==== Inference Evaluation ====\n")
+        self.accelerator.print(f"Score: {mean_reward:.5f}")
+        self.accelerator.print(f"Success: {mean_success:.5f}")
+
+
+def merge_eval_shards(journals: Sequence[EvalJournal], output_file: str) -> dict:
+    """
+    Writes the committed results of all shard *journals* to *output_file*, each
+    item once, and returns their summary.
+    """
+    entries, seen = [], set()
+    with open(output_file, "wb") as out:
+        for journal in journals:
+            with open(journal.trajectory_file, "rb") as f:
+                for entry in journal.entries():
+                    key = (entry["task"], entry["idx"])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    entries.append(entry)
+                    f.seek(entry["offset"])
+                    out.write(f.read(entry["length"]))
+    return summarize_entries(entries)
@@ -0,0 +1,183 @@
+"""
+Sequence packing for the supervised trainers.
+
+Tokenized conversations are binned into rows of ``pack_length`` tokens with a
+first-fit-decreasing packer. Each packed row keeps per-document
+``position_ids`` and ``cu_seqlens``; the collate function turns them into a
+block-diagonal causal mask (or leaves the mask out for flash-attention-2,
+which splits documents on ``position_ids``) so attention never crosses
+trajectories. ``labels`` keep their -100 masking, and the first label of every
+document is masked as well since it would otherwise be predicted from the
+previous trajectory. ``prefix_tree_attention_mask`` is the analogue for
+continuations sharing one prompt, such as DPO chosen/rejected pairs.
+"""
+
+from typing import Optional, Sequence
+
+import torch
+from torch.utils.data import Dataset
+
+
+def first_fit_decreasing(lengths: Sequence[int], capacity: int) -> list[list[int]]:
+    """
+    Bins item indices so that the lengths in a bin sum to at most *capacity*.
+    Items are placed longest first into the first bin with room; a max segment
+    tree over the remaining room finds that bin in O(log n).
+    """
+    if any(length > capacity for length in lengths):
+        raise ValueError("An item is longer than the bin capacity")
+    n = len(lengths)
+    size = 1
+    while size < max(n, 1):
+        size *= 2
+    # leaves are the bins, unopened bins have the full capacity
+    room = [capacity] * (2 * size)
+    bins: list[list[int]] = []
+    for index in sorted(range(n), key=lambda i: -lengths[i]):
+        length = lengths[index]
+        node = 1
+        while node < size:
+            node = 2 * node if room[2 * node] >= length else 2 * node + 1
+        b = node - size
+        if b == len(bins):
+            bins.append([])
+        bins[b].append(index)
+        room[node] -= length
+        node //= 2
+        while node:
+            room[node] = max(room[2 * node], room[2 * node + 1])
+            node //= 2
+    return bins
+
+
+class PackedDataset(Dataset):
+    """Rows of concatenated ``input_ids``/``labels`` from a tokenized dataset."""
+
+    def __init__(self, dataset, pack_length: int) -> None:
+        self.pack_length = pack_length
+        input_ids = dataset["input_ids"]
+        labels = dataset["labels"]
+        self.documents = [
+            (ids[:pack_length], lab[:pack_length]) for ids, lab in zip(input_ids, labels)
+        ]
+        self.bins = first_fit_decreasing(
+            [len(ids) for ids, _ in self.documents], pack_length
+        )
+        self.num_tokens = sum(len(ids) for ids, _ in self.documents)
+
+    @property
+    def efficiency(self) -> float:
+        """Fraction of the packed rows filled with real tokens."""
+        return self.num_tokens / max(1, len(self.bins) * self.pack_length)
+
+    def __len__(self) -> int:
+        return len(self.bins)
+
+    def __getitem__(self, index: int) -> dict:
+        input_ids, labels, position_ids, seqlens = [], [], [], []
+        for doc in self.bins[index]:
+            ids, lab = self.documents[doc]
+            input_ids += ids
+            labels += [-100] + list(lab[1:])
+            position_ids += range(len(ids))
+            seqlens.append(len(ids))
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "seqlens": seqlens,
+        }
+
+
+def packed_collate_fn(
+    batch: list[dict],
+    tokenizer,
+    pack_length: Optional[int] = None,
+    document_mask: bool = True,
+    mask_dtype: torch.dtype = torch.float32,
+) -> dict:
+    """
+    Pads packed rows to ``pack_length`` (or the longest row) and returns the
+    model kwargs under ``forward_kwargs`` like the padding collate functions.
+    With ``document_mask`` a 4D block-diagonal causal mask is added; without it
+    (flash-attention-2) documents are separated by ``position_ids`` alone.
+    ``cu_seqlens`` holds the document boundaries of the flattened batch.
+    """
+    length = pack_length or max(len(item["input_ids"]) for item in batch)
+    input_ids, labels, position_ids = [], [], []
+    cu_seqlens = [0]
+    for item in batch:
+        pad = length - len(item["input_ids"])
+        input_ids.append(item["input_ids"] + [tokenizer.pad_token_id] * pad)
+        labels.append(item["labels"] + [-100] * pad)
+        position_ids.append(item["position_ids"] + list(range(pad)))
+        for seqlen in item["seqlens"]:
+            cu_seqlens.append(cu_seqlens[-1] + seqlen)
+        if pad:
+            cu_seqlens.append(cu_seqlens[-1] + pad)
+
+    forward_kwargs = {
+        "input_ids": torch.LongTensor(input_ids),
+        "labels": torch.LongTensor(labels),
+        "position_ids": torch.LongTensor(position_ids),
+    }
+    if document_mask:
+        forward_kwargs["attention_mask"] = document_attention_mask(
+            [item["seqlens"] for item in batch], length, mask_dtype
+        )
+    num_tokens = sum(len(item["input_ids"]) for item in batch)
+    return {
+        "forward_kwargs": forward_kwargs,
+        "cu_seqlens": torch.IntTensor(cu_seqlens),
+        "num_tokens": num_tokens,
+        "packing_efficiency": num_tokens / (len(batch) * length),
+    }
+
+
+def document_attention_mask(
+    seqlens: list[list[int]], length: int, dtype: torch.dtype = torch.float32
+) -> torch.Tensor:
+    """
+    Additive ``[batch, 1, length, length]`` mask: causal inside each document,
+    blocked across documents. Padding tokens only attend to themselves.
+    """
+    allowed = torch.zeros(len(seqlens), length, length, dtype=torch.bool)
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    for row, row_seqlens in enumerate(seqlens):
+        start = 0
+        for seqlen in row_seqlens:
+            end = start + seqlen
+            allowed[row, start:end, start:end] = causal[:seqlen, :seqlen]
+            start = end
+        allowed[row, start:, start:] = torch.eye(length - start, dtype=torch.bool)
+    mask = torch.zeros(allowed.shape, dtype=dtype)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask[:, None]
+
+
+def prefix_tree_attention_mask(
+    prefix_lens: Sequence[int],
+    branch_lens: Sequence[Sequence[int]],
+    length: int,
+    dtype: torch.dtype = torch.float32,
+) -> torch.Tensor:
+    """
+    Additive ``[batch, 1, length, length]`` mask for rows laid out as a shared
+    prefix followed by its branches, ``[prefix | branch 1 | branch 2 | ...]``.
+    Every branch attends to the prefix and causally to itself, never to the
+    other branches; padding tokens only attend to themselves.
+    """
+    allowed = torch.zeros(len(prefix_lens), length, length, dtype=torch.bool)
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    for row, (prefix_len, row_branch_lens) in enumerate(zip(prefix_lens, branch_lens)):
+        allowed[row, :prefix_len, :prefix_len] = causal[:prefix_len, :prefix_len]
+        start = prefix_len
+        for branch_len in row_branch_lens:
+            end = start + branch_len
+            allowed[row, start:end, :prefix_len] = True
+            allowed[row, start:end, start:end] = causal[:branch_len, :branch_len]
+            start = end
+        allowed[row, start:, start:] = torch.eye(length - start, dtype=torch.bool)
+    mask = torch.zeros(allowed.shape, dtype=dtype)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask[:, None]
@@ -0,0 +1,88 @@
+"""
+Persistent cache of DPO reference log probabilities.
+
+The reference pass of DPO only depends on the reference weights, the
+tokenized dataset and the settings that shape the padded batches, so its
+output is saved once under ``cache_dir`` keyed by a hash of all three and
+memory-mapped on later runs. Reruns, hyperparameter sweeps and evaluation on
+the same data then skip the reference forward pass entirely, and the pass
+itself can run ahead of training in a separate, low-priority process.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from datasets import Dataset
+
+REF_LOGPS_FILES = ("reference_chosen_logps.npy", "reference_rejected_logps.npy")
+
+
+def model_hash(model: torch.nn.Module, skip_trainable: bool = False) -> str:
+    """
+    Hash of the model config and every parameter and buffer. With
+    *skip_trainable*, trainable parameters (e.g. freshly initialized LoRA
+    adapters, disabled for the reference pass) are left out.
+    """
+    hasher = hashlib.sha256()
+    config = getattr(model, "config", None)
+    if config is not None:
+        hasher.update(config.to_json_string(use_diff=False).encode())
+    trainable = {name for name, p in model.named_parameters() if p.requires_grad}
+    for name, tensor in model.state_dict().items():
+        if skip_trainable and name in trainable:
+            continue
+        tensor = tensor.detach().to("cpu").contiguous()
+        hasher.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        hasher.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def ref_logps_cache_key(dataset: Dataset, ref_model_hash: str, settings: dict) -> str:
+    """*settings* are the tokenization/padding options that change the logps."""
+    settings_hash = hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+    return "_".join([dataset._fingerprint, ref_model_hash, settings_hash])
+
+
+def load_ref_logps(
+    cache_dir: str, key: str
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """The memory-mapped chosen/rejected logps saved under *key*, or None."""
+    path = os.path.join(os.path.expanduser(cache_dir), key)
+    if not os.path.isdir(path):
+        return None
+    return tuple(
+        np.load(os.path.join(path, name), mmap_mode="r") for name in REF_LOGPS_FILES
+    )
+
+
+def save_ref_logps(
+    cache_dir: str,
+    key: str,
+    chosen: np.ndarray,
+    rejected: np.ndarray,
+    meta: Optional[dict] = None,
+) -> str:
+    if len(chosen) != len(rejected):
+        raise ValueError("chosen and rejected logps must have the same length")
+    path = os.path.join(os.path.expanduser(cache_dir), key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary directory first, readers never see a partial save
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, logps in zip(REF_LOGPS_FILES, (chosen, rejected)):
+        np.save(os.path.join(tmp_path, name), np.asarray(logps, dtype=np.float32))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"num_rows": len(chosen), **(meta or {})}, f, default=str)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process saved the same key first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
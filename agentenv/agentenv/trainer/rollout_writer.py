@@ -0,0 +1,147 @@
+"""
+Per-rank streaming output of sampled trajectories.
+
+Every rank appends its own experiences to ``rank{r}.jsonl`` in a shard
+directory and the ones above the task's reward threshold to
+``rank{r}.filtered.jsonl``, so nothing but the per-rank counters in
+``rank{r}.index.json`` has to cross processes. ``merge_rollout_shards`` then
+concatenates the shards on the main process into the files the AgentEvol
+pipeline reads.
+"""
+
+import json
+import os
+import shutil
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from agentenv.controller.types import ExperienceOutput
+
+# the reward a trajectory has to exceed to be kept, by item_id prefix;
+# mirrors task_list/threshold_list in utils/agentevol_filter.py
+REWARD_THRESHOLDS = {
+    "webshop": 0.99,
+    "alfworld": 0.99,
+    "textcraft": 0.99,
+    "sciworld": 99,
+    "sqlgym": 0.99,
+    "lmrlgym_wordle": 0.99,
+    "lmrlgym_maze": 0.99,
+    "weather": 0.99,
+    "movie": 0.99,
+    "todo": 0.99,
+    "babyai": 0,
+}
+DEFAULT_REWARD_THRESHOLD = 0.99
+
+
+def task_of(item_id: str, thresholds: dict[str, float] = REWARD_THRESHOLDS) -> Optional[str]:
+    """The task of an ``item_id`` such as ``webshop_12``."""
+    for task in thresholds:
+        if item_id.startswith(task):
+            return task
+    return None
+
+
+def reward_threshold(item_id: str, thresholds: dict[str, float] = REWARD_THRESHOLDS) -> float:
+    task = task_of(item_id, thresholds)
+    return thresholds[task] if task is not None else DEFAULT_REWARD_THRESHOLD
+
+
+class RolloutShardWriter:
+    def __init__(
+        self,
+        shard_dir: str,
+        rank: int,
+        thresholds: dict[str, float] = REWARD_THRESHOLDS,
+    ) -> None:
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.rank = rank
+        self.thresholds = thresholds
+        self._all = open(os.path.join(shard_dir, f"rank{rank}.jsonl"), "w", encoding="utf-8")
+        self._filtered = open(
+            os.path.join(shard_dir, f"rank{rank}.filtered.jsonl"), "w", encoding="utf-8"
+        )
+        self.index = {
+            "rank": rank,
+            "lines": 0,
+            "kept": 0,
+            "tasks": defaultdict(lambda: {"episodes": 0, "kept": 0, "reward_sum": 0.0}),
+        }
+
+    def write_batch(self, item_ids: Iterable[str], exps: Iterable[ExperienceOutput]) -> None:
+        for item_id, exp in zip(item_ids, exps):
+            success = 1 if exp.reward == 1 else 0
+            self._all.write(
+                json.dumps(
+                    {
+                        "conversations": exp.conversation,
+                        "item_id": item_id,
+                        "reward": exp.reward,
+                        "success": success,
+                    },
+                    ensure_ascii=False,
+                )
+                + "\n"
+            )
+            task = task_of(item_id, self.thresholds) or "unknown"
+            stats = self.index["tasks"][task]
+            stats["episodes"] += 1
+            stats["reward_sum"] += exp.reward
+            self.index["lines"] += 1
+            if exp.reward > reward_threshold(item_id, self.thresholds):
+                self._filtered.write(
+                    json.dumps(
+                        {"conversations": exp.conversation, "item_id": item_id},
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+                stats["kept"] += 1
+                self.index["kept"] += 1
+        # a crashed run keeps everything up to the last batch
+        self._all.flush()
+        self._filtered.flush()
+
+    def close(self) -> None:
+        self._all.close()
+        self._filtered.close()
+        with open(os.path.join(self.shard_dir, f"rank{self.rank}.index.json"), "w") as f:
+            json.dump({**self.index, "tasks": dict(self.index["tasks"])}, f)
+
+    def __enter__(self) -> "RolloutShardWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def merge_rollout_shards(
+    shard_dir: str,
+    world_size: int,
+    inference_file: str,
+    filtered_file: str,
+) -> dict:
+    """
+    Appends the shards of all ranks to *inference_file* and *filtered_file*
+    (rank order) and returns the merged index.
+    """
+    merged = {"lines": 0, "kept": 0, "tasks": {}}
+    for rank in range(world_size):
+        with open(os.path.join(shard_dir, f"rank{rank}.index.json")) as f:
+            index = json.load(f)
+        merged["lines"] += index["lines"]
+        merged["kept"] += index["kept"]
+        for task, stats in index["tasks"].items():
+            total = merged["tasks"].setdefault(
+                task, {"episodes": 0, "kept": 0, "reward_sum": 0.0}
+            )
+            for k, v in stats.items():
+                total[k] += v
+    for source, target in [("", inference_file), (".filtered", filtered_file)]:
+        with open(target, "a", encoding="utf-8") as out:
+            for rank in range(world_size):
+                with open(os.path.join(shard_dir, f"rank{rank}{source}.jsonl"), encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+    return merged
@@ -0,0 +1,104 @@
+"""
+Length-grouped batching for the trainers.
+
+Padding a batch costs as much as its longest sequence, so batches of similarly
+sized trajectories waste far less compute. ``LengthGroupedBatchSampler`` sorts
+the samples by length (ties broken randomly), cuts the sorted order into
+buckets of ``bucket_size`` samples, shuffles inside every bucket and then
+shuffles the resulting batches. Smaller buckets mean less padding, larger ones
+more randomness.
+
+The order only depends on ``seed`` and the epoch, never on the global RNG
+(the trainers seed it with ``seed + process_index``), so every process builds
+the same batches and ``accelerator.prepare`` can hand out whole batches
+round-robin. Batches are shuffled in groups of ``num_processes`` neighbours,
+so the processes of one optimizer step get batches of similar length and do
+not wait for each other.
+"""
+
+from typing import Iterator, Optional, Sequence
+
+import torch
+from torch.utils.data import Sampler
+
+
+class LengthGroupedBatchSampler(Sampler[list[int]]):
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        bucket_size: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_processes: int = 1,
+        drop_last: bool = False,
+    ) -> None:
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        if bucket_size is not None and bucket_size < batch_size:
+            raise ValueError("bucket_size must be at least batch_size")
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.num_processes = max(1, num_processes)
+        # buckets hold whole steps (num_processes batches), default 4 steps
+        step = batch_size * self.num_processes
+        self.bucket_size = -(-(bucket_size or 4 * step) // step) * step
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[list[int]]:
+        batches = self.batches(self.epoch)
+        # iterating again without set_epoch gives the next epoch's order
+        self.epoch += 1
+        return iter(batches)
+
+    def batches(self, epoch: int) -> list[list[int]]:
+        """The batches of *epoch*, longest first when not shuffling."""
+        n = len(self.lengths)
+        if not self.shuffle:
+            order = sorted(range(n), key=lambda i: -self.lengths[i])
+            return self._chunk(order)
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        # random permutation first, so the stable sort breaks ties randomly
+        permutation = torch.randperm(n, generator=generator).tolist()
+        order = sorted(permutation, key=lambda i: -self.lengths[i])
+        for start in range(0, n, self.bucket_size):
+            bucket = order[start : start + self.bucket_size]
+            shuffled = torch.randperm(len(bucket), generator=generator).tolist()
+            order[start : start + self.bucket_size] = [bucket[i] for i in shuffled]
+        batches = self._chunk(order)
+
+        # a short last batch and an incomplete last group stay at the end, so
+        # the groups keep lining up with the processes of a step
+        tail = []
+        if batches and len(batches[-1]) < self.batch_size:
+            tail = [batches.pop()]
+        n_full = len(batches) - len(batches) % self.num_processes
+        tail = batches[n_full:] + tail
+        groups = [
+            batches[start : start + self.num_processes]
+            for start in range(0, n_full, self.num_processes)
+        ]
+        group_order = torch.randperm(len(groups), generator=generator).tolist()
+        return [batch for g in group_order for batch in groups[g]] + tail
+
+    def _chunk(self, order: list[int]) -> list[list[int]]:
+        batches = [
+            order[start : start + self.batch_size]
+            for start in range(0, len(order), self.batch_size)
+        ]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
@@ -0,0 +1,162 @@
+"""
+Template-driven tokenization of the trainer datasets, cached on disk.
+
+Conversations are tokenized with the agent's ``BaseChatTemplate``, the same
+template used for rollouts, and trained on the messages whose ``loss`` flag is
+set (``gpt`` messages when the flag is missing). The tokenized dataset is
+saved under ``cache_dir`` keyed by the dataset fingerprint, a hash of the
+tokenizer, the template (class and source) and ``max_input_length``, so
+restarts and later AgentEvol iterations on the same data skip tokenization.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from collections import defaultdict
+from typing import Callable, Optional
+
+from datasets import Dataset, load_from_disk
+from transformers import PreTrainedTokenizerBase
+
+from agentenv.controller.agent import BaseChatTemplate
+
+
+def tokenizer_hash(tokenizer: PreTrainedTokenizerBase) -> str:
+    """Hash of the vocabulary, the pre/post-processing and the special tokens."""
+    hasher = hashlib.sha256()
+    hasher.update(type(tokenizer).__name__.encode())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        hasher.update(backend.to_str().encode())
+    else:
+        hasher.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    # setup_tokenizer overrides pad/eos ids on the tokenizer object
+    special = {
+        "special_tokens_map": tokenizer.special_tokens_map,
+        "pad_token_id": tokenizer.pad_token_id,
+        "eos_token_id": tokenizer.eos_token_id,
+        "bos_token_id": tokenizer.bos_token_id,
+    }
+    hasher.update(json.dumps(special, sort_keys=True, default=str).encode())
+    return hasher.hexdigest()[:16]
+
+
+def template_hash(chat_template: BaseChatTemplate) -> str:
+    """Hash of the template class, its source and its attributes."""
+    cls = type(chat_template)
+    hasher = hashlib.sha256()
+    hasher.update(f"{cls.__module__}.{cls.__qualname__}".encode())
+    for klass in cls.__mro__:
+        if klass is object:
+            continue
+        try:
+            hasher.update(inspect.getsource(klass).encode())
+        except (OSError, TypeError):
+            pass
+    hasher.update(
+        json.dumps(
+            vars(chat_template), sort_keys=True, default=lambda o: type(o).__qualname__
+        ).encode()
+    )
+    return hasher.hexdigest()[:16]
+
+
+def tokenization_cache_key(
+    dataset: Dataset,
+    tokenizer: PreTrainedTokenizerBase,
+    chat_template: BaseChatTemplate,
+    max_input_length: int,
+) -> str:
+    return "_".join(
+        [
+            dataset._fingerprint,
+            tokenizer_hash(tokenizer),
+            type(chat_template).__name__,
+            template_hash(chat_template),
+            str(max_input_length),
+        ]
+    )
+
+
+def tokenize_fn(
+    batch: dict,
+    tokenizer: PreTrainedTokenizerBase,
+    chat_template: BaseChatTemplate,
+    max_input_length: int,
+) -> dict:
+    """Batched ``datasets.map`` function over ``item_id``/``conversations`` rows."""
+    new_batch = defaultdict(list)
+    for item_id, conversations in zip(batch["item_id"], batch["conversations"]):
+        conversation = []
+        for message in conversations:
+            loss = message.get("loss")
+            if loss is None:
+                loss = message["from"] == "gpt"
+            conversation.append({"from": message["from"], "loss": loss, "value": message["value"]})
+        tokenized = chat_template.tokenize_conversation(conversation, tokenizer)
+        input_ids = list(tokenized["input_ids"])
+        labels = [
+            token if mask else -100
+            for token, mask in zip(input_ids, tokenized["action_mask"])
+        ]
+
+        # Truncation
+        input_ids_max_length = len(input_ids)
+        input_ids = input_ids[:max_input_length]
+        labels = labels[:max_input_length]
+
+        new_batch["input_ids"].append(input_ids)
+        new_batch["labels"].append(labels)
+        new_batch["attention_mask"].append([1] * len(input_ids))
+        new_batch["item_id"].append(item_id)
+        new_batch["input_ids_max_length"].append(input_ids_max_length)
+    return new_batch
+
+
+def tokenize_dataset(
+    dataset: Dataset,
+    tokenizer: PreTrainedTokenizerBase,
+    chat_template: BaseChatTemplate,
+    max_input_length: int,
+    cache_dir: Optional[str] = None,
+    num_proc: Optional[int] = 8,
+    print_fn: Callable = print,
+) -> Dataset:
+    """
+    Tokenizes *dataset* with *chat_template*, loading it from *cache_dir* when
+    the same data was tokenized before. Without *cache_dir* nothing is cached.
+    """
+    path = None
+    if cache_dir:
+        key = tokenization_cache_key(dataset, tokenizer, chat_template, max_input_length)
+        path = os.path.join(os.path.expanduser(cache_dir), key)
+        if os.path.isdir(path):
+            print_fn(f"Loading tokenized dataset from {path}")
+            return load_from_disk(path)
+
+    tokenized = dataset.map(
+        tokenize_fn,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "chat_template": chat_template,
+            "max_input_length": max_input_length,
+        },
+        batched=True,
+        remove_columns=dataset.column_names,
+        num_proc=num_proc if num_proc and num_proc > 1 and len(dataset) > 1 else None,
+        load_from_cache_file=False,
+    )
+    if path is not None:
+        # write to a temporary directory first, readers never see a partial save
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        tokenized.save_to_disk(tmp_path)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # another process saved the same key first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        print_fn(f"Saved tokenized dataset to {path}")
+        tokenized = load_from_disk(path)
+    return tokenized
@@ -0,0 +1,64 @@
+"""
+Shared counters that hand out evaluation work to whichever rank asks first.
+
+Instead of a static shard per rank, every rank repeatedly claims the next
+``n`` positions of a common task list, so fast ranks keep pulling work while a
+slow one is still on a long episode, and no position is ever handed out
+twice. ``StoreWorkQueue`` keeps the counter in a ``torch.distributed``
+store shared by the ranks; ``FileWorkQueue`` keeps it in a file guarded by
+``fcntl.flock`` for single-process runs or independent processes sharing a
+file system.
+"""
+
+import fcntl
+import os
+
+
+class WorkQueue:
+    def __init__(self, num_items: int) -> None:
+        self.num_items = num_items
+
+    def _claim(self, n: int) -> int:
+        """Advances the counter by *n* and returns the new value."""
+        raise NotImplementedError
+
+    def next(self, n: int = 1) -> range:
+        """The next at most *n* unclaimed positions, empty once all are taken."""
+        end = self._claim(n)
+        return range(min(end - n, self.num_items), min(end, self.num_items))
+
+
+class StoreWorkQueue(WorkQueue):
+    def __init__(self, store, key: str, num_items: int) -> None:
+        """
+        Args:
+            store: A ``torch.distributed.Store`` shared by all ranks.
+            key: Counter key, unique per run so restarts start from zero.
+        """
+        super().__init__(num_items)
+        self.store = store
+        self.key = key
+
+    def _claim(self, n: int) -> int:
+        return self.store.add(self.key, n)
+
+
+class FileWorkQueue(WorkQueue):
+    def __init__(self, path: str, num_items: int) -> None:
+        """The counter in *path* starts at zero if the file does not exist yet."""
+        super().__init__(num_items)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _claim(self, n: int) -> int:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            value = int(os.read(fd, 32) or b"0") + n
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(value).encode())
+            os.fsync(fd)
+            return value
+        finally:
+            os.close(fd)  # releases the lock
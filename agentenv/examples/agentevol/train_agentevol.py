@@ -2,7 +2,13 @@ from dataclasses import dataclass, field
 
 import torch
 import transformers
-from agentenv.controller import Agent
+from agentenv.controller import (
+    Agent,
+    ChatGLM4Template,
+    ChatMLTemplate,
+    Llama2Template,
+    Llama3Template,
+)
 from agentenv.envs import (
     AlfWorldTask,
     SciworldTask,
@@ -11,6 +17,7 @@ from agentenv.envs import (
     WebshopTask,
 )
 from agentenv.trainer.agentevol_trainer import AgentEvolTrainer
+from agentenv.trainer.async_rollout import DEFAULT_MAX_STALENESS, DEFAULT_POLICY_SYNC_STEPS
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 
@@ -55,10 +62,49 @@ class TrainingArguments:
     logging_step_freq: int = field(default=None)
     seed: int = field(default=42)
     max_input_length: int = field(default=700)
+    packing: bool = field(
+        default=False,
+        metadata={"help": "Pack conversations into rows of pack_length tokens instead of padding"},
+    )
+    pack_length: int = field(default=None, metadata={"help": "Packed row length (default: max_input_length)"})
+    group_by_length: bool = field(
+        default=False,
+        metadata={"help": "Batch conversations of similar length, shuffled within length buckets"},
+    )
+    chat_template: str = field(
+        default="llama2",
+        metadata={"help": "Chat template for training and rollouts: llama2, chatml, llama3 or chatglm4"},
+    )
+    tokenization_cache_dir: str = field(
+        default="~/.cache/agentenv/tokenized",
+        metadata={"help": "Cache of tokenized training data, empty to disable"},
+    )
 
     # agent evol
     sample_num: int = field(default=5)
     iter_num: int = field(default=0)
+    save_trajectory_trie: bool = field(
+        default=False,
+        metadata={"help": "Also store the sampled trajectories as a prefix trie (inference_iter_N.trie.npz)"},
+    )
+    async_rollouts: bool = field(
+        default=False,
+        metadata={"help": "Roll out the inference set with a copy of the policy while training on the filtered trajectories"},
+    )
+    replay_buffer_size: int = field(default=256, metadata={"help": "Filtered trajectories waiting for the learner"})
+    replay_batch_size: int = field(
+        default=None, metadata={"help": "Replay trajectories added to each train batch (default: batch_size)"}
+    )
+    replay_wait: float = field(default=0.0, metadata={"help": "Seconds the learner waits for replay trajectories"})
+    max_staleness: int = field(
+        default=DEFAULT_MAX_STALENESS,
+        metadata={"help": "Drop trajectories of policies more than this many syncs old"},
+    )
+    policy_sync_steps: int = field(
+        default=DEFAULT_POLICY_SYNC_STEPS, metadata={"help": "Optimizer steps between policy syncs"}
+    )
+    rollout_chunk_size: int = field(default=8, metadata={"help": "Episodes rolled out between policy syncs"})
+    rollout_max_new_tokens: int = field(default=None, metadata={"help": "Generation cap per action"})
 
     # environment
     max_round: int = field(
@@ -96,6 +142,16 @@ def main():
         "webarena": WebarenaTask,
     }
 
+    chat_templates = {
+        "llama2": Llama2Template,
+        "chatml": ChatMLTemplate,
+        "llama3": Llama3Template,
+        "chatglm4": ChatGLM4Template,
+    }
+    chat_template_class = chat_templates.get(args.chat_template.lower(), None)
+    if chat_template_class is None:
+        raise ValueError(f"Unsupported chat template: {args.chat_template}")
+
     # select task according to the name
     task_class = task_classes.get(args.task_name.lower(), None)
     if task_class is None:
@@ -109,7 +165,7 @@ def main():
     }
 
     trainer = AgentEvolTrainer(
-        Agent(model, tokenizer),
+        Agent(model, tokenizer, chat_template_class()),
         [task_class(client_args=env_args, n_clients=1)],
         args,
     )
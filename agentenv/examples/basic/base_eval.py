@@ -11,6 +11,7 @@ from agentenv.controller import (
     Agent,
     ChatGLM4Template,
     ChatMLTemplate,
+    EvalJournal,
     Evaluator,
     Llama2Template,
     Llama3Template,
@@ -57,6 +58,12 @@ class EvalArguments:
     chat_template: str = field(default="llama2")
     use_vllm: bool = field(default=False)
     action_format: str = field(default="default")
+    resume: bool = field(
+        default=False,
+        metadata={
+            "help": "Journal finished items in {output_file}.journal and skip them when the run is restarted."
+        },
+    )
 
 
 def main(args):
@@ -130,6 +137,14 @@ def main(args):
         test_data = json.load(file)
 
     data_idxs = [int(item["item_id"].split("_")[-1]) for item in test_data]
+    num_items = len(data_idxs)
+
+    journal = None
+    if args.get("resume"):
+        journal = EvalJournal(f"{args['output_file']}.journal", args["output_file"])
+        done = journal.completed(args["task_name"])
+        data_idxs = [data_idx for data_idx in data_idxs if data_idx not in done]
+        print(f"Resuming: {num_items - len(data_idxs)} items done before")
 
     total_score = 0.0
     total_success = 0.0
@@ -153,6 +168,22 @@ def main(args):
 
         cur_experiences = exps.experiences
         # write inference results to file
+        if journal is not None:
+            for exp in cur_experiences:
+                cur_success = 1 if exp.reward == 1 else 0
+                journal.commit(
+                    args["task_name"],
+                    data_idx,
+                    exp.reward,
+                    cur_success,
+                    {
+                        "conversations": exp.conversation,
+                        "item_id": f"{args['task_name']}_{data_idx}",
+                        "reward": exp.reward,
+                        "success": cur_success,
+                    },
+                )
+            continue
         with jsonlines.open(args["output_file"], mode="a") as f:
             for exp in cur_experiences:
                 conversation = exp.conversation
@@ -169,8 +200,13 @@ def main(args):
                 )
     process_time = time.time() - start_time
 
-    Score = total_score / len(data_idxs)
-    Success = total_success / len(data_idxs)
+    if journal is not None:
+        # the items of earlier runs count as well
+        summary = journal.summary(args["task_name"])
+        Score, Success = summary["score"], summary["success"]
+    else:
+        Score = total_score / num_items
+        Success = total_success / num_items
     print("\n\n==== EVALUATION ====\n")
     print(f"Score: {Score}")
     print(f"Success: {Success}")
@@ -8,6 +8,7 @@ from tqdm import tqdm
 
 from agentenv.controller import (
     APIAgent,
+    EvalJournal,
     Evaluator,
 )
 from agentenv.envs import (
@@ -92,6 +93,10 @@ def init(args):
         "timeout": args["timeout"],
     }
 
+    # the main process has repaired the journal already
+    global journal
+    journal = EvalJournal(*journal_files(args), recover=False)
+
     # set env client
     global evaluator
     evaluator = Evaluator(
@@ -107,14 +112,14 @@ def init(args):
     )
 
 
-def process(data_idx, args):
-    try:
-        with open(os.path.join(args["output_dir"], f"{args['task_name']}_{data_idx}.json"), 'r') as f:
-            item = json.load(f)
-        return item["reward"], item["success"]
-    except:
-        pass
+def journal_files(args):
+    return (
+        os.path.join(args["output_dir"], "journal.jsonl"),
+        os.path.join(args["output_dir"], "trajectories.jsonl"),
+    )
 
+
+def process(data_idx, args):
     while True:
         try:
             exps = evaluator.eval(
@@ -125,30 +130,22 @@ def process(data_idx, args):
         except Exception as e:
             print(e)
             continue
-    # total_score += exps.score
-    # total_success += exps.success
 
-    # cur_experiences = exps.experiences
     # write inference results to file
-    with open(os.path.join(args["output_dir"], f"{args['task_name']}_{data_idx}.json"), 'w') as f:
-        # for exp in cur_experiences:
-            # conversation = exp.conversation
-            # cur_reward = exp.reward
-            # cur_success = 1 if exp.reward == 1 else 0
-            # item_id = f"{args['task_name']}_{data_idx}"
-            # json.dump({
-            #     "conversations": conversation,
-            #     "item_id": item_id,
-            #     "reward": cur_reward,
-            #     "success": cur_success,
-            # }, f, ensure_ascii=False, indent=4)
-        json.dump({
-            "conversations": exps.experiences[0].conversation,
+    exp = exps.experiences[0]
+    success = 1 if exp.reward == 1 else 0
+    journal.commit(
+        args["task_name"],
+        data_idx,
+        exp.reward,
+        success,
+        {
+            "conversations": exp.conversation,
             "item_id": f"{args['task_name']}_{data_idx}",
-            "reward": exps.experiences[0].reward,
-            "success": 1 if exps.experiences[0].reward == 1 else 0,
-        }, f, ensure_ascii=False, indent=4)
-    return exps.score, exps.success
+            "reward": exp.reward,
+            "success": success,
+        },
+    )
 
 
 def main(args):
@@ -164,17 +161,20 @@ def main(args):
     # total_score = 0.0
     # total_success = 0.0
     start_time = time.time()
-    os.makedirs(args["output_dir"], exist_ok=True)
+    # finished items of an interrupted run are taken from the journal
+    journal = EvalJournal(*journal_files(args))
+    done = journal.completed(args["task_name"])
+    pending = [data_idx for data_idx in data_idxs if data_idx not in done]
+    print(f"{len(data_idxs) - len(pending)} items done before, {len(pending)} to go")
     with multiprocessing.Pool(args["processes"], init, (args,)) as pool:
-        results = list(pool.starmap(process, [(data_idx, args) for data_idx in data_idxs]))
+        pool.starmap(process, [(data_idx, args) for data_idx in pending])
     # for data_idx in tqdm(data_idxs, total=len(data_idxs), desc="[Evaluation Loop]"):
 
-    total_score = sum(score for score, success in results)
-    total_success = sum(success for score, success in results)
+    summary = journal.summary(args["task_name"])
     process_time = time.time() - start_time
 
-    Score = total_score / len(data_idxs)
-    Success = total_success / len(data_idxs)
+    Score = summary["score"]
+    Success = summary["success"]
     print("\n\n==== EVALUATION ====\n")
     print(f"Score: {Score}")
     print(f"Success: {Success}")
@@ -2,7 +2,13 @@ from dataclasses import dataclass, field
 
 import torch
 import transformers
-from agentenv.controller import Agent
+from agentenv.controller import (
+    Agent,
+    ChatGLM4Template,
+    ChatMLTemplate,
+    Llama2Template,
+    Llama3Template,
+)
 from agentenv.envs import (
     AlfWorldTask,
     SciworldTask,
@@ -62,6 +68,23 @@ class TrainingArguments:
     logging_step_freq: int = field(default=None)
     seed: int = field(default=42)
     max_input_length: int = field(default=700)
+    packing: bool = field(
+        default=False,
+        metadata={"help": "Pack conversations into rows of pack_length tokens instead of padding"},
+    )
+    pack_length: int = field(default=None, metadata={"help": "Packed row length (default: max_input_length)"})
+    group_by_length: bool = field(
+        default=False,
+        metadata={"help": "Batch conversations of similar length, shuffled within length buckets"},
+    )
+    chat_template: str = field(
+        default="llama2",
+        metadata={"help": "Chat template for training and rollouts: llama2, chatml, llama3 or chatglm4"},
+    )
+    tokenization_cache_dir: str = field(
+        default="~/.cache/agentenv/tokenized",
+        metadata={"help": "Cache of tokenized training data, empty to disable"},
+    )
 
     # environment
     max_round: int = field(
@@ -99,6 +122,16 @@ def main():
         "webarena": WebarenaTask,
     }
 
+    chat_templates = {
+        "llama2": Llama2Template,
+        "chatml": ChatMLTemplate,
+        "llama3": Llama3Template,
+        "chatglm4": ChatGLM4Template,
+    }
+    chat_template_class = chat_templates.get(args.chat_template.lower(), None)
+    if chat_template_class is None:
+        raise ValueError(f"Unsupported chat template: {args.chat_template}")
+
     # select task according to the name
     task_class = task_classes.get(args.task_name.lower(), None)
     if task_class is None:
@@ -112,7 +145,7 @@ def main():
     }
 
     trainer = BCTrainer(
-        Agent(model, tokenizer),
+        Agent(model, tokenizer, chat_template_class()),
         [task_class(client_args=env_args, n_clients=1)],
         args,
     )
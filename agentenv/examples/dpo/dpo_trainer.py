@@ -47,6 +47,14 @@ from trl.trainer.utils import (
     trl_sanitze_kwargs_for_tagging,
 )
 
+from agentenv.trainer.packing import prefix_tree_attention_mask
+from agentenv.trainer.ref_logps_cache import (
+    load_ref_logps,
+    model_hash,
+    ref_logps_cache_key,
+    save_ref_logps,
+)
+
 if is_peft_available():
     from peft import PeftModel, get_peft_model, prepare_model_for_kbit_training
 
@@ -119,6 +127,14 @@ class DPOMultiTrainer(Trainer):
         precompute_ref_log_probs (`bool`, defaults to `False`):
             Flag to precompute reference model log probabilities and evaluation datasets. This is useful if you want to train
             without the reference model and reduce the total GPU memory needed.
+        ref_logps_cache_dir (`Optional[str]`, *optional*):
+            With `precompute_ref_log_probs`, the directory the reference log probabilities are saved to, keyed by the
+            reference model weights, the dataset fingerprint and the tokenization settings. Later runs on the same data
+            load them memory-mapped instead of running the reference model.
+        shared_prompt_forward (`bool`, defaults to `False`):
+            Encode the prompt shared by the chosen and rejected sequences of a pair once and branch both continuations
+            off it with a prefix-tree attention mask, instead of encoding the prompt twice. Needs the `eager` or `sdpa`
+            attention implementation and a decoder-only model.
         model_init_kwargs: (`Optional[Dict]`, *optional*):
             Dict of Optional kwargs to pass when instantiating the model from a string
         ref_model_init_kwargs: (`Optional[Dict]`, *optional*):
@@ -160,6 +176,8 @@ class DPOMultiTrainer(Trainer):
         generate_during_eval: bool = False,
         compute_metrics: Optional[Callable[[EvalLoopOutput], Dict]] = None,
         precompute_ref_log_probs: bool = False,
+        ref_logps_cache_dir: Optional[str] = None,
+        shared_prompt_forward: bool = False,
         model_init_kwargs: Optional[Dict] = None,
         ref_model_init_kwargs: Optional[Dict] = None,
     ):
@@ -253,6 +271,17 @@ class DPOMultiTrainer(Trainer):
                     make_inputs_require_grad
                 )
 
+        if (
+            shared_prompt_forward
+            and model is not None
+            and getattr(model.config, "_attn_implementation", None)
+            == "flash_attention_2"
+        ):
+            raise ValueError(
+                "`shared_prompt_forward=True` needs a 4D attention mask, which flash_attention_2 does not support."
+                " Load the model with `attn_implementation='sdpa'` or `'eager'`."
+            )
+
         if generate_during_eval and not is_wandb_available():
             raise ValueError(
                 "`generate_during_eval=True` requires Weights and Biases to be installed."
@@ -341,6 +370,18 @@ class DPOMultiTrainer(Trainer):
         self.max_target_length = max_target_length
         self.tokenizer = tokenizer
         self.precompute_ref_log_probs = precompute_ref_log_probs
+        self.ref_logps_cache_dir = ref_logps_cache_dir
+        self.shared_prompt_forward = shared_prompt_forward and not self.is_encoder_decoder
+        self._shared_prompt_stats = None
+        # hashed before the reference model gets wrapped by accelerate
+        self._ref_model_hash = None
+        if precompute_ref_log_probs and ref_logps_cache_dir:
+            if self.ref_model is not None:
+                self._ref_model_hash = model_hash(self.ref_model)
+            else:
+                self._ref_model_hash = model_hash(
+                    model, skip_trainable=self.is_peft_model
+                )
 
         # Since ref_logs are precomputed on the first call to get_train/eval_dataloader
         # keep track of first called to avoid computation of future calls
@@ -451,40 +492,12 @@ class DPOMultiTrainer(Trainer):
         """
 
         if self.precompute_ref_log_probs and not self._precomputed_train_ref_log_probs:
-            dataloader_params = {
-                "batch_size": self.args.per_device_train_batch_size,
-                "collate_fn": self.data_collator,
-                "num_workers": self.args.dataloader_num_workers,
-                "pin_memory": self.args.dataloader_pin_memory,
-                "shuffle": False,
-            }
-
-            # prepare dataloader
-            data_loader = self.accelerator.prepare(
-                DataLoader(self.train_dataset, **dataloader_params)
-            )
-
-            reference_chosen_logps = []
-            reference_rejected_logps = []
-            for padded_batch in tqdm(
-                iterable=data_loader, desc="Train dataset reference log probs"
-            ):
-                reference_chosen_logp, reference_rejected_logp = (
-                    self.compute_reference_log_probs(padded_batch)
-                )
-                reference_chosen_logp, reference_rejected_logp = (
-                    self.accelerator.gather_for_metrics(
-                        (reference_chosen_logp, reference_rejected_logp)
-                    )
+            all_reference_chosen_logps, all_reference_rejected_logps = (
+                self.precompute_reference_log_probs(
+                    self.train_dataset,
+                    self.args.per_device_train_batch_size,
+                    desc="Train dataset reference log probs",
                 )
-                reference_chosen_logps.append(reference_chosen_logp.cpu())
-                reference_rejected_logps.append(reference_rejected_logp.cpu())
-
-            all_reference_chosen_logps = (
-                torch.cat(reference_chosen_logps).float().numpy()
-            )
-            all_reference_rejected_logps = (
-                torch.cat(reference_rejected_logps).float().numpy()
             )
 
             self.train_dataset = self.train_dataset.add_column(
@@ -514,40 +527,12 @@ class DPOMultiTrainer(Trainer):
         eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
 
         if self.precompute_ref_log_probs and not self._precomputed_eval_ref_log_probs:
-            dataloader_params = {
-                "batch_size": self.args.per_device_eval_batch_size,
-                "collate_fn": self.data_collator,
-                "num_workers": self.args.dataloader_num_workers,
-                "pin_memory": self.args.dataloader_pin_memory,
-                "shuffle": False,
-            }
-
-            # prepare dataloader
-            data_loader = self.accelerator.prepare(
-                DataLoader(eval_dataset, **dataloader_params)
-            )
-
-            reference_chosen_logps = []
-            reference_rejected_logps = []
-            for padded_batch in tqdm(
-                iterable=data_loader, desc="Eval dataset reference log probs"
-            ):
-                reference_chosen_logp, reference_rejected_logp = (
-                    self.compute_reference_log_probs(padded_batch)
-                )
-                reference_chosen_logp, reference_rejected_logp = (
-                    self.accelerator.gather_for_metrics(
-                        (reference_chosen_logp, reference_rejected_logp)
-                    )
+            all_reference_chosen_logps, all_reference_rejected_logps = (
+                self.precompute_reference_log_probs(
+                    eval_dataset,
+                    self.args.per_device_eval_batch_size,
+                    desc="Eval dataset reference log probs",
                 )
-                reference_chosen_logps.append(reference_chosen_logp.cpu())
-                reference_rejected_logps.append(reference_rejected_logp.cpu())
-
-            all_reference_chosen_logps = (
-                torch.cat(reference_chosen_logps).float().numpy()
-            )
-            all_reference_rejected_logps = (
-                torch.cat(reference_rejected_logps).float().numpy()
             )
 
             eval_dataset = eval_dataset.add_column(
@@ -564,6 +549,78 @@ class DPOMultiTrainer(Trainer):
 
         return super().get_eval_dataloader(eval_dataset=eval_dataset)
 
+    def ref_logps_settings(self) -> Dict:
+        """The options besides the weights and the data that change the reference log probs."""
+        return {
+            "max_length": self.max_length,
+            "max_prompt_length": self.max_prompt_length,
+            "max_target_length": self.max_target_length,
+            "truncation_mode": self.truncation_mode,
+            "label_pad_token_id": self.label_pad_token_id,
+            "padding_value": self.padding_value,
+            "is_encoder_decoder": self.is_encoder_decoder,
+        }
+
+    def precompute_reference_log_probs(
+        self, dataset: Dataset, batch_size: int, desc: str
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Reference chosen/rejected log probs of every row of `dataset`, loaded from `ref_logps_cache_dir`
+        when this reference model saw the same data before, computed and saved there otherwise.
+        """
+        key = None
+        if self.ref_logps_cache_dir and self._ref_model_hash is not None:
+            key = ref_logps_cache_key(
+                dataset, self._ref_model_hash, self.ref_logps_settings()
+            )
+            cached = load_ref_logps(self.ref_logps_cache_dir, key)
+            if cached is not None and len(cached[0]) == len(dataset):
+                self.accelerator.print(
+                    f"{desc}: loaded from {self.ref_logps_cache_dir}/{key}"
+                )
+                return cached
+
+        dataloader_params = {
+            "batch_size": batch_size,
+            "collate_fn": self.data_collator,
+            "num_workers": self.args.dataloader_num_workers,
+            "pin_memory": self.args.dataloader_pin_memory,
+            "shuffle": False,
+        }
+
+        # prepare dataloader
+        data_loader = self.accelerator.prepare(DataLoader(dataset, **dataloader_params))
+
+        reference_chosen_logps = []
+        reference_rejected_logps = []
+        for padded_batch in tqdm(iterable=data_loader, desc=desc):
+            reference_chosen_logp, reference_rejected_logp = (
+                self.compute_reference_log_probs(padded_batch)
+            )
+            reference_chosen_logp, reference_rejected_logp = (
+                self.accelerator.gather_for_metrics(
+                    (reference_chosen_logp, reference_rejected_logp)
+                )
+            )
+            reference_chosen_logps.append(reference_chosen_logp.cpu())
+            reference_rejected_logps.append(reference_rejected_logp.cpu())
+
+        all_reference_chosen_logps = torch.cat(reference_chosen_logps).float().numpy()
+        all_reference_rejected_logps = (
+            torch.cat(reference_rejected_logps).float().numpy()
+        )
+
+        if key is not None and self.accelerator.is_main_process:
+            path = save_ref_logps(
+                self.ref_logps_cache_dir,
+                key,
+                all_reference_chosen_logps,
+                all_reference_rejected_logps,
+                meta=self.ref_logps_settings(),
+            )
+            self.accelerator.print(f"{desc}: saved to {path}")
+        return all_reference_chosen_logps, all_reference_rejected_logps
+
     def build_tokenized_answer(self, prompt, answer):
         """
         Llama tokenizer does satisfy `enc(a + b) = enc(a) + enc(b)`.
@@ -847,6 +904,62 @@ class DPOMultiTrainer(Trainer):
 
         return concatenated_batch
 
+    @staticmethod
+    def shared_prompt_inputs(
+        batch: Dict[str, Union[List, torch.LongTensor]],
+        padding_value: int = 0,
+        mask_dtype: torch.dtype = torch.float32,
+        device: Optional[torch.device] = None,
+    ) -> Dict[str, torch.LongTensor]:
+        """Lay out every pair as one row `[shared prefix | chosen suffix | rejected suffix]`.
+
+        The shared prefix is the longest common prefix of the chosen and rejected input ids (the prompt, at least).
+        Both suffixes attend to the prefix and to themselves only, and keep the position ids they have in their
+        own sequence, so each token sees exactly the context it has in `concatenated_inputs`.
+
+        Returns:
+            A dictionary with the `input_ids`, the 4D `attention_mask` and the `position_ids` of the tree rows,
+            and `chosen_index`/`rejected_index`, which gather the positions of the full chosen/rejected sequences
+            (padded to the longer of both) from the tree rows.
+        """
+        chosen_ids, rejected_ids = batch["chosen_input_ids"], batch["rejected_input_ids"]
+        chosen_lens = batch["chosen_attention_mask"].sum(-1).tolist()
+        rejected_lens = batch["rejected_attention_mask"].sum(-1).tolist()
+        common = min(chosen_ids.shape[1], rejected_ids.shape[1])
+        prefix_lens = (
+            (chosen_ids[:, :common] == rejected_ids[:, :common]).long().cumprod(-1).sum(-1).tolist()
+        )
+        prefix_lens = [
+            min(p, lc, lr) for p, lc, lr in zip(prefix_lens, chosen_lens, rejected_lens)
+        ]
+        length = max(lc + lr - p for p, lc, lr in zip(prefix_lens, chosen_lens, rejected_lens))
+        max_length = max(chosen_ids.shape[1], rejected_ids.shape[1])
+
+        input_ids, position_ids, chosen_index, rejected_index = [], [], [], []
+        for i, (p, lc, lr) in enumerate(zip(prefix_lens, chosen_lens, rejected_lens)):
+            row = chosen_ids[i, :lc].tolist() + rejected_ids[i, p:lr].tolist()
+            pad = length - len(row)
+            input_ids.append(row + [padding_value] * pad)
+            position_ids.append(list(range(lc)) + list(range(p, lr)) + list(range(pad)))
+            chosen_index.append(list(range(lc)) + [0] * (max_length - lc))
+            rejected_index.append(
+                list(range(p)) + list(range(lc, lc + lr - p)) + [0] * (max_length - lr)
+            )
+
+        return dict(
+            input_ids=torch.LongTensor(input_ids).to(device=device),
+            attention_mask=prefix_tree_attention_mask(
+                prefix_lens,
+                [[lc - p, lr - p] for p, lc, lr in zip(prefix_lens, chosen_lens, rejected_lens)],
+                length,
+                mask_dtype,
+            ).to(device=device),
+            position_ids=torch.LongTensor(position_ids).to(device=device),
+            chosen_index=torch.LongTensor(chosen_index).to(device=device),
+            rejected_index=torch.LongTensor(rejected_index).to(device=device),
+            prefix_lens=prefix_lens,
+        )
+
     def dpo_loss(
         self,
         policy_chosen_logps: torch.FloatTensor,
@@ -972,6 +1085,9 @@ class DPOMultiTrainer(Trainer):
 
         We do this to avoid doing two forward passes, because it's faster for FSDP.
         """
+        if self.shared_prompt_forward:
+            return self.shared_prompt_concatenated_forward(model, batch)
+
         concatenated_batch = self.concatenated_inputs(
             batch,
             is_encoder_decoder=self.is_encoder_decoder,
@@ -1013,6 +1129,66 @@ class DPOMultiTrainer(Trainer):
 
         return (chosen_logps, rejected_logps, chosen_logits, rejected_logits)
 
+    def shared_prompt_concatenated_forward(
+        self, model: nn.Module, batch: Dict[str, Union[List, torch.LongTensor]]
+    ) -> Tuple[
+        torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor
+    ]:
+        """Same outputs as `concatenated_forward`, but the prompt shared by each pair is encoded once."""
+        tree_batch = self.shared_prompt_inputs(
+            batch,
+            padding_value=self.padding_value,
+            mask_dtype=getattr(
+                self.accelerator.unwrap_model(model), "dtype", torch.float32
+            ),
+            device=self.accelerator.device,
+        )
+        logits = model(
+            tree_batch["input_ids"],
+            attention_mask=tree_batch["attention_mask"],
+            position_ids=tree_batch["position_ids"],
+        ).logits
+
+        def gather(index):
+            return logits.gather(
+                1, index.unsqueeze(-1).expand(-1, -1, logits.shape[-1])
+            )
+
+        # the chosen and rejected sequences as concatenated_forward sees them
+        all_logits = torch.cat(
+            (gather(tree_batch["chosen_index"]), gather(tree_batch["rejected_index"])),
+            dim=0,
+        )
+        max_length = all_logits.shape[1]
+        all_labels = torch.cat(
+            (
+                pad_to_length(batch["chosen_labels"], max_length, self.label_pad_token_id),
+                pad_to_length(batch["rejected_labels"], max_length, self.label_pad_token_id),
+            ),
+            dim=0,
+        ).to(device=self.accelerator.device)
+        all_logps = self.get_batch_logps(
+            all_logits,
+            all_labels,
+            average_log_prob=False,
+            is_encoder_decoder=self.is_encoder_decoder,
+            label_pad_token_id=self.label_pad_token_id,
+        )
+
+        len_chosen = batch["chosen_labels"].shape[0]
+        self._shared_prompt_stats = {
+            # prompt tokens not encoded a second time
+            "tokens_saved": sum(tree_batch["prefix_lens"]),
+            # padded positions concatenated_forward would have run minus the tree rows
+            "positions_saved": 2 * len_chosen * max_length - tree_batch["input_ids"].numel(),
+        }
+        return (
+            all_logps[:len_chosen],
+            all_logps[len_chosen:],
+            all_logits[:len_chosen],
+            all_logits[len_chosen:],
+        )
+
     def get_batch_loss_metrics(
         self,
         model,
@@ -1028,6 +1204,7 @@ class DPOMultiTrainer(Trainer):
             policy_chosen_logits,
             policy_rejected_logits,
         ) = self.concatenated_forward(model, batch)
+        shared_prompt_stats = self._shared_prompt_stats
 
         # if reference_chosen_logps and reference_rejected_logps in batch use them, otherwise use the reference model
         if "reference_chosen_logps" in batch and "reference_rejected_logps" in batch:
@@ -1072,6 +1249,9 @@ class DPOMultiTrainer(Trainer):
             policy_rejected_logits.detach().cpu().mean()
         )
         metrics[f"{prefix}logits/chosen"] = policy_chosen_logits.detach().cpu().mean()
+        if shared_prompt_stats is not None:
+            for key, value in shared_prompt_stats.items():
+                metrics[f"{prefix}shared_prompt/{key}"] = torch.tensor(float(value))
 
         return losses.mean(), metrics
 
@@ -1,19 +1,169 @@
+"""
+Builds chosen/rejected DPO pairs from expert and sampled trajectories.
+
+Both inputs are streamed, JSONL files line by line and JSON arrays item by
+item, and records are sorted by ``item_id`` in bounded runs on disk and merged
+back with a k-way merge, so only one run and the trajectories of one
+``item_id`` are in memory at a time, however large the rollout dumps.
+The pairs are written as JSON, JSONL or Parquet, all of which
+``train_dpo_multiturn.py`` reads.
+"""
+
 import argparse
+import glob
+import heapq
 import json
+import os
+import tempfile
+from itertools import groupby
+from operator import itemgetter
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
+SOURCES = ("expert", "experience")
+
+MESSAGE_TYPE = pa.struct(
+    [("from", pa.string()), ("loss", pa.bool_()), ("value", pa.string())]
+)
+PAIR_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("prompt", pa.list_(MESSAGE_TYPE)),
+        ("chosen", pa.list_(MESSAGE_TYPE)),
+        ("rejected", pa.list_(MESSAGE_TYPE)),
+    ]
+)
+
+
+def iter_json_array(f, chunk_size=1 << 20):
+    """
+    Yields the items of the JSON array in text file *f*, reading it in chunks
+    of *chunk_size* characters, so only one item is held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def peek():
+        # next non-whitespace character, "" at the end of the file
+        nonlocal buf, pos, eof
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\n\r":
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+
+    if peek() != "[":
+        raise ValueError(f"{f.name} does not hold a JSON array")
+    pos += 1
+    if peek() == "]":
+        return
+    while True:
+        peek()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(buf) or eof:
+                    break
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+        pos = end
+        yield item
+        separator = peek()
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or ']' in {f.name}, got {separator!r}")
+        pos += 1
+
 
 def load_data(file_path):
-    if file_path.endswith(".jsonl"):
-        with open(file_path, "r", encoding="utf8") as f:
-            data = [json.loads(line) for line in f]
-    else:
-        assert file_path.endswith(".json")
-        with open(file_path, "r", encoding="utf8") as f:
-            data = json.load(f)
-    print(f"Loaded {len(data)} data from {file_path}")
-    return data
+    """Yields the records of a ``.jsonl`` file line by line, or of a ``.json`` array item by item."""
+    with open(file_path, "r", encoding="utf8") as f:
+        if file_path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            assert file_path.endswith(".json")
+            yield from iter_json_array(f)
+
+
+def expand_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No file matches {pattern}")
+        paths += matches
+    return paths
+
+
+def write_sorted_runs(inputs, tmp_dir, run_size, task=None):
+    """
+    Sorts ``(source, paths)`` inputs by item_id in runs of *run_size* records
+    and returns the run files. Records keep their input order within an item_id.
+    """
+    runs = []
+
+    def flush(buffer):
+        buffer.sort(key=itemgetter(0))
+        path = os.path.join(tmp_dir, f"run{len(runs)}.jsonl")
+        with open(path, "w", encoding="utf8") as f:
+            for item_id, source, record in buffer:
+                f.write(json.dumps([item_id, source, record], ensure_ascii=False) + "\n")
+        runs.append(path)
+        buffer.clear()
+
+    buffer = []
+    for source, paths in inputs:
+        for path in paths:
+            for record in tqdm(load_data(path), desc=f"Reading {path}"):
+                if task is not None and not record["item_id"].startswith(task):
+                    continue
+                buffer.append((record["item_id"], source, record))
+                if len(buffer) >= run_size:
+                    flush(buffer)
+    if buffer:
+        flush(buffer)
+    return runs
+
+
+def read_run(path):
+    with open(path, "r", encoding="utf8") as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def merge_runs(runs, tmp_dir, max_open_runs=64):
+    """k-way merge of sorted runs, in several passes if there are too many to open at once."""
+    while len(runs) > max_open_runs:
+        merged = []
+        for start in range(0, len(runs), max_open_runs):
+            group = runs[start : start + max_open_runs]
+            path = os.path.join(tmp_dir, f"merge{len(merged)}_{os.path.basename(group[0])}")
+            with open(path, "w", encoding="utf8") as f:
+                for entry in heapq.merge(*map(read_run, group), key=itemgetter(0)):
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            for run in group:
+                os.remove(run)
+            merged.append(path)
+        runs = merged
+    return heapq.merge(*map(read_run, runs), key=itemgetter(0))
+
+
+def reward_of(record, source):
+    # expert trajectories without a reward are taken as successful
+    return record.get("reward", 1.0) if source == "expert" else record["reward"]
 
 
 def make_dpo_data(chosen, rejected, prompt_length):
@@ -25,73 +175,166 @@ def make_dpo_data(chosen, rejected, prompt_length):
     }
 
 
-def main(args):
-    expert = load_data(args.expert)
-    experience = load_data(args.experience)
-
-    if args.task is not None:
-        expert = [x for x in expert if x["item_id"].startswith(args.task)]
-        experience = [x for x in experience if x["item_id"].startswith(args.task)]
-
-    # deduplicate
-    new_expert = {}
-    for x in expert:
-        idx = x["item_id"]
-        if idx not in new_expert:
-            new_expert[idx] = x
-        elif x["reward"] < new_expert[idx]["reward"]:
-            new_expert[idx] = x
-    expert = list(new_expert.values())
-
-    new_experience = {}
-    for x in experience:
-        idx = x["item_id"]
-        if idx not in new_experience:
-            new_experience[idx] = x
-        elif x["reward"] < new_experience[idx]["reward"]:
-            new_experience[idx] = x
-    experience = list(new_experience.values())
-
-    if len(expert) != len(experience):
-        raise ValueError(
-            f"Length of expert ({len(expert)}) and experience ({len(experience)}) are different."
-        )
+def pair_expert_experience(item_id, candidates, reward_gap, expert_threshold, max_pairs):
+    """
+    One expert against one sampled trajectory, the lowest-reward one of each
+    source; whichever is better by *reward_gap* and reaches
+    *expert_threshold* is chosen.
+    """
+    picked = {}
+    for source in SOURCES:
+        records = [r for s, r in candidates if s == source]
+        if not records:
+            raise ValueError(f"Item ID {item_id} has no {source} trajectory.")
+        picked[source] = min(records, key=lambda r, s=source: reward_of(r, s))
+    e, x = picked["expert"], picked["experience"]
+    reward_expert, reward_experience = reward_of(e, "expert"), reward_of(x, "experience")
+    if reward_expert - reward_experience >= reward_gap and reward_expert >= expert_threshold:
+        return [(e, x)]
+    if reward_experience - reward_expert >= reward_gap and reward_experience >= expert_threshold:
+        return [(x, e)]
+    return []
+
+
+def pair_best_worst(item_id, candidates, reward_gap, expert_threshold, max_pairs):
+    """The best trajectory of either source against the worst one."""
+    rewards = [reward_of(r, s) for s, r in candidates]
+    best = max(range(len(candidates)), key=rewards.__getitem__)
+    worst = min(range(len(candidates)), key=rewards.__getitem__)
+    if rewards[best] - rewards[worst] >= reward_gap and rewards[best] >= expert_threshold:
+        return [(candidates[best][1], candidates[worst][1])]
+    return []
+
+
+def pair_all(item_id, candidates, reward_gap, expert_threshold, max_pairs):
+    """Every qualifying (chosen, rejected) combination, widest reward gap first."""
+    rewards = [reward_of(r, s) for s, r in candidates]
+    pairs = [
+        (rewards[i] - rewards[j], i, j)
+        for i in range(len(candidates))
+        for j in range(len(candidates))
+        if rewards[i] - rewards[j] >= reward_gap
+        and rewards[i] - rewards[j] > 0
+        and rewards[i] >= expert_threshold
+    ]
+    pairs.sort(key=lambda p: -p[0])
+    if max_pairs is not None:
+        pairs = pairs[:max_pairs]
+    return [(candidates[i][1], candidates[j][1]) for _, i, j in pairs]
+
 
-    expert.sort(key=lambda x: x["item_id"])
-    experience.sort(key=lambda x: x["item_id"])
+PAIRING_POLICIES = {
+    "expert_vs_experience": pair_expert_experience,
+    "best_worst": pair_best_worst,
+    "all": pair_all,
+}
 
-    print(f"Length of expert and experience: {len(expert)}")
 
-    dpo_data = []
-    for e, x in tqdm(zip(expert, experience)):
-        if e["item_id"] != x["item_id"]:
-            raise ValueError(f"Item ID of expert ({e['item_id']}) and experience ({x['item_id']}) are different.")
-        reward_expert = e.get("reward", 1.0)
-        reward_experience = x["reward"]
-        if (
-            reward_expert - reward_experience >= args.reward_gap
-            and reward_expert >= args.expert_threshold
-        ):
-            dpo_data.append(make_dpo_data(e, x, args.prompt_length))
-        elif (
-            reward_experience - reward_expert >= args.reward_gap
-            and reward_experience >= args.expert_threshold
-        ):
-            dpo_data.append(make_dpo_data(x, e, args.prompt_length))
+class PairWriter:
+    """Writes pairs to ``.json``, ``.jsonl`` or ``.parquet`` as they come."""
 
-    print(f"Length of DPO dataset: {len(dpo_data)}")
+    def __init__(self, path, row_group_size=1000):
+        self.path = path
+        self.tmp_path = f"{path}.tmp{os.getpid()}"
+        self.format = os.path.splitext(path)[1].lstrip(".")
+        if self.format not in ("json", "jsonl", "parquet"):
+            raise ValueError(f"Unsupported output format: {path}")
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.count = 0
+        if self.format == "parquet":
+            self.writer = pq.ParquetWriter(self.tmp_path, PAIR_SCHEMA)
+        else:
+            self.file = open(self.tmp_path, "w", encoding="utf8")
+            if self.format == "json":
+                self.file.write("[")
+
+    def write(self, row):
+        if self.format == "parquet":
+            self.rows.append(row)
+            if len(self.rows) >= self.row_group_size:
+                self._write_row_group()
+        elif self.format == "jsonl":
+            self.file.write(json.dumps(row, ensure_ascii=True) + "\n")
+        else:
+            self.file.write(("," if self.count else "") + "\n")
+            self.file.write(json.dumps(row, ensure_ascii=True, indent=4))
+        self.count += 1
+
+    def _write_row_group(self):
+        self.writer.write_table(pa.Table.from_pylist(self.rows, schema=PAIR_SCHEMA))
+        self.rows = []
+
+    def close(self):
+        """Moves the finished output into place."""
+        if self.format == "parquet":
+            if self.rows:
+                self._write_row_group()
+            self.writer.close()
+        else:
+            if self.format == "json":
+                self.file.write("\n]\n")
+            self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.format == "parquet":
+            self.writer.close()
+        else:
+            self.file.close()
+        os.remove(self.tmp_path)
+
+
+def main(args):
+    pair_fn = PAIRING_POLICIES[args.pairing]
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        runs = write_sorted_runs(
+            [("expert", expand_paths(args.expert)), ("experience", expand_paths(args.experience))],
+            tmp_dir,
+            args.run_size,
+            args.task,
+        )
+        writer = PairWriter(args.output)
+        num_items = 0
+        try:
+            entries = merge_runs(runs, tmp_dir, args.max_open_runs)
+            for item_id, group in tqdm(groupby(entries, key=itemgetter(0)), desc="Pairing"):
+                num_items += 1
+                candidates = [(source, record) for _, source, record in group]
+                for chosen, rejected in pair_fn(
+                    item_id, candidates, args.reward_gap, args.expert_threshold, args.max_pairs_per_id
+                ):
+                    writer.write(make_dpo_data(chosen, rejected, args.prompt_length))
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
 
-    with open(args.output, "w", encoding="utf8") as f:
-        json.dump(dpo_data, f, ensure_ascii=True, indent=4)
+    print(f"Number of item ids: {num_items}")
+    print(f"Length of DPO dataset: {writer.count}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--expert", type=str, required=True)
+    parser.add_argument("--expert", type=str, nargs="+", required=True,
+                        help="Expert .json/.jsonl files or glob patterns. Both formats are "
+                             "streamed: .jsonl line by line, .json arrays item by item.")
     parser.add_argument("--prompt_length", type=int, default=3)
-    parser.add_argument("--experience", type=str, required=True)
+    parser.add_argument("--experience", type=str, nargs="+", required=True,
+                        help="Sampled .json/.jsonl files or glob patterns, e.g. per-rank shards, "
+                             "streamed like --expert.")
     parser.add_argument("--reward_gap", type=float, default=0.01)
     parser.add_argument("--expert_threshold", type=float, default=0.7)
-    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True,
+                        help="Output .json, .jsonl or .parquet file.")
     parser.add_argument("--task", type=str, required=False)
+    parser.add_argument("--pairing", type=str, default="expert_vs_experience",
+                        choices=sorted(PAIRING_POLICIES))
+    parser.add_argument("--max_pairs_per_id", type=int, default=None,
+                        help="Cap on the pairs per item id with --pairing all.")
+    parser.add_argument("--run_size", type=int, default=100000,
+                        help="Records sorted in memory at a time.")
+    parser.add_argument("--max_open_runs", type=int, default=64)
+    parser.add_argument("--tmp_dir", type=str, default=None,
+                        help="Directory for the sorted runs.")
     main(parser.parse_args())
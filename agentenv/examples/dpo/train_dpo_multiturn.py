@@ -31,7 +31,8 @@ class ModelArguments:
 @dataclass
 class DataArguments:
     data_path: str = field(
-        default=None, metadata={"help": "Path to the training data."}
+        default=None,
+        metadata={"help": "Path to the training data (.json, .jsonl or .parquet)."},
     )
 
 
@@ -56,6 +57,34 @@ class TrainingArguments(transformers.TrainingArguments):
         metadata={"help": "Maximum target length."},
     )
     remove_unused_columns: bool = field(default=False)
+    precompute_ref_log_probs: bool = field(
+        default=False,
+        metadata={
+            "help": "Compute the reference log probs once before training instead of every step."
+        },
+    )
+    ref_logps_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Save the precomputed reference log probs here and reuse them on runs with the same reference model, data and lengths."
+        },
+    )
+    ref_logps_only: bool = field(
+        default=False,
+        metadata={
+            "help": "Only fill ref_logps_cache_dir with the reference log probs and exit, e.g. ahead of the training run."
+        },
+    )
+    shared_prompt_forward: bool = field(
+        default=False,
+        metadata={
+            "help": "Encode the prompt of each chosen/rejected pair once (loads the models with sdpa attention)."
+        },
+    )
+    ref_logps_niceness: int = field(
+        default=10,
+        metadata={"help": "Niceness increment of the process with ref_logps_only."},
+    )
 
 
 def tokenize_conversation(
@@ -149,12 +178,23 @@ def train():
     global local_rank  # pylint: disable=W0604:global-at-module-level
     local_rank = training_args.local_rank
 
+    if training_args.ref_logps_only:
+        if not training_args.ref_logps_cache_dir:
+            raise ValueError("ref_logps_only requires ref_logps_cache_dir")
+        training_args.precompute_ref_log_probs = True
+        os.nice(training_args.ref_logps_niceness)
+
     config = transformers.AutoConfig.from_pretrained(
         model_args.model_name_or_path,
         cache_dir=training_args.cache_dir,
         trust_remote_code=model_args.trust_remote_code,
     )
 
+    # flash-attention-2 cannot take the prefix-tree mask of shared_prompt_forward
+    attn_implementation = (
+        "sdpa" if training_args.shared_prompt_forward else "flash_attention_2"
+    )
+
     # Load model and tokenizer
     model = transformers.AutoModelForCausalLM.from_pretrained(
         model_args.model_name_or_path,
@@ -162,7 +202,7 @@ def train():
         cache_dir=training_args.cache_dir,
         trust_remote_code=model_args.trust_remote_code,
         torch_dtype=torch.bfloat16,
-        attn_implementation="flash_attention_2",
+        attn_implementation=attn_implementation,
     )
     model.gradient_checkpointing_enable()
 
@@ -174,7 +214,7 @@ def train():
         cache_dir=training_args.cache_dir,
         trust_remote_code=model_args.trust_remote_code,
         torch_dtype=torch.bfloat16,
-        attn_implementation="flash_attention_2",
+        attn_implementation=attn_implementation,
     ).eval()
 
     tokenizer = transformers.AutoTokenizer.from_pretrained(
@@ -190,7 +230,8 @@ def train():
         tokenizer.pad_token = tokenizer.unk_token
 
     # Load data
-    dataset = load_dataset("json", data_files=data_args.data_path)
+    data_format = "parquet" if data_args.data_path.endswith(".parquet") else "json"
+    dataset = load_dataset(data_format, data_files=data_args.data_path)
     preprocess = partial(
         preprocess_multi_turn,
         tokenizer=tokenizer,
@@ -207,8 +248,15 @@ def train():
         max_target_length=training_args.max_target_length,
         max_prompt_length=training_args.max_prompt_length,
         generate_during_eval=True,
+        precompute_ref_log_probs=training_args.precompute_ref_log_probs,
+        ref_logps_cache_dir=training_args.ref_logps_cache_dir,
+        shared_prompt_forward=training_args.shared_prompt_forward,
     )
 
+    if training_args.ref_logps_only:
+        trainer.get_train_dataloader()
+        return
+
     if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
         trainer.train(resume_from_checkpoint=True)
     else:
@@ -38,6 +38,23 @@ class EvalArguments:
     seed: int = field(default=42)
     do_sample: bool = field(default=False, metadata={"help": "Do sampling or not."})
     temperature: float = field(default=1.0, metadata={"help": "Sampling temperature."})
+    group_by_length: bool = field(
+        default=False,
+        metadata={"help": "Batch rollouts of similar expected length, longest first."},
+    )
+    resume: bool = field(
+        default=False,
+        metadata={
+            "help": "Journal finished items in {output_file}.journal and skip them when the run is restarted."
+        },
+    )
+    work_stealing: bool = field(
+        default=False,
+        metadata={
+            "help": "Ranks pull the next batch from a shared queue when they finish one and "
+            "a restarted run skips the ids already journaled in {output_file}.shards."
+        },
+    )
 
     # conversation rounds
     max_round: int = field(
@@ -0,0 +1,125 @@
+"""
+Microbenchmark for the adapter action parsers — replays recorded actions
+
+The actions in tests/traj/processed are rendered into each action format with
+the adapter's own ``to_*`` helpers, then parsed back one at a time
+(``action_parser``) and in one call (``action_parser_batch``). For
+code-as-action the legacy ``eval`` path is timed as a baseline.
+
+用法:
+    python tests/benchmarks/bench_action_parser.py --env-name webshop --repeat 20
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+from agentenv.controller.types import ActionFormat, ActionWithTought
+from agentenv.controller.utils import extract_python_code_blocks
+from agentenv.envs import AlfWorldAdapter, SciWorldAdapter, WebshopAdapter
+from agentenv.envs.alfworld import ALFWORLD_CODE_ACTION_EVALUATOR
+from agentenv.envs.sciworld import SCIWORLD_CODE_ACTION_EVALUATOR
+from agentenv.envs.webshop import WEBSHOP_CODE_ACTION_EVALUATOR
+
+TRAJ_DIR = os.path.join(os.path.dirname(__file__), "..", "traj", "processed")
+
+ADAPTERS = {
+    "alfworld": (AlfWorldAdapter, ALFWORLD_CODE_ACTION_EVALUATOR),
+    "sciworld": (SciWorldAdapter, SCIWORLD_CODE_ACTION_EVALUATOR),
+    "webshop": (WebshopAdapter, WEBSHOP_CODE_ACTION_EVALUATOR),
+}
+
+RENDERERS = {
+    ActionFormat.REACT: "to_react",
+    ActionFormat.FUNCTION_CALLING: "to_function_calling",
+    ActionFormat.CODE_AS_ACTION: "to_code_as_action",
+}
+
+
+def load_actions(env_name: str) -> list[str]:
+    actions = []
+    for fpath in sorted(glob.glob(os.path.join(TRAJ_DIR, f"{env_name}_*.jsonl"))):
+        with open(fpath) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    actions.extend(json.loads(line).get("actions", []))
+    return actions
+
+
+def render_responses(adapter, actions: list[str], action_format: ActionFormat) -> list[str]:
+    render = getattr(adapter, RENDERERS[action_format])
+    responses = []
+    for action in actions:
+        try:
+            responses.append(
+                render(ActionWithTought(thought="I think this is next.", action=action))
+            )
+        except (ValueError, TypeError, IndexError):
+            continue  # action not expressible in this format
+    return responses
+
+
+def legacy_eval(evaluator, text: str) -> str | None:
+    try:
+        return eval(extract_python_code_blocks(text), {}, evaluator.functions)
+    except Exception:
+        return None
+
+
+def bench(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main():
+    p = argparse.ArgumentParser(description="Adapter action parser microbenchmark")
+    p.add_argument("--env-name", choices=list(ADAPTERS), default=None,
+                   help="Only benchmark one environment (default: all)")
+    p.add_argument("--repeat", type=int, default=10, help="Repetitions, best is reported")
+    args = p.parse_args()
+
+    env_names = [args.env_name] if args.env_name else list(ADAPTERS)
+    print(f"{'env':<10} {'format':<18} {'n':>6} {'single us':>10} {'batch us':>10} {'eval us':>10}")
+    for env_name in env_names:
+        adapter, evaluator = ADAPTERS[env_name]
+        actions = load_actions(env_name)
+        if not actions:
+            print(f"ERROR: no trajectories for {env_name} in {TRAJ_DIR}")
+            sys.exit(1)
+        for action_format in RENDERERS:
+            responses = render_responses(adapter, actions, action_format)
+            if not responses:
+                continue
+            n = len(responses)
+
+            def single():
+                for r in responses:
+                    try:
+                        adapter.action_parser(r, action_format)
+                    except Exception:
+                        pass
+
+            t_single = bench(single, args.repeat)
+            t_batch = bench(
+                lambda: adapter.action_parser_batch(responses, action_format), args.repeat
+            )
+            eval_col = "-"
+            if action_format == ActionFormat.CODE_AS_ACTION:
+                t_eval = bench(lambda: [legacy_eval(evaluator, r) for r in responses], args.repeat)
+                eval_col = f"{t_eval / n * 1e6:.2f}"
+            print(
+                f"{env_name:<10} {action_format.value:<18} {n:>6} "
+                f"{t_single / n * 1e6:>10.2f} {t_batch / n * 1e6:>10.2f} {eval_col:>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark of WebShop env creation — latency and resident memory per env count
+
+Creates envs through ``WebshopEnvServer.create`` like the ``/create`` endpoint
+does and reports, at each checkpoint, the latency of the first create (which
+loads the shared catalog), the mean latency of the others and the RSS of the
+process. ``--isolated`` drops the shared catalog before every create to
+measure the old one-catalog-per-env behaviour.
+
+Runs in the webshop environment (Python 3.8, ``agentenv_webshop`` installed):
+    python tests/benchmarks/bench_webshop_create.py --counts 1 100 1000
+"""
+
+import argparse
+import os
+import time
+
+from agentenv_webshop.environment import WebshopEnvServer
+from web_agent_site.engine.catalog import clear_catalogs
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def main():
+    p = argparse.ArgumentParser(description="WebShop env creation benchmark")
+    p.add_argument("--counts", type=int, nargs="+", default=[1, 100, 1000],
+                   help="Env counts to report at")
+    p.add_argument("--isolated", action="store_true",
+                   help="Reload the catalog for every env, as before sharing")
+    args = p.parse_args()
+
+    server = WebshopEnvServer(max_envs=max(args.counts) + 1)
+    rss_start = rss_mb()
+    latencies = []
+    print(f"{'envs':>6} {'first s':>9} {'mean ms':>9} {'rss MB':>9} {'MB/env':>9}")
+    for n in range(1, max(args.counts) + 1):
+        if args.isolated:
+            clear_catalogs()
+        t = time.perf_counter()
+        server.create()
+        latencies.append(time.perf_counter() - t)
+        if n in args.counts:
+            rest = latencies[1:]
+            mean_ms = sum(rest) / len(rest) * 1e3 if rest else float("nan")
+            rss = rss_mb()
+            print(
+                f"{n:>6} {latencies[0]:>9.2f} {mean_ms:>9.2f} {rss:>9.0f} "
+                f"{(rss - rss_start) / n:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark of WebShop server throughput — steps per second under concurrent clients
+
+``--clients`` threads (64 by default) each create an env and play episodes
+against a running server for ``--duration`` seconds: reset to a random task,
+search for the first words of the instruction, open the first result, read
+its Description and Features and buy it. Reports, for each server URL, the
+steps per second over all clients and the median and p99 step latency.
+
+Compare one worker process, which runs every env on one core like the
+single-process server did, with a pool of workers:
+
+    webshop --port 36001 --parallel-actor 1
+    webshop --port 36002 --parallel-actor 16
+    python tests/benchmarks/bench_webshop_pool.py \\
+        --urls http://127.0.0.1:36001 http://127.0.0.1:36002 --clients 64
+
+No WebShop result is recorded yet: the comparison needs a multi-core host
+with the search index built, and has not been run on one.
+"""
+
+import argparse
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ASIN = re.compile(r"\bB[0-9A-Z]{9}\b")
+
+
+def play(session, url, env_id, tasks, rng, latencies):
+    """Plays one episode, appending the latency of each step"""
+
+    def post(route, **body):
+        start = time.perf_counter()
+        res = session.post(f"{url}/{route}", json=body, timeout=120)
+        res.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        return res.json()["observation"]
+
+    observation = post("reset", env_id=env_id, task_id=rng.randrange(tasks))
+    # "WebShop [SEP] Instruction: [SEP] <instruction> [SEP] Search"
+    instruction = observation.split(" [SEP] ")[2]
+    observation = post("step", env_id=env_id, action=f"search[{' '.join(instruction.split()[:8])}]")
+    asins = ASIN.findall(observation)
+    if not asins:
+        return
+    post("step", env_id=env_id, action=f"click[{asins[0].lower()}]")
+    for sub_page in ("description", "features"):
+        post("step", env_id=env_id, action=f"click[{sub_page}]")
+        post("step", env_id=env_id, action="click[< prev]")
+    post("step", env_id=env_id, action="click[buy now]")
+
+
+def run(url, clients, duration, tasks):
+    """
+    Returns the step latencies of all clients and the seconds they played
+    for, from the moment every env is created
+    """
+    barrier = threading.Barrier(clients)
+    deadline = []
+
+    def client(i):
+        session = requests.Session()
+        env_id = session.post(f"{url}/create", timeout=120).json()["env_id"]
+        rng = random.Random(i)
+        latencies = []
+        if barrier.wait() == 0:
+            deadline.append(time.perf_counter() + duration)
+        barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            play(session, url, env_id, tasks, rng, latencies)
+        end = time.perf_counter()
+        session.post(f"{url}/close", json={"env_id": env_id}, timeout=120)
+        return latencies, end
+
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(client, range(clients)))
+    # Episodes under way at the deadline are played to the end
+    elapsed = max(end for _, end in results) - (deadline[0] - duration)
+    return [lat for latencies, _ in results for lat in latencies], elapsed
+
+
+def main():
+    p = argparse.ArgumentParser(description="WebShop server throughput benchmark")
+    p.add_argument("--urls", nargs="+", default=["http://127.0.0.1:36001"])
+    p.add_argument("--clients", type=int, default=64, help="Concurrent clients")
+    p.add_argument("--duration", type=float, default=60.0, help="Seconds per server")
+    p.add_argument("--tasks", type=int, default=500, help="Tasks drawn from, by task_id")
+    args = p.parse_args()
+
+    print(f"{'url':<28} {'steps/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for url in args.urls:
+        latencies, elapsed = run(url, args.clients, args.duration, args.tasks)
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1e3
+        p99 = latencies[int(len(latencies) * 0.99)] * 1e3
+        print(f"{url:<28} {len(latencies) / elapsed:>9.1f} {p50:>9.1f} {p99:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark of WebShop page rendering — pages per second from SimServer.render_time
+
+Each episode searches for the goal's query, then opens the top products and
+tours their pages (item page, Description, Features, Reviews, back to the
+item page) ``--revisits`` times, as agents do when comparing products. Only
+the time spent in ``map_action_to_html`` is counted, through the
+``SimServer.render_time`` counter. ``--cache-size 0`` disables the item page
+memo to time the compiled templates alone. ``--render-backend text`` builds
+the text observations straight from the product data instead of rendering
+and parsing HTML, so render time then counts the page builders.
+
+Runs in the webshop environment (Python 3.8, search index and data in place):
+    python tests/benchmarks/bench_webshop_render.py --episodes 50 --revisits 3
+    python tests/benchmarks/bench_webshop_render.py --episodes 50 --render-backend text
+"""
+
+import argparse
+import time
+
+import gym
+from web_agent_site.engine import engine
+from web_agent_site.envs import WebAgentTextEnv  # noqa: F401, registers the env
+
+SUB_PAGES = ["description", "features", "reviews"]
+
+
+def tour(env, product, revisits):
+    """Steps through a product's pages, returns the number of pages rendered"""
+    pages = 0
+    for _ in range(revisits):
+        env.step(f"click[{product}]")
+        pages += 1
+        for sub_page in SUB_PAGES:
+            env.step(f"click[{sub_page}]")
+            env.step("click[< prev]")
+            pages += 2
+        env.step("click[< prev]")
+        pages += 1
+    return pages
+
+
+def main():
+    p = argparse.ArgumentParser(description="WebShop page render benchmark")
+    p.add_argument("--episodes", type=int, default=50)
+    p.add_argument("--products", type=int, default=3, help="Products opened per episode")
+    p.add_argument("--revisits", type=int, default=3, help="Tours of each product's pages")
+    p.add_argument("--cache-size", type=int, default=engine.PAGE_CACHE_SIZE,
+                   help="Item page memo size, 0 disables it")
+    p.add_argument("--render-backend", choices=["html", "text"], default="html")
+    args = p.parse_args()
+
+    engine.PAGE_CACHE_SIZE = args.cache_size
+    env = gym.make(
+        "WebAgentTextEnv-v0", observation_mode="text", num_products=1000,
+        render_backend=args.render_backend,
+    )
+    server = env.unwrapped.server
+    pages = 0
+    start = time.perf_counter()
+    for episode in range(args.episodes):
+        env.reset(session=episode)
+        goal = server.user_sessions[env.unwrapped.session]["goal"]
+        env.step(f"search[{goal['query']}]")
+        pages += 1
+        env.unwrapped.get_available_actions()
+        products = [
+            name for name, tag in env.unwrapped.text_to_clickable.items()
+            if tag.get("class") == ["product-link"]
+        ][: args.products]
+        for product in products:
+            pages += tour(env, product, args.revisits)
+    wall_time = time.perf_counter() - start
+
+    print(f"pages rendered:  {pages}")
+    print(f"render time s:   {server.render_time:.3f}")
+    print(f"pages per s:     {pages / server.render_time:.1f}")
+    print(f"search time s:   {server.search_time:.3f}")
+    print(f"steps per s:     {pages / wall_time:.1f}  (render, parse and search)")
+
+
+if __name__ == "__main__":
+    main()
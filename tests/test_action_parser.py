@@ -0,0 +1,131 @@
+"""
+Test cases for the adapter action parsers.
+
+These tests need no env server:
+    pytest tests/test_action_parser.py -v
+"""
+
+import logging
+
+import pytest
+
+from agentenv.controller import CodeActionEvaluator
+from agentenv.controller.types import ActionFormat, ActionWithTought
+from agentenv.envs import AlfWorldAdapter, SciWorldAdapter, WebshopAdapter
+
+
+class TestReactParser:
+    """Test ReAct parsing."""
+
+    def test_well_formed(self):
+        text = "Thought:\nI need shoes.\n\nAction:\nsearch[red shoes]"
+        result = WebshopAdapter.parse_react(text)
+        assert result == ActionWithTought("I need shoes.", "search[red shoes]")
+
+    def test_missing_action_keeps_webshop_command(self):
+        result = WebshopAdapter.parse_react("click[buy now]")
+        assert result.action == "click[buy now]"
+        assert result.thought == ""
+
+    def test_malformed_does_not_print(self, capsys, caplog):
+        with caplog.at_level(logging.DEBUG, logger="agentenv.controller.parsing"):
+            WebshopAdapter.parse_react("no format here")
+        assert capsys.readouterr().out == ""
+        assert "not in the correct format" in caplog.text
+
+
+class TestFunctionCallingParser:
+    """Test function-calling parsing."""
+
+    def test_surrounding_text_is_ignored(self):
+        text = 'Sure!\n```json\n{"thought": "t", "function_name": "click", "arguments": {"item": "buy now"}}\n```'
+        assert WebshopAdapter.action_parser(text, ActionFormat.FUNCTION_CALLING) == "click[buy now]"
+
+    def test_no_json_raises(self):
+        with pytest.raises(ValueError):
+            WebshopAdapter.parse_function_calling("click buy now")
+
+
+class TestCodeAsActionParser:
+    """Test code-as-action parsing through the whitelisted evaluator."""
+
+    @pytest.mark.parametrize(
+        "code, expected",
+        [
+            ("```python\n# look for shoes\nsearch('red shoes')\n```", "search[red shoes]"),
+            ('click(item="buy now")', "click[buy now]"),
+            ("search('it\\'s red')", "search[it's red]"),
+        ],
+    )
+    def test_webshop(self, code, expected):
+        assert WebshopAdapter.action_parser(code, ActionFormat.CODE_AS_ACTION) == expected
+
+    @pytest.mark.parametrize(
+        "code, expected",
+        [
+            ("#go\ngoto('kitchen')", "go to kitchen"),
+            ("use('lighter', 'candle')", "use lighter on candle"),
+            ("use(tool='lighter')", "use lighter"),
+            ("wait('1')", "wait1"),
+            ("lookaround()", "look around"),
+            ("choose('2')", "2"),
+        ],
+    )
+    def test_sciworld(self, code, expected):
+        assert SciWorldAdapter.action_parser(code, ActionFormat.CODE_AS_ACTION) == expected
+
+    def test_alfworld_optional_argument(self):
+        assert AlfWorldAdapter.action_parser("examine('desk 1')", ActionFormat.CODE_AS_ACTION) == "examine desk 1"
+        assert (
+            AlfWorldAdapter.action_parser("examine('desk 1', 'desklamp 1')", ActionFormat.CODE_AS_ACTION)
+            == "examine desk 1 with desklamp 1"
+        )
+
+    @pytest.mark.parametrize(
+        "code",
+        [
+            "__import__('os').system('echo pwned')",
+            "search(open('/etc/passwd').read())",
+            "search('a'); click('b')",
+            "search(*['a'])",
+            "search(**{'keywords': 'a'})",
+            "unknown('a')",
+            "search()",
+            "search('a', 'b')",
+        ],
+    )
+    def test_rejected(self, code):
+        with pytest.raises(ValueError):
+            WebshopAdapter.parse_code_as_action(code)
+
+    def test_roundtrip_matches_renderer(self):
+        for action in ["go to kitchen", "pour water into cup", "focus on thermometer", "inventory"]:
+            code = SciWorldAdapter.to_code_as_action(ActionWithTought("t", action))
+            assert SciWorldAdapter.parse_code_as_action(code).action == action
+
+    def test_custom_functions(self):
+        evaluator = CodeActionEvaluator({"move": lambda x, y=0: f"move {x} {y}"})
+        assert evaluator("move('a')") == "move a 0"
+        assert evaluator("move('a', y=3)") == "move a 3"
+
+
+class TestBatchParsing:
+    """Test batched parsing."""
+
+    def test_errors_are_returned_in_place(self):
+        results = WebshopAdapter.action_parser_batch(
+            ["search('a')", "rm -rf /", "click('b')"], ActionFormat.CODE_AS_ACTION
+        )
+        assert results[0] == "search[a]"
+        assert isinstance(results[1], ValueError)
+        assert results[2] == "click[b]"
+
+    def test_matches_single_parser(self):
+        texts = [
+            "Thought:\nt\n\nAction:\nclick[next >]",
+            "Action:\nsearch[x]",
+            "click[b09npml43m]",
+        ]
+        assert WebshopAdapter.action_parser_batch(texts, ActionFormat.REACT) == [
+            WebshopAdapter.action_parser(t, ActionFormat.REACT) for t in texts
+        ]
@@ -0,0 +1,269 @@
+"""
+Test cases for the asynchronous actor/learner mode of AgentEvolTrainer.
+
+These tests need no env server: a fake env client stands in for it, and the
+end-to-end run trains a tiny random Llama on CPU:
+    pytest tests/test_async_rollout.py -v
+"""
+
+import json
+import threading
+import time
+from dataclasses import dataclass
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import (
+    GenerationConfig,
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedTokenizerFast,
+)
+
+from agentenv.controller import Agent, BaseEnvClient, BaseTask, StepOutput
+from agentenv.trainer import AgentEvolTrainer
+from agentenv.trainer.async_rollout import (
+    PolicyStore,
+    ReplayBuffer,
+    RolloutWorker,
+    pad_and_concat,
+)
+
+
+def make_tokenizer():
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for char in sorted(pre_tokenizers.ByteLevel.alphabet()):
+        vocab[char] = len(vocab)
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+
+
+class OneStepClient(BaseEnvClient):
+    """Any action finishes the episode with reward 1."""
+
+    conversation_start = (
+        {"from": "human", "loss": None, "value": "Act."},
+        {"from": "gpt", "loss": False, "value": "OK"},
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__()
+
+    def __len__(self):
+        return 100
+
+    def reset(self, idx):
+        self.idx = idx
+
+    def observe(self):
+        return f"task {self.idx}"
+
+    def step(self, action):
+        return StepOutput("done", 1.0, True)
+
+
+class OneStepTask(BaseTask):
+    env_client_cls = OneStepClient
+    env_name = "onestep"
+
+
+class TestReplayBuffer:
+    """Test staleness, backpressure and shutdown."""
+
+    def test_stale_items_are_dropped(self):
+        buffer = ReplayBuffer(10, max_staleness=1)
+        buffer.put("v1", 1)
+        buffer.put("v2", 2)
+        buffer.put("v3", 3)
+        assert buffer.get(10, version=3) == ["v2", "v3"]
+        assert buffer.stats == {"added": 3, "consumed": 2, "stale_dropped": 1}
+
+    def test_full_buffer_blocks_producer(self):
+        buffer = ReplayBuffer(1)
+        buffer.put("a", 0)
+        assert not buffer.put("b", 0, timeout=0.05)
+
+        threading.Timer(0.05, lambda: buffer.get(1, 0)).start()
+        assert buffer.put("b", 0, timeout=5)
+        assert buffer.get(1, 0) == ["b"]
+
+    def test_get_waits_for_items_and_close(self):
+        buffer = ReplayBuffer(4)
+        threading.Timer(0.05, lambda: buffer.put("x", 0)).start()
+        assert buffer.get(4, 0, timeout=5) == ["x"]
+        start = time.monotonic()
+        threading.Timer(0.05, buffer.close).start()
+        assert buffer.get(4, 0, timeout=5) == []
+        assert time.monotonic() - start < 4
+        assert not buffer.put("y", 0)
+
+
+class TestPolicyStore:
+    """Test weight publishing."""
+
+    def test_sync_only_newer(self):
+        learner, actor = torch.nn.Linear(2, 2), torch.nn.Linear(2, 2)
+        store = PolicyStore()
+        assert store.sync(actor, 0) == 0
+        version = store.publish(learner)
+        assert store.sync(actor, 0) == version == 1
+        torch.testing.assert_close(actor.weight, learner.weight)
+        with torch.no_grad():
+            learner.weight.add_(1)
+            actor.weight.zero_()
+        # the published copy is not affected by later learner updates
+        assert store.sync(actor, 0) == 1
+        assert not torch.equal(actor.weight, learner.weight)
+        assert store.sync(actor, 1) == 1
+
+
+def test_worker_refreshes_engine_after_sync():
+    class RecordingAgent(Agent):
+        def __init__(self):
+            super().__init__(torch.nn.Linear(2, 2), make_tokenizer(), inference_engine="vllm")
+            self.refreshes = []
+
+        def generate(self, input_ids, generation_config, refresh_engine=False):
+            self.refreshes.append(refresh_engine)
+            return [[self.tokenizer.eos_token_id] for _ in input_ids]
+
+    agent = RecordingAgent()
+    store = PolicyStore()
+    versions = []
+
+    def make_item(task_i, idx, exp, version):
+        versions.append(version)
+        if len(versions) == 1:
+            store.publish(torch.nn.Linear(2, 2))
+        elif len(versions) == 3:
+            worker.stop()
+        return idx
+
+    worker = RolloutWorker(
+        agent,
+        [OneStepTask({}, n_clients=1)],
+        [[0, 1, 2]],
+        store,
+        ReplayBuffer(8),
+        make_item,
+        generation_config=GenerationConfig(max_length=128),
+        chunk_size=1,
+    )
+    worker.run()
+    worker.check()
+    # the engine is rebuilt for the chunk that follows a new policy only
+    assert versions == [0, 1, 1]
+    assert agent.refreshes == [False, True, False]
+
+
+def test_pad_and_concat():
+    forward_kwargs = {
+        "input_ids": torch.LongTensor([[5, 6, 0]]),
+        "attention_mask": torch.BoolTensor([[1, 1, 0]]),
+        "labels": torch.LongTensor([[-100, 6, -100]]),
+    }
+    rows = [{"input_ids": [7, 8, 9, 10], "attention_mask": [1] * 4, "labels": [-100, 8, 9, 10]}]
+    merged = pad_and_concat(forward_kwargs, rows, pad_token_id=0)
+    assert merged["input_ids"].tolist() == [[5, 6, 0, 0], [7, 8, 9, 10]]
+    assert merged["attention_mask"].dtype == torch.bool
+    assert merged["attention_mask"].tolist() == [[True, True, False, False], [True] * 4]
+    assert merged["labels"].tolist() == [[-100, 6, -100, -100], [-100, 8, 9, 10]]
+
+
+@dataclass
+class Args:
+    train_file: str
+    inference_file: str
+    test_file: str
+    model_save_path: str
+    task_name: str = "onestep"
+    batch_size: int = 2
+    eval_batch_size: int = 2
+    n_epochs: int = 2
+    num_workers: int = 0
+    learning_rate: float = 1e-3
+    weight_decay: float = 0.0
+    warmup_step: int = 0
+    clip_grad_norm: float = 1.0
+    gradient_accumulation_steps: int = 1
+    evaluating_epoch_freq: int = None
+    logging_epoch_freq: int = 1
+    saving_epoch_freq: int = None
+    logging_step_freq: int = None
+    seed: int = 0
+    max_input_length: int = 128
+    iter_num: int = 0
+    max_round: int = 2
+    wandb_log: bool = False
+    wandb_project: str = "test"
+    wandb_run_name: str = "test"
+    async_rollouts: bool = True
+    replay_buffer_size: int = 4
+    replay_batch_size: int = 2
+    replay_wait: float = 30.0
+    max_staleness: int = 2
+    policy_sync_steps: int = 1
+    rollout_chunk_size: int = 2
+    rollout_max_new_tokens: int = 3
+
+
+def test_async_evol_end_to_end(tmp_path):
+    torch.manual_seed(0)
+    train = [
+        {
+            "item_id": f"onestep_{i}",
+            "conversations": [
+                {"from": "human", "loss": None, "value": f"task {i}"},
+                {"from": "gpt", "loss": True, "value": "go"},
+            ],
+        }
+        for i in range(8)
+    ]
+    for name, data in [
+        ("train.json", train),
+        ("inference.json", [{"item_id": f"onestep_{i}"} for i in range(6)]),
+        ("test.json", [{"item_id": "onestep_0"}]),
+    ]:
+        (tmp_path / name).write_text(json.dumps(data))
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=300,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            max_position_embeddings=256,
+        )
+    )
+    args = Args(
+        train_file=str(tmp_path / "train.json"),
+        inference_file=str(tmp_path / "inference.json"),
+        test_file=str(tmp_path / "test.json"),
+        model_save_path=str(tmp_path / "model"),
+    )
+    trainer = AgentEvolTrainer(
+        Agent(model, make_tokenizer()), [OneStepTask({}, n_clients=2)], args
+    )
+    learner_before = {k: v.clone() for k, v in model.state_dict().items()}
+    trainer.evol()
+
+    assert trainer.rollout_worker is None
+    # every learner step waited for and consumed fresh rollouts
+    stats = trainer.replay_buffer.stats
+    assert stats["consumed"] >= 2 * 4
+    assert stats["added"] == stats["consumed"] + stats["stale_dropped"] + len(trainer.replay_buffer)
+    assert trainer.policy_store.version == 1 + 2 * 4
+    assert not torch.equal(model.state_dict()["lm_head.weight"], learner_before["lm_head.weight"])
+
+    rollouts = [
+        json.loads(line)
+        for line in (tmp_path / "model" / "async_rollouts_iter_1_rank0.jsonl").read_text().splitlines()
+    ]
+    assert len(rollouts) >= trainer.replay_buffer.stats["added"]
+    assert all(r["reward"] == 1.0 and r["item_id"].startswith("onestep_") for r in rollouts)
+    # the actor picked up newer policies while the learner trained
+    assert max(r["policy_version"] for r in rollouts) > 1
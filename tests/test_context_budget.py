@@ -0,0 +1,166 @@
+"""
+Test cases for the per-episode context budget.
+
+These tests use a character-level tokenizer and a fake env client, no env server or model:
+    pytest tests/test_context_budget.py -v
+"""
+
+import pytest
+from transformers import GenerationConfig
+
+from agentenv.controller import (
+    Agent,
+    BaseChatTemplate,
+    BaseEnvClient,
+    BaseTask,
+    ContextBudget,
+    StepOutput,
+    TruncationStrategy,
+)
+
+
+class CharTokenizer:
+    eos_token = "</s>"
+    eos_token_id = 1
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(c) for c in text]
+
+    def decode(self, ids):
+        return "".join(self.eos_token if i == self.eos_token_id else chr(i) for i in ids)
+
+
+class PlainTemplate(BaseChatTemplate):
+    def tokenize_conversation_one(self, message, tokenizer, idx=-1, add_generation_prompt=False):
+        text = f"<{message['from']}>{message['value']}"
+        input_ids = tokenizer.encode(text)
+        mask = [1 if message["loss"] else 0] * len(input_ids)
+        return {"text": text, "input_ids": input_ids, "action_mask": mask}
+
+
+class FixedAgent(Agent):
+    def __init__(self, reply="go"):
+        super().__init__(None, CharTokenizer(), PlainTemplate())
+        self.reply = reply
+        self.configs = []
+
+    def generate(self, input_ids, generation_config, refresh_engine=False):
+        self.configs.append(generation_config)
+        return [self.tokenizer.encode(self.reply) for _ in input_ids]
+
+
+class VerboseClient(BaseEnvClient):
+    """Every observation is ``obs_len`` characters; never done."""
+
+    conversation_start = (
+        {"from": "human", "loss": None, "value": "hi"},
+        {"from": "gpt", "loss": False, "value": "ok"},
+    )
+
+    def __init__(self, obs_len):
+        super().__init__()
+        self.obs_len = obs_len
+
+    def __len__(self):
+        return 1
+
+    def reset(self, idx):
+        pass
+
+    def observe(self):
+        return "A" * (self.obs_len // 2) + "Z" * (self.obs_len - self.obs_len // 2)
+
+    def step(self, action):
+        return StepOutput(self.observe(), 0, False)
+
+
+class VerboseTask(BaseTask):
+    env_client_cls = VerboseClient
+    env_name = "verbose"
+
+
+MARKER = "[cut]"
+
+
+class TestContextBudget:
+    """Test truncation strategies and generation caps."""
+
+    @pytest.mark.parametrize(
+        "strategy, expected",
+        [
+            ("head", "AAAAA[cut]"),
+            ("tail", "[cut]ZZZZZ"),
+            ("middle", "AAA[cut]ZZ"),
+        ],
+    )
+    def test_strategies(self, strategy, expected):
+        budget = ContextBudget(strategy=strategy, marker=MARKER)
+        text = "A" * 20 + "Z" * 20
+        assert budget.fit_observation(text, CharTokenizer(), 10) == expected
+        assert budget.stats["truncated_observations"] == 1
+        assert budget.stats["dropped_tokens"] == 30
+
+    def test_short_observation_untouched(self):
+        budget = ContextBudget(marker=MARKER)
+        assert budget.fit_observation("short", CharTokenizer(), 10) == "short"
+        assert budget.stats["truncated_observations"] == 0
+
+    def test_summarizer_with_fallback(self):
+        budget = ContextBudget(
+            strategy=TruncationStrategy.SUMMARIZE,
+            summarizer=lambda text, limit: text[:3] if len(text) > 30 else text,
+            marker=MARKER,
+        )
+        assert budget.fit_observation("x" * 40, CharTokenizer(), 10) == "xxx"
+        # the summary is still too long: truncated from the middle
+        assert len(budget.fit_observation("y" * 20, CharTokenizer(), 10)) == 10
+        with pytest.raises(ValueError):
+            ContextBudget(strategy="summarize")
+
+    def test_generation_config_cap(self):
+        budget = ContextBudget(max_length=100)
+        config = GenerationConfig(max_new_tokens=50)
+        assert budget.generation_config(20, config) is config
+        capped = budget.generation_config(70, config)
+        assert capped.max_new_tokens == 30
+        assert config.max_new_tokens == 50
+        assert budget.generation_config(70, GenerationConfig()).max_new_tokens == 30
+
+    def test_should_stop(self):
+        budget = ContextBudget(max_length=100, min_new_tokens=16)
+        assert not budget.should_stop(84)
+        assert budget.should_stop(85)
+        assert budget.stats["early_stops"] == 1
+
+
+class TestBudgetedRollout:
+    """Test the budget inside BaseTask rollouts."""
+
+    def test_observations_fit_and_episode_stops_early(self):
+        budget = ContextBudget(max_length=300, max_observation_tokens=60, min_new_tokens=20)
+        task = VerboseTask({"obs_len": 500}, context_budget=budget)
+        agent = FixedAgent()
+        (exp,) = task.generate_experience(agent, [0], GenerationConfig(max_length=300))
+        assert len(exp.seq_ids) <= 300
+        observations = [m["value"] for m in exp.conversation[2::2]]
+        assert all(len(o) <= 60 for o in observations)
+        assert observations[0].startswith("AAA") and observations[0].endswith("ZZZ")
+        assert budget.stats["early_stops"] == 1
+        # the episode stopped without a generation that could not fit
+        assert all(config.max_new_tokens >= budget.min_new_tokens for config in agent.configs)
+
+    def test_caps_follow_remaining_tokens(self):
+        budget = ContextBudget(max_length=200, max_observation_tokens=30)
+        task = VerboseTask({"obs_len": 30}, context_budget=budget)
+        agent = FixedAgent()
+        task.generate_experience(agent, [0], GenerationConfig(max_length=200), max_rounds=3)
+        caps = [config.max_new_tokens for config in agent.configs]
+        assert caps == sorted(caps, reverse=True)
+        assert len(set(caps)) == 3
+
+    def test_without_budget_observations_are_verbatim(self):
+        task = VerboseTask({"obs_len": 500})
+        (exp,) = task.generate_experience(
+            FixedAgent(), [0], GenerationConfig(max_length=4096), max_rounds=2
+        )
+        assert len(exp.conversation[2]["value"]) == 500
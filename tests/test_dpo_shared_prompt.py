@@ -0,0 +1,107 @@
+"""
+Test cases for the shared-prompt forward pass of DPOMultiTrainer.
+
+These tests need no env server, a tiny random Llama runs on CPU:
+    pytest tests/test_dpo_shared_prompt.py -v
+"""
+
+import os
+import sys
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, TrainingArguments
+from trl.trainer.utils import DPODataCollatorWithPadding
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "agentenv", "examples", "dpo"))
+try:
+    from dpo_trainer import DPOMultiTrainer
+except ImportError:  # the example targets the trl release pinned in agentenv
+    DPOMultiTrainer = None
+
+pytestmark = pytest.mark.skipif(DPOMultiTrainer is None, reason="dpo_trainer needs trl<0.9")
+
+
+class PadTokenizer:
+    pad_token_id = 0
+
+
+def make_rows():
+    rows = []
+    for i in range(3):
+        prompt = [1] + list(range(10, 14 + 3 * i))
+        chosen = list(range(40, 43 + i)) + [2]
+        rejected = list(range(40, 41 + (i % 2))) + list(range(70, 73 + 2 * i)) + [2]
+        rows.append(
+            {
+                "prompt_input_ids": prompt,
+                "prompt_attention_mask": [1] * len(prompt),
+                "chosen_input_ids": prompt + chosen,
+                "chosen_attention_mask": [1] * (len(prompt) + len(chosen)),
+                "chosen_labels": [-100] * len(prompt) + chosen,
+                "rejected_input_ids": prompt + rejected,
+                "rejected_attention_mask": [1] * (len(prompt) + len(rejected)),
+                "rejected_labels": [-100] * len(prompt) + rejected,
+            }
+        )
+    return rows
+
+
+def make_trainer(tmp_path, model, shared_prompt_forward):
+    return DPOMultiTrainer(
+        model=model,
+        ref_model=model,
+        args=TrainingArguments(
+            output_dir=str(tmp_path), remove_unused_columns=False, report_to=[], use_cpu=True
+        ),
+        tokenizer=PadTokenizer(),
+        max_length=64,
+        max_prompt_length=32,
+        shared_prompt_forward=shared_prompt_forward,
+    )
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_logps_match_concatenated_forward(tmp_path, attn_implementation):
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=128,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            attn_implementation=attn_implementation,
+        )
+    )
+    batch = DPODataCollatorWithPadding(pad_token_id=0)(make_rows())
+    baseline = make_trainer(tmp_path, model, shared_prompt_forward=False)
+    shared = make_trainer(tmp_path, model, shared_prompt_forward=True)
+
+    expected = baseline.concatenated_forward(model, batch)
+    got = shared.concatenated_forward(model, batch)
+    torch.testing.assert_close(got[0], expected[0], atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(got[1], expected[1], atol=1e-5, rtol=1e-5)
+
+    # gradients flow through the shared prompt into both branches
+    (got[0].sum() - got[1].sum()).backward()
+    shared_grad = model.model.embed_tokens.weight.grad.clone()
+    model.zero_grad()
+    (expected[0].sum() - expected[1].sum()).backward()
+    torch.testing.assert_close(shared_grad, model.model.embed_tokens.weight.grad, atol=1e-5, rtol=1e-4)
+
+    # the prompt and the reply tokens both branches start with are encoded once
+    prefix_lens = [len(row["prompt_input_ids"]) + 1 + i % 2 for i, row in enumerate(make_rows())]
+    assert shared._shared_prompt_stats["tokens_saved"] == sum(prefix_lens)
+    assert shared._shared_prompt_stats["positions_saved"] > 0
+
+
+def test_flash_attention_is_rejected(tmp_path):
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=128, hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=4
+        )
+    )
+    model.config._attn_implementation = "flash_attention_2"
+    with pytest.raises(ValueError, match="flash_attention_2"):
+        make_trainer(tmp_path, model, shared_prompt_forward=True)
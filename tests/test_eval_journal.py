@@ -0,0 +1,95 @@
+"""
+Test cases for the append-only evaluation journal.
+
+These tests only write temporary files, no env server or model:
+    pytest tests/test_eval_journal.py -v
+"""
+
+import json
+import multiprocessing
+
+import pytest
+
+from agentenv.controller import EvalJournal, summarize_entries
+
+
+def record(idx, reward):
+    return {"conversations": [{"from": "gpt", "value": "x" * idx}], "item_id": f"webshop_{idx}", "reward": reward}
+
+
+def commit_many(journal_path, trajectory_file, idxs):
+    journal = EvalJournal(journal_path, trajectory_file, recover=False)
+    for idx in idxs:
+        journal.commit("webshop", idx, idx / 10, int(idx % 2 == 0), record(idx, idx / 10))
+
+
+class TestEvalJournal:
+    """Test commits, crash recovery and aggregation."""
+
+    def test_commit_and_read(self, tmp_path):
+        journal = EvalJournal(str(tmp_path / "journal.jsonl"), str(tmp_path / "out.jsonl"))
+        first = journal.commit("webshop", 3, 0.5, 0, record(3, 0.5))
+        second = journal.commit("alfworld", 3, 1.0, 1, record(4, 1.0))
+        assert second["offset"] == first["offset"] + first["length"]
+        assert journal.read_trajectory(second) == record(4, 1.0)
+        assert journal.completed("webshop") == {3}
+        assert journal.completed() == {3}
+        # the trajectory file stays plain JSONL
+        lines = (tmp_path / "out.jsonl").read_text().splitlines()
+        assert [json.loads(line) for line in lines] == [record(3, 0.5), record(4, 1.0)]
+
+    def test_recover_after_crash(self, tmp_path):
+        journal_path, trajectory_file = str(tmp_path / "journal.jsonl"), str(tmp_path / "out.jsonl")
+        journal = EvalJournal(journal_path, trajectory_file)
+        entry = journal.commit("webshop", 1, 1.0, 1, record(1, 1.0))
+        # killed after writing a trajectory but before committing it,
+        # and in the middle of a journal line
+        with open(trajectory_file, "a") as f:
+            f.write(json.dumps(record(2, 0.0)) + "\n")
+        with open(journal_path, "a") as f:
+            f.write('{"task": "webshop", "idx": 2, "rew')
+        assert journal.completed() == {1}
+
+        reopened = EvalJournal(journal_path, trajectory_file)
+        assert reopened.entries() == [entry]
+        assert (tmp_path / "out.jsonl").read_text() == json.dumps(record(1, 1.0)) + "\n"
+        reopened.commit("webshop", 2, 0.0, 0, record(2, 0.0))
+        assert [json.loads(line)["item_id"] for line in open(trajectory_file)] == ["webshop_1", "webshop_2"]
+
+    def test_existing_output_without_journal_is_kept(self, tmp_path):
+        journal_path, trajectory_file = str(tmp_path / "journal.jsonl"), str(tmp_path / "out.jsonl")
+        content = json.dumps(record(1, 1.0)) + "\n" + json.dumps(record(2, 0.0)) + "\n"
+        (tmp_path / "out.jsonl").write_text(content)
+        with pytest.raises(ValueError, match="no journal"):
+            EvalJournal(journal_path, trajectory_file)
+        assert (tmp_path / "out.jsonl").read_text() == content
+        assert not (tmp_path / "journal.jsonl").exists()
+        # an empty output file is adopted
+        (tmp_path / "out.jsonl").write_text("")
+        assert EvalJournal(journal_path, trajectory_file).entries() == []
+
+    def test_concurrent_commits(self, tmp_path):
+        journal_path, trajectory_file = str(tmp_path / "journal.jsonl"), str(tmp_path / "out.jsonl")
+        journal = EvalJournal(journal_path, trajectory_file)
+        ctx = multiprocessing.get_context("fork")
+        workers = [
+            ctx.Process(target=commit_many, args=(journal_path, trajectory_file, range(start, 40, 4)))
+            for start in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        entries = journal.entries()
+        assert sorted(e["idx"] for e in entries) == list(range(40))
+        assert all(journal.read_trajectory(e)["item_id"] == f"webshop_{e['idx']}" for e in entries)
+        assert journal.summary("webshop") == {"count": 40, "score": 1.95, "success": 0.5}
+
+    def test_summary_counts_items_once(self):
+        entries = [
+            {"task": "webshop", "idx": 0, "reward": 1.0, "success": 1},
+            {"task": "webshop", "idx": 0, "reward": 0.0, "success": 0},
+            {"task": "webshop", "idx": 1, "reward": 0.0, "success": 0},
+        ]
+        assert summarize_entries(entries) == {"count": 2, "score": 0.5, "success": 0.5}
+        assert summarize_entries([]) == {"count": 0, "score": 0.0, "success": 0.0}
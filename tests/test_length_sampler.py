@@ -0,0 +1,96 @@
+"""
+Test cases for the length-grouped batch sampler.
+
+These tests need no env server or model:
+    pytest tests/test_length_sampler.py -v
+"""
+
+import random
+
+import pytest
+import torch
+from accelerate.data_loader import BatchSamplerShard
+
+from agentenv.trainer.sampler import LengthGroupedBatchSampler
+
+
+def make_lengths(n=1000, seed=0):
+    rng = random.Random(seed)
+    return [rng.randint(10, 4096) for _ in range(n)]
+
+
+def padded_tokens(batches, lengths):
+    return sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+
+
+class TestLengthGroupedBatchSampler:
+    """Test batch composition, determinism and sharding."""
+
+    def test_every_index_once(self):
+        lengths = make_lengths(1003)
+        sampler = LengthGroupedBatchSampler(lengths, 8, seed=1)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(1003))
+        assert all(len(batch) == 8 for batch in batches[:-1])
+        assert len(batches[-1]) == 1003 % 8
+
+    def test_less_padding_than_random_batches(self):
+        lengths = make_lengths()
+        grouped = list(LengthGroupedBatchSampler(lengths, 8, seed=0))
+        order = list(range(len(lengths)))
+        random.Random(0).shuffle(order)
+        shuffled = [order[i : i + 8] for i in range(0, len(order), 8)]
+        assert padded_tokens(grouped, lengths) < 0.7 * padded_tokens(shuffled, lengths)
+
+    def test_deterministic_per_seed_and_epoch(self):
+        lengths = make_lengths()
+        a = LengthGroupedBatchSampler(lengths, 8, seed=3)
+        b = LengthGroupedBatchSampler(lengths, 8, seed=3)
+        # the global RNG (seeded per process by the trainers) is not used
+        torch.manual_seed(0)
+        first = list(a)
+        torch.manual_seed(1)
+        assert list(b) == first
+        # the next iteration is the next epoch
+        second = list(a)
+        assert second != first
+        b.set_epoch(1)
+        assert list(b) == second
+        assert list(LengthGroupedBatchSampler(lengths, 8, seed=4)) != first
+
+    def test_no_shuffle_is_longest_first(self):
+        lengths = make_lengths(50)
+        batches = list(LengthGroupedBatchSampler(lengths, 4, shuffle=False))
+        flat = [lengths[i] for batch in batches for i in batch]
+        assert flat == sorted(lengths, reverse=True)
+
+    def test_invalid_sizes(self):
+        with pytest.raises(ValueError):
+            LengthGroupedBatchSampler([1, 2], 0)
+        with pytest.raises(ValueError):
+            LengthGroupedBatchSampler([1, 2], 4, bucket_size=2)
+
+    def test_shards_cover_dataset_with_matched_steps(self):
+        lengths = make_lengths(1000)
+        num_processes = 4
+        shards = [
+            list(
+                BatchSamplerShard(
+                    LengthGroupedBatchSampler(lengths, 8, seed=5, num_processes=num_processes),
+                    num_processes=num_processes,
+                    process_index=rank,
+                )
+            )
+            for rank in range(num_processes)
+        ]
+        assert len({len(shard) for shard in shards}) == 1
+        seen = [i for shard in shards for batch in shard for i in batch]
+        assert sorted(set(seen)) == list(range(1000))
+        # the batches of one step come from the same bucket
+        step_spread = [
+            max(lengths[i] for shard in shards for i in shard[step])
+            - min(lengths[i] for shard in shards for i in shard[step])
+            for step in range(len(shards[0]) - 1)
+        ]
+        assert max(step_spread) < 4096 / 4
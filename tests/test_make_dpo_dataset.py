@@ -0,0 +1,145 @@
+"""
+Test cases for the streaming DPO pair builder.
+
+These tests only write small JSONL files, no model or env server:
+    pytest tests/test_make_dpo_dataset.py -v
+"""
+
+import json
+import os
+import sys
+from argparse import Namespace
+
+import pytest
+from datasets import load_dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "agentenv", "examples", "dpo"))
+import make_dpo_dataset  # noqa: E402
+
+
+def trajectory(item_id, reward, tag):
+    return {
+        "item_id": item_id,
+        "reward": reward,
+        "conversations": [
+            {"from": "human", "loss": None, "value": f"task {item_id}"},
+            {"from": "gpt", "loss": False, "value": "OK"},
+            {"from": "human", "loss": None, "value": "observation"},
+            {"from": "gpt", "loss": True, "value": tag},
+        ],
+    }
+
+
+def write_jsonl(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    return str(path)
+
+
+def make_args(tmp_path, expert, experience, output, **kwargs):
+    defaults = dict(
+        expert=expert,
+        experience=experience,
+        output=str(tmp_path / output),
+        prompt_length=3,
+        reward_gap=0.01,
+        expert_threshold=0.7,
+        task=None,
+        pairing="expert_vs_experience",
+        max_pairs_per_id=None,
+        run_size=2,
+        max_open_runs=2,
+        tmp_dir=str(tmp_path),
+    )
+    defaults.update(kwargs)
+    return Namespace(**defaults)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    ids = [f"webshop_{i}" for i in (3, 1, 4, 0, 2)]
+    expert = write_jsonl(tmp_path / "expert.jsonl", [trajectory(i, 1.0, "expert") for i in ids])
+    # sampled trajectories spread over unsorted per-rank shards
+    write_jsonl(
+        tmp_path / "rank0.jsonl",
+        [trajectory("webshop_4", 0.5, "x4a"), trajectory("webshop_0", 1.0, "x0"), trajectory("webshop_2", 0.2, "x2")],
+    )
+    write_jsonl(
+        tmp_path / "rank1.jsonl",
+        [trajectory("webshop_1", 0.0, "x1"), trajectory("webshop_3", 0.3, "x3"), trajectory("webshop_4", 0.1, "x4b")],
+    )
+    return [expert], [str(tmp_path / "rank*.jsonl")]
+
+
+class TestMakeDPODataset:
+    """Test the external merge, the pairing policies and the output formats."""
+
+    def test_expert_vs_experience(self, tmp_path, inputs):
+        make_dpo_dataset.main(make_args(tmp_path, *inputs, "pairs.jsonl"))
+        pairs = [json.loads(line) for line in open(tmp_path / "pairs.jsonl")]
+        # sorted by item_id, webshop_0 has no reward gap, the lowest sampled reward is kept
+        assert [p["id"] for p in pairs] == [1, 2, 3, 4]
+        assert [p["rejected"][-1]["value"] for p in pairs] == ["x1", "x2", "x3", "x4b"]
+        assert all(p["chosen"][-1]["value"] == "expert" for p in pairs)
+        assert pairs[0]["prompt"] == trajectory("webshop_1", 1.0, "")["conversations"][:3]
+        # only the output is left behind
+        assert sorted(os.listdir(tmp_path)) == ["expert.jsonl", "pairs.jsonl", "rank0.jsonl", "rank1.jsonl"]
+
+    def test_missing_side_raises(self, tmp_path, inputs):
+        expert, experience = inputs
+        write_jsonl(tmp_path / "rank2.jsonl", [trajectory("webshop_9", 0.0, "x9")])
+        with pytest.raises(ValueError, match="webshop_9"):
+            make_dpo_dataset.main(make_args(tmp_path, expert, experience, "pairs.json"))
+        assert not os.path.exists(tmp_path / "pairs.json")
+
+    def test_all_pairs(self, tmp_path, inputs):
+        make_dpo_dataset.main(make_args(tmp_path, *inputs, "pairs.json", pairing="all", max_pairs_per_id=2))
+        pairs = json.load(open(tmp_path / "pairs.json"))
+        webshop_4 = [(p["chosen"][-1]["value"], p["rejected"][-1]["value"]) for p in pairs if p["id"] == 4]
+        # widest gap first, x4a (0.5) is below the threshold as chosen
+        assert webshop_4 == [("expert", "x4b"), ("expert", "x4a")]
+
+    def test_best_worst_parquet(self, tmp_path, inputs):
+        make_dpo_dataset.main(make_args(tmp_path, *inputs, "pairs.parquet", pairing="best_worst"))
+        dataset = load_dataset("parquet", data_files=str(tmp_path / "pairs.parquet"))["train"]
+        assert dataset["id"] == [1, 2, 3, 4]
+        row = dataset[3]
+        assert row["rejected"][-1] == {"from": "gpt", "loss": True, "value": "x4b"}
+        assert row["prompt"][0]["loss"] is None
+
+    def test_many_runs_merge(self, tmp_path):
+        ids = [f"alfworld_{i}" for i in range(30)]
+        expert = write_jsonl(tmp_path / "expert.jsonl", [trajectory(i, 1.0, "e") for i in reversed(ids)])
+        experience = write_jsonl(tmp_path / "exp.jsonl", [trajectory(i, 0.0, "x") for i in ids])
+        entries = list(
+            make_dpo_dataset.merge_runs(
+                make_dpo_dataset.write_sorted_runs(
+                    [("expert", [expert]), ("experience", [experience])], str(tmp_path), 4
+                ),
+                str(tmp_path),
+                max_open_runs=3,
+            )
+        )
+        assert [e[0] for e in entries] == sorted(ids * 2)
+        # expert before experience within an item_id
+        assert [e[1] for e in entries[:2]] == ["expert", "experience"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_json_array_is_streamed(tmp_path, chunk_size):
+    records = [
+        trajectory("webshop_1", 0.5, 'a "quoted" ], [ value'),
+        {"item_id": "webshop_2", "reward": 12345, "nested": [[], {}, [1, [2]]]},
+        trajectory("webshop_3", 1.0, "\u00fcnicode \\ backslash"),
+    ]
+    path = tmp_path / "expert.json"
+    path.write_text("\n  " + json.dumps(records, indent=2) + "\n")
+    with open(path) as f:
+        assert list(make_dpo_dataset.iter_json_array(f, chunk_size)) == records
+    assert list(make_dpo_dataset.load_data(str(path))) == records
+    path.write_text(" [ ] ")
+    assert list(make_dpo_dataset.load_data(str(path))) == []
+    path.write_text('[{"item_id": "webshop_1"} {"item_id": "webshop_2"}]')
+    with pytest.raises(ValueError):
+        list(make_dpo_dataset.load_data(str(path)))
@@ -0,0 +1,137 @@
+"""
+Test cases for sequence packing in the supervised trainers.
+
+These tests need no env server; attention isolation is checked with a tiny random Llama:
+    pytest tests/test_packing.py -v
+"""
+
+import random
+
+import pytest
+import torch
+import torch.nn.functional as F
+from datasets import Dataset
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from agentenv.trainer.packing import (
+    PackedDataset,
+    first_fit_decreasing,
+    packed_collate_fn,
+    prefix_tree_attention_mask,
+)
+
+
+class PadTokenizer:
+    pad_token_id = 0
+
+
+def make_dataset(n=20, max_len=40, seed=0):
+    rng = random.Random(seed)
+    input_ids, labels = [], []
+    for _ in range(n):
+        length = rng.randint(3, max_len)
+        ids = [rng.randint(3, 60) for _ in range(length)]
+        # human prefix masked, assistant reply trained on
+        split = rng.randint(1, length - 1)
+        input_ids.append(ids)
+        labels.append([-100] * split + ids[split:])
+    return Dataset.from_dict({"input_ids": input_ids, "labels": labels})
+
+
+def token_losses(logits, labels):
+    """Per-token cross entropy as the HF causal LM loss computes it."""
+    return F.cross_entropy(logits[:-1], labels[1:], ignore_index=-100, reduction="none")
+
+
+class TestFirstFitDecreasing:
+    """Test the bin packer."""
+
+    def test_every_item_once_within_capacity(self):
+        rng = random.Random(1)
+        lengths = [rng.randint(1, 100) for _ in range(500)]
+        bins = first_fit_decreasing(lengths, 128)
+        assert sorted(i for b in bins for i in b) == list(range(500))
+        assert all(sum(lengths[i] for i in b) <= 128 for b in bins)
+        # first-fit-decreasing uses at most 11/9 OPT + 6/9 bins
+        assert len(bins) <= 11 / 9 * (sum(lengths) / 128 + 1) + 1
+
+    def test_known_packing(self):
+        assert first_fit_decreasing([5, 3, 4, 2, 6], 10) == [[4, 2], [0, 1, 3]]
+
+    def test_too_long_item(self):
+        with pytest.raises(ValueError):
+            first_fit_decreasing([11], 10)
+
+
+class TestPackedDataset:
+    """Test packed rows and their collation."""
+
+    def test_rows_keep_labels_and_positions(self):
+        dataset = make_dataset()
+        packed = PackedDataset(dataset, 64)
+        assert len(packed) < len(dataset)
+        assert 0 < packed.efficiency <= 1
+        seen = 0
+        for row_index, row in enumerate(packed):
+            start = 0
+            for doc, seqlen in zip(packed.bins[row_index], row["seqlens"]):
+                ids, labels = dataset[doc]["input_ids"], dataset[doc]["labels"]
+                assert row["input_ids"][start : start + seqlen] == ids
+                assert row["labels"][start : start + seqlen] == [-100] + labels[1:]
+                assert row["position_ids"][start : start + seqlen] == list(range(seqlen))
+                start += seqlen
+                seen += 1
+        assert seen == len(dataset)
+
+    def test_collate(self):
+        packed = PackedDataset(make_dataset(), 64)
+        batch = packed_collate_fn([packed[0], packed[1]], PadTokenizer(), pack_length=64)
+        forward_kwargs = batch["forward_kwargs"]
+        assert forward_kwargs["input_ids"].shape == (2, 64)
+        assert forward_kwargs["attention_mask"].shape == (2, 1, 64, 64)
+        assert batch["cu_seqlens"][-1].item() == 2 * 64
+        assert batch["num_tokens"] == len(packed[0]["input_ids"]) + len(packed[1]["input_ids"])
+        without_mask = packed_collate_fn([packed[0]], PadTokenizer(), document_mask=False)
+        assert "attention_mask" not in without_mask["forward_kwargs"]
+
+    def test_no_attention_across_documents(self):
+        torch.manual_seed(0)
+        model = LlamaForCausalLM(
+            LlamaConfig(
+                vocab_size=64,
+                hidden_size=32,
+                intermediate_size=64,
+                num_hidden_layers=2,
+                num_attention_heads=4,
+                max_position_embeddings=128,
+            )
+        ).eval()
+        dataset = make_dataset(n=8)
+        packed = PackedDataset(dataset, 96)
+        batch = packed_collate_fn([packed[i] for i in range(len(packed))], PadTokenizer(), pack_length=96)
+        with torch.no_grad():
+            logits = model(**batch["forward_kwargs"]).logits
+            labels = batch["forward_kwargs"]["labels"]
+            for row_index in range(len(packed)):
+                row_losses = token_losses(logits[row_index], labels[row_index])
+                start = 0
+                for doc, seqlen in zip(packed.bins[row_index], packed[row_index]["seqlens"]):
+                    ids = torch.tensor([dataset[doc]["input_ids"]])
+                    expected = token_losses(model(input_ids=ids).logits[0], torch.tensor(dataset[doc]["labels"]))
+                    # packed position start+t-1 predicts the label at start+t
+                    got = row_losses[start : start + seqlen - 1]
+                    torch.testing.assert_close(got, expected, atol=1e-4, rtol=1e-4)
+                    start += seqlen
+
+
+def test_prefix_tree_attention_mask():
+    mask = prefix_tree_attention_mask([2], [[2, 1]], 6)
+    allowed = (mask[0, 0] == 0).int().tolist()
+    assert allowed == [
+        [1, 0, 0, 0, 0, 0],
+        [1, 1, 0, 0, 0, 0],
+        [1, 1, 1, 0, 0, 0],
+        [1, 1, 1, 1, 0, 0],
+        [1, 1, 0, 0, 1, 0],
+        [0, 0, 0, 0, 0, 1],
+    ]
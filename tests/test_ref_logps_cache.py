@@ -0,0 +1,160 @@
+"""
+Test cases for the persistent DPO reference log-prob cache.
+
+These tests train nothing and need no env server, a tiny random Llama runs on CPU:
+    pytest tests/test_ref_logps_cache.py -v
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+from datasets import Dataset
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast, TrainingArguments
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+
+from agentenv.trainer.ref_logps_cache import (
+    load_ref_logps,
+    model_hash,
+    ref_logps_cache_key,
+    save_ref_logps,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "agentenv", "examples", "dpo"))
+try:
+    from dpo_trainer import DPOMultiTrainer
+except ImportError:  # the example targets the trl release pinned in agentenv
+    DPOMultiTrainer = None
+
+
+def make_tokenizer():
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for char in sorted(pre_tokenizers.ByteLevel.alphabet()):
+        vocab[char] = len(vocab)
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    fast = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+    fast.pad_token = "<unk>"
+    return fast
+
+
+def make_model(seed=0):
+    torch.manual_seed(seed)
+    return LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=300,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+        )
+    )
+
+
+def make_dataset(n=5):
+    rows = []
+    for i in range(n):
+        prompt = list(range(10, 14 + i))
+        chosen = list(range(40, 43 + i))
+        rejected = list(range(70, 72 + 2 * i))
+        rows.append(
+            {
+                "prompt_input_ids": prompt,
+                "prompt_attention_mask": [1] * len(prompt),
+                "chosen_input_ids": prompt + chosen,
+                "chosen_attention_mask": [1] * (len(prompt) + len(chosen)),
+                "chosen_labels": [-100] * len(prompt) + chosen,
+                "rejected_input_ids": prompt + rejected,
+                "rejected_attention_mask": [1] * (len(prompt) + len(rejected)),
+                "rejected_labels": [-100] * len(prompt) + rejected,
+            }
+        )
+    return Dataset.from_list(rows)
+
+
+def make_trainer(tmp_path, model, cache_dir):
+    args = TrainingArguments(
+        output_dir=str(tmp_path / "out"),
+        per_device_train_batch_size=2,
+        remove_unused_columns=False,
+        report_to=[],
+        use_cpu=True,
+    )
+    return DPOMultiTrainer(
+        model=model,
+        args=args,
+        train_dataset=make_dataset(),
+        tokenizer=make_tokenizer(),
+        max_length=64,
+        max_prompt_length=32,
+        precompute_ref_log_probs=True,
+        ref_logps_cache_dir=cache_dir,
+    )
+
+
+class TestCacheHelpers:
+    """Test keys and the on-disk format."""
+
+    def test_model_hash(self):
+        model = make_model()
+        assert model_hash(model) == model_hash(make_model())
+        assert model_hash(model) != model_hash(make_model(seed=1))
+        model.lm_head.weight.requires_grad_(False)
+        frozen = model_hash(model, skip_trainable=True)
+        with torch.no_grad():
+            model.model.embed_tokens.weight.add_(1)
+        # only frozen weights count
+        assert model_hash(model, skip_trainable=True) == frozen
+
+    def test_key(self):
+        dataset = make_dataset()
+        key = ref_logps_cache_key(dataset, "abc", {"max_length": 64})
+        assert key == ref_logps_cache_key(make_dataset(), "abc", {"max_length": 64})
+        assert key != ref_logps_cache_key(make_dataset(4), "abc", {"max_length": 64})
+        assert key != ref_logps_cache_key(dataset, "abd", {"max_length": 64})
+        assert key != ref_logps_cache_key(dataset, "abc", {"max_length": 128})
+
+    def test_save_and_load(self, tmp_path):
+        assert load_ref_logps(str(tmp_path), "key") is None
+        save_ref_logps(str(tmp_path), "key", np.array([-1.0, -2.0]), np.array([-3.0, -4.0]))
+        chosen, rejected = load_ref_logps(str(tmp_path), "key")
+        assert isinstance(chosen, np.memmap)
+        assert chosen.tolist() == [-1.0, -2.0] and rejected.tolist() == [-3.0, -4.0]
+        with pytest.raises(ValueError):
+            save_ref_logps(str(tmp_path), "bad", np.zeros(2), np.zeros(3))
+
+
+@pytest.mark.skipif(DPOMultiTrainer is None, reason="dpo_trainer needs trl<0.9")
+class TestDPOMultiTrainer:
+    """Test that reruns skip the reference pass."""
+
+    def test_rerun_loads_cache(self, tmp_path, monkeypatch):
+        cache_dir = str(tmp_path / "cache")
+        first = make_trainer(tmp_path, make_model(), cache_dir)
+        first.get_train_dataloader()
+        expected = first.train_dataset["reference_chosen_logps"]
+        assert len(os.listdir(cache_dir)) == 1
+        assert all(logp < 0 for logp in expected)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("reference pass ran again")
+
+        monkeypatch.setattr(DPOMultiTrainer, "compute_reference_log_probs", fail)
+        second = make_trainer(tmp_path, make_model(), cache_dir)
+        second.get_train_dataloader()
+        np.testing.assert_allclose(second.train_dataset["reference_chosen_logps"], expected)
+        np.testing.assert_allclose(
+            second.train_dataset["reference_rejected_logps"],
+            first.train_dataset["reference_rejected_logps"],
+        )
+
+    def test_other_reference_model_misses(self, tmp_path):
+        cache_dir = str(tmp_path / "cache")
+        make_trainer(tmp_path, make_model(), cache_dir).get_train_dataloader()
+        make_trainer(tmp_path, make_model(seed=1), cache_dir).get_train_dataloader()
+        assert len(os.listdir(cache_dir)) == 2
@@ -0,0 +1,253 @@
+"""
+Test cases for the multi-task rollout scheduler.
+
+These tests use in-process fake env clients and a scripted agent, no env server or model:
+    pytest tests/test_rollout_scheduler.py -v
+"""
+
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from agentenv.controller import (
+    Agent,
+    BaseChatTemplate,
+    BaseEnvClient,
+    BaseTask,
+    RolloutScheduler,
+    StepOutput,
+)
+from agentenv.controller import tracing
+from agentenv.controller.utils import BaseAgentEnvController
+from transformers import GenerationConfig
+
+GENERATION_CONFIG = GenerationConfig(max_length=4096)
+
+
+class CharTokenizer:
+    eos_token = "</s>"
+    eos_token_id = 1
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(c) for c in text]
+
+    def decode(self, ids):
+        return "".join(self.eos_token if i == self.eos_token_id else chr(i) for i in ids)
+
+
+class PlainTemplate(BaseChatTemplate):
+    def tokenize_conversation_one(self, message, tokenizer, idx=-1, add_generation_prompt=False):
+        text = f"<{message['from']}>{message['value']}"
+        input_ids = tokenizer.encode(text)
+        mask = [1 if message["loss"] else 0] * len(input_ids)
+        return {"text": text, "input_ids": input_ids, "action_mask": mask}
+
+
+class ScriptedAgent(Agent):
+    """Answers every prompt with ``act <n>``, n = number of prompt tokens."""
+
+    def __init__(self, inference_engine="vllm"):
+        super().__init__(None, CharTokenizer(), PlainTemplate(), inference_engine)
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def generate(self, input_ids, generation_config, refresh_engine=False):
+        with self._lock:
+            self.batches.append([ids[:] for ids in input_ids])
+        return [self.tokenizer.encode(f"act {len(ids)}") for ids in input_ids]
+
+
+class ServerStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.intervals = []
+
+
+class FakeClient(BaseEnvClient):
+    """Episode ``idx`` lasts ``idx % 3 + 1`` steps and ends with reward ``idx``."""
+
+    conversation_start = (
+        {"from": "human", "loss": None, "value": "start"},
+        {"from": "gpt", "loss": False, "value": "ok"},
+    )
+
+    def __init__(self, name, stats, latency=0.01):
+        super().__init__()
+        self.name = name
+        self.stats = stats
+        self.latency = latency
+        self.idx = None
+        self.steps = 0
+
+    def __len__(self):
+        return 100
+
+    def _call(self):
+        with self.stats.lock:
+            self.stats.active += 1
+            self.stats.max_active = max(self.stats.max_active, self.stats.active)
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        with self.stats.lock:
+            self.stats.active -= 1
+            self.stats.intervals.append((start, time.perf_counter()))
+
+    def reset(self, idx):
+        self._call()
+        self.idx = idx
+        self.steps = 0
+
+    def observe(self):
+        return f"{self.name} task {self.idx} step {self.steps}"
+
+    def step(self, action):
+        self._call()
+        self.steps += 1
+        done = self.steps > self.idx % 3
+        return StepOutput(self.observe() + f" after {action}", self.idx if done else 0, done)
+
+
+def make_task(name, n_clients, latency=0.01):
+    stats = ServerStats()
+
+    class FakeTask(BaseTask):
+        env_client_cls = FakeClient
+        env_name = name
+
+    task = FakeTask({"name": name, "stats": stats, "latency": latency}, n_clients)
+    return task, stats
+
+
+class TestRolloutScheduler:
+    """Test interleaved multi-task rollouts."""
+
+    def test_results_grouped_in_order(self):
+        webshop, _ = make_task("webshop", 3)
+        alfworld, _ = make_task("alfworld", 2)
+        idxs = [[5, 0, 7, 2], [4, 1, 3]]
+        results = RolloutScheduler(ScriptedAgent(), [webshop, alfworld]).run(
+            idxs, GENERATION_CONFIG
+        )
+        assert [[exp.reward for exp in group] for group in results] == idxs
+        assert "webshop task 5" in results[0][0].conversation[2]["value"]
+        assert "alfworld task 1" in results[1][1].conversation[2]["value"]
+
+    def test_matches_sequential_rollout(self):
+        idxs = [0, 1, 2, 3, 4, 5]
+        sequential_task, _ = make_task("webshop", 1, latency=0)
+        expected = sequential_task.generate_experience(
+            ScriptedAgent("default"), idxs, GENERATION_CONFIG
+        )
+        task, _ = make_task("webshop", 4, latency=0)
+        (results,) = RolloutScheduler(ScriptedAgent(), [task]).run([idxs], GENERATION_CONFIG)
+        for exp, ref in zip(results, expected):
+            assert exp.conversation == ref.conversation
+            assert exp.seq_ids == ref.seq_ids
+            assert exp.action_mask == ref.action_mask
+            assert exp.text == ref.text
+
+    def test_concurrency_limits_and_overlap(self):
+        webshop, webshop_stats = make_task("webshop", 4, latency=0.02)
+        alfworld, alfworld_stats = make_task("alfworld", 4, latency=0.02)
+        RolloutScheduler(ScriptedAgent(), [webshop, alfworld], max_concurrency=[3, 2]).run(
+            [list(range(9)), list(range(6))], GENERATION_CONFIG
+        )
+        assert webshop_stats.max_active == 3
+        assert alfworld_stats.max_active == 2
+        # both env servers work at the same time
+        assert any(
+            a0 < b1 and b0 < a1
+            for a0, a1 in webshop_stats.intervals
+            for b0, b1 in alfworld_stats.intervals
+        )
+
+    def test_batch_spans_tasks(self):
+        webshop, _ = make_task("webshop", 2)
+        alfworld, _ = make_task("alfworld", 2)
+        agent = ScriptedAgent()
+        RolloutScheduler(agent, [webshop, alfworld], batch_wait=0.5).run(
+            [[2, 2], [2, 2]], GENERATION_CONFIG
+        )
+        assert max(len(batch) for batch in agent.batches) == 4
+        prompts = [agent.tokenizer.decode(ids) for ids in agent.batches[0]]
+        assert any("webshop" in p for p in prompts) and any("alfworld" in p for p in prompts)
+
+    def test_default_engine_generates_one_at_a_time(self):
+        task, _ = make_task("webshop", 3)
+        agent = ScriptedAgent("default")
+        RolloutScheduler(agent, [task]).run([[0, 1, 2]], GENERATION_CONFIG)
+        assert all(len(batch) == 1 for batch in agent.batches)
+
+    def test_context_limit_stops_episode(self):
+        task, _ = make_task("webshop", 1)
+        (results,) = RolloutScheduler(ScriptedAgent(), [task]).run(
+            [[2]], GenerationConfig(max_length=10)
+        )
+        assert results[0].reward == 0
+        assert len(results[0].conversation) == 3
+
+    def test_generation_error_is_logged(self, caplog):
+        class FailingAgent(ScriptedAgent):
+            def generate(self, input_ids, generation_config, refresh_engine=False):
+                raise RuntimeError("engine down")
+
+        task, _ = make_task("webshop", 2)
+        with caplog.at_level(logging.WARNING, logger="agentenv.controller.scheduler"):
+            results, = RolloutScheduler(FailingAgent(), [task]).run([[1, 2]], GENERATION_CONFIG)
+        assert [r.reward for r in results] == [0, 0]
+        (record,) = caplog.records
+        assert "stopping 2 episodes" in record.getMessage()
+        assert record.exc_info[1].args == ("engine down",)
+
+    def test_refresh_engine_on_first_generate_only(self):
+        class RecordingAgent(ScriptedAgent):
+            def generate(self, input_ids, generation_config, refresh_engine=False):
+                self.refreshes.append(refresh_engine)
+                return super().generate(input_ids, generation_config)
+
+        task, _ = make_task("webshop", 2)
+        agent = RecordingAgent()
+        agent.refreshes = []
+        scheduler = RolloutScheduler(agent, [task])
+        scheduler.run([[1, 2]], GENERATION_CONFIG, refresh_engine=True)
+        assert agent.refreshes[0] and not any(agent.refreshes[1:])
+        agent.refreshes.clear()
+        scheduler.run([[1, 2]], GENERATION_CONFIG)
+        assert not any(agent.refreshes)
+
+    def test_episode_spans(self, tmp_path):
+        path = str(tmp_path / "trace.jsonl")
+        tracing.enable_tracing(path)
+        try:
+            task, _ = make_task("webshop", 2)
+            RolloutScheduler(ScriptedAgent(), [task]).run([[3, 5, 7]], GENERATION_CONFIG)
+        finally:
+            tracing.disable_tracing()
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        episodes = {e["args"]["idx"]: e for e in events if e["name"] == "episode"}
+        assert {idx: e["args"]["reward"] for idx, e in episodes.items()} == {3: 3, 5: 5, 7: 7}
+        # resets and steps run on other threads but belong to their episode
+        for event in events:
+            if event["name"] in ("env.reset", "env.step"):
+                episode = episodes[event["args"]["idx"]]
+                assert event["args"]["parent_id"] == episode["args"]["span_id"]
+                assert event["args"]["trace_id"] == episode["args"]["trace_id"]
+        assert sum(e["name"] == "env.step" for e in events) == 1 + 3 + 2
+
+    def test_max_concurrency_length_checked(self):
+        task, _ = make_task("webshop", 1)
+        with pytest.raises(ValueError):
+            RolloutScheduler(ScriptedAgent(), [task], max_concurrency=[1, 1])
+
+    def test_controller_flattens_in_task_order(self):
+        webshop, _ = make_task("webshop", 2)
+        alfworld, _ = make_task("alfworld", 2)
+        controller = BaseAgentEnvController(ScriptedAgent(), [webshop, alfworld])
+        exps = controller.generate_experience([[3, 4], [5]], GENERATION_CONFIG)
+        assert [exp.reward for exp in exps] == [3, 4, 5]
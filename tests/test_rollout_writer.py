@@ -0,0 +1,69 @@
+"""
+Test cases for the per-rank rollout shards of inference_and_filter.
+
+These tests need no env server or model:
+    pytest tests/test_rollout_writer.py -v
+"""
+
+import json
+
+from agentenv.controller.types import ExperienceOutput
+from agentenv.trainer.rollout_writer import (
+    RolloutShardWriter,
+    merge_rollout_shards,
+    reward_threshold,
+    task_of,
+)
+
+
+def make_exp(reward, text="a"):
+    conversation = [{"from": "human", "loss": None, "value": text}]
+    return ExperienceOutput(
+        conversation=conversation, reward=reward, text=text, seq_ids=[], attention_mask=[], action_mask=[]
+    )
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class TestThresholds:
+    """Test the per-task reward thresholds."""
+
+    def test_task_prefixes(self):
+        assert task_of("webshop_3") == "webshop"
+        assert task_of("lmrlgym_maze_7") == "lmrlgym_maze"
+        assert task_of("unknown_1") is None
+        assert reward_threshold("sciworld_0") == 99
+        assert reward_threshold("babyai_0") == 0
+        assert reward_threshold("unknown_1") == 0.99
+
+
+class TestRolloutShards:
+    """Test streaming shards and their merge."""
+
+    def test_write_and_merge(self, tmp_path):
+        shard_dir = str(tmp_path / "shards")
+        batches = {
+            0: [("webshop_0", 1.0), ("sciworld_1", 50.0), ("babyai_2", 0.5)],
+            1: [("webshop_3", 0.2), ("sciworld_4", 100.0)],
+        }
+        for rank, rows in batches.items():
+            with RolloutShardWriter(shard_dir, rank) as writer:
+                writer.write_batch([i for i, _ in rows], [make_exp(r, i) for i, r in rows])
+                # written before close, a crashed run keeps it
+                assert len(read_jsonl(tmp_path / "shards" / f"rank{rank}.jsonl")) == len(rows)
+
+        inference_file = tmp_path / "inference.jsonl"
+        filtered_file = tmp_path / "filtered.jsonl"
+        index = merge_rollout_shards(shard_dir, 2, str(inference_file), str(filtered_file))
+
+        inference = read_jsonl(inference_file)
+        assert [r["item_id"] for r in inference] == ["webshop_0", "sciworld_1", "babyai_2", "webshop_3", "sciworld_4"]
+        assert inference[0]["success"] == 1 and inference[3]["success"] == 0
+        filtered = read_jsonl(filtered_file)
+        assert [r["item_id"] for r in filtered] == ["webshop_0", "babyai_2", "sciworld_4"]
+        assert set(filtered[0]) == {"conversations", "item_id"}
+        assert index["lines"] == 5 and index["kept"] == 3
+        assert index["tasks"]["sciworld"] == {"episodes": 2, "kept": 1, "reward_sum": 150.0}
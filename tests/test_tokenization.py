@@ -0,0 +1,108 @@
+"""
+Test cases for the cached, template-driven trainer tokenization.
+
+These tests build a tiny byte-level tokenizer in memory, no model download or env server:
+    pytest tests/test_tokenization.py -v
+"""
+
+from datasets import Dataset
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast
+
+from agentenv.controller import ChatMLTemplate, Llama2Template
+from agentenv.trainer import tokenization
+from agentenv.trainer.tokenization import tokenization_cache_key, tokenize_dataset
+
+
+def make_tokenizer():
+    alphabet = sorted(pre_tokenizers.ByteLevel.alphabet())
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for char in alphabet:
+        vocab[char] = len(vocab)
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    fast = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+    fast.pad_token_id = 0
+    return fast
+
+
+def make_dataset(n=6):
+    rows = []
+    for i in range(n):
+        rows.append(
+            {
+                "item_id": f"webshop_{i}",
+                "conversations": [
+                    {"from": "human", "loss": None, "value": f"Instruction {i}"},
+                    {"from": "gpt", "loss": False, "value": "OK"},
+                    {"from": "human", "loss": None, "value": "Observation " * (i + 1)},
+                    {"from": "gpt", "loss": True, "value": f"Action: click[{i}]"},
+                ],
+            }
+        )
+    return Dataset.from_list(rows)
+
+
+class TestTokenizeDataset:
+    """Test labels, truncation and the disk cache."""
+
+    def test_labels_follow_template_and_loss(self):
+        tokenizer = make_tokenizer()
+        template = Llama2Template()
+        dataset = make_dataset()
+        tokenized = tokenize_dataset(dataset, tokenizer, template, 4096, num_proc=None)
+        row = tokenized[2]
+        expected = template.tokenize_conversation(dataset[2]["conversations"], tokenizer)
+        assert row["input_ids"] == expected["input_ids"]
+        trained = [t for t, label in zip(row["input_ids"], row["labels"]) if label != -100]
+        assert tokenizer.decode(trained) == "Action: click[2]</s>"
+        assert row["item_id"] == "webshop_2"
+        assert row["input_ids_max_length"] == len(row["input_ids"])
+
+    def test_missing_loss_trains_on_gpt(self):
+        dataset = Dataset.from_list(
+            [
+                {
+                    "item_id": "alfworld_0",
+                    "conversations": [
+                        {"from": "human", "value": "hi"},
+                        {"from": "gpt", "value": "go"},
+                    ],
+                }
+            ]
+        )
+        tokenizer = make_tokenizer()
+        row = tokenize_dataset(dataset, tokenizer, Llama2Template(), 4096, num_proc=None)[0]
+        trained = [t for t, label in zip(row["input_ids"], row["labels"]) if label != -100]
+        assert tokenizer.decode(trained) == "go</s>"
+
+    def test_truncation(self):
+        tokenized = tokenize_dataset(make_dataset(), make_tokenizer(), Llama2Template(), 16, num_proc=None)
+        assert all(len(ids) == 16 for ids in tokenized["input_ids"])
+        assert all(length > 16 for length in tokenized["input_ids_max_length"])
+
+    def test_cache_is_reused(self, tmp_path, monkeypatch):
+        tokenizer, template = make_tokenizer(), Llama2Template()
+        first = tokenize_dataset(make_dataset(), tokenizer, template, 64, cache_dir=str(tmp_path), num_proc=None)
+        assert len(list(tmp_path.iterdir())) == 1
+
+        def fail(*args, **kwargs):
+            raise AssertionError("tokenized again")
+
+        monkeypatch.setattr(tokenization, "tokenize_fn", fail)
+        # a freshly loaded copy of the same data hits the cache
+        second = tokenize_dataset(make_dataset(), tokenizer, template, 64, cache_dir=str(tmp_path), num_proc=None)
+        assert second["input_ids"] == first["input_ids"]
+
+    def test_cache_key_changes(self):
+        tokenizer, template, dataset = make_tokenizer(), Llama2Template(), make_dataset()
+        key = tokenization_cache_key(dataset, tokenizer, template, 64)
+        assert key == tokenization_cache_key(make_dataset(), make_tokenizer(), Llama2Template(), 64)
+        assert key != tokenization_cache_key(make_dataset(5), tokenizer, template, 64)
+        assert key != tokenization_cache_key(dataset, tokenizer, ChatMLTemplate(), 64)
+        assert key != tokenization_cache_key(dataset, tokenizer, template, 128)
+        tokenizer.eos_token_id = 1
+        assert key != tokenization_cache_key(dataset, tokenizer, template, 64)
@@ -0,0 +1,139 @@
+"""
+Test cases for per-step latency tracing.
+
+These tests need no env server; the pool test forks one worker with a dummy wrapper:
+    pytest tests/test_tracing.py -v
+"""
+
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import agentenv_pool.tracing as pool_tracing
+from agentenv.controller import tracing
+from agentenv_pool import BaseEnvWrapper, Router, StepRequestBody, create_app
+
+
+class EchoWrapper(BaseEnvWrapper):
+    def __init__(self):
+        self.ls = []
+
+    def create_with_id(self, idx):
+        self.ls.append(idx)
+        return {"env_id": idx}
+
+    def step(self, idx, action):
+        return {"observation": action}
+
+    def reset(self, idx, **kwargs):
+        return {"observation": ""}
+
+    def close(self, idx):
+        return True
+
+
+def _read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    tracing.enable_tracing(path)
+    pool_tracing.enable_tracing(path)
+    yield path
+    tracing.disable_tracing()
+    pool_tracing.disable_tracing()
+
+
+class TestSpans:
+    """Test span recording in one process."""
+
+    def test_disabled_is_noop(self):
+        for module in (tracing, pool_tracing):
+            assert not module.tracing_enabled()
+            with module.trace_span("x") as span:
+                span.set(tokens=1)
+                assert span.traceparent is None
+                assert module.trace_headers() == {}
+
+    def test_nested_spans_share_trace(self, trace_file):
+        with tracing.trace_span("episode", idx=3) as outer:
+            with tracing.trace_span("env.step") as inner:
+                inner.set(round=0)
+        inner_event, outer_event = _read_events(trace_file)
+        assert outer_event["name"] == "episode" and outer_event["ph"] == "X"
+        assert outer_event["args"]["idx"] == 3
+        assert outer_event["args"]["parent_id"] is None
+        assert inner_event["args"]["parent_id"] == outer.context.span_id
+        assert inner_event["args"]["trace_id"] == outer_event["args"]["trace_id"]
+        assert inner_event["args"]["round"] == 0
+        assert outer_event["dur"] >= inner_event["dur"]
+
+    def test_headers_continue_span(self, trace_file):
+        with tracing.trace_span("client") as span:
+            headers = tracing.trace_headers()
+        value = headers[tracing.TRACEPARENT_HEADER]
+        assert value == f"00-{span.context.trace_id}-{span.context.span_id}-01"
+        with tracing.trace_span("server", traceparent=value):
+            pass
+        server_event = _read_events(trace_file)[-1]
+        assert server_event["args"]["parent_id"] == span.context.span_id
+
+    def test_exception_is_recorded(self, trace_file):
+        with pytest.raises(RuntimeError):
+            with tracing.trace_span("boom"):
+                raise RuntimeError
+        assert _read_events(trace_file)[0]["args"]["error"] == "RuntimeError"
+
+    def test_to_chrome_trace(self, trace_file, tmp_path):
+        with tracing.trace_span("a"):
+            pass
+        out = str(tmp_path / "trace.json")
+        assert tracing.to_chrome_trace([trace_file], out) == 1
+        with open(out) as f:
+            assert json.load(f)["traceEvents"][0]["name"] == "a"
+
+
+class TestPoolPropagation:
+    """Test that one trace covers client, HTTP server, router and worker."""
+
+    def test_step_is_traced_end_to_end(self, trace_file):
+        router = Router(parallel_actor=1, wrapper_factory=EchoWrapper)
+
+        def register(app, r):
+            @app.post("/create")
+            async def create():
+                return await r.create()
+
+            @app.post("/step")
+            async def step(body: StepRequestBody):
+                return await r.step(body.env_id, body.action)
+
+        with TestClient(create_app(router, register)) as client:
+            env_id = client.post("/create").json()["env_id"]
+            with tracing.trace_span("env.step") as span:
+                res = client.post(
+                    "/step",
+                    json={"env_id": env_id, "action": "look"},
+                    headers=tracing.trace_headers(),
+                )
+        assert res.json() == {"observation": "look"}
+
+        events = {
+            e["name"]: e
+            for e in _read_events(trace_file)
+            if e["args"]["trace_id"] == span.context.trace_id
+        }
+        assert events["server.step"]["args"]["parent_id"] == span.context.span_id
+        assert (
+            events["router.queue"]["args"]["parent_id"]
+            == events["server.step"]["args"]["span_id"]
+        )
+        assert (
+            events["worker.step"]["args"]["parent_id"]
+            == events["router.ipc"]["args"]["span_id"]
+        )
+        assert events["worker.step"]["pid"] != events["router.ipc"]["pid"]
@@ -0,0 +1,173 @@
+"""
+Test cases for the prefix-tree trajectory store.
+
+These tests need no env server; the tree batch is checked against flat rows with a tiny random Llama:
+    pytest tests/test_trajectory_trie.py -v
+"""
+
+import random
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from agentenv.controller import TrajectoryTrie, tree_attention_mask
+from agentenv.controller.types import ExperienceOutput
+
+START = [5, 6, 7, 8, 9, 10]
+
+
+def make_trajectories(n=12, seed=0):
+    """Best-of-N style samples: common start, few distinct first actions."""
+    rng = random.Random(seed)
+    trajectories = []
+    for _ in range(n):
+        ids, mask = list(START), [0] * len(START)
+        for turn in range(rng.randint(1, 3)):
+            action = [20 + rng.randint(0, 1 if turn == 0 else 5) for _ in range(3)]
+            observation = [40 + rng.randint(0, 3), 41]
+            ids += action + observation
+            mask += [1] * len(action) + [0] * len(observation)
+        trajectories.append((ids, mask))
+    return trajectories
+
+
+@pytest.fixture
+def trie_and_rows():
+    trajectories = make_trajectories()
+    trie = TrajectoryTrie()
+    for i, (ids, mask) in enumerate(trajectories):
+        trie.add(ids, mask, reward=i / 10, item_id=f"webshop_{i % 4}")
+    return trie, trajectories
+
+
+class TestTrajectoryTrie:
+    """Test insertion, export and persistence."""
+
+    def test_sequences_roundtrip(self, trie_and_rows):
+        trie, trajectories = trie_and_rows
+        assert len(trie) == len(trajectories)
+        for record_id, (ids, mask) in enumerate(trajectories):
+            assert trie.sequence(record_id) == (ids, mask)
+
+    def test_shared_prefixes_stored_once(self, trie_and_rows):
+        trie, trajectories = trie_and_rows
+        assert trie.num_tokens == sum(len(ids) for ids, _ in trajectories)
+        assert trie.num_stored_tokens < trie.num_tokens
+        assert trie.compression_ratio() > 1.5
+
+    def test_mask_is_part_of_the_key(self):
+        trie = TrajectoryTrie()
+        trie.add([1, 2, 3], [0, 0, 0])
+        trie.add([1, 2, 3], [0, 1, 1])
+        assert trie.sequence(1) == ([1, 2, 3], [0, 1, 1])
+        assert trie.num_stored_tokens == 5
+
+    def test_prefix_of_existing_sequence(self):
+        trie = TrajectoryTrie()
+        trie.add([1, 2, 3, 4], [0, 0, 1, 1])
+        trie.add([1, 2], [0, 0])
+        trie.add([], [])
+        assert trie.sequence(1) == ([1, 2], [0, 0])
+        assert trie.sequence(2) == ([], [])
+        assert trie.num_stored_tokens == 4
+
+    def test_rows(self, trie_and_rows):
+        trie, trajectories = trie_and_rows
+        rows = list(trie.to_rows())
+        assert [row["input_ids"] for row in rows] == [ids for ids, _ in trajectories]
+        assert rows[3]["reward"] == pytest.approx(0.3)
+        assert rows[3]["item_id"] == "webshop_3"
+
+        trie.add(*trajectories[0], reward=1.0, item_id="webshop_0")
+        unique = list(trie.to_rows(unique=True))
+        assert sum(row["count"] for row in unique) == len(trie)
+        duplicated = [row for row in unique if row["input_ids"] == trajectories[0][0]]
+        assert duplicated[0]["count"] >= 2 and 1.0 in duplicated[0]["rewards"]
+
+    def test_add_experience(self):
+        trie = TrajectoryTrie()
+        exp = ExperienceOutput(
+            conversation=[], reward=1.0, text="", seq_ids=[1, 2], attention_mask=[1, 1], action_mask=[0, 1]
+        )
+        record_id = trie.add_experience(exp, item_id="alfworld_3")
+        assert next(trie.to_rows())["item_id"] == "alfworld_3"
+        assert trie.sequence(record_id) == ([1, 2], [0, 1])
+
+    def test_save_load(self, trie_and_rows, tmp_path):
+        trie, _ = trie_and_rows
+        path = str(tmp_path / "trie.npz")
+        trie.save(path)
+        loaded = TrajectoryTrie.load(path)
+        assert list(loaded.to_rows()) == list(trie.to_rows())
+        # the loaded trie keeps deduplicating
+        before = loaded.num_stored_tokens
+        loaded.add(*trie.sequence(0))
+        assert loaded.num_stored_tokens == before
+
+    def test_extend(self, trie_and_rows):
+        trie, trajectories = trie_and_rows
+        merged = TrajectoryTrie()
+        merged.add(*trajectories[0], reward=0.5, item_id="alfworld_9")
+        merged.extend(trie)
+        assert len(merged) == len(trie) + 1
+        assert list(merged.to_rows())[1:] == list(trie.to_rows())
+        assert merged.num_stored_tokens == trie.num_stored_tokens
+
+
+class TestTreeBatch:
+    """Test the packed tree batch."""
+
+    def test_paths_reproduce_rows(self, trie_and_rows):
+        trie, trajectories = trie_and_rows
+        batch = trie.to_tree_batch()
+        assert batch["input_ids"].numel() == trie.num_stored_tokens
+        parent_ids = batch["parent_ids"].tolist()
+        for record_id, (ids, mask) in enumerate(trajectories):
+            path, index = [], batch["record_last_index"][record_id].item()
+            while index >= 0:
+                path.append(index)
+                index = parent_ids[index]
+            path.reverse()
+            assert batch["input_ids"][path].tolist() == ids
+            assert batch["action_mask"][path].tolist() == mask
+            assert batch["position_ids"][path].tolist() == list(range(len(ids)))
+        # weighted token count equals the flat rows' token count
+        assert batch["weights"].sum().item() == trie.num_tokens
+
+    def test_subset(self, trie_and_rows):
+        trie, trajectories = trie_and_rows
+        batch = trie.to_tree_batch([2, 5])
+        assert batch["weights"].sum().item() == len(trajectories[2][0]) + len(trajectories[5][0])
+        assert batch["rewards"].tolist() == pytest.approx([0.2, 0.5])
+
+    def test_logits_match_flat_rows(self, trie_and_rows):
+        trie, trajectories = trie_and_rows
+        torch.manual_seed(0)
+        model = LlamaForCausalLM(
+            LlamaConfig(
+                vocab_size=64,
+                hidden_size=32,
+                intermediate_size=64,
+                num_hidden_layers=2,
+                num_attention_heads=4,
+                max_position_embeddings=128,
+            )
+        ).eval()
+        batch = trie.to_tree_batch()
+        allowed = tree_attention_mask(batch["parent_ids"])
+        attention_mask = torch.zeros(allowed.shape).masked_fill(~allowed, torch.finfo(torch.float).min)
+        with torch.no_grad():
+            tree_logits = model(
+                input_ids=batch["input_ids"][None],
+                position_ids=batch["position_ids"][None],
+                attention_mask=attention_mask[None, None],
+            ).logits[0]
+            parent_ids = batch["parent_ids"].tolist()
+            for record_id, (ids, _) in enumerate(trajectories):
+                flat_logits = model(input_ids=torch.tensor([ids])).logits[0]
+                path, index = [], batch["record_last_index"][record_id].item()
+                while index >= 0:
+                    path.append(index)
+                    index = parent_ids[index]
+                torch.testing.assert_close(tree_logits[path[::-1]], flat_logits, atol=1e-4, rtol=1e-4)
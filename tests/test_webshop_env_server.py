@@ -0,0 +1,246 @@
+"""
+Test cases for env id allocation and eviction in WebshopEnvServer.
+
+These tests build fake envs and need neither the WebShop data nor a server;
+the pool test forks two workers:
+    pytest tests/test_webshop_env_server.py -v
+"""
+
+import functools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from agentenv_pool import Router, create_app
+from agentenv_webshop import environment
+from agentenv_webshop.environment import WebshopEnvServer, WebshopEnvWrapper
+from agentenv_webshop.server import _register_routes
+from agentenv_webshop.utils import EnvCapacityError, EnvClosedError, EnvNotFoundError
+
+
+jitter = random.Random(0)
+
+
+class FakeSearcher:
+    """LuceneSearcher stand-in without hits, recording its batch queries"""
+    def __init__(self):
+        self.batch_searches = []
+
+    def search(self, query, k=10):
+        return []
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        self.batch_searches.append(list(queries))
+        return {qid: [] for qid in qids}
+
+
+searcher = FakeSearcher()
+
+
+class FakeEnv:
+    def __init__(self, seed):
+        self.seed = seed
+        self.closed = False
+        self.actions = []
+        self.unwrapped = self
+        self.server = SimpleNamespace(search_engine=searcher)
+        # Interleave the creators
+        time.sleep(jitter.random() * 1e-3)
+
+    def reset(self, session=None):
+        return "obs", None
+
+    def step(self, action):
+        self.actions.append(action)
+        return f"{self.seed}: {action}", 0.0, False, None
+
+    def close(self):
+        self.closed = True
+
+
+def create_all(server, n, workers=64):
+    """Creates `n` envs from `workers` threads, returns the ids and the errors"""
+    barrier = threading.Barrier(workers)
+
+    def create(i):
+        if i < workers:
+            barrier.wait()
+        try:
+            return server.create()
+        except EnvCapacityError as e:
+            return e
+
+    with ThreadPoolExecutor(workers) as pool:
+        results = list(pool.map(create, range(n)))
+    ids = [r for r in results if isinstance(r, int)]
+    errors = [r for r in results if isinstance(r, EnvCapacityError)]
+    return ids, errors
+
+
+def test_parallel_creators_get_distinct_ids():
+    server = WebshopEnvServer(env_factory=FakeEnv)
+    ids, errors = create_all(server, 500)
+    assert not errors
+    assert sorted(ids) == list(range(500))
+    assert len(server.env) == 500
+    assert len({id(env) for env in server.env.values()}) == 500
+
+
+def test_capacity_error_instead_of_sharing_envs():
+    server = WebshopEnvServer(max_envs=50, min_idle_seconds=3600, env_factory=FakeEnv)
+    ids, errors = create_all(server, 300)
+    assert len(ids) == 50
+    assert len(set(ids)) == 50
+    assert len(errors) == 250
+    assert errors[0].status == 503 and errors[0].retryable
+    assert sorted(server.env) == sorted(ids)
+
+
+def test_least_recently_used_idle_env_is_evicted():
+    server = WebshopEnvServer(max_envs=3, min_idle_seconds=0, env_factory=FakeEnv)
+    first, second, third = (server.create() for _ in range(3))
+    server.step(first, "search[shoes]")
+    evicted = server.env[second]
+    fourth = server.create()
+    assert fourth == 3
+    assert evicted.closed
+    assert list(server.env) == [third, first, fourth]
+    with pytest.raises(EnvClosedError):
+        server.step(second, "search[shoes]")
+    with pytest.raises(EnvNotFoundError):
+        server.step(17, "search[shoes]")
+    server.close(third)
+    with pytest.raises(EnvClosedError):
+        server.close(third)
+    # Closed ids are not reused
+    assert server.create() == 4
+
+
+def test_memory_budget_evicts_one_env_per_create(monkeypatch):
+    server = WebshopEnvServer(memory_budget_mb=1000, min_idle_seconds=0, env_factory=FakeEnv)
+    monkeypatch.setattr(environment, "rss_mb", lambda: 500.0)
+    for _ in range(5):
+        server.create()
+    monkeypatch.setattr(environment, "rss_mb", lambda: 1500.0)
+    for _ in range(5):
+        server.create()
+    assert list(server.env) == [5, 6, 7, 8, 9]
+    server.min_idle_seconds = 3600
+    with pytest.raises(EnvCapacityError, match="memory budget"):
+        server.create()
+
+
+def test_per_env_rng_leaves_global_random_alone():
+    state = random.getstate()
+    server = WebshopEnvServer(seed="run", env_factory=FakeEnv)
+    ids = [server.create() for _ in range(3)]
+    assert [server.env[idx].seed for idx in ids] == ["run-0", "run-1", "run-2"]
+    server = WebshopEnvServer(env_factory=FakeEnv)
+    assert server.env[server.create()].seed is None
+    assert random.getstate() == state
+
+
+def test_step_batch_prefetches_searches():
+    wrapper = WebshopEnvWrapper(seed="run", env_factory=FakeEnv)
+    for env_id in (4, 7):
+        wrapper.create_with_id(env_id)
+    results = wrapper.step_batch([
+        (4, "search[Red Shoes]"),
+        (7, "click[b0abc]"),
+        (7, "search[blue hat]"),
+        (4, "search[<c> beauty]"),
+    ])
+    assert searcher.batch_searches[-1] == ["red shoes", "blue hat"]
+    assert [r["observation"] for r in results] == [
+        "run-4: search[Red Shoes]",
+        "run-7: click[b0abc]",
+        "run-7: search[blue hat]",
+        "run-4: search[<c> beauty]",
+    ]
+
+
+def test_step_batch_reports_failed_steps_per_step():
+    wrapper = WebshopEnvWrapper(seed="run", env_factory=FakeEnv)
+    for env_id in (0, 1, 2):
+        wrapper.create_with_id(env_id)
+    wrapper.close(1)
+    results = wrapper.step_batch([
+        (0, "search[a]"),
+        (1, "search[b]"),
+        (2, "search[c]"),
+        (9, "click[d]"),
+    ])
+    assert searcher.batch_searches[-1] == ["a", "c"]
+    assert results[0]["observation"] == "run-0: search[a]"
+    assert results[1]["error"]["code"] == "ENV_CLOSED"
+    assert results[2]["observation"] == "run-2: search[c]"
+    assert results[3]["error"]["code"] == "ENV_NOT_FOUND"
+    assert wrapper.server.env[2].actions == ["search[c]"]
+
+
+def test_pool_routes_envs_to_workers():
+    router = Router(
+        parallel_actor=2,
+        wrapper_factory=functools.partial(
+            WebshopEnvWrapper, max_envs=2, min_idle_seconds=3600, seed="run", env_factory=FakeEnv
+        ),
+    )
+    app = create_app(router, extra_setup=_register_routes, service="webshop")
+    with TestClient(app) as client:
+        assert client.get("/health").json() == {"status": "ok", "service": "webshop"}
+        ids = [client.post("/create").json()["env_id"] for _ in range(4)]
+        assert ids == [0, 1, 2, 3]
+        res = client.post("/create")
+        assert res.status_code == 503
+        assert res.json()["error"]["code"] == "ENV_CAPACITY"
+        assert res.json()["error"]["retryable"]
+
+        assert client.post("/reset", json={"env_id": 1, "task_id": 0}).json() == {
+            "observation": "obs",
+            "info": {},
+        }
+        assert client.post("/step", json={"env_id": 2, "action": "search[shoes]"}).json() == {
+            "observation": "run-2: search[shoes]",
+            "reward": 0.0,
+            "done": False,
+            "info": {},
+        }
+        steps = [
+            {"env_id": 0, "action": "search[a]"},
+            {"env_id": 1, "action": "search[b]"},
+            {"env_id": 0, "action": "click[c]"},
+        ]
+        results = client.post("/step_batch", json={"steps": steps}).json()
+        assert [r["observation"] for r in results] == [
+            "run-0: search[a]",
+            "run-1: search[b]",
+            "run-0: click[c]",
+        ]
+
+        assert client.post("/close", json={"env_id": 3}).json() == {"closed": True, "env_id": 3}
+        # A closed env in the middle of a batch fails on its own
+        steps = [
+            {"env_id": 2, "action": "click[a]"},
+            {"env_id": 3, "action": "click[b]"},
+            {"env_id": 1, "action": "click[c]"},
+            {"env_id": 2, "action": "click[d]"},
+        ]
+        res = client.post("/step_batch", json={"steps": steps})
+        assert res.status_code == 200
+        results = res.json()
+        assert [r.get("observation") for r in results] == [
+            "run-2: click[a]",
+            None,
+            "run-1: click[c]",
+            "run-2: click[d]",
+        ]
+        assert results[1]["error"]["code"] == "ENV_CLOSED"
+        res = client.post("/step", json={"env_id": 3, "action": "search[shoes]"})
+        assert res.status_code == 409
+        res = client.post("/step", json={"env_id": 5, "action": "search[shoes]"})
+        assert res.status_code == 404
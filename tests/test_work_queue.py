@@ -0,0 +1,248 @@
+"""
+Test cases for the work-stealing evaluation queue.
+
+These tests need no env server: a fake env client stands in for it and a tiny
+random Llama generates on CPU:
+    pytest tests/test_work_queue.py -v
+"""
+
+import json
+import multiprocessing
+import socket
+import threading
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+import torch
+import torch.distributed as dist
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import GenerationConfig, LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from agentenv.controller import Agent, BaseEnvClient, BaseTask, EvalJournal, StepOutput
+from agentenv.trainer import DistributedEvaluator, distributed_evaluator
+from agentenv.trainer.work_queue import FileWorkQueue, StoreWorkQueue
+
+
+def drain(queue, n, out):
+    while True:
+        positions = queue.next(n)
+        if not positions:
+            return
+        out.extend(positions)
+
+
+def drain_file_queue(path, num_items, n, results):
+    claimed = []
+    drain(FileWorkQueue(path, num_items), n, claimed)
+    results.put(claimed)
+
+
+class TestWorkQueue:
+    """Test that every position is handed out exactly once."""
+
+    def test_file_queue_across_processes(self, tmp_path):
+        path = str(tmp_path / "queue")
+        ctx = multiprocessing.get_context("fork")
+        results = ctx.Queue()
+        workers = [ctx.Process(target=drain_file_queue, args=(path, 103, 4, results)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        claimed = [results.get(timeout=60) for _ in workers]
+        for worker in workers:
+            worker.join()
+        assert sorted(sum(claimed, [])) == list(range(103))
+
+    def test_store_queue_across_threads(self):
+        store = dist.HashStore()
+        claimed = [[] for _ in range(4)]
+        threads = [
+            threading.Thread(target=drain, args=(StoreWorkQueue(store, "run", 50), 3, out))
+            for out in claimed
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(sum(claimed, [])) == list(range(50))
+        # another key is another counter
+        assert list(StoreWorkQueue(store, "run2", 50).next(2)) == [0, 1]
+
+    def test_last_claim_is_cut(self, tmp_path):
+        queue = FileWorkQueue(str(tmp_path / "queue"), 5)
+        assert list(queue.next(4)) == [0, 1, 2, 3]
+        assert list(queue.next(4)) == [4]
+        assert not queue.next(4)
+
+
+def rank(is_main_process):
+    """Stands in for an evaluator in ``create_queue_store``"""
+    return SimpleNamespace(accelerator=SimpleNamespace(is_main_process=is_main_process, print=print))
+
+
+class TestQueueStore:
+    """Test the store the ranks share the work queue through."""
+
+    def test_ranks_share_a_tcp_store(self, monkeypatch):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        monkeypatch.setenv("MASTER_ADDR", "127.0.0.1")
+        monkeypatch.setenv("MASTER_PORT", str(port - distributed_evaluator.WORK_QUEUE_PORT_OFFSET))
+        monkeypatch.setattr(distributed_evaluator, "broadcast_object_list", lambda objects: objects)
+        main = DistributedEvaluator.create_queue_store(rank(True))
+        assert isinstance(main, dist.TCPStore)
+        monkeypatch.setattr(distributed_evaluator, "broadcast_object_list", lambda objects: [True])
+        other = DistributedEvaluator.create_queue_store(rank(False))
+        assert list(StoreWorkQueue(main, "run", 5).next(2)) == [0, 1]
+        assert list(StoreWorkQueue(other, "run", 5).next(2)) == [2, 3]
+
+    def test_taken_port_falls_back_to_default_store(self, monkeypatch):
+        default_store = dist.HashStore()
+        monkeypatch.setattr(
+            dist.distributed_c10d, "_get_default_store", lambda: default_store, raising=False
+        )
+        monkeypatch.setattr(distributed_evaluator, "broadcast_object_list", lambda objects: objects)
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            sock.listen()
+            monkeypatch.setenv("MASTER_ADDR", "127.0.0.1")
+            monkeypatch.setenv(
+                "MASTER_PORT",
+                str(sock.getsockname()[1] - distributed_evaluator.WORK_QUEUE_PORT_OFFSET),
+            )
+            assert DistributedEvaluator.create_queue_store(rank(True)) is default_store
+
+
+def make_tokenizer():
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for char in sorted(pre_tokenizers.ByteLevel.alphabet()):
+        vocab[char] = len(vocab)
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+
+
+class RewardByIdxClient(BaseEnvClient):
+    """Any action finishes the episode, even task ids succeed."""
+
+    conversation_start = (
+        {"from": "human", "loss": None, "value": "Act."},
+        {"from": "gpt", "loss": False, "value": "OK"},
+    )
+    resets = []
+
+    def __init__(self, **kwargs):
+        super().__init__()
+
+    def __len__(self):
+        return 100
+
+    def reset(self, idx):
+        self.idx = idx
+        self.resets.append(idx)
+
+    def observe(self):
+        return f"task {self.idx}"
+
+    def step(self, action):
+        return StepOutput("done", float(self.idx % 2 == 0), True)
+
+
+class RewardByIdxTask(BaseTask):
+    env_client_cls = RewardByIdxClient
+    env_name = "fake"
+
+
+@dataclass
+class EvalArgs:
+    inference_file: str
+    output_file: str
+    task_name: str = "fake"
+    eval_batch_size: int = 3
+    num_workers: int = 0
+    seed: int = 0
+    do_sample: bool = False
+    temperature: float = 1.0
+    max_round: int = 1
+    group_by_length: bool = False
+    work_stealing: bool = True
+    resume: bool = False
+
+
+def test_work_stealing_resumes(tmp_path):
+    torch.manual_seed(0)
+    (tmp_path / "inference.json").write_text(
+        json.dumps([{"item_id": f"fake_{i}"} for i in range(10)])
+    )
+    output_file = tmp_path / "out.jsonl"
+    shard_dir = tmp_path / "out.jsonl.shards"
+    # an earlier run committed ids 0 and 1 and crashed while writing id 2
+    journal = EvalJournal(str(shard_dir / "rank0.journal.jsonl"), str(shard_dir / "rank0.jsonl"))
+    for i in range(2):
+        journal.commit(
+            "fake", i, 1.0 - i, 1 - i,
+            {"conversations": [], "item_id": f"fake_{i}", "reward": 1.0 - i, "success": 1 - i},
+        )
+    with open(shard_dir / "rank0.jsonl", "a") as f:
+        f.write('{"conversations": [], "item_id": "fa')
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=300, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4
+        )
+    )
+    evaluator = DistributedEvaluator(
+        Agent(model, make_tokenizer()),
+        [RewardByIdxTask({}, n_clients=1)],
+        EvalArgs(inference_file=str(tmp_path / "inference.json"), output_file=str(output_file)),
+    )
+    # short replies keep the random model fast
+    evaluator.get_generation_config = lambda: GenerationConfig(
+        max_length=4096, max_new_tokens=3, pad_token_id=0, eos_token_id=2
+    )
+    RewardByIdxClient.resets.clear()
+    evaluator.generate()
+
+    assert sorted(RewardByIdxClient.resets) == list(range(2, 10))
+    results = [json.loads(line) for line in output_file.read_text().splitlines()]
+    assert sorted(r["item_id"] for r in results) == sorted(f"fake_{i}" for i in range(10))
+    assert sum(r["success"] for r in results) == 5
+    assert all(json.loads(line) for line in (shard_dir / "rank0.jsonl").read_text().splitlines())
+
+
+def test_static_sharding_resumes(tmp_path):
+    torch.manual_seed(0)
+    (tmp_path / "inference.json").write_text(
+        json.dumps([{"item_id": f"fake_{i}"} for i in range(6)])
+    )
+    output_file = tmp_path / "out.jsonl"
+    journal = EvalJournal(f"{output_file}.journal", str(output_file))
+    journal.commit("fake", 4, 1.0, 1, {"item_id": "fake_4"})
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=300, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4
+        )
+    )
+    evaluator = DistributedEvaluator(
+        Agent(model, make_tokenizer()),
+        [RewardByIdxTask({}, n_clients=1)],
+        EvalArgs(
+            inference_file=str(tmp_path / "inference.json"),
+            output_file=str(output_file),
+            work_stealing=False,
+            resume=True,
+        ),
+    )
+    assert len(evaluator.raw_dataset["inference"]) == 5
+    evaluator.get_generation_config = lambda: GenerationConfig(
+        max_length=4096, max_new_tokens=3, pad_token_id=0, eos_token_id=2
+    )
+    RewardByIdxClient.resets.clear()
+    evaluator.generate()
+
+    assert sorted(RewardByIdxClient.resets) == [0, 1, 2, 3, 5]
+    summary = journal.summary("fake")
+    assert summary == {"count": 6, "score": 0.5, "success": 0.5}
+    assert len(output_file.read_text().splitlines()) == 6